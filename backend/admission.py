@@ -0,0 +1,210 @@
+"""Per-route admission control and load shedding.
+
+Each route has a ``Gate``. At most ``concurrency`` of its requests run at
+once. Up to ``queue`` more wait, first come first served, for at most
+``wait`` seconds. Anything beyond that gets ``Overloaded``, which the app
+turns into ``503`` with a ``Retry-After`` header.
+
+Routes belong to a priority class. The routes of the priority class (the
+cheap lookups) also pass one ``priority`` gate, and every other route passes
+one ``shared`` gate. The two are sized so that together they stay within the
+connection pool minus a reserve for background refreshes. A burst of heavy
+analytics can fill its own queue, but it can never take the connections that
+``/api/genres`` needs, and no mix of requests can empty the pool.
+"""
+import math
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List, Mapping, NamedTuple, Optional
+
+EWMA_WEIGHT = 0.2  # weight of the newest sample in a gate's average service time
+
+
+class Limit(NamedTuple):
+    concurrency: int
+    queue: int
+    wait: float  # seconds a queued request waits before it is shed
+
+
+class Overloaded(Exception):
+    """A request was shed: its gate's queue was full or the wait ran out."""
+
+    def __init__(self, gate: str, reason: str, retry_after: int):
+        super().__init__(f"{gate}: {reason}")
+        self.gate = gate
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def parse_limits(value: Optional[str], default_wait: float) -> Dict[str, Limit]:
+    """Parse ``name=concurrency[:queue[:wait]],...`` (as found in MAL_ADMISSION_LIMITS)."""
+    limits: Dict[str, Limit] = {}
+    for item in (value or "").split(","):
+        if not item.strip():
+            continue
+        name, _, spec = item.partition("=")
+        parts = spec.strip().split(":")
+        try:
+            concurrency = int(parts[0])
+            queue = int(parts[1]) if len(parts) > 1 else concurrency * 4
+            wait = float(parts[2]) if len(parts) > 2 else default_wait
+        except ValueError:
+            raise ValueError(f"admission limit for {name.strip()!r} must be concurrency[:queue[:wait]]") from None
+        if len(parts) > 3 or concurrency < 0 or queue < 0 or wait < 0:
+            raise ValueError(f"admission limit for {name.strip()!r} must be concurrency[:queue[:wait]]")
+        limits[name.strip()] = Limit(concurrency, queue, wait)
+    return limits
+
+
+class Gate:
+    """A concurrency limit with a bounded FIFO wait queue."""
+
+    def __init__(self, name: str, limit: Limit):
+        self.name = name
+        self.limit = limit
+        self._cond = threading.Condition()
+        self._waiting: deque = deque()
+        self.active = 0
+        self.admitted = 0
+        self.rejected = 0  # queue full
+        self.timed_out = 0  # waited the whole ``wait``
+        self.peak_queued = 0
+        self.avg_seconds: Optional[float] = None
+
+    def acquire(self, wait: Optional[float] = None) -> None:
+        wait = self.limit.wait if wait is None else wait
+        with self._cond:
+            if self.active < self.limit.concurrency and not self._waiting:
+                self.active += 1
+                self.admitted += 1
+                return
+            if len(self._waiting) >= self.limit.queue:
+                self.rejected += 1
+                raise Overloaded(self.name, "queue full", self.retry_after())
+            ticket = object()
+            self._waiting.append(ticket)
+            self.peak_queued = max(self.peak_queued, len(self._waiting))
+            deadline = time.monotonic() + wait
+            try:
+                while self._waiting[0] is not ticket or self.active >= self.limit.concurrency:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.timed_out += 1
+                        raise Overloaded(self.name, "timed out in queue", self.retry_after())
+                    self._cond.wait(remaining)
+                self.active += 1
+                self.admitted += 1
+            finally:
+                self._waiting.remove(ticket)
+                # The next in line may be able to go now.
+                self._cond.notify_all()
+
+    def release(self, seconds: Optional[float] = None) -> None:
+        with self._cond:
+            self.active -= 1
+            if seconds is not None:
+                self.avg_seconds = seconds if self.avg_seconds is None else (
+                    EWMA_WEIGHT * seconds + (1 - EWMA_WEIGHT) * self.avg_seconds
+                )
+            self._cond.notify_all()
+
+    def retry_after(self) -> int:
+        """Whole seconds until the queue ahead of a new request has likely drained."""
+        avg = self.avg_seconds or 0.0
+        return max(1, math.ceil(avg * (len(self._waiting) + 1) / max(1, self.limit.concurrency)))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "concurrency": self.limit.concurrency,
+            "queue_limit": self.limit.queue,
+            "wait": self.limit.wait,
+            "active": self.active,
+            "queued": len(self._waiting),
+            "peak_queued": self.peak_queued,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "avg_seconds": self.avg_seconds,
+        }
+
+
+class Ticket(NamedTuple):
+    gates: List[Gate]
+    started: float
+
+
+class AdmissionController:
+    """Gates per route, by priority class, plus one gate for the priority class and one shared by the others."""
+
+    def __init__(
+        self,
+        classes: Mapping[str, Limit],
+        route_classes: Mapping[str, str],
+        shared: Optional[Limit] = None,
+        priority: Optional[Limit] = None,
+        overrides: Optional[Mapping[str, Limit]] = None,
+        default_class: str = "standard",
+        priority_class: str = "lookup",
+    ):
+        missing = (set(route_classes.values()) | {default_class}) - set(classes)
+        if missing:
+            raise ValueError(f"no limits for route classes: {', '.join(sorted(missing))}")
+        self.classes = {**classes, **{k: v for k, v in (overrides or {}).items() if k in classes}}
+        self.route_classes = dict(route_classes)
+        self.overrides = {k: v for k, v in (overrides or {}).items() if k not in classes}
+        self.default_class = default_class
+        self.priority_class = priority_class
+        self.shared = None if shared is None else Gate("shared", shared)
+        self.priority = None if priority is None else Gate("priority", priority)
+        self._gates: Dict[str, Gate] = {}
+        self._lock = threading.Lock()
+
+    def class_of(self, route: str) -> str:
+        return self.route_classes.get(route, self.default_class)
+
+    def gate(self, route: str) -> Gate:
+        gate = self._gates.get(route)
+        if gate is None:
+            with self._lock:
+                gate = self._gates.get(route)
+                if gate is None:
+                    limit = self.overrides.get(route) or self.classes[self.class_of(route)]
+                    gate = self._gates[route] = Gate(route, limit)
+        return gate
+
+    def admit(self, route: str, max_wait: Optional[float] = None) -> Ticket:
+        """Wait for room on the route's gate (and the priority or shared gate); raises Overloaded.
+
+        ``max_wait`` caps the gate's own wait, e.g. at the request's deadline.
+        """
+        started = time.monotonic()
+        gate = self.gate(route)
+        wait = gate.limit.wait if max_wait is None else min(gate.limit.wait, max_wait)
+        gate.acquire(wait)
+        gates = [gate]
+        pooled = self.priority if self.class_of(route) == self.priority_class else self.shared
+        if pooled is not None:
+            remaining = max(0.0, wait - (time.monotonic() - started))
+            try:
+                pooled.acquire(remaining)
+            except Overloaded:
+                gate.release()
+                raise
+            gates.append(pooled)
+        return Ticket(gates, time.monotonic())
+
+    def release(self, ticket: Ticket) -> None:
+        seconds = time.monotonic() - ticket.started
+        for gate in reversed(ticket.gates):
+            gate.release(seconds)
+
+    def stats(self) -> Dict[str, Any]:
+        routes = {
+            name: {"class": self.class_of(name), **gate.stats()} for name, gate in sorted(self._gates.items())
+        }
+        return {
+            "shared": None if self.shared is None else self.shared.stats(),
+            "priority": None if self.priority is None else self.priority.stats(),
+            "routes": routes,
+        }
@@ -1,7 +1,42 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+from contextlib import contextmanager
+
 import psycopg2
-from flask import Flask, jsonify, request
+from flask import Flask, Response, current_app, g, jsonify, request
 from flask_cors import CORS
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
+
+from admission import AdmissionController, Limit, Overloaded, parse_limits
+import arrow_ipc
+from arrow_ipc import ArrowUnavailable
+from autocomplete import AutocompleteIndex
+from cache import TTLCache
+from catalog import ANIME_BY_ID_QUERY, ANIME_SELECT, Catalog, CatalogHolder, SnapshotError
+from changes import ChangeFeed, ChangeSet
+import cube
+from cube import CubeIndex
+from compression import DEFAULT_BROTLI_QUALITY, DEFAULT_CACHE_BYTES, DEFAULT_GZIP_LEVEL, DEFAULT_MIN_SIZE, Compressor
+import deadlines
+from deadlines import ClientDisconnected, Deadline, DeadlineExceeded, parse_deadlines
+import franchises
+from franchises import FranchiseIndex
+from genre_mask import MAX_GENRE_BITS
+import json_rows
+from minhash import DEFAULT_BANDS, DEFAULT_ROWS, SimilarIndex, similarity_number
+from pagerank import DEFAULT_CACHE_SIZE, DEFAULT_MAX_ITERATIONS, DEFAULT_RESTART, DEFAULT_TOLERANCE, GraphIndex
+from profiling import DEFAULT_PROFILES_KEPT, DEFAULT_SAMPLE_INTERVAL, Profiler
+import quantiles
+from quantiles import DEFAULT_QUANTILES, DEFAULT_RELATIVE_ACCURACY, DistributionIndex
+from scheduler import DEFAULT_POLL_SECONDS, Scheduler, parse_jobs
+from singleflight import CoalesceTimeout, SingleFlight, coalesce_key
+from statements import StatementRegistry, parse_plan_cache_modes
+from storage import Columns, open_backend
+from textsim import TextIndex
 
 
 DB_CONFIG = {
@@ -13,19 +48,881 @@ DB_CONFIG = {
 }
 
 
+POOL_MIN_CONN = int(os.environ.get("MAL_POOL_MIN_CONN", "1"))
+POOL_MAX_CONN = int(os.environ.get("MAL_POOL_MAX_CONN", "10"))
+# Seconds a request waits for a pooled connection before it is answered with 503.
+POOL_WAIT = float(os.environ.get("MAL_POOL_WAIT", "5"))
+
+# Admin routes are disabled unless a token is configured.
+ADMIN_TOKEN = os.environ.get("MAL_ADMIN_TOKEN")
+
+# Parameter types for the server-side PREPARE of each named route query.
+# Queries without parameters do not need an entry.
+STATEMENT_PARAM_TYPES = {
+    "search_anime": {
+        "season": "text",
+        "type": "anime_type_enum",
+        "source_type": "source_type_enum",
+        "min_score": "numeric",
+        "max_score": "numeric",
+        "genre_ids": "int[]",
+        "limit": "int",
+    },
+    "anime_facets": {
+        "season": "text",
+        "type": "anime_type_enum",
+        "source_type": "source_type_enum",
+        "min_score": "numeric",
+        "max_score": "numeric",
+        "genre_ids": "int[]",
+    },
+    "top_anime": {"metric": "text", "limit": "int", "offset": "int"},
+    "recommendations": {
+        "seed_id": "int",
+        "min_score": "numeric",
+        "genre_id": "int",
+        "era_start": "int",
+        "era_end": "int",
+        "limit": "int",
+    },
+    "recommendations_multi": {
+        "seeds": "int[]",
+        "weights": "int[]",
+        "min_score": "numeric",
+        "genre_id": "int",
+        "era_start": "int",
+        "era_end": "int",
+        "limit": "int",
+    },
+    "similar": {"seed_id": "int", "limit": "int"},
+    "similar_topk": {"run_id": "int", "seed_id": "int", "limit": "int"},
+    "top_adjusted_score": {"limit": "int"},
+    "ratings_volatile": {"limit": "int"},
+    "get_anime": {"id": "int"},
+    "search_anime_by_title": {"pattern": "text", "starts_with": "text", "limit": "int"},
+    "catalog_anime_by_id": {"ids": "int[]"},
+    "job_history": {"limit": "int"},
+    "autocomplete_titles_by_id": {"ids": "int[]"},
+}
+
+# The optional-filter queries ("x IS NULL OR col = x") plan badly as generic
+# plans, so by default they are re-planned with the actual values. Override
+# with MAL_PLAN_CACHE_MODES="search_anime=force_generic_plan,...".
+DEFAULT_PLAN_CACHE_MODES = {
+    "search_anime": "force_custom_plan",
+    "recommendations": "force_custom_plan",
+    "recommendations_multi": "force_custom_plan",
+    "anime_facets": "force_custom_plan",
+}
+
+STATEMENTS = StatementRegistry(
+    param_types=STATEMENT_PARAM_TYPES,
+    plan_cache_modes={
+        **DEFAULT_PLAN_CACHE_MODES,
+        **parse_plan_cache_modes(os.environ.get("MAL_PLAN_CACHE_MODES")),
+    },
+    enabled=os.environ.get("MAL_PREPARED_STATEMENTS", "1") != "0",
+)
+
+_pool = None
+_pool_lock = threading.Lock()
+# getconn() raises PoolError instead of waiting once every connection is out,
+# so callers queue here first, for at most POOL_WAIT (or the deadline).
+_pool_slots = threading.BoundedSemaphore(POOL_MAX_CONN)
+
+
+def _get_pool() -> ThreadedConnectionPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadedConnectionPool(
+                    POOL_MIN_CONN, POOL_MAX_CONN, cursor_factory=RealDictCursor, **DB_CONFIG
+                )
+    return _pool
+
+
+@contextmanager
 def get_conn():
-    return psycopg2.connect(cursor_factory=RealDictCursor, **DB_CONFIG)
+    # Connections are pooled so that prepared statements outlive a request.
+    deadline = deadlines.current()
+    wait = POOL_WAIT if deadline is None else min(POOL_WAIT, deadline.remaining_seconds())
+    if not _pool_slots.acquire(timeout=max(0.0, wait)):
+        if deadline is not None and deadline.expired():
+            raise DeadlineExceeded(deadline.budget_ms)
+        raise Overloaded("pool", "no free database connection", 1)
+    try:
+        pool = _get_pool()
+        conn = pool.getconn()
+        try:
+            with conn:
+                yield conn
+        finally:
+            pool.putconn(conn, close=bool(conn.closed))
+    finally:
+        _pool_slots.release()
+
+
+# Where route queries run: "postgres" (default) or "sqlite:///path/to/mal.sqlite3"
+# for a read-only local copy built by storage.py. get_conn is looked up per call.
+STORAGE = os.environ.get("MAL_STORAGE", "postgres")
+BACKEND = open_backend(STORAGE, lambda: get_conn(), STATEMENTS)  # pylint: disable=unnecessary-lambda
+
+
+# Identical concurrent route queries share one execution; followers give up
+# after MAL_COALESCE_TIMEOUT seconds.
+COALESCE_ENABLED = os.environ.get("MAL_COALESCE", "1") != "0"
+COALESCE_TIMEOUT = float(os.environ.get("MAL_COALESCE_TIMEOUT", "30"))
+INFLIGHT = SingleFlight(timeout=COALESCE_TIMEOUT)
+
+
+# Response compression (see compression.py): gzip, or brotli when installed,
+# for JSON bodies of at least MAL_COMPRESS_MIN_BYTES. A body served again is
+# compressed once and then answered from a byte-bounded cache.
+COMPRESSION_ENABLED = os.environ.get("MAL_COMPRESS", "1") != "0"
+COMPRESSION = Compressor(
+    min_size=int(os.environ.get("MAL_COMPRESS_MIN_BYTES", str(DEFAULT_MIN_SIZE))),
+    gzip_level=int(os.environ.get("MAL_COMPRESS_LEVEL", str(DEFAULT_GZIP_LEVEL))),
+    brotli_quality=int(os.environ.get("MAL_BROTLI_QUALITY", str(DEFAULT_BROTLI_QUALITY))),
+    cache_bytes=int(os.environ.get("MAL_COMPRESS_CACHE_BYTES", str(DEFAULT_CACHE_BYTES))),
+)
+
+
+# Admission control (see admission.py): per-route concurrency limits with
+# bounded wait queues; overload is answered with 503 + Retry-After. Requests
+# may hold POOL_MAX_CONN - MAL_RESERVED_CONNECTIONS connections at once; the
+# reserve is left to background refreshes (catalog, indexes, change patches).
+# Half of the rest is a gate for the lookup routes, the other half is shared
+# by every other route, so heavy analytics cannot starve the cheap lookups.
+ADMISSION_ENABLED = os.environ.get("MAL_ADMISSION", "1") != "0"
+ADMISSION_WAIT = float(os.environ.get("MAL_ADMISSION_WAIT", "2"))
+RESERVED_CONNECTIONS = int(os.environ.get("MAL_RESERVED_CONNECTIONS", "2"))
+LOOKUP_CONNECTIONS = max(1, (POOL_MAX_CONN - RESERVED_CONNECTIONS) // 2)
+SHARED_CONNECTIONS = max(1, POOL_MAX_CONN - RESERVED_CONNECTIONS - LOOKUP_CONNECTIONS)
+ADMISSION_CLASSES = {
+    "lookup": Limit(LOOKUP_CONNECTIONS, 16 * LOOKUP_CONNECTIONS, ADMISSION_WAIT),
+    "standard": Limit(SHARED_CONNECTIONS, 4 * SHARED_CONNECTIONS, ADMISSION_WAIT),
+    "heavy": Limit(max(1, SHARED_CONNECTIONS // 2), 8, ADMISSION_WAIT),
+}
+ROUTE_CLASSES = {
+    "list_genres": "lookup",
+    "get_anime": "lookup",
+    "search_anime_by_title": "lookup",
+    "autocomplete_titles": "lookup",
+    "top_lists": "lookup",
+    "top_anime": "lookup",
+    "similar": "heavy",
+    "top_adjusted_score": "heavy",
+    "stats_years_ratings": "heavy",
+    "stats_episodes_vs_metrics": "heavy",
+    "ratings_volatile": "heavy",
+    "stats_sequels_vs_first_season": "heavy",
+}
+# MAL_ADMISSION_LIMITS overrides a class, a route (by endpoint name), "priority" or "shared".
+_admission_limits = parse_limits(os.environ.get("MAL_ADMISSION_LIMITS"), ADMISSION_WAIT)
+ADMISSION = AdmissionController(
+    ADMISSION_CLASSES,
+    ROUTE_CLASSES,
+    shared=_admission_limits.pop(
+        "shared", Limit(SHARED_CONNECTIONS, 4 * POOL_MAX_CONN, ADMISSION_WAIT)
+    ),
+    priority=_admission_limits.pop(
+        "priority", Limit(LOOKUP_CONNECTIONS, 16 * LOOKUP_CONNECTIONS, ADMISSION_WAIT)
+    ),
+    overrides=_admission_limits,
+)
+
+# Query deadlines (see deadlines.py), in milliseconds per admission class.
+# The budget starts when the request arrives and covers the admission queue;
+# Postgres gets the rest as statement_timeout. Overruns are answered with 504.
+DEADLINE_CLASSES_MS = {"lookup": 2000, "standard": 5000, "heavy": 15000}
+# MAL_DEADLINES overrides a class or a route (by endpoint name); 0 disables.
+DEADLINE_OVERRIDES_MS = parse_deadlines(os.environ.get("MAL_DEADLINES"))
+
+
+def deadline_ms(endpoint: str) -> int:
+    if endpoint in DEADLINE_OVERRIDES_MS:
+        return DEADLINE_OVERRIDES_MS[endpoint]
+    route_class = ADMISSION.class_of(endpoint)
+    return DEADLINE_OVERRIDES_MS.get(route_class, DEADLINE_CLASSES_MS.get(route_class, 0))
+
+
+def fetch_rows(name: str, query: str, params=None, one: bool = False, coalesce: bool = True,
+               columns: bool = False):
+    """Run a named route query and return all rows, the first row if ``one``, or a ``Columns`` if ``columns``."""
+
+    def _run():
+        return BACKEND.fetch(name, query, params, one=one, columns=columns)
+
+    if not (coalesce and COALESCE_ENABLED):
+        return _run()
+    deadline = deadlines.current()
+    timeout = None if deadline is None else min(COALESCE_TIMEOUT, deadline.remaining_seconds())
+    key = coalesce_key(name, params)
+    try:
+        return INFLIGHT.do((*key, "columns") if columns else key, _run, timeout=timeout)
+    except CoalesceTimeout:
+        if deadline is not None and deadline.expired():
+            raise DeadlineExceeded(deadline.budget_ms) from None
+        raise
+    except ClientDisconnected as exc:
+        if exc.deadline is deadline:
+            raise
+        # The leader's client hung up, not ours: run the query for this request.
+        return _run()
+
+
+def parse_format(args) -> str:
+    """``format`` of the list and stats routes: ``json`` (default) or ``arrow``; raises ValueError."""
+    fmt = args.get("format", "json")
+    if fmt not in ("json", "arrow"):
+        raise ValueError("format must be json or arrow")
+    if fmt == "arrow" and not arrow_ipc.available():
+        raise ArrowUnavailable("format=arrow needs the pyarrow package")
+    return fmt
+
+
+def arrow_response(columns) -> Response:
+    """``columns`` (a ``Columns``, or dict rows) as an Arrow IPC stream."""
+    if isinstance(columns, list):
+        columns = arrow_ipc.columns_from_rows(columns)
+    return Response(arrow_ipc.to_ipc(columns), mimetype=arrow_ipc.MEDIA_TYPE)
+
+
+def json_response(value) -> Response:
+    """``value`` (a ``Columns``, or a dict holding some) as the JSON ``jsonify`` sends for its dict rows."""
+    provider = current_app.json
+    if provider.compact is False or (provider.compact is None and current_app.debug):
+        # Indented debug output is left to jsonify.
+        if isinstance(value, Columns):
+            return jsonify(json_rows.rows(value))
+        return jsonify({k: json_rows.rows(v) if isinstance(v, Columns) else v for k, v in value.items()})
+    return Response(json_rows.encode(value), mimetype=provider.mimetype)
+
+
+def parse_anime_filters(args) -> dict:
+    """Parse the /api/anime filter arguments; raises ValueError for bad genre_ids."""
+
+    def _get_float_arg(name: str):
+        if name not in args:
+            return None
+        try:
+            return float(args.get(name))
+        except (TypeError, ValueError):
+            return None
+
+    raw_genre_ids = args.getlist("genre_ids")
+    genre_ids = None
+    if raw_genre_ids:
+        # Allow comma-separated list or repeated query params
+        parts = []
+        for item in raw_genre_ids:
+            parts.extend(item.split(","))
+        try:
+            # A set of required genres: order and duplicates do not matter.
+            genre_ids = sorted({int(gid) for gid in parts if str(gid).strip() != ""})
+        except ValueError:
+            raise ValueError("genre_ids must be integers") from None
+        if not genre_ids:
+            genre_ids = None
+
+    return {
+        "season": args.get("season"),
+        "type": args.get("type"),
+        "source_type": args.get("source_type"),
+        "min_score": _get_float_arg("min_score"),
+        "max_score": _get_float_arg("max_score"),
+        "genre_ids": genre_ids,
+    }
+
+
+def parse_recommendation_filters(args) -> dict:
+    """Parse the recommendation routes' filters; bad values are ignored, as route 4 always has."""
+
+    def _get_int_arg(name: str):
+        try:
+            return int(args[name]) if name in args else None
+        except ValueError:
+            return None
+
+    limit = _get_int_arg("limit")
+    min_score = None
+    if "min_score" in args:
+        try:
+            min_score = float(args["min_score"])
+        except ValueError:
+            pass
+    # era is a decade's first year, like 2020 or 2010.
+    era_start = _get_int_arg("era")
+    return {
+        "limit": limit if limit is not None and limit > 0 else 10,
+        "min_score": min_score,
+        "genre_id": _get_int_arg("genre_ids"),
+        "era_start": era_start,
+        "era_end": None if era_start is None else era_start + 9,
+    }
+
+
+def parse_seeds(args) -> dict:
+    """Parse ``seeds`` and optional ``weights`` into {anime_id: weight}; raises ValueError."""
+    try:
+        seeds = [int(s) for s in args.get("seeds", "").split(",") if s.strip()]
+    except ValueError:
+        raise ValueError("seeds must be comma-separated anime ids") from None
+    if not 0 < len(seeds) <= MAX_RECOMMENDATION_SEEDS:
+        raise ValueError(f"seeds must list 1 to {MAX_RECOMMENDATION_SEEDS} anime ids")
+    if len(set(seeds)) != len(seeds):
+        raise ValueError("seeds must be distinct")
+    weights = [1] * len(seeds)
+    if "weights" in args:
+        try:
+            weights = [int(w) for w in args["weights"].split(",")]
+            if len(weights) != len(seeds) or min(weights) <= 0:
+                raise ValueError()
+        except ValueError:
+            raise ValueError("weights must be one positive integer per seed") from None
+    return dict(zip(seeds, weights))
+
+
+# Columnar copy of the catalog (see catalog.py). At boot it is mapped from the
+# MAL_SNAPSHOT_PATH file, so a cold machine can answer the catalog-only routes
+# before Postgres is reachable, and then refreshed from Postgres in the background.
+SNAPSHOT_PATH = os.environ.get("MAL_SNAPSHOT_PATH")
+CATALOG_REFRESH = os.environ.get("MAL_CATALOG_REFRESH", "1") != "0"
+SNAPSHOT_WRITE = os.environ.get("MAL_SNAPSHOT_WRITE", "1") != "0"
+CATALOG = CatalogHolder()
+_catalog_booted = False
+
+
+def load_catalog() -> Catalog:
+    with BACKEND.cursor() as cur:
+        return Catalog.from_db(cur, source=BACKEND.name)
+
+
+def refresh_catalog(background: bool = True):
+    snapshot_path = SNAPSHOT_PATH if SNAPSHOT_WRITE else None
+    if background:
+        return CATALOG.refresh_in_background(load_catalog, snapshot_path)
+    return CATALOG.refresh(load_catalog, snapshot_path)
+
+
+def boot_catalog() -> None:
+    global _catalog_booted
+    if _catalog_booted or not SNAPSHOT_PATH:
+        return
+    _catalog_booted = True
+    try:
+        catalog = CATALOG.load_snapshot(SNAPSHOT_PATH)
+        print(f"Mapped catalog snapshot {SNAPSHOT_PATH} ({catalog.n} anime)")
+    except (OSError, SnapshotError) as exc:
+        # Serve from Postgres until the background load below has finished.
+        print(f"Catalog snapshot unavailable: {exc}")
+    if CATALOG_REFRESH or CATALOG.current() is None:
+        refresh_catalog()
+
+
+def load_autocomplete_rows(anime_ids=None):
+    catalog = CATALOG.current()
+    if catalog is not None:
+        return catalog.autocomplete_rows(anime_ids)
+    if anime_ids is not None:
+        query = """
+        SELECT a.anime_id, a.title, a.score, a.num_episodes, a.members_count
+        FROM anime a
+        WHERE a.title IS NOT NULL AND a.anime_id = ANY(%(ids)s);
+        """
+        return fetch_rows("autocomplete_titles_by_id", query, {"ids": sorted(anime_ids)}, coalesce=False)
+    query = """
+    SELECT a.anime_id, a.title, a.score, a.num_episodes, a.members_count
+    FROM anime a
+    WHERE a.title IS NOT NULL;
+    """
+    return fetch_rows("autocomplete_titles", query)
+
+
+# Title trie for /api/anime/autocomplete; rebuilt in the background once it
+# is older than MAL_AUTOCOMPLETE_TTL seconds.
+AUTOCOMPLETE = AutocompleteIndex(
+    load_autocomplete_rows,
+    top_k=int(os.environ.get("MAL_AUTOCOMPLETE_TOP_K", "10")),
+    ttl=float(os.environ.get("MAL_AUTOCOMPLETE_TTL", "3600")),
+)
+
+
+def _rebuild_autocomplete(_catalog) -> None:
+    # Before the first lookup there is nothing to rebuild; the trie is built lazily.
+    if AUTOCOMPLETE.built:
+        AUTOCOMPLETE.rebuild()
+
+
+CATALOG.subscribe(_rebuild_autocomplete)
+
+
+# MinHash/LSH index for /api/anime/<id>/similar?mode=approx, built from the
+# catalog on first use (see minhash.py).
+SIMILAR_INDEX = SimilarIndex(
+    lambda: CATALOG.current() or load_catalog(),
+    bands=int(os.environ.get("MAL_MINHASH_BANDS", str(DEFAULT_BANDS))),
+    rows=int(os.environ.get("MAL_MINHASH_ROWS", str(DEFAULT_ROWS))),
+)
+
+
+def _rebuild_similar_index(_catalog) -> None:
+    if SIMILAR_INDEX.built:
+        SIMILAR_INDEX.rebuild_in_background()
+
+
+CATALOG.subscribe(_rebuild_similar_index)
+
+
+# Personalized PageRank over the recommendation graph for
+# /api/anime/<id>/recommendations?mode=graph (see pagerank.py), built from the
+# catalog on first use. Rankings of hot seeds are cached until the next rebuild.
+RECOMMENDATION_GRAPH = GraphIndex(
+    lambda: CATALOG.current() or load_catalog(),
+    current=CATALOG.current,
+    restart=float(os.environ.get("MAL_PAGERANK_RESTART", str(DEFAULT_RESTART))),
+    tolerance=float(os.environ.get("MAL_PAGERANK_TOLERANCE", str(DEFAULT_TOLERANCE))),
+    max_iterations=int(os.environ.get("MAL_PAGERANK_MAX_ITERATIONS", str(DEFAULT_MAX_ITERATIONS))),
+    cache_size=int(os.environ.get("MAL_PAGERANK_CACHE", str(DEFAULT_CACHE_SIZE))),
+)
+
+
+def _rebuild_recommendation_graph(_catalog) -> None:
+    # Only a reload brings new recommendations; patches change the filtered
+    # columns, which are read from the current catalog at request time.
+    if RECOMMENDATION_GRAPH.built:
+        RECOMMENDATION_GRAPH.rebuild_in_background()
+
+
+CATALOG.subscribe(_rebuild_recommendation_graph)
+
+
+# Quantile sketches for /api/stats/distribution (see quantiles.py), built from
+# the catalog on first use and then moved anime by anime as it changes.
+DISTRIBUTIONS = DistributionIndex(
+    lambda: CATALOG.current() or load_catalog(),
+    relative_accuracy=float(os.environ.get("MAL_DISTRIBUTION_ACCURACY", str(DEFAULT_RELATIVE_ACCURACY))),
+)
+MAX_DISTRIBUTION_QUANTILES = 20
+MAX_RECOMMENDATION_SEEDS = 50
+
+
+def _sync_distributions(catalog) -> None:
+    if DISTRIBUTIONS.built:
+        DISTRIBUTIONS.sync(catalog)
+
+
+CATALOG.subscribe(_sync_distributions)
+
+
+# Pre-aggregated cube for /api/stats/cube (see cube.py), built from the
+# catalog on first use and rebuilt in the background when it changes.
+CUBE = CubeIndex(lambda: CATALOG.current() or load_catalog())
+
+
+def _rebuild_cube(_catalog) -> None:
+    if CUBE.built:
+        CUBE.rebuild_in_background()
+
+
+CATALOG.subscribe(_rebuild_cube)
+
+
+# Franchises (related_anime components) for /api/franchises (see
+# franchises.py), built from the catalog on first use.
+FRANCHISES = FranchiseIndex(lambda: CATALOG.current() or load_catalog())
+
+
+def _rebuild_franchises(_catalog) -> None:
+    if FRANCHISES.built:
+        FRANCHISES.rebuild_in_background()
+
+
+CATALOG.subscribe(_rebuild_franchises)
+
+
+# Every anime's top-N exact matches, written by similar_topk.py (Postgres
+# only). Route 5 reads them by primary key when ``limit`` fits in the run;
+# otherwise, or after a genre/studio change, it scores live.
+SIMILAR_TOPK_ENABLED = os.environ.get("MAL_SIMILAR_TOPK", "1") == "1"
+SIMILAR_TOPK_CACHE = TTLCache(ttl=float(os.environ.get("MAL_SIMILAR_TOPK_TTL", "60")), max_entries=1)
+SIMILAR_TOPK_COLUMNS = ("genres", "studios", "genre_mask")
+_similar_topk_stale_through = 0  # runs up to this id predate a genre/studio change
+
+SIMILAR_TOPK_RUN_QUERY = """
+SELECT run_id, top_n FROM similar_topk_run
+WHERE finished_at IS NOT NULL
+ORDER BY run_id DESC
+LIMIT 1;
+"""
+
+
+def similar_topk_run():
+    """``{"run_id", "top_n"}`` of the newest finished run route 5 may read, or None."""
+    if not SIMILAR_TOPK_ENABLED or BACKEND.name != "postgres":
+        return None
+
+    def _load():
+        try:
+            row = fetch_rows("similar_topk_run", SIMILAR_TOPK_RUN_QUERY, one=True, coalesce=False)
+        except psycopg2.errors.UndefinedTable:
+            row = None  # migration 4 has not run yet
+        return {"run": row}
+
+    run = SIMILAR_TOPK_CACHE.get_or_set("run", _load)["run"]
+    if run is None or run["run_id"] <= _similar_topk_stale_through:
+        return None
+    return run
+
+
+# TF-IDF synopsis index for /api/anime/<id>/similar-text, built offline by
+# textsim.py and mapped from MAL_TEXT_INDEX_PATH on first use.
+TEXT_INDEX_PATH = os.environ.get("MAL_TEXT_INDEX_PATH")
+_text_index = None
+_text_index_error = None
+_text_index_lock = threading.Lock()
+
+
+def load_text_index(reload: bool = False):
+    """The mapped synopsis index, or None if it is not configured or cannot be opened."""
+    global _text_index, _text_index_error
+    if _text_index is not None and not reload:
+        return _text_index
+    with _text_index_lock:
+        # A failed open is not retried on every request, only on reload.
+        if TEXT_INDEX_PATH and (reload or (_text_index is None and _text_index_error is None)):
+            try:
+                _text_index, _text_index_error = TextIndex.open(TEXT_INDEX_PATH), None
+            except (OSError, SnapshotError) as exc:
+                _text_index_error = str(exc)
+                print(f"Synopsis index unavailable: {exc}")
+        return _text_index
+
+
+def anime_summaries(anime_ids):
+    """``anime_id`` -> the SimilarAnime fields, from the catalog or Postgres."""
+    fields = ("anime_id", "title", "score", "favorites_count", "members_count")
+    catalog = CATALOG.current()
+    if catalog is not None:
+        rows = (catalog.row_of(anime_id) for anime_id in anime_ids)
+        return {
+            catalog.anime_id[row]: catalog.summary(row, "score", "favorites_count", "members_count")
+            for row in rows
+            if row is not None
+        }
+    rows = fetch_rows("catalog_anime_by_id", ANIME_BY_ID_QUERY, {"ids": sorted(anime_ids)})
+    return {row["anime_id"]: {f: row[f] for f in fields} for row in rows}
+
+
+# Facet counts for the unfiltered catalog are the same for every visitor.
+FACETS_TTL = float(os.environ.get("MAL_FACETS_TTL", "300"))
+FACETS_CACHE = TTLCache(ttl=FACETS_TTL, max_entries=1)
+
+FACETS = ("season", "type", "source_type", "genre")
+
+# One count per possible genre bit, so the genre facet comes out of the same
+# scan as the others; bits without a genre are dropped by the join on genre.bit.
+_GENRE_BIT_COUNTS = ",\n              ".join(
+    f"SUM(((genre_mask >> {bit}) & 1)::int) FILTER (WHERE f_season AND f_type AND f_source_type AND f_score)"
+    for bit in range(MAX_GENRE_BITS)
+)
+
+
+def _shape_facets(rows) -> dict:
+    body = {"total": 0, **{facet: [] for facet in FACETS}}
+    for row in rows:
+        facet = row["facet"]
+        if facet == "total":
+            body["total"] = row["count"]
+        elif facet == "genre":
+            body["genre"].append({"genre_id": row["genre_id"], "name": row["value"], "count": row["count"]})
+        else:
+            body[facet].append({"value": row["value"], "count": row["count"]})
+    for facet in FACETS:
+        key = "name" if facet == "genre" else "value"
+        body[facet].sort(key=lambda item: (-item["count"], item[key] is None, item[key] or ""))
+    return body
+
+
+# Change sets from the ingest job (see changes.py and ingest.py). Each
+# subscriber drops or patches only the anime that changed. With
+# MAL_LISTEN_CHANGES=1 every server LISTENs for them on its own connection.
+LISTEN_CHANGES = os.environ.get("MAL_LISTEN_CHANGES", "0") == "1"
+CHANGES = ChangeFeed()
+_change_listener = None
+
+AUTOCOMPLETE_COLUMNS = ("title", "score", "num_episodes", "members_count")
+FACET_COLUMNS = ("season", "type", "source_type", "score", "genres")
+
+
+def _patch_catalog(changes: ChangeSet) -> None:
+    catalog = CATALOG.current()
+    if catalog is None:
+        return
+    patched = None
+    if changes.anime_ids is not None and not changes.touches(("studios",)):
+        params = {"ids": sorted(changes.anime_ids)}
+        patched = catalog.patched(fetch_rows("catalog_anime_by_id", ANIME_BY_ID_QUERY, params, coalesce=False))
+    if patched is not None:
+        CATALOG.swap(patched, notify=False)
+    if patched is None or CATALOG.refreshing:
+        # New anime, new titles and studio changes reshape the catalog. A refresh
+        # that is already running may have read the rows before this change, and
+        # would overwrite the patch; asking again makes it load once more.
+        refresh_catalog()
+
+
+def _patch_autocomplete(changes: ChangeSet) -> None:
+    if not AUTOCOMPLETE.built or not changes.touches(AUTOCOMPLETE_COLUMNS):
+        return
+    if changes.anime_ids is None:
+        AUTOCOMPLETE.rebuild()
+    else:
+        AUTOCOMPLETE.update(load_autocomplete_rows(changes.anime_ids))
+
+
+def _invalidate_facets(changes: ChangeSet) -> None:
+    if changes.touches(FACET_COLUMNS):
+        FACETS_CACHE.invalidate("unfiltered")
+
+
+# In this order: the autocomplete rows are read from the patched catalog.
+CHANGES.subscribe(_patch_catalog)
+CHANGES.subscribe(_patch_autocomplete)
+SIMILAR_COLUMNS = ("genres", "studios", "genre_mask", "title", "score", "members_count", "favorites_count")
+
+
+def _refresh_similar_index(changes: ChangeSet) -> None:
+    # Catalog patches swap without notifying, so the index is rebuilt from here.
+    if SIMILAR_INDEX.built and changes.touches(SIMILAR_COLUMNS):
+        SIMILAR_INDEX.rebuild_in_background()
+
+
+def _expire_similar_topk(changes: ChangeSet) -> None:
+    # Runs written so far, finished or not, scored the old genres and studios.
+    global _similar_topk_stale_through
+    if not changes.touches(SIMILAR_TOPK_COLUMNS) or similar_topk_run() is None:
+        return
+    latest = fetch_rows("similar_topk_latest", "SELECT MAX(run_id) AS run_id FROM similar_topk_run;", one=True,
+                        coalesce=False)
+    _similar_topk_stale_through = max(_similar_topk_stale_through, latest["run_id"] or 0)
+    SIMILAR_TOPK_CACHE.clear()
+
+
+CHANGES.subscribe(_invalidate_facets)
+CHANGES.subscribe(_refresh_similar_index)
+CHANGES.subscribe(_expire_similar_topk)
+
+
+def _patch_distributions(changes: ChangeSet) -> None:
+    # After _patch_catalog: reads the patched rows. Anime the patch could not
+    # take (new ones) arrive with the catalog reload, through _sync_distributions.
+    if not DISTRIBUTIONS.built or not changes.touches(quantiles.COLUMNS):
+        return
+    catalog = CATALOG.current()
+    if catalog is None:
+        DISTRIBUTIONS.sync()
+    else:
+        DISTRIBUTIONS.sync(catalog, changes.anime_ids)
+
+
+CHANGES.subscribe(_patch_distributions)
+
+
+def _refresh_cube(changes: ChangeSet) -> None:
+    # Catalog patches swap without notifying, so the cube is rebuilt from here.
+    if CUBE.built and changes.touches(cube.COLUMNS):
+        CUBE.rebuild_in_background()
+
+
+CHANGES.subscribe(_refresh_cube)
+
+
+def _refresh_franchises(changes: ChangeSet) -> None:
+    if FRANCHISES.built and changes.touches(franchises.COLUMNS):
+        FRANCHISES.rebuild_in_background()
+
+
+CHANGES.subscribe(_refresh_franchises)
+
+
+def start_change_listener() -> None:
+    global _change_listener
+    if _change_listener is None and LISTEN_CHANGES and BACKEND.name == "postgres":
+        _change_listener = CHANGES.listen_in_background(lambda: psycopg2.connect(**DB_CONFIG))
+
+
+# Periodic jobs (see scheduler.py). Every server runs the scheduler, and the
+# one holding its advisory lock runs the jobs listed in MAL_JOBS.
+SIMILAR_TOPK_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "similar_topk.py")
+
+
+def _refresh_similar_topk(conn) -> dict:
+    # similar_topk.py runs as its own process, with two spawned workers that score
+    # off this server's GIL. A spawned worker re-imports its parent's main module:
+    # here similar_topk.py, where in the server it would be server.py and a whole app.
+    proc = subprocess.Popen(
+        [sys.executable, SIMILAR_TOPK_SCRIPT, "--workers", "2"], stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    try:
+        # Waiting in pg_sleep keeps the run cancellable: on a timeout or a lost
+        # leader lock the scheduler cancels this query, and the process is killed.
+        with conn.cursor() as cur:
+            while proc.poll() is None:
+                cur.execute("SELECT pg_sleep(1);")
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        raise
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        lines = err.decode(errors="replace").strip().splitlines()
+        raise RuntimeError(f"similar_topk.py exited with {proc.returncode}: {lines[-1] if lines else ''}")
+    return json.loads(out)
+
+
+JOBS = {"similar_topk": _refresh_similar_topk}
+SCHEDULER = Scheduler(
+    lambda: psycopg2.connect(**DB_CONFIG), poll=float(os.environ.get("MAL_JOBS_POLL", str(DEFAULT_POLL_SECONDS)))
+)
+for _name, _spec in parse_jobs(os.environ.get("MAL_JOBS")).items():
+    if _name not in JOBS:
+        raise ValueError(f"unknown job {_name!r} in MAL_JOBS; known jobs: {', '.join(sorted(JOBS))}")
+    SCHEDULER.add(_name, JOBS[_name], _spec)
+
+
+def start_scheduler() -> None:
+    if SCHEDULER.jobs and not SCHEDULER.running and BACKEND.name == "postgres":
+        SCHEDULER.start()
+
+
+# Per-request profiles (see profiling.py), for admin requests that ask for one.
+PROFILER = Profiler(
+    interval=float(os.environ.get("MAL_PROFILE_INTERVAL_MS", str(DEFAULT_SAMPLE_INTERVAL * 1000))) / 1000,
+    keep=int(os.environ.get("MAL_PROFILE_KEEP", str(DEFAULT_PROFILES_KEPT))),
+)
+
+
+def _is_admin() -> bool:
+    return bool(ADMIN_TOKEN) and request.headers.get("X-Admin-Token") == ADMIN_TOKEN
 
 
 def create_app() -> Flask:
     app = Flask(__name__)
-    CORS(app)
+    CORS(app, expose_headers=["Retry-After", "X-Deadline-Ms", "X-Deadline-Remaining-Ms", "X-Profile-Id"])
+    boot_catalog()
+    start_change_listener()
+    start_scheduler()
+
+    # Registered first, so the profile covers the other hooks and ends after their teardown.
+    @app.before_request
+    def start_profile():
+        if "X-Profile" not in request.headers and "profile" not in request.args:
+            return
+        if request.endpoint is None or request.path.startswith("/api/admin/") or not _is_admin():
+            return
+        g.profile, g.profile_token = PROFILER.start(request.method, request.full_path.rstrip("?"))
+
+    @app.after_request
+    def profile_header(resp):
+        profile = g.get("profile")
+        if profile is not None:
+            g.profile_status = resp.status_code
+            resp.headers["X-Profile-Id"] = str(profile.id)
+        return resp
+
+    @app.teardown_request
+    def end_profile(_exc):
+        profile = g.pop("profile", None)
+        if profile is not None:
+            PROFILER.stop(profile, g.pop("profile_token"), g.pop("profile_status", 500))
+
+    @app.before_request
+    def start_deadline():
+        if request.endpoint is None or request.method == "OPTIONS" or request.path.startswith("/api/admin/"):
+            return
+        budget = deadline_ms(request.endpoint)
+        if budget <= 0:
+            return
+        # The dev server and gunicorn both expose the client socket, used to notice hang-ups.
+        client_socket = request.environ.get("werkzeug.socket") or request.environ.get("gunicorn.socket")
+        g.deadline = Deadline(budget, client_socket)
+        g.deadline_token = deadlines.activate(g.deadline)
+
+    @app.before_request
+    def admit_request():
+        if not ADMISSION_ENABLED or request.endpoint is None or request.method == "OPTIONS":
+            return
+        if request.path.startswith("/api/admin/"):
+            return
+        deadline = g.get("deadline")
+        try:
+            g.admission = ADMISSION.admit(request.endpoint, None if deadline is None else deadline.remaining_seconds())
+        except Overloaded:
+            if deadline is not None and deadline.expired():
+                raise DeadlineExceeded(deadline.budget_ms) from None
+            raise
+
+    @app.after_request
+    def deadline_headers(resp):
+        deadline = g.get("deadline")
+        if deadline is not None:
+            resp.headers["X-Deadline-Ms"] = str(deadline.budget_ms)
+            resp.headers["X-Deadline-Remaining-Ms"] = str(deadline.remaining_ms())
+        return resp
+
+    @app.after_request
+    def compress_response(resp):
+        if COMPRESSION_ENABLED:
+            COMPRESSION.apply(resp, request.headers.get("Accept-Encoding"))
+        return resp
+
+    @app.teardown_request
+    def end_deadline(_exc):
+        token = g.pop("deadline_token", None)
+        if token is not None:
+            deadlines.deactivate(token)
+
+    @app.teardown_request
+    def release_admission(_exc):
+        ticket = g.pop("admission", None)
+        if ticket is not None:
+            ADMISSION.release(ticket)
+
+    @app.errorhandler(Overloaded)
+    def overloaded(exc):
+        resp = jsonify({"error": "server is busy, retry later"})
+        resp.status_code = 503
+        resp.headers["Retry-After"] = str(exc.retry_after)
+        return resp
+
+    @app.errorhandler(DeadlineExceeded)
+    def deadline_exceeded(exc):
+        return jsonify({"error": "query exceeded its deadline", "deadline_ms": exc.budget_ms}), 504
+
+    @app.errorhandler(ClientDisconnected)
+    def client_disconnected(_exc):
+        # Nobody is listening; 499 (nginx's "client closed request") shows up in the logs.
+        return jsonify({"error": "client disconnected"}), 499
+
+    @app.errorhandler(ArrowUnavailable)
+    def arrow_unavailable(exc):
+        return jsonify({"error": str(exc)}), 406
+
+    @app.errorhandler(CoalesceTimeout)
+    def coalesce_timeout(_exc):
+        return jsonify({"error": "timed out waiting for an identical request"}), 504
 
     # Route 1 – Search Anime with Filters
     @app.get("/api/anime")
     def search_anime():
         # Accepts: season, type, source_type, min_score, max_score, genre_ids, limit
-        # Return: JSON Array of Anime objects
+        # Return: JSON Array of Anime objects (or an Arrow stream with format=arrow)
+        try:
+            fmt = parse_format(request.args)
+        except ValueError as exc:
+            return jsonify({"error": str(exc)}), 400
         try:
             limit = int(request.args["limit"])
             if limit <= 0:
@@ -33,70 +930,51 @@ def create_app() -> Flask:
         except (KeyError, ValueError):
             return jsonify({"error": "limit is required and must be a positive integer"}), 400
 
-        season = request.args.get("season")
-        anime_type = request.args.get("type")
-        source_type = request.args.get("source_type")
-
-        def _get_float_arg(name: str):
-            if name not in request.args:
-                return None
-            try:
-                return float(request.args.get(name))
-            except (TypeError, ValueError):
-                return None
-
-        min_score = _get_float_arg("min_score")
-        max_score = _get_float_arg("max_score")
-
-        raw_genre_ids = request.args.getlist("genre_ids")
-        genre_ids = None
-        if raw_genre_ids:
-            # Allow comma-separated list or repeated query params
-            parts = []
-            for item in raw_genre_ids:
-                parts.extend(item.split(","))
-            try:
-                genre_ids = [int(gid) for gid in parts if str(gid).strip() != ""]
-            except ValueError:
-                return jsonify({"error": "genre_ids must be integers"}), 400
-            if not genre_ids:
-                genre_ids = None
+        try:
+            filters = parse_anime_filters(request.args)
+        except ValueError as exc:
+            return jsonify({"error": str(exc)}), 400
 
-        query = """
-        SELECT a.*
-        FROM anime a
-        LEFT JOIN anime_genre ag ON ag.anime_id = a.anime_id
+        # "Has all of these genres" is one bitmask test per row (see genre_mask.py);
+        # an unknown genre id leaves wanted.n short, so nothing matches.
+        query = f"""
+        WITH wanted AS (
+          SELECT COALESCE(bit_or(1::bigint << g.bit), 0) AS mask, COUNT(*) AS n
+          FROM genre g
+          WHERE g.genre_id = ANY(%(genre_ids)s::int[])
+        )
+        SELECT {ANIME_SELECT}
+        FROM anime a, wanted w
         WHERE
           (%(season)s IS NULL OR a.season = %(season)s) AND
           (%(type)s IS NULL OR a.type = %(type)s) AND
           (%(source_type)s IS NULL OR a.source_type = %(source_type)s) AND
           (%(min_score)s IS NULL OR a.score >= %(min_score)s) AND
-          (%(max_score)s IS NULL OR a.score <= %(max_score)s)
-        GROUP BY a.anime_id
-        HAVING
-          (%(genre_ids)s::int[] IS NULL OR COUNT(DISTINCT CASE WHEN ag.genre_id = ANY(%(genre_ids)s::int[]) THEN ag.genre_id END) = COALESCE(cardinality(%(genre_ids)s::int[]),0))
+          (%(max_score)s IS NULL OR a.score <= %(max_score)s) AND
+          (%(genre_ids)s::int[] IS NULL OR (
+            w.n = cardinality(%(genre_ids)s::int[]) AND (a.genre_mask & w.mask) = w.mask
+          ))
         ORDER BY a.score DESC NULLS LAST, a.members_count DESC NULLS LAST
         LIMIT %(limit)s;
         """
 
-        params = {
-            "season": season,
-            "type": anime_type,
-            "source_type": source_type,
-            "min_score": min_score,
-            "max_score": max_score,
-            "genre_ids": genre_ids,
-            "limit": limit,
-        }
+        params = {**filters, "limit": limit}
 
-        with get_conn() as conn, conn.cursor() as cur:
-            cur.execute(query, params)
-            rows = cur.fetchall()
-            return jsonify(rows)
+        columns = fetch_rows("search_anime", query, params, columns=True)
+        return arrow_response(columns) if fmt == "arrow" else json_response(columns)
 
     # Route 2 – Top Lists by Rating, Popularity, and Favorites
     @app.get("/api/anime/top-lists")
     def top_lists():
+        try:
+            fmt = parse_format(request.args)
+        except ValueError as exc:
+            return jsonify({"error": str(exc)}), 400
+        catalog = CATALOG.current()
+        if catalog is not None:
+            rows = catalog.top_lists()
+            return arrow_response(rows) if fmt == "arrow" else jsonify(rows)
+
         query = """
         (
           SELECT 'rating' AS list, a.anime_id, a.title, a.score AS metric
@@ -122,10 +1000,8 @@ def create_app() -> Flask:
         ORDER BY list, metric DESC NULLS LAST;
         """
 
-        with get_conn() as conn, conn.cursor() as cur:
-            cur.execute(query)
-            rows = cur.fetchall()
-            return jsonify(rows)
+        columns = fetch_rows("top_lists", query, columns=True)
+        return arrow_response(columns) if fmt == "arrow" else json_response(columns)
 
     # Route 3 – Top Anime by a Chosen Metric
     @app.get("/api/anime/top")
@@ -153,6 +1029,16 @@ def create_app() -> Flask:
         except ValueError:
             return jsonify({"error": "offset must be a non-negative integer"}), 400
 
+        try:
+            fmt = parse_format(request.args)
+        except ValueError as exc:
+            return jsonify({"error": str(exc)}), 400
+
+        catalog = CATALOG.current()
+        if catalog is not None:
+            rows = catalog.top(metric, limit, offset)
+            return arrow_response(rows) if fmt == "arrow" else jsonify(rows)
+
         query = """
         SELECT a.anime_id, a.title, a.score, a.favorites_count, a.members_count
         FROM anime a
@@ -166,46 +1052,24 @@ def create_app() -> Flask:
         LIMIT %(limit)s
         OFFSET %(offset)s;
         """
-        with get_conn() as conn, conn.cursor() as cur:
-            cur.execute(query, {"metric": metric, "limit": limit, "offset": offset})
-            rows = cur.fetchall()
-            return jsonify(rows)
+        params = {"metric": metric, "limit": limit, "offset": offset}
+        columns = fetch_rows("top_anime", query, params, columns=True)
+        return arrow_response(columns) if fmt == "arrow" else json_response(columns)
 
     # Route 4 – Recommendations from Recommendation Table + Filters
     @app.get("/api/anime/<int:seed_id>/recommendations")
     def recommendations(seed_id: int):
-        # Accepts: min_score, limit, genre_ids, era
-        try:
-            limit = int(request.args.get("limit", 10))
-            if limit <= 0:
-                limit = 10
-        except ValueError:
-            limit = 10
-
-        min_score = None
-        if "min_score" in request.args:
-            try:
-                min_score = float(request.args.get("min_score"))
-            except (TypeError, ValueError):
-                pass
+        # Accepts: min_score, limit, genre_ids, era, mode (direct | graph)
+        mode = request.args.get("mode", "direct")
+        if mode not in ("direct", "graph"):
+            return jsonify({"error": "mode must be direct or graph"}), 400
+        filters = parse_recommendation_filters(request.args)
 
-        # Parse genre_ids
-        genre_id = None
-        if "genre_ids" in request.args:
-            try:
-                genre_id = int(request.args.get("genre_ids"))
-            except (TypeError, ValueError):
-                pass
-
-        # Parse era (decade start year like 2020, 2010, etc.)
-        era_start = None
-        era_end = None
-        if "era" in request.args:
-            try:
-                era_start = int(request.args.get("era"))
-                era_end = era_start + 9
-            except (TypeError, ValueError):
-                pass
+        if mode == "graph":
+            era = None if filters["era_start"] is None else (filters["era_start"], filters["era_end"])
+            return jsonify(RECOMMENDATION_GRAPH.recommend(
+                {seed_id: 1}, filters["limit"], filters["min_score"], filters["genre_id"], era
+            ))
 
         # Query with optional genre and era filtering
         query = """
@@ -226,28 +1090,15 @@ def create_app() -> Flask:
         LEFT JOIN anime_genre ag ON ag.anime_id = a.anime_id
         WHERE (%(min_score)s IS NULL OR a.score >= %(min_score)s)
           AND (%(genre_id)s IS NULL OR ag.genre_id = %(genre_id)s)
-          AND (%(era_start)s IS NULL OR (
-            NULLIF(substring(a.season FROM '\\d{4}'), '')::int >= %(era_start)s
-            AND NULLIF(substring(a.season FROM '\\d{4}'), '')::int <= %(era_end)s
-          ))
+          AND (%(era_start)s IS NULL OR a.year BETWEEN %(era_start)s AND %(era_end)s)
         ORDER BY recs.votes DESC, a.score DESC NULLS LAST
         LIMIT %(limit)s;
         """
 
-        params = {
-            "seed_id": seed_id,
-            "min_score": min_score,
-            "genre_id": genre_id,
-            "era_start": era_start,
-            "era_end": era_end,
-            "limit": limit,
-        }
+        params = {"seed_id": seed_id, **filters}
 
         try:
-            with get_conn() as conn, conn.cursor() as cur:
-                cur.execute(query, params)
-                rows = cur.fetchall()
-                return jsonify(rows)
+            return json_response(fetch_rows("recommendations", query, params, columns=True))
         except Exception as e:
             print(f"Recommendations error: {e}")
             return jsonify({"error": str(e)}), 500
@@ -255,13 +1106,36 @@ def create_app() -> Flask:
     # Route 5 – Similar Anime by Overlapping Genres and Studios
     @app.get("/api/anime/<int:seed_id>/similar")
     def similar(seed_id: int):
-        # Accepts: limit
+        # Accepts: limit, mode (exact | approx)
         try:
             limit = int(request.args["limit"])
             if limit <= 0:
                 raise ValueError()
         except (KeyError, ValueError):
             return jsonify({"error": "limit is required and must be a positive integer"}), 400
+        mode = request.args.get("mode", "exact")
+        if mode not in ("exact", "approx"):
+            return jsonify({"error": "mode must be exact or approx"}), 400
+        if mode == "approx":
+            # The index scores with NUMERIC digits; every mode sends the same rounded number.
+            return jsonify([
+                {**row, "similarity": similarity_number(row["similarity"])}
+                for row in SIMILAR_INDEX.similar(seed_id, limit)
+            ])
+        run = similar_topk_run()
+        if run is not None and limit <= run["top_n"]:
+            # Ties are re-ordered by the current score and members, as the live query would.
+            query = """
+            SELECT a.anime_id, a.title,
+                   a.score, a.favorites_count, a.members_count,
+                   ROUND(t.similarity, 6)::float8 AS similarity
+            FROM similar_topk t
+            JOIN anime a ON a.anime_id = t.similar_id
+            WHERE t.run_id = %(run_id)s AND t.anime_id = %(seed_id)s AND t.rank <= %(limit)s
+            ORDER BY t.similarity DESC, a.score DESC NULLS LAST, a.members_count DESC NULLS LAST, t.rank;
+            """
+            params = {"run_id": run["run_id"], "seed_id": seed_id, "limit": limit}
+            return json_response(fetch_rows("similar_topk", query, params, columns=True))
 
         query = """
         WITH seed_g AS (
@@ -287,25 +1161,27 @@ def create_app() -> Flask:
           LEFT JOIN anime_genre ag ON ag.anime_id = c.anime_id
           LEFT JOIN anime_studio ast ON ast.anime_id = c.anime_id
           GROUP BY c.anime_id
+        ),
+        scored AS (
+          SELECT o.anime_id, o.g_overlap, o.s_overlap,
+                 (CASE WHEN (g_total_c + g_total_s - g_overlap) > 0
+                       THEN g_overlap::decimal / NULLIF((g_total_c + g_total_s - g_overlap),0) ELSE 0 END) * 0.7
+               + (CASE WHEN (s_total_c + s_total_s - s_overlap) > 0
+                       THEN s_overlap::decimal / NULLIF((s_total_c + s_total_s - s_overlap),0) ELSE 0 END) * 0.3
+                 AS similarity
+          FROM overlap_stats o
         )
         SELECT a.anime_id, a.title,
                a.score, a.favorites_count, a.members_count,
-               (CASE WHEN (g_total_c + g_total_s - g_overlap) > 0
-                     THEN g_overlap::decimal / NULLIF((g_total_c + g_total_s - g_overlap),0) ELSE 0 END) * 0.7
-             + (CASE WHEN (s_total_c + s_total_s - s_overlap) > 0
-                     THEN s_overlap::decimal / NULLIF((s_total_c + s_total_s - s_overlap),0) ELSE 0 END) * 0.3
-               AS similarity
-        FROM overlap_stats o
-        JOIN anime a ON a.anime_id = o.anime_id
-        WHERE o.g_overlap > 0 OR o.s_overlap > 0
-        ORDER BY similarity DESC, a.score DESC NULLS LAST, a.members_count DESC NULLS LAST
+               ROUND(s.similarity, 6)::float8 AS similarity
+        FROM scored s
+        JOIN anime a ON a.anime_id = s.anime_id
+        WHERE s.g_overlap > 0 OR s.s_overlap > 0
+        ORDER BY s.similarity DESC, a.score DESC NULLS LAST, a.members_count DESC NULLS LAST
         LIMIT %(limit)s;
         """
 
-        with get_conn() as conn, conn.cursor() as cur:
-            cur.execute(query, {"seed_id": seed_id, "limit": limit})
-            rows = cur.fetchall()
-            return jsonify(rows)
+        return json_response(fetch_rows("similar", query, {"seed_id": seed_id, "limit": limit}, columns=True))
 
     # Route 6 – Top Rated Anime Ignoring Scores of 1
     @app.get("/api/anime/top/adjusted-score")
@@ -317,6 +1193,10 @@ def create_app() -> Flask:
                 raise ValueError()
         except (KeyError, ValueError):
             return jsonify({"error": "limit is required and must be a positive integer"}), 400
+        try:
+            fmt = parse_format(request.args)
+        except ValueError as exc:
+            return jsonify({"error": str(exc)}), 400
 
         query = """
         WITH hist AS (
@@ -358,18 +1238,20 @@ def create_app() -> Flask:
         LIMIT %(limit)s;
         """
 
-        with get_conn() as conn, conn.cursor() as cur:
-            cur.execute(query, {"limit": limit})
-            rows = cur.fetchall()
-            return jsonify(rows)
+        columns = fetch_rows("top_adjusted_score", query, {"limit": limit}, columns=True)
+        return arrow_response(columns) if fmt == "arrow" else json_response(columns)
 
     # Route 7 – Rank Years by Average Rating
     @app.get("/api/stats/years/ratings")
     def stats_years_ratings():
+        try:
+            fmt = parse_format(request.args)
+        except ValueError as exc:
+            return jsonify({"error": str(exc)}), 400
         query = """
         WITH with_year AS (
           SELECT
-            NULLIF(substring(a.season FROM '\\d{4}'), '')::int AS year,
+            a.year,
             a.score,
             (a.score_1_count + a.score_2_count + a.score_3_count + a.score_4_count +
              a.score_5_count + a.score_6_count + a.score_7_count + a.score_8_count +
@@ -398,14 +1280,16 @@ def create_app() -> Flask:
         ORDER BY rank_by_avg, year;
         """
 
-        with get_conn() as conn, conn.cursor() as cur:
-            cur.execute(query)
-            rows = cur.fetchall()
-            return jsonify(rows)
+        columns = fetch_rows("stats_years_ratings", query, columns=True)
+        return arrow_response(columns) if fmt == "arrow" else json_response(columns)
 
     # Route 8 – Episodes vs Rating/Favorites/Popularity Stats
     @app.get("/api/stats/episodes-vs-metrics")
     def stats_episodes_vs_metrics():
+        try:
+            fmt = parse_format(request.args)
+        except ValueError as exc:
+            return jsonify({"error": str(exc)}), 400
         query = """
         WITH base AS (
           SELECT num_episodes, score, favorites_count, members_count
@@ -432,41 +1316,16 @@ def create_app() -> Flask:
         ORDER BY bucket;
         """
 
-        with get_conn() as conn, conn.cursor() as cur:
-            cur.execute(query)
-            rows = cur.fetchall()
-
-            if not rows:
-                return jsonify({
-                    "bins": [],
-                    "corr_eps_score": None,
-                    "corr_eps_favorites": None,
-                    "corr_eps_members": None
-                })
-
-            # Correlation values are repeated per row; take from first row and strip keys from bins.
-            corr_eps_score = rows[0].get("corr_eps_score")
-            corr_eps_favorites = rows[0].get("corr_eps_favorites")
-            corr_eps_members = rows[0].get("corr_eps_members")
-
-            bins = []
-            for row in rows:
-                bins.append({
-                    "bucket": row.get("bucket"),
-                    "min_eps": row.get("min_eps"),
-                    "max_eps": row.get("max_eps"),
-                    "n": row.get("n"),
-                    "avg_score": row.get("avg_score"),
-                    "avg_favorites": row.get("avg_favorites"),
-                    "avg_members": row.get("avg_members"),
-                })
+        columns = fetch_rows("stats_episodes_vs_metrics", query, columns=True)
+        if fmt == "arrow":
+            # One row per bin; the correlations repeat on every row.
+            return arrow_response(columns)
 
-            return jsonify({
-                "bins": bins,
-                "corr_eps_score": corr_eps_score,
-                "corr_eps_favorites": corr_eps_favorites,
-                "corr_eps_members": corr_eps_members,
-            })
+        # Correlation values are repeated per row; take them from the first row and leave them out of the bins.
+        correlations = ("corr_eps_score", "corr_eps_favorites", "corr_eps_members")
+        first = dict(zip(columns.names, (values[0] if values else None for values in columns.values)))
+        bins = json_rows.select(columns, [name for name in columns.names if name not in correlations])
+        return json_response({"bins": bins, **{name: first.get(name) for name in correlations}})
 
     # Route 9 – Random Pair of Comparable Anime
     @app.get("/api/anime/compare/random-pair")
@@ -499,23 +1358,22 @@ def create_app() -> Flask:
         SELECT 'B' AS slot, * FROM challenger;
         """
 
-        with get_conn() as conn, conn.cursor() as cur:
-            cur.execute(query)
-            rows = cur.fetchall()
+        # Every call must draw a fresh pair, so identical requests are not coalesced.
+        rows = fetch_rows("compare_random_pair", query, coalesce=False)
 
-            result = {"A": None, "B": None}
-            for row in rows:
-                slot = row.get("slot")
-                if slot in ("A", "B"):
-                    result[slot] = {
-                        "anime_id": row.get("anime_id"),
-                        "title": row.get("title"),
-                        "score": row.get("score"),
-                        "members_count": row.get("members_count"),
-                        "favorites_count": row.get("favorites_count"),
-                    }
+        result = {"A": None, "B": None}
+        for row in rows:
+            slot = row.get("slot")
+            if slot in ("A", "B"):
+                result[slot] = {
+                    "anime_id": row.get("anime_id"),
+                    "title": row.get("title"),
+                    "score": row.get("score"),
+                    "members_count": row.get("members_count"),
+                    "favorites_count": row.get("favorites_count"),
+                }
 
-            return jsonify(result)
+        return jsonify(result)
 
     # Route 10 – Most Polarizing Anime (Stddev of Ratings)
     @app.get("/api/anime/ratings/volatile")
@@ -527,6 +1385,10 @@ def create_app() -> Flask:
                 raise ValueError()
         except (KeyError, ValueError):
             return jsonify({"error": "limit is required and must be a positive integer"}), 400
+        try:
+            fmt = parse_format(request.args)
+        except ValueError as exc:
+            return jsonify({"error": str(exc)}), 400
 
         query = """
         WITH hist AS (
@@ -559,14 +1421,16 @@ def create_app() -> Flask:
         LIMIT %(limit)s;
         """
 
-        with get_conn() as conn, conn.cursor() as cur:
-            cur.execute(query, {"limit": limit})
-            rows = cur.fetchall()
-            return jsonify(rows)
+        columns = fetch_rows("ratings_volatile", query, {"limit": limit}, columns=True)
+        return arrow_response(columns) if fmt == "arrow" else json_response(columns)
 
     # Route 11 – Sequel vs First-Season Score Stats
     @app.get("/api/stats/sequels-vs-first-season")
     def stats_sequels_vs_first_season():
+        try:
+            fmt = parse_format(request.args)
+        except ValueError as exc:
+            return jsonify({"error": str(exc)}), 400
         query = """
         WITH RECURSIVE
         edges AS (
@@ -622,42 +1486,41 @@ def create_app() -> Flask:
         FROM pairs;
         """
 
-        with get_conn() as conn, conn.cursor() as cur:
-            cur.execute(query)
-            row = cur.fetchone()
-            if not row:
-                return jsonify({
-                    "comparisons": 0,
-                    "avg_diff": None,
-                    "median_diff": None,
-                    "pct_later_higher": None,
-                })
-            return jsonify(row)
+        if fmt == "arrow":
+            return arrow_response(fetch_rows("stats_sequels_vs_first_season", query, columns=True))
+        row = fetch_rows("stats_sequels_vs_first_season", query, one=True)
+        if not row:
+            return jsonify({
+                "comparisons": 0,
+                "avg_diff": None,
+                "median_diff": None,
+                "pct_later_higher": None,
+            })
+        return jsonify(row)
 
     # Route 12 – List All Genres
     @app.get("/api/genres")
     def list_genres():
+        catalog = CATALOG.current()
+        if catalog is not None:
+            return jsonify(catalog.genre_list())
+
         query = """
         SELECT g.genre_id, g.name
         FROM genre g
         ORDER BY g.name;
         """
 
-        with get_conn() as conn, conn.cursor() as cur:
-            cur.execute(query)
-            rows = cur.fetchall()
-            return jsonify(rows)
+        return json_response(fetch_rows("list_genres", query, columns=True))
 
     # Route 13 – Get Anime by ID (full record)
     @app.get("/api/anime/<int:anime_id>")
     def get_anime(anime_id: int):
-        query = "SELECT * FROM anime WHERE anime_id = %(id)s;"
-        with get_conn() as conn, conn.cursor() as cur:
-            cur.execute(query, {"id": anime_id})
-            row = cur.fetchone()
-            if row is None:
-                return jsonify({"error": "anime not found"}), 404
-            return jsonify(row)
+        query = f"SELECT {ANIME_SELECT} FROM anime a WHERE a.anime_id = %(id)s;"
+        row = fetch_rows("get_anime", query, {"id": anime_id}, one=True)
+        if row is None:
+            return jsonify({"error": "anime not found"}), 404
+        return jsonify(row)
 
     # Route 14 – Search Anime by Title
     @app.get("/api/anime/search")
@@ -690,10 +1553,462 @@ def create_app() -> Flask:
             "limit": limit,
         }
 
-        with get_conn() as conn, conn.cursor() as cur:
-            cur.execute(query, params)
-            rows = cur.fetchall()
-            return jsonify(rows)
+        return json_response(fetch_rows("search_anime_by_title", query, params, columns=True))
+
+    # Route 15 – Autocomplete Titles by Prefix
+    @app.get("/api/anime/autocomplete")
+    def autocomplete_titles():
+        prefix = request.args.get("q", "").strip()
+        if not prefix:
+            return jsonify([])
+
+        try:
+            limit = int(request.args.get("limit", AUTOCOMPLETE.top_k))
+            if limit <= 0:
+                raise ValueError()
+        except ValueError:
+            limit = AUTOCOMPLETE.top_k
+
+        return jsonify(AUTOCOMPLETE.lookup(prefix, limit))
+
+    # Route 16 – Facet Counts for the Search Filters
+    @app.get("/api/anime/facets")
+    def anime_facets():
+        # Accepts: the /api/anime filters (season, type, source_type, min_score, max_score, genre_ids)
+        # Return: counts per season, type, source_type and genre. Each facet ignores its own
+        # filter, so the sidebar can offer the other values of a multi-select.
+        try:
+            filters = parse_anime_filters(request.args)
+        except ValueError as exc:
+            return jsonify({"error": str(exc)}), 400
+
+        query = f"""
+        WITH wanted AS (
+          SELECT COALESCE(bit_or(1::bigint << g.bit), 0) AS mask, COUNT(*) AS n
+          FROM genre g
+          WHERE g.genre_id = ANY(%(genre_ids)s::int[])
+        ),
+        base AS (
+          SELECT
+            a.season, a.type, a.source_type, a.genre_mask,
+            (%(season)s IS NULL OR a.season = %(season)s) AS f_season,
+            (%(type)s IS NULL OR a.type = %(type)s) AS f_type,
+            (%(source_type)s IS NULL OR a.source_type = %(source_type)s) AS f_source_type,
+            ((%(min_score)s IS NULL OR a.score >= %(min_score)s) AND
+             (%(max_score)s IS NULL OR a.score <= %(max_score)s)) AS f_score,
+            (%(genre_ids)s::int[] IS NULL OR (
+              w.n = cardinality(%(genre_ids)s::int[]) AND (a.genre_mask & w.mask) = w.mask
+            )) AS f_genre
+          FROM anime a, wanted w
+        ),
+        grouped AS (
+          SELECT
+            CASE
+              WHEN GROUPING(season) = 0 THEN 'season'
+              WHEN GROUPING(type) = 0 THEN 'type'
+              WHEN GROUPING(source_type) = 0 THEN 'source_type'
+              ELSE 'total'
+            END AS facet,
+            COALESCE(season, type::text, source_type::text) AS value,
+            CASE
+              WHEN GROUPING(season) = 0 THEN SUM((f_type AND f_source_type AND f_score AND f_genre)::int)
+              WHEN GROUPING(type) = 0 THEN SUM((f_season AND f_source_type AND f_score AND f_genre)::int)
+              WHEN GROUPING(source_type) = 0 THEN SUM((f_season AND f_type AND f_score AND f_genre)::int)
+              ELSE SUM((f_season AND f_type AND f_source_type AND f_score AND f_genre)::int)
+            END AS n,
+            ARRAY[
+              {_GENRE_BIT_COUNTS}
+            ] AS genre_counts
+          FROM base
+          GROUP BY GROUPING SETS ((season), (type), (source_type), ())
+        )
+        SELECT facet, value, NULL::int AS genre_id, n AS count
+        FROM grouped
+        WHERE n > 0 OR facet = 'total'
+        UNION ALL
+        SELECT 'genre', g.name, g.genre_id, b.n
+        FROM grouped gr
+        CROSS JOIN LATERAL unnest(gr.genre_counts) WITH ORDINALITY AS b(n, k)
+        JOIN genre g ON g.bit = b.k - 1
+        WHERE gr.facet = 'total' AND b.n > 0;
+        """
+
+        unfiltered = all(value is None for value in filters.values())
+        if not unfiltered:
+            return jsonify(_shape_facets(fetch_rows("anime_facets", query, filters)))
+
+        body = FACETS_CACHE.get_or_set(
+            "unfiltered", lambda: _shape_facets(fetch_rows("anime_facets", query, filters))
+        )
+        resp = jsonify(body)
+        resp.headers["Cache-Control"] = f"public, max-age={int(FACETS_TTL)}"
+        return resp
+
+    # Route 17 – Similar Anime by Synopsis Text
+    @app.get("/api/anime/<int:seed_id>/similar-text")
+    def similar_text(seed_id: int):
+        # Accepts: limit, mode (auto | precomputed | query)
+        try:
+            limit = int(request.args["limit"])
+            if limit <= 0:
+                raise ValueError()
+        except (KeyError, ValueError):
+            return jsonify({"error": "limit is required and must be a positive integer"}), 400
+        mode = request.args.get("mode", "auto")
+        if mode not in ("auto", "precomputed", "query"):
+            return jsonify({"error": "mode must be auto, precomputed or query"}), 400
+        index = load_text_index()
+        if index is None:
+            return jsonify({"error": "synopsis index is not available"}), 503
+        if mode == "precomputed" and limit > index.top_k:
+            return jsonify({"error": f"limit must be at most {index.top_k} with mode=precomputed"}), 400
+
+        neighbours = index.similar(seed_id, limit, None if mode == "auto" else mode == "precomputed")
+        summaries = anime_summaries([anime_id for anime_id, _ in neighbours])
+        return jsonify([
+            {**summaries[anime_id], "similarity": round(score, 6)}
+            for anime_id, score in neighbours
+            if anime_id in summaries
+        ])
+
+    # Route 18 – Score, Members and Favorites Distribution by Group
+    @app.get("/api/stats/distribution")
+    def stats_distribution():
+        # Accepts: metric, by, q, genre_id, type, source_type, season, year
+        try:
+            qs = [float(q) for q in request.args.get("q", "").split(",") if q.strip()] or list(DEFAULT_QUANTILES)
+            if len(qs) > MAX_DISTRIBUTION_QUANTILES or not all(0 <= q <= 1 for q in qs):
+                raise ValueError()
+        except ValueError:
+            return jsonify({"error": f"q must be up to {MAX_DISTRIBUTION_QUANTILES} numbers between 0 and 1"}), 400
+        filters = {name: request.args.get(name) for name in ("type", "source_type", "season")}
+        try:
+            for name in ("genre_id", "year"):
+                filters[name] = int(request.args[name]) if name in request.args else None
+        except ValueError:
+            return jsonify({"error": "genre_id and year must be integers"}), 400
+        try:
+            rows = DISTRIBUTIONS.distribution(request.args.get("metric"), request.args.get("by"), filters, qs)
+        except ValueError as exc:
+            return jsonify({"error": str(exc)}), 400
+        return jsonify(rows)
+
+    # Route 19 – Aggregates by Any Combination of Genre, Type, Source, Season and Year
+    @app.get("/api/stats/cube")
+    def stats_cube():
+        # Accepts: by, measures, genre_id, type, source_type, season, year
+        filters = {name: request.args.get(name) for name in ("type", "source_type", "season")}
+        try:
+            for name in ("genre_id", "year"):
+                filters[name] = int(request.args[name]) if name in request.args else None
+        except ValueError:
+            return jsonify({"error": "genre_id and year must be integers"}), 400
+        try:
+            rows = CUBE.query(request.args.get("by"), filters, request.args.get("measures"))
+        except ValueError as exc:
+            return jsonify({"error": str(exc)}), 400
+        return jsonify(rows)
+
+    # Route 20 – Franchise of an Anime (its related_anime component)
+    @app.get("/api/franchises/<int:anime_id>")
+    def franchise(anime_id):
+        found = FRANCHISES.franchises().franchise(anime_id)
+        if found is None:
+            return jsonify({"error": "anime not found"}), 404
+        return jsonify(found)
+
+    # Route 21 – Top Franchises by Size, Average Score or Total Members
+    @app.get("/api/franchises/top")
+    def top_franchises():
+        # Accepts: metric, limit, offset, min_size
+        metric = request.args.get("metric", "members")
+        if metric not in franchises.METRICS:
+            return jsonify({"error": f"metric must be one of: {', '.join(franchises.METRICS)}"}), 400
+        try:
+            limit = int(request.args.get("limit", 10))
+            if limit <= 0:
+                raise ValueError()
+        except ValueError:
+            return jsonify({"error": "limit must be a positive integer"}), 400
+        try:
+            offset = int(request.args.get("offset", 0))
+            if offset < 0:
+                raise ValueError()
+        except ValueError:
+            return jsonify({"error": "offset must be a non-negative integer"}), 400
+        try:
+            min_size = int(request.args.get("min_size", 1))
+            if min_size <= 0:
+                raise ValueError()
+        except ValueError:
+            return jsonify({"error": "min_size must be a positive integer"}), 400
+        return jsonify(FRANCHISES.franchises().top(metric, limit, offset, min_size))
+
+    # Route 22 – Recommendations Merged over Several Seed Anime
+    @app.get("/api/anime/recommendations")
+    def recommendations_multi():
+        # Accepts: seeds, weights, min_score, limit, genre_ids, era, mode (direct | graph)
+        try:
+            seeds = parse_seeds(request.args)
+        except ValueError as exc:
+            return jsonify({"error": str(exc)}), 400
+        mode = request.args.get("mode", "direct")
+        if mode not in ("direct", "graph"):
+            return jsonify({"error": "mode must be direct or graph"}), 400
+        filters = parse_recommendation_filters(request.args)
+        era = None if filters["era_start"] is None else (filters["era_start"], filters["era_end"])
+
+        if mode == "graph":
+            return jsonify(RECOMMENDATION_GRAPH.recommend(
+                seeds, filters["limit"], filters["min_score"], filters["genre_id"], era
+            ))
+        catalog = CATALOG.current()
+        if catalog is not None:
+            return jsonify(catalog.merged_recommendations(
+                seeds, filters["limit"], filters["min_score"], filters["genre_id"], era
+            ))
+
+        # Each seed's neighbours with MAX(votes) as in route 4, then weighted and summed per anime.
+        query = """
+        WITH seeds AS (
+          SELECT s.seed_id, s.weight
+          FROM unnest(%(seeds)s::int[], %(weights)s::int[]) AS s(seed_id, weight)
+        ),
+        pairs AS (
+          SELECT
+            s.seed_id,
+            s.weight,
+            CASE WHEN r.anime_id_a = s.seed_id THEN r.anime_id_b ELSE r.anime_id_a END AS rec_id,
+            MAX(r.num_recommenders) AS votes
+          FROM seeds s
+          JOIN recommendation r ON r.anime_id_a = s.seed_id OR r.anime_id_b = s.seed_id
+          GROUP BY s.seed_id, s.weight, rec_id
+        ),
+        recs AS (
+          SELECT p.rec_id, SUM(p.weight * p.votes) AS votes, COUNT(*) AS seeds
+          FROM pairs p
+          WHERE p.rec_id <> ALL(%(seeds)s::int[])
+          GROUP BY p.rec_id
+        )
+        SELECT DISTINCT a.anime_id, a.title, a.score, a.num_episodes, recs.votes, recs.seeds
+        FROM recs
+        JOIN anime a ON a.anime_id = recs.rec_id
+        LEFT JOIN anime_genre ag ON ag.anime_id = a.anime_id
+        WHERE (%(min_score)s IS NULL OR a.score >= %(min_score)s)
+          AND (%(genre_id)s IS NULL OR ag.genre_id = %(genre_id)s)
+          AND (%(era_start)s IS NULL OR a.year BETWEEN %(era_start)s AND %(era_end)s)
+        ORDER BY recs.votes DESC, a.score DESC NULLS LAST, a.anime_id
+        LIMIT %(limit)s;
+        """
+        params = {"seeds": list(seeds), "weights": list(seeds.values()), **filters}
+        return json_response(fetch_rows("recommendations_multi", query, params, columns=True))
+
+    # Admin – Autocomplete trie size and rebuild
+    @app.get("/api/admin/autocomplete")
+    def autocomplete_stats():
+        if not _is_admin():
+            return jsonify({"error": "admin token required"}), 403
+        return jsonify(AUTOCOMPLETE.stats())
+
+    @app.post("/api/admin/autocomplete/rebuild")
+    def autocomplete_rebuild():
+        if not _is_admin():
+            return jsonify({"error": "admin token required"}), 403
+        AUTOCOMPLETE.rebuild()
+        return jsonify(AUTOCOMPLETE.stats())
+
+    # Admin – Catalog snapshot status and refresh from Postgres
+    @app.get("/api/admin/catalog")
+    def catalog_stats():
+        if not _is_admin():
+            return jsonify({"error": "admin token required"}), 403
+        catalog = CATALOG.current()
+        body = catalog.stats() if catalog is not None else {"source": None}
+        return jsonify({**body, "last_error": CATALOG.last_error})
+
+    @app.post("/api/admin/catalog/refresh")
+    def catalog_refresh():
+        if not _is_admin():
+            return jsonify({"error": "admin token required"}), 403
+        if refresh_catalog(background=False) is None:
+            return jsonify({"error": CATALOG.last_error or "refresh already running"}), 503
+        return jsonify({**CATALOG.current().stats(), "last_error": None})
+
+    # Admin – Change feed status, and publishing a change set by hand
+    @app.get("/api/admin/changes")
+    def change_feed_stats():
+        if not _is_admin():
+            return jsonify({"error": "admin token required"}), 403
+        return jsonify({**CHANGES.stats(), "listening": _change_listener is not None})
+
+    @app.post("/api/admin/changes")
+    def publish_changes():
+        if not _is_admin():
+            return jsonify({"error": "admin token required"}), 403
+        body = request.get_json(silent=True) or {}
+        anime_ids, columns = body.get("anime_ids"), body.get("columns")
+        if anime_ids is not None and not (
+            isinstance(anime_ids, list) and all(isinstance(i, int) and not isinstance(i, bool) for i in anime_ids)
+        ):
+            return jsonify({"error": "anime_ids must be a list of integers"}), 400
+        if columns is not None and not (isinstance(columns, list) and all(isinstance(c, str) for c in columns)):
+            return jsonify({"error": "columns must be a list of column names"}), 400
+        changes = ChangeSet(
+            None if anime_ids is None else frozenset(anime_ids), None if columns is None else frozenset(columns)
+        )
+        CHANGES.publish(changes)
+        return jsonify({"anime_ids": None if anime_ids is None else len(changes.anime_ids), **CHANGES.stats()})
+
+    # Admin – Periodic jobs: leader, schedule and recent runs
+    @app.get("/api/admin/jobs")
+    def job_stats():
+        if not _is_admin():
+            return jsonify({"error": "admin token required"}), 403
+        try:
+            limit = int(request.args.get("history", 20))
+            if limit < 0:
+                raise ValueError()
+        except ValueError:
+            return jsonify({"error": "history must be a non-negative integer"}), 400
+        history = []
+        if SCHEDULER.jobs and limit:
+            query = """
+            SELECT run_id, job, instance, started_at, finished_at, status, error, result
+            FROM job_run
+            ORDER BY run_id DESC
+            LIMIT %(limit)s;
+            """
+            history = fetch_rows("job_history", query, {"limit": limit}, coalesce=False)
+        return jsonify({**SCHEDULER.stats(), "history": history})
+
+    # Admin – Per-request profiles, as collapsed stacks or speedscope JSON
+    @app.get("/api/admin/profiles")
+    def profile_list():
+        if not _is_admin():
+            return jsonify({"error": "admin token required"}), 403
+        return jsonify(PROFILER.stats())
+
+    @app.get("/api/admin/profiles/<int:profile_id>")
+    def profile_download(profile_id: int):
+        if not _is_admin():
+            return jsonify({"error": "admin token required"}), 403
+        fmt = request.args.get("format", "speedscope")
+        if fmt not in ("speedscope", "collapsed"):
+            return jsonify({"error": "format must be speedscope or collapsed"}), 400
+        profile = PROFILER.get(profile_id)
+        if profile is None:
+            return jsonify({"error": "profile not found"}), 404
+        if fmt == "collapsed":
+            resp = Response(profile.collapsed(), mimetype="text/plain")
+            filename = f"profile-{profile_id}.txt"
+        else:
+            resp = jsonify(profile.speedscope())
+            filename = f"profile-{profile_id}.speedscope.json"
+        resp.headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+        return resp
+
+    # Admin – Admission control queues and rejections
+    @app.get("/api/admin/admission")
+    def admission_stats():
+        if not _is_admin():
+            return jsonify({"error": "admin token required"}), 403
+        return jsonify({"enabled": ADMISSION_ENABLED, **ADMISSION.stats()})
+
+    # Admin – Response compression
+    @app.get("/api/admin/compression")
+    def compression_stats():
+        if not _is_admin():
+            return jsonify({"error": "admin token required"}), 403
+        return jsonify({"enabled": COMPRESSION_ENABLED, **COMPRESSION.stats()})
+
+    # Admin – MinHash index behind /similar?mode=approx
+    @app.get("/api/admin/similar-index")
+    def similar_index_stats():
+        if not _is_admin():
+            return jsonify({"error": "admin token required"}), 403
+        return jsonify(SIMILAR_INDEX.stats())
+
+    @app.post("/api/admin/similar-index/rebuild")
+    def similar_index_rebuild():
+        if not _is_admin():
+            return jsonify({"error": "admin token required"}), 403
+        SIMILAR_INDEX.rebuild()
+        return jsonify(SIMILAR_INDEX.stats())
+
+    # Admin – Recommendation graph behind /recommendations?mode=graph
+    @app.get("/api/admin/pagerank")
+    def pagerank_stats():
+        if not _is_admin():
+            return jsonify({"error": "admin token required"}), 403
+        return jsonify(RECOMMENDATION_GRAPH.stats())
+
+    @app.post("/api/admin/pagerank/rebuild")
+    def pagerank_rebuild():
+        if not _is_admin():
+            return jsonify({"error": "admin token required"}), 403
+        RECOMMENDATION_GRAPH.rebuild()
+        return jsonify(RECOMMENDATION_GRAPH.stats())
+
+    # Admin – Quantile sketches behind /stats/distribution
+    @app.get("/api/admin/distribution")
+    def distribution_stats():
+        if not _is_admin():
+            return jsonify({"error": "admin token required"}), 403
+        return jsonify(DISTRIBUTIONS.stats())
+
+    # Admin – OLAP cube behind /stats/cube
+    @app.get("/api/admin/cube")
+    def cube_stats():
+        if not _is_admin():
+            return jsonify({"error": "admin token required"}), 403
+        return jsonify(CUBE.stats())
+
+    @app.post("/api/admin/cube/rebuild")
+    def cube_rebuild():
+        if not _is_admin():
+            return jsonify({"error": "admin token required"}), 403
+        CUBE.rebuild()
+        return jsonify(CUBE.stats())
+
+    # Admin – Franchises behind /franchises
+    @app.get("/api/admin/franchises")
+    def franchise_stats():
+        if not _is_admin():
+            return jsonify({"error": "admin token required"}), 403
+        return jsonify(FRANCHISES.stats())
+
+    @app.post("/api/admin/franchises/rebuild")
+    def franchise_rebuild():
+        if not _is_admin():
+            return jsonify({"error": "admin token required"}), 403
+        FRANCHISES.rebuild()
+        return jsonify(FRANCHISES.stats())
+
+    # Admin – Synopsis TF-IDF index behind /similar-text
+    @app.get("/api/admin/text-index")
+    def text_index_stats():
+        if not _is_admin():
+            return jsonify({"error": "admin token required"}), 403
+        index = load_text_index()
+        body = {"loaded": False} if index is None else {"loaded": True, **index.stats()}
+        return jsonify({**body, "last_error": _text_index_error})
+
+    @app.post("/api/admin/text-index/reload")
+    def text_index_reload():
+        if not _is_admin():
+            return jsonify({"error": "admin token required"}), 403
+        index = load_text_index(reload=True)
+        if index is None or _text_index_error:
+            return jsonify({"error": _text_index_error or "MAL_TEXT_INDEX_PATH is not set"}), 503
+        return jsonify({"loaded": True, **index.stats(), "last_error": None})
+
+    # Admin – Drop prepared statements after a schema change
+    @app.post("/api/admin/statements/invalidate")
+    def invalidate_statements():
+        if not _is_admin():
+            return jsonify({"error": "admin token required"}), 403
+        generation = STATEMENTS.invalidate()
+        return jsonify({"generation": generation})
 
     return app
 
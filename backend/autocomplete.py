@@ -0,0 +1,253 @@
+"""In-process title autocomplete backed by a compressed prefix trie.
+
+Titles are normalized (case-folded, accents and punctuation removed) and
+inserted into a radix trie, once for the whole title and once for every
+later word so that "kyojin" finds "Shingeki no Kyojin". After the build each
+node caches the ids of its top-k anime by ``members_count``; a lookup walks
+the prefix and slices that list, so it costs O(len(prefix)) and never sorts.
+
+``AutocompleteIndex`` owns the current trie and swaps in a freshly built or
+patched one in a single assignment, so readers never see a half-built index.
+A patched trie copies only the nodes above the changed titles and shares
+the rest with the trie it replaces, which is never modified.
+"""
+import re
+import sys
+import time
+import unicodedata
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional
+
+from derived import DerivedIndex
+
+_NON_WORD = re.compile(r"[^0-9a-z]+")
+
+DEFAULT_TOP_K = 10
+
+
+def normalize(text: str) -> str:
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return _NON_WORD.sub(" ", text.casefold()).strip()
+
+
+def _keys_for(title: str) -> List[str]:
+    norm = normalize(title)
+    if not norm:
+        return []
+    words = norm.split(" ")
+    return [" ".join(words[i:]) for i in range(len(words))]
+
+
+def _common_prefix(a: str, b: str) -> int:
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+class _Node:
+    __slots__ = ("label", "children", "ids", "top")
+
+    def __init__(self, label: str = ""):
+        self.label = label
+        self.children: Dict[str, "_Node"] = {}
+        self.ids: Optional[List[int]] = None  # anime whose key ends exactly here
+        self.top: List[int] = []
+
+    def copy(self) -> "_Node":
+        node = _Node(self.label)
+        node.children = dict(self.children)
+        node.ids = self.ids
+        node.top = self.top
+        return node
+
+
+class Trie:
+    """Radix trie over normalized titles with per-node top-k caches."""
+
+    def __init__(self, top_k: int = DEFAULT_TOP_K):
+        self.top_k = top_k
+        self.root = _Node()
+        self.rows: Dict[int, Dict[str, Any]] = {}
+        self.nodes = 1
+
+    @classmethod
+    def build(cls, rows: Iterable[Mapping[str, Any]], top_k: int = DEFAULT_TOP_K) -> "Trie":
+        trie = cls(top_k)
+        for row in rows:
+            trie.rows[row["anime_id"]] = dict(row)
+            for key in _keys_for(row.get("title") or ""):
+                trie._insert(key, row["anime_id"])
+        trie._finalize(trie.root)
+        return trie
+
+    def _insert(self, key: str, anime_id: int) -> None:
+        node = self.root
+        while True:
+            if not key:
+                if node.ids is None:
+                    node.ids = []
+                if anime_id not in node.ids:
+                    node.ids.append(anime_id)
+                return
+            child = node.children.get(key[0])
+            if child is None:
+                leaf = node.children[key[0]] = _Node(key)
+                leaf.ids = [anime_id]
+                self.nodes += 1
+                return
+            common = _common_prefix(key, child.label)
+            if common < len(child.label):
+                # Split the edge: node -> mid(common) -> child(rest).
+                mid = _Node(child.label[:common])
+                child.label = child.label[common:]
+                mid.children[child.label[0]] = child
+                node.children[key[0]] = mid
+                self.nodes += 1
+                child = mid
+            node = child
+            key = key[common:]
+
+    def _rank(self, anime_id: int):
+        members = self.rows[anime_id].get("members_count") or 0
+        return (-members, anime_id)
+
+    def _rerank(self, node: _Node) -> None:
+        candidates = set(node.ids or ())
+        for child in node.children.values():
+            candidates.update(child.top)
+        node.top = sorted(candidates, key=self._rank)[: self.top_k]
+
+    def _finalize(self, node: _Node) -> None:
+        # Iterative post-order so deep tries cannot hit the recursion limit.
+        stack = [(node, False)]
+        while stack:
+            current, expanded = stack.pop()
+            if not expanded:
+                stack.append((current, True))
+                stack.extend((child, False) for child in current.children.values())
+                continue
+            self._rerank(current)
+
+    def patched(self, rows: Iterable[Mapping[str, Any]]) -> Optional["Trie"]:
+        """A new trie with new payloads for existing titles, re-ranking only the nodes above them.
+
+        Nodes off those paths are shared, and this trie is left as it is.
+        Returns None when a row is new or its normalized title changed: that
+        changes the trie's shape and needs a rebuild.
+        """
+        rows = [dict(row) for row in rows]
+        for row in rows:
+            old = self.rows.get(row["anime_id"])
+            if old is None or normalize(old.get("title") or "") != normalize(row.get("title") or ""):
+                return None
+        trie = Trie(self.top_k)
+        trie.rows = {**self.rows, **{row["anime_id"]: row for row in rows}}
+        trie.nodes = self.nodes
+        trie.root = self.root.copy()
+        copied = {id(self.root): (0, trie.root)}  # original node -> (depth, copy)
+        for row in rows:
+            for key in _keys_for(row.get("title") or ""):
+                node, copy, depth = self.root, trie.root, 0
+                while key:
+                    child = node.children[key[0]]
+                    if id(child) not in copied:
+                        copied[id(child)] = (depth + 1, child.copy())
+                        copy.children[key[0]] = copied[id(child)][1]
+                    node, copy, depth = child, copied[id(child)][1], depth + 1
+                    key = key[len(child.label):]
+        # Deepest first, so every node re-ranks over its children's new lists.
+        for _, node in sorted(copied.values(), key=lambda item: -item[0]):
+            trie._rerank(node)
+        return trie
+
+    def lookup(self, prefix: str, limit: int = DEFAULT_TOP_K) -> List[Dict[str, Any]]:
+        key = normalize(prefix)
+        if not key:
+            return []
+        node = self.root
+        while key:
+            child = node.children.get(key[0])
+            if child is None:
+                return []
+            common = _common_prefix(key, child.label)
+            if common == len(key):
+                node = child
+                break
+            if common < len(child.label):
+                return []
+            node = child
+            key = key[common:]
+        return [self.rows[anime_id] for anime_id in node.top[:limit]]
+
+    def memory_bytes(self) -> int:
+        """Approximate heap size of the trie and its row payloads."""
+        total = sys.getsizeof(self.rows)
+        for row in self.rows.values():
+            total += sys.getsizeof(row) + sum(sys.getsizeof(v) for v in row.values())
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            total += sys.getsizeof(node) + sys.getsizeof(node.label) + sys.getsizeof(node.children)
+            total += sys.getsizeof(node.top)
+            if node.ids is not None:
+                total += sys.getsizeof(node.ids)
+            stack.extend(node.children.values())
+        return total
+
+
+class AutocompleteIndex(DerivedIndex[Trie]):
+    """Holds the live trie and rebuilds it from ``loader`` on demand."""
+
+    name = "autocomplete"
+
+    def __init__(
+        self,
+        loader: Callable[[], Iterable[Mapping[str, Any]]],
+        top_k: int = DEFAULT_TOP_K,
+        ttl: Optional[float] = None,
+    ):
+        super().__init__(loader)
+        self.top_k = top_k
+        self.ttl = ttl
+
+    def _make(self) -> Trie:
+        return Trie.build(self.loader(), self.top_k)
+
+    def update(self, rows: Iterable[Mapping[str, Any]]) -> bool:
+        """Swap in a patched trie for ``rows``, or rebuild it in the background if that is not possible."""
+        with self._lock:
+            trie = self._value
+            if trie is None:
+                return True  # an unbuilt trie will be built from fresh rows anyway
+            patched = trie.patched(rows)
+            if patched is not None:
+                self._value = patched
+                return True
+        self.rebuild_in_background()
+        return False
+
+    def trie(self) -> Trie:
+        trie = self.get()
+        if self.ttl is not None and time.time() - self._built_at > self.ttl and not self.rebuilding:
+            # Keep serving the current trie while a fresh one is built.
+            self.rebuild_in_background()
+        return trie
+
+    def lookup(self, prefix: str, limit: int = DEFAULT_TOP_K) -> List[Dict[str, Any]]:
+        return self.trie().lookup(prefix, min(limit, self.top_k))
+
+    def stats(self) -> Dict[str, Any]:
+        trie = self._value
+        if trie is None:
+            return {"built": False}
+        return {
+            "built": True,
+            "built_at": self._built_at,
+            "build_seconds": self._build_seconds,
+            "titles": len(trie.rows),
+            "nodes": trie.nodes,
+            "top_k": trie.top_k,
+            "memory_bytes": trie.memory_bytes(),
+        }
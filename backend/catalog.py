@@ -0,0 +1,658 @@
+"""Columnar in-memory anime catalog with a memory-mapped snapshot file.
+
+A ``Catalog`` holds the anime table's hot columns, each anime's genre mask
+and studio set, the recommendation graph as adjacency lists, each anime's
+franchise (its connected component in ``related_anime``) and the titles,
+all as flat typed arrays indexed by row number. It can be built from
+Postgres or mapped straight from a snapshot file, in which case the arrays
+are ``memoryview`` casts over the ``mmap`` and nothing is copied or parsed.
+
+Snapshot layout (little-endian)::
+
+    header   magic(8) format(u16) reserved(u16) toc_len(u32) payload_len(u64) sha256(32)
+    toc      JSON: {"meta": {...}, "sections": {name: [typecode, offset, count]}}
+    padding  to an 8-byte boundary
+    payload  sections, each 8-byte aligned; offsets are relative to the payload
+
+The checksum covers the TOC and the payload. Export a snapshot with
+
+    python catalog.py export catalog.snap
+    python catalog.py info catalog.snap
+"""
+import argparse
+import hashlib
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from decimal import Decimal
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple
+
+SNAPSHOT_MAGIC = b"MALCAT\r\n"
+FORMAT_VERSION = 1
+_HEADER = struct.Struct("<8sHHIQ32s")
+_ALIGN = 8
+
+NULL = -1  # stands in for SQL NULL in the integer columns
+
+# name -> array typecode. Scores are stored in hundredths (NUMERIC(4,2)).
+COLUMNS = {
+    "anime_id": "i",
+    "score_cents": "h",
+    "members_count": "q",
+    "favorites_count": "q",
+    "num_episodes": "i",
+    "year": "h",
+    "genre_mask": "q",
+    "type_code": "b",
+    "source_type_code": "b",
+    "season_code": "i",
+    "title_offsets": "i",  # n + 1 offsets into title_bytes
+    "title_bytes": "B",
+    "studio_offsets": "i",  # n + 1 offsets into studio_ids
+    "studio_ids": "i",
+    "rec_offsets": "i",  # n + 1 offsets into rec_rows / rec_votes
+    "rec_rows": "i",  # neighbour row numbers, most votes first
+    "rec_votes": "i",
+    "franchise_id": "i",  # smallest anime_id of the anime's related_anime component
+}
+
+ANIME_QUERY = """
+SELECT a.anime_id, a.title, a.score, a.members_count, a.favorites_count, a.num_episodes,
+       a.year, a.genre_mask, a.type, a.source_type, a.season
+FROM anime a
+ORDER BY a.anime_id;
+"""
+GENRE_QUERY = "SELECT g.genre_id, g.name, g.bit FROM genre g ORDER BY g.genre_id;"
+STUDIO_QUERY = "SELECT ast.anime_id, ast.studio_id FROM anime_studio ast ORDER BY ast.anime_id, ast.studio_id;"
+# The Anime row that routes 1 and 13 return (see api.md): the source columns,
+# without year, decade, season_name and genre_mask, which migrations derive.
+ANIME_COLUMNS = (
+    "anime_id", "title", "synopsis", "main_pic", "type", "source_type", "num_episodes", "status", "season",
+    "score", "favorites_count", "members_count", "watching_count", "completed_count", "on_hold_count",
+    "dropped_count", "plan_to_watch_count", "score_10_count", "score_9_count", "score_8_count",
+    "score_7_count", "score_6_count", "score_5_count", "score_4_count", "score_3_count", "score_2_count",
+    "score_1_count",
+)
+ANIME_SELECT = ", ".join(f"a.{name}" for name in ANIME_COLUMNS)
+ANIME_BY_ID_QUERY = """
+SELECT a.anime_id, a.title, a.score, a.members_count, a.favorites_count, a.num_episodes,
+       a.year, a.genre_mask, a.type, a.source_type, a.season
+FROM anime a
+WHERE a.anime_id = ANY(%(ids)s)
+ORDER BY a.anime_id;
+"""
+RECOMMENDATION_QUERY = "SELECT r.anime_id_a, r.anime_id_b, r.num_recommenders FROM recommendation r;"
+RELATED_QUERY = "SELECT ra.anime_id_a, ra.anime_id_b FROM related_anime ra;"
+
+# Per-anime sections that Catalog.patched() can rewrite without a full rebuild.
+_PATCHABLE = (
+    "score_cents", "members_count", "favorites_count", "num_episodes", "year", "genre_mask",
+    "type_code", "source_type_code", "season_code",
+)
+
+
+class SnapshotError(ValueError):
+    """The snapshot file is missing, truncated, corrupt or of another format."""
+
+
+def _nullable(value) -> int:
+    return NULL if value is None else int(value)
+
+
+def _score_cents(value) -> int:
+    return NULL if value is None else int(round(Decimal(str(value)) * 100))
+
+
+def _interned(value, codes: Dict[str, int], names: List[str]) -> int:
+    if value is None:
+        return NULL
+    code = codes.get(value)
+    if code is None:
+        code = codes[value] = len(names)
+        names.append(value)
+    return code
+
+
+class Catalog:
+    def __init__(self, sections: Mapping[str, Sequence], meta: Mapping[str, Any], source: str, mapped=None):
+        missing = [name for name in COLUMNS if name not in sections]
+        if missing:
+            raise SnapshotError(f"catalog is missing sections: {', '.join(missing)}")
+        self.sections = dict(sections)
+        self.meta = dict(meta)
+        self.source = source
+        self._mapped = mapped  # keeps the mmap alive while views point into it
+        for name, values in self.sections.items():
+            setattr(self, name, values)
+        self.n = len(self.anime_id)
+        self.types: List[str] = list(self.meta.get("types", []))
+        self.source_types: List[str] = list(self.meta.get("source_types", []))
+        self.seasons: List[str] = list(self.meta.get("seasons", []))
+        self.genres: List[Dict[str, Any]] = list(self.meta.get("genres", []))
+        self._genre_bits = sorted((g["bit"], g["genre_id"]) for g in self.genres if g.get("bit") is not None)
+        self._row_of = {anime_id: row for row, anime_id in enumerate(self.anime_id)}
+        self._orders: Dict[str, List[int]] = {}
+        self._lock = threading.Lock()
+
+    # -- building -----------------------------------------------------------
+
+    @classmethod
+    def from_rows(
+        cls,
+        anime_rows: Iterable[Mapping[str, Any]],
+        genre_rows: Iterable[Mapping[str, Any]] = (),
+        studio_rows: Iterable[Mapping[str, Any]] = (),
+        recommendation_rows: Iterable[Mapping[str, Any]] = (),
+        related_rows: Iterable[Mapping[str, Any]] = (),
+        source: str = "rows",
+    ) -> "Catalog":
+        cols = {name: array(code) for name, code in COLUMNS.items()}
+        interned = {"types": ({}, []), "source_types": ({}, []), "seasons": ({}, [])}
+        title_bytes = bytearray()
+        cols["title_offsets"].append(0)
+
+        anime_rows = sorted(anime_rows, key=lambda r: r["anime_id"])
+        for row in anime_rows:
+            cols["anime_id"].append(row["anime_id"])
+            cols["score_cents"].append(_score_cents(row.get("score")))
+            cols["members_count"].append(_nullable(row.get("members_count")))
+            cols["favorites_count"].append(_nullable(row.get("favorites_count")))
+            cols["num_episodes"].append(_nullable(row.get("num_episodes")))
+            cols["year"].append(_nullable(row.get("year")))
+            cols["genre_mask"].append(int(row.get("genre_mask") or 0))
+            cols["type_code"].append(_interned(row.get("type"), *interned["types"]))
+            cols["source_type_code"].append(_interned(row.get("source_type"), *interned["source_types"]))
+            cols["season_code"].append(_interned(row.get("season"), *interned["seasons"]))
+            title_bytes += (row.get("title") or "").encode("utf-8")
+            cols["title_offsets"].append(len(title_bytes))
+        cols["title_bytes"].frombytes(bytes(title_bytes))
+
+        row_of = {anime_id: i for i, anime_id in enumerate(cols["anime_id"])}
+        n = len(row_of)
+
+        studios: List[List[int]] = [[] for _ in range(n)]
+        for row in studio_rows:
+            i = row_of.get(row["anime_id"])
+            if i is not None:
+                studios[i].append(row["studio_id"])
+        _fill_csr(cols["studio_offsets"], cols["studio_ids"], [sorted(set(s)) for s in studios])
+
+        # Same as the recommendations route: an undirected edge weighted by the
+        # larger num_recommenders of the two directions.
+        votes: List[Dict[int, int]] = [{} for _ in range(n)]
+        for row in recommendation_rows:
+            a, b = row_of.get(row["anime_id_a"]), row_of.get(row["anime_id_b"])
+            if a is None or b is None or a == b:
+                continue
+            v = row.get("num_recommenders") or 0
+            for x, y in ((a, b), (b, a)):
+                if votes[x].get(y, -1) < v:
+                    votes[x][y] = v
+        ordered = [sorted(d.items(), key=lambda kv: (-kv[1], kv[0])) for d in votes]
+        _fill_csr(cols["rec_offsets"], cols["rec_rows"], [[y for y, _ in edges] for edges in ordered])
+        for edges in ordered:
+            cols["rec_votes"].extend(v for _, v in edges)
+
+        # Franchises: every relation type links two anime, in either direction.
+        roots = _components(n, (
+            (row_of[r["anime_id_a"]], row_of[r["anime_id_b"]])
+            for r in related_rows
+            if r["anime_id_a"] in row_of and r["anime_id_b"] in row_of
+        ))
+        first: Dict[int, int] = {}
+        for i, root in enumerate(roots):
+            # Rows are in anime_id order, so a component's first row has its smallest id.
+            cols["franchise_id"].append(cols["anime_id"][first.setdefault(root, i)])
+
+        meta = {
+            "built_at": time.time(),
+            "types": interned["types"][1],
+            "source_types": interned["source_types"][1],
+            "seasons": interned["seasons"][1],
+            "genres": [
+                {"genre_id": g["genre_id"], "name": g["name"], "bit": g.get("bit")}
+                for g in genre_rows
+            ],
+        }
+        return cls(cols, meta, source)
+
+    @classmethod
+    def from_db(cls, cur, source: str = "postgres") -> "Catalog":
+        """Load the catalog through an open cursor whose rows are dicts; ``source`` names the backend."""
+        results = []
+        for query in (ANIME_QUERY, GENRE_QUERY, STUDIO_QUERY, RECOMMENDATION_QUERY, RELATED_QUERY):
+            cur.execute(query)
+            results.append(cur.fetchall())
+        return cls.from_rows(*results, source=source)
+
+    def patched(self, anime_rows: Iterable[Mapping[str, Any]]) -> Optional["Catalog"]:
+        """A copy with the fixed-width columns of ``anime_rows`` replaced.
+
+        Returns None when a row cannot be patched in place (a new anime, a
+        changed title or a genre bit the catalog does not know); the caller
+        then reloads the whole catalog. The title, studio, recommendation and
+        franchise sections are shared with this catalog, not copied.
+        """
+        known_bits = 0
+        for genre in self.genres:
+            if genre.get("bit") is not None:
+                known_bits |= 1 << genre["bit"]
+        cols = {name: array(COLUMNS[name], self.sections[name]) for name in _PATCHABLE}
+        meta = {key: list(self.meta.get(key, [])) for key in ("types", "source_types", "seasons")}
+        interned = {key: ({name: code for code, name in enumerate(names)}, names) for key, names in meta.items()}
+        for row in anime_rows:
+            i = self._row_of.get(row["anime_id"])
+            mask = int(row.get("genre_mask") or 0)
+            if i is None or (row.get("title") or "") != self.title(i) or mask & ~known_bits:
+                return None
+            cols["score_cents"][i] = _score_cents(row.get("score"))
+            cols["members_count"][i] = _nullable(row.get("members_count"))
+            cols["favorites_count"][i] = _nullable(row.get("favorites_count"))
+            cols["num_episodes"][i] = _nullable(row.get("num_episodes"))
+            cols["year"][i] = _nullable(row.get("year"))
+            cols["genre_mask"][i] = mask
+            cols["type_code"][i] = _interned(row.get("type"), *interned["types"])
+            cols["source_type_code"][i] = _interned(row.get("source_type"), *interned["source_types"])
+            cols["season_code"][i] = _interned(row.get("season"), *interned["seasons"])
+        # The snapshot checksum no longer describes these sections.
+        meta = {**{k: v for k, v in self.meta.items() if k not in ("checksum", "path")}, **meta}
+        meta["patched_at"] = time.time()
+        return Catalog({**self.sections, **cols}, meta, self.source, mapped=self._mapped)
+
+    # -- snapshot file ------------------------------------------------------
+
+    def write(self, path: str) -> None:
+        """Write a snapshot to ``path`` atomically (temp file + rename)."""
+        write_sections(path, SNAPSHOT_MAGIC, {name: (code, self.sections[name]) for name, code in COLUMNS.items()},
+                       self.meta, kind="catalog")
+
+    @classmethod
+    def open(cls, path: str, verify: bool = True) -> "Catalog":
+        """Map a snapshot file; the arrays are views into the mapping."""
+        sections, meta, mapped = map_sections(path, SNAPSHOT_MAGIC, verify, kind="catalog")
+        return cls(sections, meta, "snapshot", mapped=mapped)
+
+    # -- lookups ------------------------------------------------------------
+
+    def row_of(self, anime_id: int) -> Optional[int]:
+        return self._row_of.get(anime_id)
+
+    def title(self, row: int) -> str:
+        return bytes(self.title_bytes[self.title_offsets[row]:self.title_offsets[row + 1]]).decode("utf-8")
+
+    def score(self, row: int) -> Optional[Decimal]:
+        cents = self.score_cents[row]
+        return None if cents == NULL else Decimal(cents).scaleb(-2)
+
+    def value(self, column: str, row: int) -> Optional[int]:
+        v = getattr(self, column)[row]
+        return None if v == NULL else v
+
+    def studios(self, row: int) -> Sequence[int]:
+        return self.studio_ids[self.studio_offsets[row]:self.studio_offsets[row + 1]]
+
+    def recommendations(self, row: int):
+        """Neighbour rows and their votes, most votes first."""
+        start, end = self.rec_offsets[row], self.rec_offsets[row + 1]
+        return self.rec_rows[start:end], self.rec_votes[start:end]
+
+    def franchise_of(self, anime_id: int) -> Optional[int]:
+        row = self._row_of.get(anime_id)
+        return None if row is None else self.franchise_id[row]
+
+    def labels(self, row: int) -> Tuple[Optional[str], Optional[str], Optional[str], Optional[int]]:
+        """``(type, source_type, season, year)`` of ``row``, None where NULL."""
+
+        def name(names, code):
+            return None if code == NULL else names[code]
+
+        return (
+            name(self.types, self.type_code[row]),
+            name(self.source_types, self.source_type_code[row]),
+            name(self.seasons, self.season_code[row]),
+            self.value("year", row),
+        )
+
+    def genre_ids(self, row: int) -> Tuple[int, ...]:
+        mask = self.genre_mask[row]
+        return tuple(sorted(genre_id for bit, genre_id in self._genre_bits if mask >> bit & 1))
+
+    def _order(self, metric: str) -> List[int]:
+        """Rows sorted like ``ORDER BY metric DESC NULLS LAST, members_count DESC NULLS LAST``."""
+        order = self._orders.get(metric)
+        if order is None:
+            column = {"rating": self.score_cents, "popularity": self.members_count, "favorites": self.favorites_count}[
+                metric
+            ]
+            members = self.members_count
+            order = sorted(range(self.n), key=lambda i: (-column[i] if column[i] != NULL else 1, -members[i], i))
+            with self._lock:
+                self._orders[metric] = order
+        return order
+
+    def summary(self, row: int, *fields: str) -> Dict[str, Any]:
+        out: Dict[str, Any] = {"anime_id": self.anime_id[row], "title": self.title(row)}
+        for field in fields:
+            out[field] = self.score(row) if field == "score" else self.value(field, row)
+        return out
+
+    def top(self, metric: str, limit: int, offset: int = 0) -> List[Dict[str, Any]]:
+        rows = self._order(metric)[offset:offset + limit]
+        return [self.summary(i, "score", "favorites_count", "members_count") for i in rows]
+
+    def recommendation_filter(
+        self,
+        min_score: Optional[float] = None,
+        genre_id: Optional[int] = None,
+        era: Optional[Tuple[int, int]] = None,
+    ) -> Optional[Callable[[int], bool]]:
+        """Row predicate for the recommendation routes' filters; None when ``genre_id`` is unknown.
+
+        ``min_score`` and ``era`` (first and last year) drop rows whose value
+        is NULL, as the SQL does.
+        """
+        wanted_bit = None
+        if genre_id is not None:
+            bits = [g["bit"] for g in self.genres if g["genre_id"] == genre_id and g.get("bit") is not None]
+            if not bits:
+                return None
+            wanted_bit = bits[0]
+        score, mask, year = self.score_cents, self.genre_mask, self.year
+        # psycopg2 sends min_score as a numeric literal, so Postgres compares exactly, in decimal.
+        min_cents = None if min_score is None else math.ceil(Decimal(str(min_score)) * 100)
+
+        def keep(row: int) -> bool:
+            if min_cents is not None and (score[row] == NULL or score[row] < min_cents):
+                return False
+            if wanted_bit is not None and not mask[row] >> wanted_bit & 1:
+                return False
+            return era is None or (year[row] != NULL and era[0] <= year[row] <= era[1])
+
+        return keep
+
+    def merged_recommendations(
+        self,
+        seeds: Mapping[int, int],
+        limit: int,
+        min_score: Optional[float] = None,
+        genre_id: Optional[int] = None,
+        era: Optional[Tuple[int, int]] = None,
+    ) -> List[Dict[str, Any]]:
+        """Neighbours of several seeds (anime_id -> weight), by weighted votes summed over the seeds.
+
+        Same rows and order as the ``recommendations_multi`` query: seeds are
+        never returned, and ties go to the higher score, then the smaller id.
+        """
+        seed_rows = {self._row_of[anime_id]: weight for anime_id, weight in seeds.items() if anime_id in self._row_of}
+        votes: Dict[int, int] = {}
+        recommenders: Dict[int, int] = {}
+        for seed, weight in seed_rows.items():
+            for row, n in zip(*self.recommendations(seed)):
+                if row not in seed_rows:
+                    votes[row] = votes.get(row, 0) + weight * n
+                    recommenders[row] = recommenders.get(row, 0) + 1
+        keep = self.recommendation_filter(min_score, genre_id, era)
+        if keep is None:
+            return []
+        score = self.score_cents
+        rows = sorted(
+            filter(keep, votes),
+            key=lambda row: (-votes[row], score[row] == NULL, -score[row], self.anime_id[row]),
+        )[:limit]
+        return [
+            {**self.summary(row, "score", "num_episodes"), "votes": votes[row], "seeds": recommenders[row]}
+            for row in rows
+        ]
+
+    def top_lists(self, per_list: int = 10) -> List[Dict[str, Any]]:
+        out = []
+        # Same row order as the SQL: ORDER BY list, metric DESC.
+        for name in ("favorites", "popularity", "rating"):
+            rows = self._order(name)
+            if name == "rating":
+                rows = [i for i in rows[:per_list] if self.score_cents[i] != NULL]
+            for i in rows[:per_list]:
+                metric = self.score(i) if name == "rating" else self.value(
+                    "members_count" if name == "popularity" else "favorites_count", i
+                )
+                out.append({
+                    "list": name,
+                    "anime_id": self.anime_id[i],
+                    "title": self.title(i),
+                    # The UNION in SQL makes every metric NUMERIC.
+                    "metric": None if metric is None else Decimal(metric),
+                })
+        return out
+
+    def genre_list(self) -> List[Dict[str, Any]]:
+        return [{"genre_id": g["genre_id"], "name": g["name"]} for g in sorted(self.genres, key=lambda g: g["name"])]
+
+    def autocomplete_rows(self, anime_ids: Optional[Iterable[int]] = None) -> List[Dict[str, Any]]:
+        offsets = self.title_offsets
+        rows = range(self.n) if anime_ids is None else sorted(
+            i for i in map(self._row_of.get, anime_ids) if i is not None
+        )
+        return [
+            self.summary(i, "score", "num_episodes", "members_count")
+            for i in rows
+            if offsets[i + 1] > offsets[i]
+        ]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "source": self.source,
+            "anime": self.n,
+            "recommendation_edges": len(self.rec_rows) // 2,
+            "franchises": len(set(self.franchise_id)),
+            "studio_links": len(self.studio_ids),
+            "built_at": self.meta.get("built_at"),
+            "patched_at": self.meta.get("patched_at"),
+            "checksum": self.meta.get("checksum"),
+        }
+
+
+def write_sections(path: str, magic: bytes, sections: Mapping[str, Any], meta: Mapping[str, Any],
+                   kind: str = "catalog") -> None:
+    """Write ``{name: (typecode, values)}`` in the snapshot layout, atomically (temp file + rename)."""
+    if sys.byteorder != "little":
+        raise SnapshotError("snapshots are little-endian; export on a little-endian machine")
+    toc_sections = {}
+    payload = bytearray()
+    for name, (code, values) in sections.items():
+        data = array(code, values).tobytes()
+        payload += b"\0" * (-len(payload) % _ALIGN)
+        toc_sections[name] = [code, len(payload), len(values)]
+        payload += data
+    toc = json.dumps({"meta": meta, "sections": toc_sections}, separators=(",", ":")).encode("utf-8")
+    toc += b" " * (-(_HEADER.size + len(toc)) % _ALIGN)
+    digest = hashlib.sha256(toc + payload).digest()
+    header = _HEADER.pack(magic, FORMAT_VERSION, 0, len(toc), len(payload), digest)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix=f".{kind}-", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(header)
+            f.write(toc)
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def map_sections(path: str, magic: bytes, verify: bool = True, kind: str = "catalog"):
+    """Map a file written by ``write_sections``: (sections as memoryviews, meta, the mmap)."""
+    with open(path, "rb") as f:
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError as exc:  # empty file
+            raise SnapshotError(f"{path}: empty snapshot") from exc
+    if len(mapped) < _HEADER.size:
+        raise SnapshotError(f"{path}: truncated header")
+    found_magic, version, _, toc_len, payload_len, digest = _HEADER.unpack_from(mapped, 0)
+    if found_magic != magic:
+        raise SnapshotError(f"{path}: not a {kind} snapshot")
+    if version != FORMAT_VERSION:
+        raise SnapshotError(f"{path}: snapshot format {version}, expected {FORMAT_VERSION}")
+    payload_start = _HEADER.size + toc_len
+    if len(mapped) != payload_start + payload_len:
+        raise SnapshotError(f"{path}: size does not match header")
+    view = memoryview(mapped)
+    if verify and hashlib.sha256(view[_HEADER.size:]).digest() != digest:
+        raise SnapshotError(f"{path}: checksum mismatch")
+
+    toc = json.loads(bytes(view[_HEADER.size:payload_start]))
+    sections = {}
+    for name, (code, offset, count) in toc["sections"].items():
+        start = payload_start + offset
+        size = array(code).itemsize * count
+        sections[name] = view[start:start + size].cast(code)
+    meta = dict(toc["meta"], checksum=digest.hex(), path=os.path.abspath(path))
+    return sections, meta, mapped
+
+
+def _components(n: int, pairs: Iterable[Tuple[int, int]]) -> List[int]:
+    """Union-find over rows ``0..n-1``: each row's component root after joining ``pairs``."""
+    parent = list(range(n))
+    size = [1] * n
+
+    def find(x: int) -> int:
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]  # path halving
+            x = parent[x]
+        return x
+
+    for a, b in pairs:
+        a, b = find(a), find(b)
+        if a == b:
+            continue
+        if size[a] < size[b]:
+            a, b = b, a
+        parent[b] = a
+        size[a] += size[b]
+    return [find(x) for x in range(n)]
+
+
+def _fill_csr(offsets: array, values: array, lists: Iterable[Iterable[int]]) -> None:
+    offsets.append(0)
+    for items in lists:
+        values.extend(items)
+        offsets.append(len(values))
+
+
+class CatalogHolder:
+    """The live catalog, swapped atomically, with listeners for each swap."""
+
+    def __init__(self):
+        self._catalog: Optional[Catalog] = None
+        self._listeners: List[Callable[[Catalog], None]] = []
+        self._refreshing = threading.Lock()
+        self._stale = False
+        self.last_error: Optional[str] = None
+
+    def current(self) -> Optional[Catalog]:
+        return self._catalog
+
+    def subscribe(self, listener: Callable[[Catalog], None]) -> None:
+        self._listeners.append(listener)
+
+    def swap(self, catalog: Catalog, notify: bool = True) -> None:
+        """Make ``catalog`` current; ``notify=False`` skips the listeners (for patches they already know about)."""
+        self._catalog = catalog
+        if notify:
+            for listener in self._listeners:
+                listener(catalog)
+
+    def load_snapshot(self, path: str, verify: bool = True) -> Catalog:
+        catalog = Catalog.open(path, verify=verify)
+        self.swap(catalog)
+        return catalog
+
+    @property
+    def refreshing(self) -> bool:
+        return self._refreshing.locked()
+
+    def refresh(self, loader: Callable[[], Catalog], snapshot_path: Optional[str] = None) -> Optional[Catalog]:
+        """Load a fresh catalog, swap it in and optionally rewrite the snapshot.
+
+        If a refresh is already running this returns None at once, and the
+        running refresh loads once more when it is done, so data committed
+        after it started is not missed.
+        """
+        self._stale = True
+        catalog = None
+        # The flag is set before trying the lock and read after releasing it,
+        # so either this call or the running one does the extra load.
+        while self._stale and self._refreshing.acquire(blocking=False):
+            try:
+                self._stale = False
+                catalog = self._load(loader, snapshot_path)
+            finally:
+                self._refreshing.release()
+        return catalog
+
+    def _load(self, loader: Callable[[], Catalog], snapshot_path: Optional[str]) -> Optional[Catalog]:
+        try:
+            catalog = loader()
+            self.swap(catalog)
+            if snapshot_path:
+                catalog.write(snapshot_path)
+            self.last_error = None
+            return catalog
+        except Exception as exc:  # keep serving the old catalog
+            self.last_error = f"{type(exc).__name__}: {exc}"
+            print(f"Catalog refresh failed: {self.last_error}")
+            return None
+
+    def refresh_in_background(self, loader: Callable[[], Catalog], snapshot_path: Optional[str] = None) -> threading.Thread:
+        thread = threading.Thread(
+            target=self.refresh, args=(loader, snapshot_path), name="catalog-refresh", daemon=True
+        )
+        thread.start()
+        return thread
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Export or inspect catalog snapshot files.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    export = sub.add_parser("export", help="write a snapshot from Postgres")
+    export.add_argument("path")
+    info = sub.add_parser("info", help="verify a snapshot and print its contents")
+    info.add_argument("path")
+    args = parser.parse_args(argv)
+
+    if args.command == "info":
+        catalog = Catalog.open(args.path)
+        print(json.dumps({**catalog.stats(), "size_bytes": os.path.getsize(args.path)}, indent=2))
+        return 0
+
+    import psycopg2  # pylint: disable=import-outside-toplevel
+    from psycopg2.extras import RealDictCursor  # pylint: disable=import-outside-toplevel
+
+    from app import DB_CONFIG  # pylint: disable=import-outside-toplevel
+
+    started = time.perf_counter()
+    conn = psycopg2.connect(cursor_factory=RealDictCursor, **DB_CONFIG)
+    try:
+        with conn.cursor() as cur:
+            catalog = Catalog.from_db(cur)
+    finally:
+        conn.close()
+    catalog.write(args.path)
+    print(f"wrote {catalog.n} anime to {args.path} in {time.perf_counter() - started:.1f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
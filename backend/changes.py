@@ -0,0 +1,120 @@
+"""Change notifications for anime rows.
+
+The ingest job (``ingest.py``) knows exactly which anime it wrote. In the
+same transaction as each batch it sends their ids on the ``CHANNEL``
+NOTIFY channel, so every server hears about a batch once it is committed
+and not before. A server passes each ``ChangeSet`` to the ``ChangeFeed``
+subscribers (the catalog, the autocomplete trie, route caches). Each one
+then patches or drops just the affected entries instead of flushing
+everything.
+"""
+import json
+import select
+import threading
+from typing import Callable, Dict, FrozenSet, Iterable, List, NamedTuple, Optional
+
+CHANNEL = "mal_anime_changes"
+# NOTIFY payloads must stay under 8000 bytes: about 1000 six-digit ids.
+MAX_IDS_PER_NOTIFY = 500
+
+
+class ChangeSet(NamedTuple):
+    anime_ids: Optional[FrozenSet[int]]  # None: any anime may have changed
+    columns: Optional[FrozenSet[str]] = None  # None: any column may have changed
+
+    @classmethod
+    def of(cls, anime_ids: Iterable[int], columns: Optional[Iterable[str]] = None) -> "ChangeSet":
+        return cls(frozenset(anime_ids), None if columns is None else frozenset(columns))
+
+    @classmethod
+    def everything(cls) -> "ChangeSet":
+        return cls(None, None)
+
+    def touches(self, columns: Iterable[str]) -> bool:
+        return self.columns is None or not self.columns.isdisjoint(columns)
+
+    def split(self, size: int = MAX_IDS_PER_NOTIFY) -> List["ChangeSet"]:
+        if self.anime_ids is None:
+            return [self]
+        ids = sorted(self.anime_ids)
+        return [ChangeSet(frozenset(ids[i:i + size]), self.columns) for i in range(0, len(ids), size)]
+
+    def to_payload(self) -> str:
+        return json.dumps({
+            "anime_ids": None if self.anime_ids is None else sorted(self.anime_ids),
+            "columns": None if self.columns is None else sorted(self.columns),
+        }, separators=(",", ":"))
+
+    @classmethod
+    def from_payload(cls, payload: str) -> "ChangeSet":
+        data = json.loads(payload)
+        ids, columns = data.get("anime_ids"), data.get("columns")
+        return cls(None if ids is None else frozenset(ids), None if columns is None else frozenset(columns))
+
+
+def notify(cur, changes: ChangeSet, channel: str = CHANNEL) -> None:
+    """Queue ``changes`` on ``channel``; Postgres delivers them when the transaction commits."""
+    for part in changes.split():
+        cur.execute("SELECT pg_notify(%s, %s);", (channel, part.to_payload()))
+
+
+class ChangeFeed:
+    """Fans change sets out to in-process subscribers, in subscription order."""
+
+    def __init__(self):
+        self._listeners: List[Callable[[ChangeSet], None]] = []
+        self.published = 0
+        self.last_error: Optional[str] = None
+
+    def subscribe(self, listener: Callable[[ChangeSet], None]) -> None:
+        self._listeners.append(listener)
+
+    def publish(self, changes: ChangeSet) -> None:
+        self.published += 1
+        for listener in self._listeners:
+            try:
+                listener(changes)
+            except Exception as exc:  # one broken subscriber must not starve the others
+                self.last_error = f"{getattr(listener, '__name__', listener)}: {type(exc).__name__}: {exc}"
+                print(f"Change subscriber failed: {self.last_error}")
+
+    def listen(self, connect: Callable, channel: str = CHANNEL, stop: Optional[threading.Event] = None,
+               poll_seconds: float = 5.0, retry_seconds: float = 5.0) -> None:
+        """LISTEN on ``channel`` and publish every notification; reconnects on errors.
+
+        Notifications sent while the connection was down are lost, so after a
+        reconnect subscribers get ``ChangeSet.everything()``.
+        """
+        stop = stop or threading.Event()
+        connected_before = False
+        while not stop.is_set():
+            conn = None
+            try:
+                conn = connect()
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {channel};")
+                if connected_before:
+                    self.publish(ChangeSet.everything())
+                connected_before = True
+                while not stop.is_set():
+                    if select.select([conn], [], [], poll_seconds) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self.publish(ChangeSet.from_payload(conn.notifies.pop(0).payload))
+            except Exception as exc:  # pylint: disable=broad-except
+                print(f"Change listener error: {type(exc).__name__}: {exc}")
+                stop.wait(retry_seconds)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+    def listen_in_background(self, connect: Callable, channel: str = CHANNEL) -> threading.Thread:
+        thread = threading.Thread(target=self.listen, args=(connect, channel), name="change-listener", daemon=True)
+        thread.start()
+        return thread
+
+    def stats(self) -> Dict[str, object]:
+        return {"subscribers": len(self._listeners), "published": self.published, "last_error": self.last_error}
+
@@ -0,0 +1,149 @@
+"""Response compression negotiated from ``Accept-Encoding``.
+
+Large JSON bodies (``/api/anime`` with a big ``limit``, the stats routes) are
+sent gzip- or brotli-compressed to clients that accept it. ``brotli`` is in
+requirements.txt; an install without it negotiates gzip only. Bodies under
+``min_size`` bytes go out as they are, because the headers would eat the saving.
+
+Compressed bodies are kept in a byte-bounded LRU keyed by a digest of the
+uncompressed body and the encoding. A response that is served again
+(a cached route result, the catalog lists, a hot search) is compressed once
+and then only hashed.
+"""
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+try:
+    import brotli
+except ImportError:  # not installed: gzip only
+    brotli = None
+
+DEFAULT_MIN_SIZE = 1024
+DEFAULT_GZIP_LEVEL = 6
+DEFAULT_BROTLI_QUALITY = 5  # 0-11; above ~6 costs far more CPU for a few percent
+DEFAULT_CACHE_BYTES = 16 * 1024 * 1024
+COMPRESSIBLE_TYPES = ("application/json", "application/vnd.apache.arrow.stream", "text/")
+
+
+def available_encodings() -> Tuple[str, ...]:
+    """What this process can produce, best first."""
+    return ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def negotiate(accept_encoding: Optional[str], encodings: Sequence[str]) -> Optional[str]:
+    """The first of ``encodings`` with the highest q-value in ``accept_encoding``, or None."""
+    if not accept_encoding:
+        return None
+    weights: Dict[str, float] = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key.lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name.strip():
+            weights[name.strip().lower()] = q
+    best, best_q = None, 0.0
+    for encoding in encodings:
+        q = weights.get(encoding, weights.get("*", 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+class Compressor:
+    """Compresses response bodies and remembers the results for bodies seen before."""
+
+    def __init__(
+        self,
+        min_size: int = DEFAULT_MIN_SIZE,
+        gzip_level: int = DEFAULT_GZIP_LEVEL,
+        brotli_quality: int = DEFAULT_BROTLI_QUALITY,
+        cache_bytes: int = DEFAULT_CACHE_BYTES,
+        encodings: Optional[Sequence[str]] = None,
+    ):
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.cache_bytes = cache_bytes
+        self.encodings = tuple(available_encodings() if encodings is None else encodings)
+        self._cache: "OrderedDict[Tuple[bytes, str], bytes]" = OrderedDict()
+        self._cached_bytes = 0
+        self._lock = threading.Lock()
+        self.compressed = 0
+        self.hits = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def _encode(self, body: bytes, encoding: str) -> bytes:
+        if encoding == "br":
+            return brotli.compress(body, quality=self.brotli_quality)
+        # mtime=0 keeps the output identical for identical bodies.
+        return gzip.compress(body, compresslevel=self.gzip_level, mtime=0)
+
+    def compress(self, body: bytes, encoding: str) -> bytes:
+        key = (hashlib.blake2b(body, digest_size=16).digest(), encoding)
+        with self._lock:
+            out = self._cache.get(key)
+            if out is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+        if out is None:
+            out = self._encode(body, encoding)
+            with self._lock:
+                self.compressed += 1
+                if len(out) <= self.cache_bytes and key not in self._cache:
+                    self._cache[key] = out
+                    self._cached_bytes += len(out)
+                    while self._cached_bytes > self.cache_bytes:
+                        _, dropped = self._cache.popitem(last=False)
+                        self._cached_bytes -= len(dropped)
+        with self._lock:
+            self.bytes_in += len(body)
+            self.bytes_out += len(out)
+        return out
+
+    def apply(self, response, accept_encoding: Optional[str]):
+        """Compress a Flask/Werkzeug ``response`` in place when the client and the body allow it."""
+        if (
+            response.direct_passthrough
+            or response.is_streamed
+            or response.status_code < 200
+            or response.status_code in (204, 206, 304)
+            or "Content-Encoding" in response.headers
+            or not (response.mimetype or "").startswith(COMPRESSIBLE_TYPES)
+        ):
+            return response
+        # The body differs by Accept-Encoding even when this one goes out plain.
+        response.vary.add("Accept-Encoding")
+        body = response.get_data()
+        if len(body) < self.min_size:
+            return response
+        encoding = negotiate(accept_encoding, self.encodings)
+        if encoding is None:
+            return response
+        response.set_data(self.compress(body, encoding))
+        response.headers["Content-Encoding"] = encoding
+        return response
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "encodings": list(self.encodings),
+                "min_size": self.min_size,
+                "gzip_level": self.gzip_level,
+                "brotli_quality": self.brotli_quality if "br" in self.encodings else None,
+                "compressed": self.compressed,
+                "cache_hits": self.hits,
+                "cache_entries": len(self._cache),
+                "cache_bytes": self._cached_bytes,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+            }
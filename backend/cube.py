@@ -0,0 +1,216 @@
+"""Pre-aggregated cube of score, members and favorites behind ``/api/stats/cube``.
+
+Every breakdown product asks for ("average score by genre per year",
+"members by source type per season") is a GROUP BY over the same few
+columns. So the catalog is aggregated once into cells of (genre, type,
+source_type, season, year), with count, sum, sum of squares, min and max of
+each measure. Every roll-up (a "cuboid") is built from those cells: one per
+subset of type, source_type, season and year, with and without genre. An
+anime is counted once per genre in the cuboids with genre and once in the
+others.
+
+A request reads the one cuboid that has exactly its grouping and filter
+columns and keeps the entries matching the filters. Nothing is merged at
+request time. Sums and sums of squares are exact integers (score in
+hundredths), so averages and sample standard deviations are exact up to the
+final rounding. The cube is rebuilt in the background after a catalog
+refresh or a change set, and requests keep reading the previous one until
+the new one is ready.
+"""
+import itertools
+import math
+import threading
+from decimal import Decimal
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple
+
+from catalog import NULL, Catalog
+from derived import DerivedIndex
+
+# measure -> catalog column; scores are in hundredths
+MEASURES = {"score": "score_cents", "members": "members_count", "favorites": "favorites_count"}
+DIMENSIONS = ("genre", "type", "source_type", "season", "year")
+FILTERS = ("genre_id", "type", "source_type", "season", "year")
+# ChangeSet columns the cube reads.
+COLUMNS = ("score", "members_count", "favorites_count", "season", "year", "type", "source_type", "genres",
+           "genre_mask")
+MAX_CACHED_RESULTS = 256
+
+_FLAT = ("type", "source_type", "season", "year")  # the dimensions every anime has one value of
+# An aggregate is [anime, then count, sum, sum of squares, min, max per measure];
+# count is of the non-NULL values.
+_STRIDE = 5
+_WIDTH = 1 + _STRIDE * len(MEASURES)
+
+
+def _aggregate(values: Sequence[int]) -> List[Any]:
+    agg: List[Any] = [1]
+    for value in values:
+        if value == NULL:
+            agg.extend((0, 0, 0, None, None))
+        else:
+            agg.extend((1, value, value * value, value, value))
+    return agg
+
+
+def _merge(into: List[Any], other: Sequence[Any]) -> None:
+    into[0] += other[0]
+    for i in range(1, _WIDTH, _STRIDE):
+        if not other[i]:
+            continue
+        if into[i]:
+            into[i] += other[i]
+            into[i + 1] += other[i + 1]
+            into[i + 2] += other[i + 2]
+            if other[i + 3] < into[i + 3]:
+                into[i + 3] = other[i + 3]
+            if other[i + 4] > into[i + 4]:
+                into[i + 4] = other[i + 4]
+        else:
+            into[i:i + _STRIDE] = other[i:i + _STRIDE]
+
+
+def _measure(agg: Sequence[Any], index: int, scale: int) -> Dict[str, Any]:
+    count, total, squares, low, high = agg[1 + _STRIDE * index:1 + _STRIDE * (index + 1)]
+    if not count:
+        return {"count": 0, "sum": None, "avg": None, "stddev": None, "min": None, "max": None}
+
+    def exact(value):
+        return Decimal(value).scaleb(-scale) if scale else value
+
+    # Sample standard deviation, from exact integer sums.
+    stddev = None
+    if count > 1:
+        stddev = round(math.sqrt(max(count * squares - total * total, 0) / (count * (count - 1))) / 10 ** scale, 4)
+    return {
+        "count": count,
+        "sum": exact(total),
+        "avg": round(total / count / 10 ** scale, 4),
+        "stddev": stddev,
+        "min": exact(low),
+        "max": exact(high),
+    }
+
+
+class Cube:
+    """Every cuboid of one catalog; immutable once built."""
+
+    def __init__(self, cuboids: Dict[Tuple[bool, Tuple[str, ...]], Dict[Tuple[Any, ...], List[Any]]],
+                 genre_names: Mapping[int, str], anime: int):
+        self.cuboids = cuboids
+        self.genre_names = dict(genre_names)
+        self.anime = anime
+        self._results: Dict[Tuple[Any, ...], List[Dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def build(cls, catalog: Catalog) -> "Cube":
+        columns = [getattr(catalog, column) for column in MEASURES.values()]
+        bases: Dict[bool, Dict[Tuple[Any, ...], List[Any]]] = {False: {}, True: {}}
+        for row in range(catalog.n):
+            labels = catalog.labels(row)
+            agg = _aggregate([column[row] for column in columns])
+            keys = [(False, labels)] + [(True, (genre_id, *labels)) for genre_id in catalog.genre_ids(row)]
+            for genre, key in keys:
+                cell = bases[genre].get(key)
+                if cell is None:
+                    bases[genre][key] = list(agg)
+                else:
+                    _merge(cell, agg)
+
+        cuboids = {}
+        for genre, base in bases.items():
+            cuboids[(genre, _FLAT)] = base
+            offset = 1 if genre else 0
+            # Each cuboid rolls up the smallest already built one with one more dimension.
+            for size in range(len(_FLAT) - 1, -1, -1):
+                for dims in itertools.combinations(_FLAT, size):
+                    parents = [
+                        tuple(d for d in _FLAT if d in dims or d == extra) for extra in _FLAT if extra not in dims
+                    ]
+                    parent_dims = min(parents, key=lambda p: len(cuboids[(genre, p)]))
+                    keep = list(range(offset)) + [offset + parent_dims.index(d) for d in dims]
+                    table: Dict[Tuple[Any, ...], List[Any]] = {}
+                    for key, agg in cuboids[(genre, parent_dims)].items():
+                        rolled = tuple(key[i] for i in keep)
+                        cell = table.get(rolled)
+                        if cell is None:
+                            table[rolled] = list(agg)
+                        else:
+                            _merge(cell, agg)
+                    cuboids[(genre, dims)] = table
+        return cls(cuboids, {g["genre_id"]: g["name"] for g in catalog.genres}, catalog.n)
+
+    def query(self, by: Sequence[str], filters: Mapping[str, Any], measures: Sequence[str]) -> List[Dict[str, Any]]:
+        """One row per combination of ``by`` among the anime matching ``filters``."""
+        cache_key = (tuple(by), tuple(sorted(filters.items())), tuple(measures))
+        result = self._results.get(cache_key)
+        if result is not None:
+            return result
+        genre = "genre" in by or "genre_id" in filters
+        dims = tuple(d for d in _FLAT if d in by or d in filters)
+        names = (("genre_id",) if genre else ()) + dims
+        checks = [(names.index(name), value) for name, value in filters.items()]
+        outputs = [(name, names.index("genre_id" if name == "genre" else name)) for name in by]
+        indexes = [(measure, list(MEASURES).index(measure), 2 if measure == "score" else 0) for measure in measures]
+
+        result = []
+        for key, agg in self.cuboids[(genre, dims)].items():
+            if any(key[i] != value for i, value in checks):
+                continue
+            item: Dict[str, Any] = {}
+            for name, i in outputs:
+                if name == "genre":
+                    item["genre_id"], item["genre"] = key[i], self.genre_names.get(key[i])
+                else:
+                    item[name] = key[i]
+            item["count"] = agg[0]
+            for measure, index, scale in indexes:
+                item[measure] = _measure(agg, index, scale)
+            result.append(item)
+        order = ["genre" if name == "genre" else name for name in by]
+        result.sort(key=lambda item: [(item[name] is None, item[name] or 0 if name == "year" else item[name] or "")
+                                      for name in order])
+        with self._lock:
+            if len(self._results) >= MAX_CACHED_RESULTS:
+                self._results.pop(next(iter(self._results)))
+            self._results[cache_key] = result
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "anime": self.anime,
+            "cuboids": len(self.cuboids),
+            "cells": sum(len(table) for table in self.cuboids.values()),
+            "base_cells": len(self.cuboids[(True, _FLAT)]) + len(self.cuboids[(False, _FLAT)]),
+            "cached_results": len(self._results),
+        }
+
+
+def parse_query(by: Optional[str], filters: Mapping[str, Any], measures: Optional[str]):
+    """Validate the request arguments; raises ValueError."""
+    by_list = [name.strip() for name in (by or "").split(",") if name.strip()]
+    if any(name not in DIMENSIONS for name in by_list) or len(set(by_list)) != len(by_list):
+        raise ValueError(f"by must be distinct names from: {', '.join(DIMENSIONS)}")
+    measure_list = [name.strip() for name in (measures or "").split(",") if name.strip()] or list(MEASURES)
+    if any(name not in MEASURES for name in measure_list) or len(set(measure_list)) != len(measure_list):
+        raise ValueError(f"measures must be distinct names from: {', '.join(MEASURES)}")
+    wanted = {name: value for name, value in filters.items() if value is not None}
+    unknown = set(wanted) - set(FILTERS)
+    if unknown:
+        raise ValueError(f"unknown filters: {', '.join(sorted(unknown))}")
+    return by_list, wanted, measure_list
+
+
+class CubeIndex(DerivedIndex[Cube]):
+    """Holds the live ``Cube`` and rebuilds it from ``loader`` (which returns a Catalog)."""
+
+    name = "cube"
+
+    def _make(self) -> Cube:
+        return Cube.build(self.loader())
+
+    def cube(self) -> Cube:
+        return self.get()
+
+    def query(self, by: Optional[str], filters: Mapping[str, Any], measures: Optional[str]) -> List[Dict[str, Any]]:
+        return self.cube().query(*parse_query(by, filters, measures))
@@ -0,0 +1,162 @@
+"""Per-request query deadlines, and cancellation when the client hangs up.
+
+Each request gets a ``Deadline`` for its route when it starts, so time spent
+in the admission queue counts against it. The backends read the current
+deadline. Postgres runs the query under ``SET LOCAL statement_timeout`` for
+the time left, and SQLite checks it from a progress handler. Either way an
+overrun raises ``DeadlineExceeded``, which the app answers with 504.
+
+While a query runs, ``DisconnectWatcher`` polls the client's socket. If the
+client has gone, it cancels the query (``connection.cancel()`` for
+psycopg2, ``interrupt()`` for sqlite3) instead of letting it run for nobody.
+"""
+import contextvars
+import select
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+_PEEK_FLAGS = socket.MSG_PEEK | getattr(socket, "MSG_DONTWAIT", 0)
+
+
+class DeadlineExceeded(TimeoutError):
+    def __init__(self, budget_ms: Optional[int]):
+        super().__init__(f"query exceeded the {budget_ms} ms deadline")
+        self.budget_ms = budget_ms
+
+
+class ClientDisconnected(Exception):
+    """The query was cancelled because the client of ``deadline`` hung up."""
+
+    def __init__(self, deadline: "Deadline"):
+        super().__init__("client disconnected; query cancelled")
+        self.deadline = deadline
+
+
+def parse_deadlines(value: Optional[str]) -> Dict[str, int]:
+    """Parse ``name=milliseconds,...`` (as found in MAL_DEADLINES)."""
+    deadlines: Dict[str, int] = {}
+    for item in (value or "").split(","):
+        if not item.strip():
+            continue
+        name, _, ms = item.partition("=")
+        try:
+            deadlines[name.strip()] = int(ms)
+        except ValueError:
+            raise ValueError(f"deadline for {name.strip()!r} must be a whole number of milliseconds") from None
+    return deadlines
+
+
+class Deadline:
+    def __init__(self, budget_ms: int, client_socket=None, clock: Callable[[], float] = time.monotonic):
+        self.budget_ms = budget_ms
+        self.client_socket = client_socket
+        self.clock = clock
+        self.started = clock()
+        self.disconnected = False
+
+    def elapsed_ms(self) -> int:
+        return int((self.clock() - self.started) * 1000)
+
+    def remaining_ms(self) -> int:
+        return max(0, self.budget_ms - self.elapsed_ms())
+
+    def remaining_seconds(self) -> float:
+        return self.remaining_ms() / 1000
+
+    def expired(self) -> bool:
+        return self.remaining_ms() <= 0
+
+    def check(self) -> None:
+        """Raise if the request should not start another query."""
+        if self.disconnected:
+            raise ClientDisconnected(self)
+        if self.expired():
+            raise DeadlineExceeded(self.budget_ms)
+
+
+_current: contextvars.ContextVar = contextvars.ContextVar("mal_deadline", default=None)
+
+
+def current() -> Optional[Deadline]:
+    return _current.get()
+
+
+def activate(deadline: Optional[Deadline]) -> contextvars.Token:
+    return _current.set(deadline)
+
+
+def deactivate(token: contextvars.Token) -> None:
+    _current.reset(token)
+
+
+class DisconnectWatcher:
+    """One thread polls the client sockets of requests whose query is in flight."""
+
+    def __init__(self, interval: float = 0.25):
+        self.interval = interval
+        self._watched: Dict[int, tuple] = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.cancelled = 0
+
+    @contextmanager
+    def watch(self, deadline: Optional[Deadline], cancel: Callable[[], None]):
+        """Call ``cancel`` if the client of ``deadline`` disconnects before the block ends."""
+        sock = None if deadline is None else deadline.client_socket
+        if sock is None:
+            yield
+            return
+        key = id(deadline)
+        with self._lock:
+            self._watched[key] = (sock, deadline, cancel)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="disconnect-watcher", daemon=True)
+                self._thread.start()
+        self._wake.set()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._watched.pop(key, None)
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                watched = dict(self._watched)
+            if not watched:
+                self._wake.wait()
+                self._wake.clear()
+                continue
+            try:
+                readable, _, _ = select.select([s for s, _, _ in watched.values()], [], [], self.interval)
+            except (OSError, ValueError):  # a socket closed under us; try again with a fresh list
+                time.sleep(self.interval)
+                continue
+            for key, (sock, deadline, cancel) in watched.items():
+                if sock in readable:
+                    self._check(key, sock, deadline, cancel)
+
+    def _check(self, key: int, sock, deadline: Deadline, cancel: Callable[[], None]) -> None:
+        try:
+            gone = sock.recv(1, _PEEK_FLAGS) == b""
+        except BlockingIOError:
+            return
+        except OSError:
+            gone = True
+        with self._lock:
+            if self._watched.pop(key, None) is None:
+                return  # the query finished meanwhile
+        if not gone:
+            # The client sent more data (a pipelined request): the socket stays
+            # readable, so stop polling it rather than spin.
+            return
+        deadline.disconnected = True
+        self.cancelled += 1
+        try:
+            cancel()
+        except Exception as exc:  # pylint: disable=broad-except
+            print(f"Cancelling query failed: {type(exc).__name__}: {exc}")
@@ -0,0 +1,94 @@
+"""Holders for the structures the routes derive from the catalog.
+
+The autocomplete trie, the MinHash index, the recommendation graph, the
+stats cube and the franchises are each built from the catalog in one pass
+and swapped in with one assignment. ``DerivedIndex`` is what they share: a
+lazy first build, ``rebuild()`` and ``rebuild_in_background()``, and the
+build time in ``stats()``. A subclass says how to build its value in
+``_make()``.
+
+``rebuild_in_background()`` runs at most one rebuild at a time. A request
+that lands while one is reading the catalog marks another as pending, and
+the thread rebuilds again before it exits. Ingest publishes one change set
+per batch, in quick succession, so dropping such a request would keep the
+structure on the catalog from before the later batches.
+"""
+import threading
+import time
+from typing import Any, Callable, Dict, Generic, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class DerivedIndex(Generic[T]):
+    """Holds the live value built by ``_make()`` from ``loader`` and rebuilds it on request."""
+
+    name = "derived"  # names the rebuild thread
+
+    def __init__(self, loader: Callable[[], Any]):
+        self.loader = loader
+        self._value: Optional[T] = None
+        self._built_at: Optional[float] = None
+        self._build_seconds: Optional[float] = None
+        self._lock = threading.Lock()
+        self._refreshing = threading.Lock()
+        self._pending = False
+
+    def _make(self) -> T:
+        raise NotImplementedError
+
+    def _swap(self, value: T) -> None:
+        self._value, self._built_at = value, time.time()
+
+    def _build(self) -> T:
+        started = time.perf_counter()
+        value = self._make()
+        self._build_seconds = time.perf_counter() - started
+        self._swap(value)
+        return value
+
+    def rebuild(self) -> T:
+        """Build a new value from the loader and swap it in."""
+        with self._lock:
+            return self._build()
+
+    def rebuild_in_background(self) -> None:
+        # A request that lands while a rebuild is reading the catalog asks for one more.
+        self._pending = True
+        if not self._refreshing.acquire(blocking=False):
+            return
+
+        def _run():
+            while True:
+                try:
+                    while self._pending:
+                        self._pending = False
+                        self.rebuild()
+                finally:
+                    self._refreshing.release()
+                if not self._pending or not self._refreshing.acquire(blocking=False):
+                    return
+
+        threading.Thread(target=_run, name=f"{self.name}-rebuild", daemon=True).start()
+
+    @property
+    def rebuilding(self) -> bool:
+        return self._refreshing.locked()
+
+    def get(self) -> T:
+        """The live value, built on first use."""
+        value = self._value
+        if value is None:
+            with self._lock:
+                return self._build() if self._value is None else self._value
+        return value
+
+    @property
+    def built(self) -> bool:
+        return self._value is not None
+
+    def stats(self) -> Dict[str, Any]:
+        value = self._value
+        if value is None:
+            return {"built": False}
+        return {"built": True, "built_at": self._built_at, "build_seconds": self._build_seconds, **value.stats()}
@@ -0,0 +1,112 @@
+"""Franchises: the connected components of ``related_anime``, behind ``/api/franchises``.
+
+The catalog assigns each anime a franchise while it loads (union-find over
+every ``related_anime`` row, whatever the relation type), so "which
+franchise is this in?" is one array lookup. A franchise is identified by the
+smallest anime_id in it. An anime without relations is a franchise of one.
+
+``Franchises`` adds what the routes show per franchise: its members, size,
+average score, total members and the title of its most popular anime. It
+also keeps one precomputed order per top-list metric, so a top list is a
+slice. It is built from the catalog in one pass (about 25 ms for 12k anime)
+and rebuilt when the catalog reloads or a change set touches a column it
+shows (``COLUMNS``).
+"""
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from catalog import NULL, Catalog
+from derived import DerivedIndex
+
+METRICS = ("size", "score", "members")
+# ChangeSet columns the aggregates read.
+COLUMNS = ("title", "score", "members_count", "year", "type")
+
+
+class Franchise(NamedTuple):
+    franchise_id: int
+    rows: List[int]  # catalog rows, by year (NULL last) then anime_id
+    size: int
+    scored: int  # members with a score
+    score_cents: int  # sum over the scored members
+    total_members: int
+    title: str
+
+
+class Franchises:
+    """Every franchise of one catalog with its aggregates; immutable once built."""
+
+    def __init__(self, catalog: Catalog):
+        self.catalog = catalog
+        groups: Dict[int, List[int]] = {}
+        for row in range(catalog.n):
+            groups.setdefault(catalog.franchise_id[row], []).append(row)
+        year, score, members = catalog.year, catalog.score_cents, catalog.members_count
+        self.by_id: Dict[int, Franchise] = {}
+        for franchise_id, rows in groups.items():
+            scores = [score[row] for row in rows if score[row] != NULL]
+            popular = max(rows, key=lambda row: (members[row], -row))
+            rows.sort(key=lambda row: (year[row] == NULL, year[row], row))
+            self.by_id[franchise_id] = Franchise(
+                franchise_id, rows, len(rows), len(scores), sum(scores),
+                sum(members[row] for row in rows if members[row] != NULL), catalog.title(popular),
+            )
+        franchises = list(self.by_id.values())
+        # The top lists: ties go to the bigger audience, then the smaller id.
+        self._orders = {
+            "size": sorted(franchises, key=lambda f: (-f.size, -f.total_members, f.franchise_id)),
+            "score": sorted(franchises, key=lambda f: (
+                not f.scored, -(f.score_cents / f.scored if f.scored else 0), -f.total_members, f.franchise_id
+            )),
+            "members": sorted(franchises, key=lambda f: (-f.total_members, f.franchise_id)),
+        }
+
+    def summary(self, franchise: Franchise) -> Dict[str, Any]:
+        return {
+            "franchise_id": franchise.franchise_id,
+            "title": franchise.title,
+            "size": franchise.size,
+            "avg_score": round(franchise.score_cents / franchise.scored / 100, 4) if franchise.scored else None,
+            "total_members": franchise.total_members,
+        }
+
+    def franchise(self, anime_id: int) -> Optional[Dict[str, Any]]:
+        """The franchise ``anime_id`` belongs to, with every member; None for an unknown anime."""
+        franchise_id = self.catalog.franchise_of(anime_id)
+        if franchise_id is None:
+            return None
+        franchise = self.by_id[franchise_id]
+        anime = [
+            {**self.catalog.summary(row, "score", "members_count", "year"), "type": self.catalog.labels(row)[0]}
+            for row in franchise.rows
+        ]
+        return {**self.summary(franchise), "anime": anime}
+
+    def top(self, metric: str, limit: int, offset: int = 0, min_size: int = 1) -> List[Dict[str, Any]]:
+        """Franchises with at least ``min_size`` anime, by ``metric``; raises ValueError for unknown metrics."""
+        if metric not in self._orders:
+            raise ValueError(f"metric must be one of: {', '.join(METRICS)}")
+        order = self._orders[metric]
+        if min_size > 1:
+            order = [f for f in order if f.size >= min_size]
+        return [self.summary(f) for f in order[offset:offset + limit]]
+
+    def stats(self) -> Dict[str, Any]:
+        sizes = [f.size for f in self.by_id.values()]
+        return {
+            "anime": self.catalog.n,
+            "franchises": len(sizes),
+            "singletons": sum(1 for size in sizes if size == 1),
+            "largest": max(sizes, default=0),
+        }
+
+
+class FranchiseIndex(DerivedIndex[Franchises]):
+    """Holds the live ``Franchises`` and rebuilds them from ``loader`` (which returns a Catalog)."""
+
+    name = "franchise"
+
+    def _make(self) -> Franchises:
+        return Franchises(self.loader())
+
+    def franchises(self) -> Franchises:
+        return self.get()
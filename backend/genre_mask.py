@@ -0,0 +1,8 @@
+"""Fixed-width genre bitmasks.
+
+Each genre owns one bit (``genre.bit``, assigned by migration 3) and an
+anime's genre set is the OR of its genres' bits, stored as
+``anime.genre_mask``. "Has all of these genres" is then a single test,
+``mask & wanted == wanted``, in SQL or in memory.
+"""
+MAX_GENRE_BITS = 63  # bit 63 would make the Postgres bigint negative
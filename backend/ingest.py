@@ -0,0 +1,303 @@
+"""Incremental update of the anime tables from a new cleaned dump.
+
+MAL's counts (members, favorites, the score and its histogram) move every
+day, but only some rows change between two dumps. Instead of reloading
+everything from the ``recon.py`` output, this job:
+
+1. hashes every dump row and every row in Postgres by ``anime_id``, over the
+   columns the dump shares with ``anime`` plus the genre and studio names;
+2. upserts only the new and changed rows and their genre/studio links,
+   ``batch_size`` rows per committed transaction;
+3. sends the ids of each batch on the change channel in the same
+   transaction (see ``changes.py``), so running servers invalidate exactly
+   those entries once the batch is visible.
+
+    python ingest.py "anime cleaned.csv"            # apply and print the changed ids
+    python ingest.py "anime cleaned.csv" --dry-run  # only diff
+
+``year``, ``decade``, ``season_name`` and ``genre_mask`` are kept up to date
+by the triggers from migrations 1 and 3. A change to ``season`` or the genres
+is reported with the columns its trigger rewrites, so a subscriber that
+reads ``year`` or ``genre_mask`` hears about it. Anime missing from the dump are
+reported but not deleted. Re-running after a failure is cheap: the batches
+that committed now hash equal and are skipped.
+"""
+import argparse
+import csv
+import datetime
+import hashlib
+import json
+import sys
+from decimal import Decimal
+from typing import Any, Dict, FrozenSet, Iterable, List, Mapping, NamedTuple, Optional, Sequence, Tuple
+
+from changes import ChangeSet, notify
+from storage import NULLS, csv_column, csv_value, parse_names, pg_column_type
+
+INGEST_LOCK_ID = 550_2902  # pg_advisory_lock key reserved for ingestion
+DEFAULT_BATCH_SIZE = 500
+
+# dump column -> the columns the triggers recompute when it changes
+DERIVED_FROM = {
+    "season": ("year", "decade", "season_name"),
+    "genres": ("genre_mask",),
+}
+DERIVED_COLUMNS = tuple(c for derived in DERIVED_FROM.values() for c in derived)
+# dump column -> (name table, link table, key)
+LINKS = {
+    "genres": ("genre", "anime_genre", "genre_id"),
+    "studios": ("studio", "anime_studio", "studio_id"),
+}
+
+
+class IngestResult(NamedTuple):
+    inserted: List[int]
+    updated: List[int]
+    unchanged: int
+    missing: List[int]
+    columns: FrozenSet[str]  # every column that changed in at least one row
+
+    @property
+    def changes(self) -> ChangeSet:
+        return ChangeSet.of([*self.inserted, *self.updated], self.columns)
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "inserted": len(self.inserted),
+            "updated": len(self.updated),
+            "unchanged": self.unchanged,
+            "missing": len(self.missing),
+            "columns": sorted(self.columns),
+            "changed_ids": sorted([*self.inserted, *self.updated]),
+        }
+
+
+def _canonical(value):
+    # 7.9 and 7.90 are the same score; dates compare as ISO text.
+    if isinstance(value, Decimal):
+        return format(value.normalize(), "f")
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, (list, tuple)):
+        return sorted(value)
+    return value
+
+
+def row_hash(values: Sequence[Any]) -> bytes:
+    """Fingerprint of one row's values, equal for equal data from the dump or from Postgres."""
+    text = json.dumps([_canonical(v) for v in values], separators=(",", ":"), ensure_ascii=False)
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+def _dump_value(value: Optional[str], column_type: str):
+    if value is None or value.strip() in NULLS:
+        return None
+    if column_type == "REAL":
+        return float(value)
+    if column_type == "BOOL":
+        return value.strip().lower() in ("1", "t", "true", "yes")
+    if column_type == "TIMESTAMP":
+        return datetime.datetime.fromisoformat(value.strip())
+    if column_type == "DATE":
+        return datetime.date.fromisoformat(value.strip()[:10])
+    return csv_value(value, column_type)
+
+
+def anime_column_types(conn) -> Dict[str, str]:
+    """``anime`` column -> storage type (INTEGER, NUMERIC_2, TEXT, ...), in table order."""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT column_name, data_type, numeric_scale
+            FROM information_schema.columns
+            WHERE table_schema = 'public' AND table_name = 'anime'
+            ORDER BY ordinal_position;
+            """
+        )
+        rows = cur.fetchall()
+    conn.commit()
+    return {name: pg_column_type(data_type, scale) for name, data_type, scale in rows}
+
+
+def read_dump(path: str, column_types: Mapping[str, str]) -> Tuple[List[str], Dict[int, Dict[str, Any]]]:
+    """The compared columns and the dump's rows by ``anime_id``."""
+    with open(path, newline="", encoding="utf-8") as f:
+        reader = csv.DictReader(f)
+        header = {csv_column(h): h for h in reader.fieldnames or []}
+        if "anime_id" not in header:
+            raise ValueError(f"{path} has no anime_id column")
+        columns = [c for c in column_types if c in header and c not in DERIVED_COLUMNS]
+        links = [link for link in LINKS if link in header]
+        rows: Dict[int, Dict[str, Any]] = {}
+        for raw in reader:
+            row = {c: _dump_value(raw[header[c]], column_types[c]) for c in columns}
+            for link in links:
+                row[link] = sorted(set(parse_names(raw[header[link]])))
+            rows[row["anime_id"]] = row
+    return columns + links, rows
+
+
+def with_derived(columns: Iterable[str]) -> FrozenSet[str]:
+    """``columns`` plus the derived columns the triggers rewrite from them, as subscribers see the change."""
+    columns = frozenset(columns)
+    return columns.union(*(DERIVED_FROM[c] for c in columns if c in DERIVED_FROM))
+
+
+def _current_sql(columns: Sequence[str], where: str = "") -> str:
+    select = []
+    for column in columns:
+        if column in LINKS:
+            table, link_table, key = LINKS[column]
+            select.append(
+                f"ARRAY(SELECT DISTINCT n.name FROM {link_table} l JOIN {table} n ON n.{key} = l.{key} "
+                f"WHERE l.anime_id = a.anime_id) AS {column}"
+            )
+        else:
+            select.append(f"a.{column}")
+    return f"SELECT {', '.join(select)} FROM anime a {where};"
+
+
+def current_hashes(conn, columns: Sequence[str], batch_size: int = 5000) -> Dict[int, bytes]:
+    """``row_hash`` of every anime in Postgres, streamed through a server-side cursor."""
+    hashes = {}
+    with conn.cursor(name="ingest_current_hashes") as cur:
+        cur.itersize = batch_size
+        cur.execute(_current_sql(columns))
+        for row in cur:
+            hashes[row[0]] = row_hash(row)
+    conn.commit()
+    return hashes
+
+
+def current_rows(conn, columns: Sequence[str], anime_ids: Iterable[int]) -> Dict[int, Dict[str, Any]]:
+    with conn.cursor() as cur:
+        cur.execute(_current_sql(columns, "WHERE a.anime_id = ANY(%s)"), (list(anime_ids),))
+        return {row[0]: dict(zip(columns, row)) for row in cur.fetchall()}
+
+
+def changed_columns(old: Optional[Mapping[str, Any]], new: Mapping[str, Any], columns: Sequence[str]) -> List[str]:
+    if old is None:
+        return list(columns)
+    return [c for c in columns if _canonical(old.get(c)) != _canonical(new.get(c))]
+
+
+def _name_ids(cur, table: str, key: str, names: Iterable[str]) -> Dict[str, int]:
+    """Ids for ``names``, adding the ones ``table`` does not have yet (new genres get the next free bit)."""
+    names = sorted(set(names))
+    cur.execute(f"SELECT name, {key} FROM {table} WHERE name = ANY(%s);", (names,))
+    ids = dict(cur.fetchall())
+    for name in names:
+        if name in ids:
+            continue
+        bit = ", (SELECT COALESCE(MAX(bit), -1) + 1 FROM genre)" if table == "genre" else ""
+        cur.execute(
+            f"INSERT INTO {table} ({key}, name{', bit' if bit else ''}) "
+            f"SELECT COALESCE(MAX({key}), 0) + 1, %s{bit} FROM {table} RETURNING {key};",
+            (name,),
+        )
+        ids[name] = cur.fetchone()[0]
+    return ids
+
+
+def _write_batch(cur, rows: Sequence[Mapping[str, Any]], old_rows: Mapping[int, Mapping[str, Any]],
+                 columns: Sequence[str]) -> None:
+    from psycopg2.extras import execute_values  # pylint: disable=import-outside-toplevel
+
+    scalar = [c for c in columns if c not in LINKS]
+    updates = ", ".join(f"{c} = EXCLUDED.{c}" for c in scalar if c != "anime_id")
+    execute_values(
+        cur,
+        f"INSERT INTO anime ({', '.join(scalar)}) VALUES %s ON CONFLICT (anime_id) DO UPDATE SET {updates}",
+        [[row[c] for c in scalar] for row in rows],
+        page_size=len(rows),
+    )
+    for link in (c for c in columns if c in LINKS):
+        table, link_table, key = LINKS[link]
+        removed, added = [], []
+        for row in rows:
+            old = set((old_rows.get(row["anime_id"]) or {}).get(link) or ())
+            new = set(row[link])
+            removed += [(row["anime_id"], name) for name in sorted(old - new)]
+            added += [(row["anime_id"], name) for name in sorted(new - old)]
+        if removed:
+            cur.execute(
+                f"""
+                DELETE FROM {link_table} l USING {table} n
+                WHERE n.{key} = l.{key}
+                  AND (l.anime_id, n.name) IN (SELECT * FROM unnest(%s::int[], %s::text[]));
+                """,
+                ([a for a, _ in removed], [name for _, name in removed]),
+            )
+        if added:
+            ids = _name_ids(cur, table, key, (name for _, name in added))
+            execute_values(
+                cur,
+                f"INSERT INTO {link_table} (anime_id, {key}) VALUES %s ON CONFLICT DO NOTHING",
+                [(a, ids[name]) for a, name in added],
+                page_size=len(added),
+            )
+
+
+def ingest(conn, dump_path: str, batch_size: int = DEFAULT_BATCH_SIZE, dry_run: bool = False,
+           log=print) -> IngestResult:
+    """Diff ``dump_path`` against Postgres and write the new and changed rows."""
+    columns, dump = read_dump(dump_path, anime_column_types(conn))
+    log(f"read {len(dump)} rows from {dump_path} ({len(columns)} columns compared)")
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_advisory_lock(%s);", (INGEST_LOCK_ID,))
+    conn.commit()
+    try:
+        hashes = current_hashes(conn, columns)
+        pending = [i for i in sorted(dump) if hashes.get(i) != row_hash([dump[i][c] for c in columns])]
+        inserted = [i for i in pending if i not in hashes]
+        updated = [i for i in pending if i in hashes]
+        missing = sorted(set(hashes) - set(dump))
+        log(f"{len(inserted)} new, {len(updated)} changed, {len(dump) - len(pending)} unchanged, "
+            f"{len(missing)} not in the dump")
+
+        touched: set = set()
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start:start + batch_size]
+            old_rows = current_rows(conn, columns, [i for i in batch if i in hashes])
+            batch_columns = with_derived(c for i in batch for c in changed_columns(old_rows.get(i), dump[i], columns))
+            touched |= batch_columns
+            if dry_run:
+                continue
+            with conn.cursor() as cur:
+                _write_batch(cur, [dump[i] for i in batch], old_rows, columns)
+                notify(cur, ChangeSet.of(batch, batch_columns))
+            conn.commit()
+            log(f"  {start + len(batch)} / {len(pending)} rows")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_unlock(%s);", (INGEST_LOCK_ID,))
+        conn.commit()
+    return IngestResult(inserted, updated, len(dump) - len(pending), missing, frozenset(touched))
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Apply a new cleaned anime dump incrementally.")
+    parser.add_argument("dump", help='path to the new "anime cleaned.csv"')
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--dry-run", action="store_true", help="diff only; write nothing")
+    args = parser.parse_args(argv)
+
+    import psycopg2  # pylint: disable=import-outside-toplevel
+
+    from app import DB_CONFIG  # pylint: disable=import-outside-toplevel
+
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        result = ingest(conn, args.dump, batch_size=args.batch_size, dry_run=args.dry_run,
+                        log=lambda line: print(line, file=sys.stderr))
+    finally:
+        conn.close()
+    print(json.dumps(result.summary()))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,141 @@
+"""JSON output of the list routes, straight from the cursor's tuples.
+
+``jsonify(rows)`` needs one dict per row (``RealDictCursor``) and then
+converts every value on its own: Decimal and date go through
+``default()`` one at a time. Here a route fetches ``storage.Columns``
+instead (one transposition of the tuples, no dicts), and ``encode`` picks one
+encoder per column, once per query, runs it over the column, and fills a
+prebuilt ``{"key":%s,...}`` template per row:
+
+    return json_response(fetch_rows("top_anime", query, params, columns=True))
+
+A route that wraps its rows in an object passes a dict whose values may be
+``Columns`` (``select`` picks columns without copying them).
+
+The bytes are the ones ``jsonify`` sends outside debug mode: keys sorted,
+ASCII only, compact separators, a trailing newline. Encoders come from the
+Postgres type OIDs. Other columns (SQLite, enums, arrays, computed values)
+are inferred from the Python types of their values, and a column with
+mixed types goes through ``json.dumps`` with Flask's ``default()``.
+"""
+import datetime
+import json
+from decimal import Decimal
+from json.encoder import encode_basestring_ascii
+from typing import Any, Callable, Dict, List, Mapping, Sequence, Union
+
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.http import http_date
+
+from storage import Columns
+
+Encoder = Callable[[Any], str]
+
+_INFINITY = float("inf")
+_generic = json.JSONEncoder(
+    ensure_ascii=True, sort_keys=True, separators=(",", ":"), default=DefaultJSONProvider.default
+).encode
+
+
+def _float(value: float) -> str:
+    # As json.dumps: NaN and the infinities are written bare.
+    if value != value:
+        return "NaN"
+    if value == _INFINITY:
+        return "Infinity"
+    if value == -_INFINITY:
+        return "-Infinity"
+    return float.__repr__(value)
+
+
+def _decimal(value: Decimal) -> str:
+    return f'"{value}"'
+
+
+def _bool(value: bool) -> str:
+    return "true" if value else "false"
+
+
+def _date(value: datetime.date) -> str:
+    return f'"{http_date(value)}"'
+
+
+# Postgres type OID -> encoder, for types psycopg2 always returns as one Python type.
+_PG_ENCODERS: Dict[int, Encoder] = {
+    16: _bool,
+    20: int.__repr__,
+    21: int.__repr__,
+    23: int.__repr__,
+    26: int.__repr__,
+    700: _float,
+    701: _float,
+    1700: _decimal,
+    19: encode_basestring_ascii,
+    25: encode_basestring_ascii,
+    1042: encode_basestring_ascii,
+    1043: encode_basestring_ascii,
+    1082: _date,
+    1114: _date,
+    1184: _date,
+}
+
+# Python type -> encoder, for columns without a known OID whose values share one type.
+_PY_ENCODERS: Dict[type, Encoder] = {
+    bool: _bool,
+    int: int.__repr__,
+    float: _float,
+    Decimal: _decimal,
+    str: encode_basestring_ascii,
+    datetime.date: _date,
+    datetime.datetime: _date,
+}
+
+
+def encoder(type_code: Any, values: Sequence[Any]) -> Encoder:
+    """The encoder of one result column (``None`` values are handled by the caller)."""
+    chosen = _PG_ENCODERS.get(type_code)
+    if chosen is not None:
+        return chosen
+    kinds = {type(value) for value in values if value is not None}
+    if len(kinds) == 1:
+        return _PY_ENCODERS.get(kinds.pop(), _generic)
+    return _generic
+
+
+def _column(type_code: Any, values: Sequence[Any]) -> List[str]:
+    encode_one = encoder(type_code, values)
+    if None in values:
+        return [("null" if value is None else encode_one(value)) for value in values]
+    return list(map(encode_one, values))
+
+
+def _array(columns: Columns) -> str:
+    # Sorted keys; a repeated column name keeps its last value, as a dict would.
+    last: Dict[str, int] = {name: i for i, name in enumerate(columns.names)}
+    order = [last[name] for name in sorted(last)]
+    template = "{" + ",".join(f"{encode_basestring_ascii(columns.names[i]).replace('%', '%%')}:%s" for i in order) + "}"
+    encoded = [_column(columns.types[i][0], columns.values[i]) for i in order]
+    return f"[{','.join([template % row for row in zip(*encoded)])}]"
+
+
+def encode(value: Union[Columns, Mapping[str, Any]]) -> bytes:
+    """``value`` as JSON: a ``Columns`` is an array of row objects, also as a value of a mapping."""
+    if isinstance(value, Columns):
+        return f"{_array(value)}\n".encode()
+    fields = ",".join(
+        f"{encode_basestring_ascii(key)}:{_array(item) if isinstance(item, Columns) else _generic(item)}"
+        for key, item in sorted(value.items())
+    )
+    return f"{{{fields}}}\n".encode()
+
+
+def rows(columns: Columns) -> List[Dict[str, Any]]:
+    """``columns`` as the dict rows ``fetch_rows`` returns without ``columns=True``."""
+    return [dict(zip(columns.names, row)) for row in zip(*columns.values)]
+
+
+def select(columns: Columns, names: Sequence[str]) -> Columns:
+    """The ``names`` columns of ``columns``, without copying them."""
+    index = {name: i for i, name in enumerate(columns.names)}
+    picked = [index[name] for name in names]
+    return Columns(list(names), [columns.types[i] for i in picked], [columns.values[i] for i in picked])
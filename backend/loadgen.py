@@ -0,0 +1,563 @@
+"""Replay a realistic traffic mix against a running server and report latency per route.
+
+Request parameters are drawn from the server's own data, which is fetched
+once before the run:
+
+- seed ids and title prefixes come from the most popular anime. Picks are
+  Zipf-weighted by popularity rank, so a few titles get most of the traffic.
+- genre filters take one to three genres, each drawn by how many anime have
+  it in the facet counts. Seasons and types are drawn the same way.
+
+There are two ways to drive load:
+
+- closed loop (``--concurrency 1,4,16``): each of N workers sends its next
+  request when the last one returns. This measures capacity. A sweep over N
+  shows where throughput stops growing and latency starts to.
+- open loop (``--rate 10,20,40``): requests arrive as a Poisson process at R
+  per second, whatever the server does, the way users do. Latency is timed
+  from the scheduled arrival, so time spent queued behind a slow server counts.
+
+Run it against a deployment, or offline against the SQLite stand-in (see
+``storage.py build-sqlite``), which ``--serve`` starts on a free local port:
+
+    python loadgen.py --serve mal.sqlite3 --concurrency 1,4,16 --duration 20
+    python loadgen.py --url https://mal.fly.dev --rate 10,20,40 --mix similar=20,facets=0 --json
+"""
+import argparse
+import bisect
+import http.client
+import itertools
+import json
+import math
+import os
+import queue
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+from urllib.parse import urlencode, urlsplit
+
+DEFAULT_URL = "http://127.0.0.1:5001"
+DEFAULT_DURATION = 10.0
+DEFAULT_TIMEOUT = 30.0
+DEFAULT_POPULAR = 1000
+DEFAULT_ZIPF = 1.0
+SERVE_START_TIMEOUT = 120.0
+
+
+class Profile(NamedTuple):
+    """The data request parameters are drawn from."""
+
+    anime_ids: List[int]  # most popular first
+    titles: List[str]
+    rank_weights: List[float]  # cumulative Zipf weights over anime_ids
+    genre_ids: List[int]
+    genre_weights: List[float]  # cumulative, by anime count
+    seasons: List[str]
+    season_weights: List[float]
+    types: List[str]
+    type_weights: List[float]
+
+    @classmethod
+    def build(cls, popular: Sequence[Dict[str, Any]], facets: Dict[str, Any], zipf: float = DEFAULT_ZIPF) -> "Profile":
+        """From ``/api/anime/top?metric=popularity`` rows and the ``/api/anime/facets`` body."""
+        if not popular:
+            raise ValueError("the server returned no anime to draw seeds from")
+
+        def counted(items, key):
+            items = [item for item in items if item[key] is not None and item["count"] > 0]
+            return [item[key] for item in items], list(itertools.accumulate(item["count"] for item in items))
+
+        genre_ids, genre_weights = counted(facets.get("genre", []), "genre_id")
+        seasons, season_weights = counted(facets.get("season", []), "value")
+        types, type_weights = counted(facets.get("type", []), "value")
+        return cls(
+            anime_ids=[row["anime_id"] for row in popular],
+            titles=[row["title"] or "" for row in popular],
+            rank_weights=list(itertools.accumulate(1.0 / (rank ** zipf) for rank in range(1, len(popular) + 1))),
+            genre_ids=genre_ids,
+            genre_weights=genre_weights,
+            seasons=seasons,
+            season_weights=season_weights,
+            types=types,
+            type_weights=type_weights,
+        )
+
+    @classmethod
+    def fetch(cls, client: "Client", popular: int = DEFAULT_POPULAR, zipf: float = DEFAULT_ZIPF) -> "Profile":
+        status, body = client.get(f"/api/anime/top?{urlencode({'metric': 'popularity', 'limit': popular})}")
+        if status != 200:
+            raise RuntimeError(f"/api/anime/top answered {status}")
+        rows = json.loads(body)
+        status, body = client.get("/api/anime/facets")
+        facets = json.loads(body) if status == 200 else {}
+        return cls.build(rows, facets, zipf)
+
+    def anime(self, rng: random.Random) -> int:
+        """Index of a popular anime, Zipf-distributed by rank."""
+        return _pick(rng, self.rank_weights)
+
+    def genre_combo(self, rng: random.Random) -> List[int]:
+        if not self.genre_ids:
+            return []
+        size = min(rng.choices((1, 2, 3), (60, 32, 8))[0], len(self.genre_ids))
+        combo = set()
+        while len(combo) < size:
+            combo.add(self.genre_ids[_pick(rng, self.genre_weights)])
+        return sorted(combo)
+
+    def season(self, rng: random.Random) -> Optional[str]:
+        return self.seasons[_pick(rng, self.season_weights)] if self.seasons else None
+
+    def type(self, rng: random.Random) -> Optional[str]:
+        return self.types[_pick(rng, self.type_weights)] if self.types else None
+
+    def prefix(self, rng: random.Random, min_len: int = 1) -> str:
+        """What a user has typed so far: the start of a popular title or of one of its words."""
+        title = self.titles[self.anime(rng)].lower()
+        words = title.split() or [title]
+        text = words[0] if rng.random() < 0.7 else rng.choice(words)
+        if len(text) < min_len:
+            text = title
+        if len(text) <= min_len:
+            return text
+        return text[:rng.randint(min_len, max(min(len(text), 8), min_len))]
+
+
+def _pick(rng: random.Random, cum_weights: Sequence[float]) -> int:
+    return bisect.bisect_right(cum_weights, rng.random() * cum_weights[-1])
+
+
+def _anime_filters(profile: Profile, rng: random.Random) -> Dict[str, Any]:
+    params: Dict[str, Any] = {}
+    if rng.random() < 0.5:
+        params["genre_ids"] = ",".join(map(str, profile.genre_combo(rng)))
+    if rng.random() < 0.25 and profile.seasons:
+        params["season"] = profile.season(rng)
+    if rng.random() < 0.3 and profile.types:
+        params["type"] = profile.type(rng)
+    if rng.random() < 0.2:
+        params["min_score"] = rng.choice((6, 7, 7.5, 8))
+    return {key: value for key, value in params.items() if value}
+
+
+def _path(path: str, params: Optional[Dict[str, Any]] = None) -> str:
+    return f"{path}?{urlencode(params)}" if params else path
+
+
+def _seed(profile: Profile, rng: random.Random) -> int:
+    return profile.anime_ids[profile.anime(rng)]
+
+
+# Route name -> request path for a draw from the profile. The names are the
+# view functions in app.py.
+ROUTES: Dict[str, Callable[[Profile, random.Random], str]] = {
+    "search_anime": lambda p, r: _path("/api/anime", {**_anime_filters(p, r), "limit": r.choice((20, 50, 100))}),
+    "top_lists": lambda p, r: "/api/anime/top-lists",
+    "top_anime": lambda p, r: _path("/api/anime/top", {
+        "metric": r.choices(("rating", "popularity", "favorites"), (50, 35, 15))[0],
+        "limit": 20,
+        "offset": 20 * r.choices((0, 1, 2, 3), (70, 18, 8, 4))[0],
+    }),
+    "recommendations": lambda p, r: _path(f"/api/anime/{_seed(p, r)}/recommendations", {"limit": 10}),
+    "similar": lambda p, r: _path(f"/api/anime/{_seed(p, r)}/similar", {"limit": r.choice((10, 10, 20))}),
+    "top_adjusted_score": lambda p, r: _path("/api/anime/top/adjusted-score", {"limit": 20}),
+    "stats_years_ratings": lambda p, r: "/api/stats/years/ratings",
+    "stats_episodes_vs_metrics": lambda p, r: "/api/stats/episodes-vs-metrics",
+    "compare_random_pair": lambda p, r: "/api/anime/compare/random-pair",
+    "ratings_volatile": lambda p, r: _path("/api/anime/ratings/volatile", {"limit": 20}),
+    "stats_sequels_vs_first_season": lambda p, r: "/api/stats/sequels-vs-first-season",
+    "list_genres": lambda p, r: "/api/genres",
+    "get_anime": lambda p, r: f"/api/anime/{_seed(p, r)}",
+    "search_anime_by_title": lambda p, r: _path("/api/anime/search", {"q": p.prefix(r, min_len=2)}),
+    "autocomplete_titles": lambda p, r: _path("/api/anime/autocomplete", {"q": p.prefix(r)}),
+    "anime_facets": lambda p, r: _path("/api/anime/facets", _anime_filters(p, r) if r.random() < 0.6 else None),
+    "similar_text": lambda p, r: _path(f"/api/anime/{_seed(p, r)}/similar-text", {"limit": 10}),
+    "stats_distribution": lambda p, r: _path("/api/stats/distribution", {
+        "metric": r.choices(("score", "members", "favorites"), (70, 20, 10))[0],
+        "by": r.choice(("genre", "type", "source_type", "year")),
+        **({"type": p.type(r)} if r.random() < 0.2 and p.types else {}),
+    }),
+    "stats_cube": lambda p, r: _path("/api/stats/cube", {
+        "by": r.choice(("genre", "genre,year", "type,source_type", "season", "year")),
+        "measures": r.choice(("score", "members", "score,members,favorites")),
+        **({"genre_id": p.genre_combo(r)[0]} if r.random() < 0.2 and p.genre_ids else {}),
+    }),
+}
+
+# Relative request rates: typing and title pages dominate, the stats pages are
+# rare. similar_text is off because it needs the synopsis index (503 without).
+DEFAULT_MIX = {
+    "search_anime": 14,
+    "top_lists": 3,
+    "top_anime": 6,
+    "recommendations": 6,
+    "similar": 8,
+    "top_adjusted_score": 1,
+    "stats_years_ratings": 1,
+    "stats_episodes_vs_metrics": 1,
+    "compare_random_pair": 2,
+    "ratings_volatile": 1,
+    "stats_sequels_vs_first_season": 1,
+    "list_genres": 2,
+    "get_anime": 15,
+    "search_anime_by_title": 10,
+    "autocomplete_titles": 24,
+    "anime_facets": 5,
+    "similar_text": 0,
+    "stats_distribution": 1,
+    "stats_cube": 1,
+}
+
+
+def parse_mix(spec: Optional[str], base: Optional[Dict[str, float]] = None) -> Dict[str, float]:
+    """``"similar=20,facets=0"`` applied over ``base`` (the default mix); raises ValueError."""
+    mix = dict(DEFAULT_MIX if base is None else base)
+    for item in filter(None, (part.strip() for part in (spec or "").split(","))):
+        name, sep, weight = item.partition("=")
+        name = name.strip()
+        if name not in ROUTES:
+            # Allow the short form of a name ("facets" for "anime_facets").
+            matches = [route for route in ROUTES if route.endswith(name) or route.startswith(name)]
+            if len(matches) != 1:
+                raise ValueError(f"unknown route {name!r}; one of: {', '.join(ROUTES)}")
+            name = matches[0]
+        try:
+            mix[name] = float(weight) if sep else 1.0
+        except ValueError:
+            raise ValueError(f"weight for {name} must be a number") from None
+        if mix[name] < 0:
+            raise ValueError(f"weight for {name} must not be negative")
+    mix = {name: weight for name, weight in mix.items() if weight > 0}
+    if not mix:
+        raise ValueError("the mix has no routes with a positive weight")
+    return mix
+
+
+class Client:
+    """One keep-alive HTTP connection; reconnects when the server closes it."""
+
+    def __init__(self, base_url: str, timeout: float = DEFAULT_TIMEOUT, headers: Optional[Dict[str, str]] = None):
+        parts = urlsplit(base_url)
+        self._factory = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+        self._netloc = parts.netloc
+        self._prefix = parts.path.rstrip("/")
+        self._timeout = timeout
+        self._headers = dict(headers or {})
+        self._conn: Optional[http.client.HTTPConnection] = None
+
+    def get(self, path: str) -> Tuple[int, bytes]:
+        reused = self._conn is not None
+        try:
+            return self._get(path)
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            self.close()
+            if not reused:
+                raise
+            # The server dropped an idle keep-alive connection: retry once on a new one.
+            return self._get(path)
+        except (http.client.HTTPException, OSError):
+            self.close()
+            raise
+
+    def _get(self, path: str) -> Tuple[int, bytes]:
+        if self._conn is None:
+            self._conn = self._factory(self._netloc, timeout=self._timeout)
+        self._conn.request("GET", self._prefix + path, headers=self._headers)
+        response = self._conn.getresponse()
+        body = response.read()
+        if response.will_close:
+            self.close()
+        return response.status, body
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class Recorder:
+    """Latency and status of every request, by route; thread-safe."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples: Dict[str, List[Tuple[float, int]]] = defaultdict(list)
+
+    def add(self, route: str, seconds: float, status: int) -> None:
+        with self._lock:
+            self.samples[route].append((seconds, status))
+
+
+def _send(client: Client, recorder: Recorder, route: str, path: str, started: float) -> None:
+    try:
+        status, _ = client.get(path)
+    except (http.client.HTTPException, OSError):
+        status = 0  # connection refused, reset or timed out
+    recorder.add(route, time.perf_counter() - started, status)
+
+
+def _chooser(mix: Dict[str, float]) -> Callable[[random.Random], str]:
+    names = list(mix)
+    cum_weights = list(itertools.accumulate(mix[name] for name in names))
+    return lambda rng: names[_pick(rng, cum_weights)]
+
+
+def run_closed(
+    make_client: Callable[[], Client],
+    profile: Profile,
+    mix: Dict[str, float],
+    concurrency: int,
+    duration: float,
+    seed: int = 0,
+) -> Tuple[Recorder, float]:
+    """``concurrency`` workers, each sending back to back for ``duration`` seconds."""
+    recorder, choose = Recorder(), _chooser(mix)
+    deadline = time.perf_counter() + duration
+
+    def worker(rng: random.Random) -> None:
+        client = make_client()
+        try:
+            while time.perf_counter() < deadline:
+                route = choose(rng)
+                path = ROUTES[route](profile, rng)
+                _send(client, recorder, route, path, time.perf_counter())
+        finally:
+            client.close()
+
+    return recorder, _run_threads([lambda i=i: worker(random.Random(seed * 7919 + i)) for i in range(concurrency)])
+
+
+def run_open(
+    make_client: Callable[[], Client],
+    profile: Profile,
+    mix: Dict[str, float],
+    rate: float,
+    duration: float,
+    max_inflight: int = 64,
+    seed: int = 0,
+) -> Tuple[Recorder, float]:
+    """Poisson arrivals at ``rate`` per second for ``duration`` seconds.
+
+    Up to ``max_inflight`` requests are outstanding at once; later arrivals wait
+    in a queue, and that wait is part of their latency.
+    """
+    recorder, choose = Recorder(), _chooser(mix)
+    rng = random.Random(seed)
+    arrivals: "queue.Queue[Optional[Tuple[str, str, float]]]" = queue.Queue()
+
+    def worker() -> None:
+        client = make_client()
+        try:
+            while True:
+                item = arrivals.get()
+                if item is None:
+                    return
+                route, path, due = item
+                _send(client, recorder, route, path, due)
+        finally:
+            client.close()
+
+    def schedule() -> None:
+        start = time.perf_counter()
+        due = start
+        while True:
+            due += rng.expovariate(rate)
+            if due - start >= duration:
+                break
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            route = choose(rng)
+            arrivals.put((route, ROUTES[route](profile, rng), due))
+        for _ in range(max_inflight):
+            arrivals.put(None)
+
+    return recorder, _run_threads([schedule] + [worker] * max_inflight)
+
+
+def _run_threads(targets: Sequence[Callable[[], None]]) -> float:
+    threads = [threading.Thread(target=target, daemon=True) for target in targets]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started
+
+
+def percentile(sorted_values: Sequence[float], q: float) -> Optional[float]:
+    """Nearest-rank percentile (``q`` in 0..1) of already sorted values."""
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, math.ceil(q * len(sorted_values)) - 1)]
+
+
+def _stats(samples: Sequence[Tuple[float, int]], elapsed: float) -> Dict[str, Any]:
+    latencies = sorted(seconds for seconds, _ in samples)
+    statuses = Counter(status for _, status in samples)
+    errors = sum(count for status, count in statuses.items() if status == 0 or status >= 400)
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 2)
+
+    return {
+        "requests": len(samples),
+        "throughput": round(len(samples) / elapsed, 2) if elapsed > 0 else None,
+        "p50_ms": ms(percentile(latencies, 0.50)),
+        "p99_ms": ms(percentile(latencies, 0.99)),
+        "max_ms": ms(latencies[-1] if latencies else None),
+        "errors": errors,
+        "error_rate": round(errors / len(samples), 4) if samples else 0.0,
+        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+    }
+
+
+def summarize(recorder: Recorder, elapsed: float) -> Dict[str, Any]:
+    """Overall and per-route throughput, p50/p99 latency and error rate."""
+    every = [sample for samples in recorder.samples.values() for sample in samples]
+    return {
+        "elapsed": round(elapsed, 3),
+        "total": _stats(every, elapsed),
+        "routes": {route: _stats(recorder.samples[route], elapsed) for route in sorted(recorder.samples)},
+    }
+
+
+def format_report(step: Dict[str, Any]) -> str:
+    total = step["total"]
+    load = f"concurrency {step['concurrency']}" if step["mode"] == "closed" else f"{step['rate']:g} req/s offered"
+    lines = [
+        f"{step['mode']} loop, {load}: {total['requests']} requests in {step['elapsed']:.1f}s, "
+        f"{total['throughput']} req/s, p50 {total['p50_ms']} ms, p99 {total['p99_ms']} ms, "
+        f"{total['error_rate']:.1%} errors",
+        f"  {'route':<32}{'requests':>9}{'req/s':>9}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}",
+    ]
+    for route, stats in step["routes"].items():
+        lines.append(
+            f"  {route:<32}{stats['requests']:>9}{stats['throughput']:>9}"
+            f"{stats['p50_ms']:>10}{stats['p99_ms']:>10}{stats['errors']:>8}"
+        )
+    return "\n".join(lines)
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@contextmanager
+def serve_sqlite(path: str, threads: bool = True) -> Iterator[str]:
+    """Run app.py against the SQLite file at ``path`` on a free local port; yields its URL."""
+    port = _free_port()
+    env = {**os.environ, "MAL_STORAGE": f"sqlite:{os.path.abspath(path)}"}
+    code = f"import app; app.create_app().run(host='127.0.0.1', port={port}, threaded={threads!r})"
+    # The access log would interleave with the report; run app.py by hand to see it.
+    process = subprocess.Popen(
+        [sys.executable, "-c", code],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{port}"
+    try:
+        client, deadline = Client(url, timeout=5), time.monotonic() + SERVE_START_TIMEOUT
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError(f"the server exited with status {process.returncode}")
+            try:
+                if client.get("/api/genres")[0] == 200:
+                    break
+            except OSError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError("the server did not start in time")
+            time.sleep(0.2)
+        client.close()
+        yield url
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def _levels(spec: str, kind: Callable[[str], Any]) -> List[Any]:
+    levels = [kind(part) for part in spec.split(",") if part.strip()]
+    if not levels or any(level <= 0 for level in levels):
+        raise ValueError("levels must be positive")
+    return levels
+
+
+def run_sweep(args, url: str, mix: Dict[str, float], log: Callable[[str], None]) -> List[Dict[str, Any]]:
+    headers = {"Accept-Encoding": args.accept_encoding} if args.accept_encoding else {}
+    setup = Client(url, args.timeout)
+    try:
+        profile = Profile.fetch(setup, args.popular, args.zipf)
+    finally:
+        setup.close()
+
+    def make_client():
+        return Client(url, args.timeout, headers)
+
+    if args.warmup > 0:
+        run_closed(make_client, profile, mix, 1, args.warmup, args.seed)
+    steps = []
+    if args.rate:
+        for rate in _levels(args.rate, float):
+            recorder, elapsed = run_open(make_client, profile, mix, rate, args.duration, args.max_inflight, args.seed)
+            steps.append({"mode": "open", "rate": rate, **summarize(recorder, elapsed)})
+            log(format_report(steps[-1]))
+    else:
+        for concurrency in _levels(args.concurrency, int):
+            recorder, elapsed = run_closed(make_client, profile, mix, concurrency, args.duration, args.seed)
+            steps.append({"mode": "closed", "concurrency": concurrency, **summarize(recorder, elapsed)})
+            log(format_report(steps[-1]))
+    return steps
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Drive the server with a realistic traffic mix and report latency.")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--url", default=DEFAULT_URL, help=f"server to load (default {DEFAULT_URL})")
+    target.add_argument("--serve", metavar="SQLITE_PATH", help="start app.py on this SQLite file and load it")
+    load = parser.add_mutually_exclusive_group()
+    load.add_argument("--concurrency", default="1,4,16", help="closed-loop workers; a list sweeps (default 1,4,16)")
+    load.add_argument("--rate", help="open-loop arrivals per second; a list sweeps")
+    parser.add_argument("--duration", type=float, default=DEFAULT_DURATION, help="seconds per step")
+    parser.add_argument("--warmup", type=float, default=2.0, help="unrecorded seconds before the first step")
+    parser.add_argument("--max-inflight", type=int, default=64, help="open loop: outstanding requests at most")
+    parser.add_argument("--mix", help="route weights over the default mix, e.g. similar=20,facets=0")
+    parser.add_argument("--popular", type=int, default=DEFAULT_POPULAR, help="popular anime to draw seeds from")
+    parser.add_argument("--zipf", type=float, default=DEFAULT_ZIPF, help="skew of seed popularity (0 = uniform)")
+    parser.add_argument("--accept-encoding", default="gzip", help="Accept-Encoding to send ('' for none)")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT, help="seconds per request")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the parameter draws")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args(argv)
+    try:
+        mix = parse_mix(args.mix)
+        _levels(args.rate or args.concurrency, float if args.rate else int)
+    except ValueError as exc:
+        parser.error(str(exc))
+    if args.duration <= 0 or args.max_inflight <= 0 or args.popular <= 0:
+        parser.error("--duration, --max-inflight and --popular must be positive")
+
+    def log(text):
+        print(text, file=sys.stderr if args.json else sys.stdout)
+
+    if args.serve:
+        with serve_sqlite(args.serve) as url:
+            steps = run_sweep(args, url, mix, log)
+    else:
+        steps = run_sweep(args, args.url, mix, log)
+    if args.json:
+        print(json.dumps(steps, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
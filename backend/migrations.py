@@ -0,0 +1,408 @@
+"""Versioned, idempotent schema migrations for derived columns and indexes.
+
+Run locally (or on a Fly machine) before deploying code that needs them:
+
+    python migrations.py            # apply everything pending
+    python migrations.py --list     # show applied / pending versions
+    python migrations.py --dry-run  # print what would run
+
+Applied versions are recorded in ``schema_migrations``; every statement is
+also written to be safe to re-run (IF NOT EXISTS, backfills that only touch
+rows still needing it). A Postgres advisory lock keeps two machines from
+migrating at the same time. Large backfills run in batches, each committed
+on its own, so they never hold a long lock on ``anime``.
+
+Running servers pick up the new columns on their own: the statement registry
+re-prepares any statement whose result shape changed. Call
+``POST /api/admin/statements/invalidate`` to make that happen eagerly.
+"""
+import argparse
+import sys
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from genre_mask import MAX_GENRE_BITS
+
+MIGRATION_LOCK_ID = 550_2901  # pg_advisory_lock key reserved for migrations
+DEFAULT_BATCH_SIZE = 1000
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    apply: Callable[["MigrationContext"], None]
+
+
+MIGRATIONS: List[Migration] = []
+
+
+def migration(version: int, name: str):
+    def register(fn):
+        if any(m.version == version for m in MIGRATIONS):
+            raise ValueError(f"duplicate migration version {version}")
+        MIGRATIONS.append(Migration(version, name, fn))
+        MIGRATIONS.sort(key=lambda m: m.version)
+        return fn
+
+    return register
+
+
+class MigrationContext:
+    """What a migration gets to work with: plain, non-transactional and batched SQL."""
+
+    def __init__(self, conn, batch_size: int = DEFAULT_BATCH_SIZE, dry_run: bool = False, log=print):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.log = log
+
+    def execute(self, sql: str, params=None) -> None:
+        """Run ``sql`` inside the migration's transaction."""
+        self.log(f"  {_first_line(sql)}")
+        if self.dry_run:
+            return
+        with self.conn.cursor() as cur:
+            cur.execute(sql, params)
+
+    def execute_autocommit(self, sql: str) -> None:
+        """Run ``sql`` outside a transaction (needed for CREATE INDEX CONCURRENTLY)."""
+        self.log(f"  {_first_line(sql)}")
+        if self.dry_run:
+            return
+        self.conn.commit()
+        self.conn.autocommit = True
+        try:
+            with self.conn.cursor() as cur:
+                cur.execute(sql)
+        finally:
+            self.conn.autocommit = False
+
+    def create_index_concurrently(self, name: str, definition: str) -> None:
+        """``CREATE INDEX CONCURRENTLY IF NOT EXISTS name definition``, rebuilding an INVALID leftover.
+
+        A concurrent build that fails partway leaves the index behind, marked
+        INVALID. IF NOT EXISTS would then skip it on every rerun and the
+        planner would never use it, so such an index is dropped first.
+        """
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s);", (name,))
+            found = cur.fetchone()
+        if found is not None and not _first_value(found):
+            self.execute_autocommit(f"DROP INDEX CONCURRENTLY IF EXISTS {name};")
+        self.execute_autocommit(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} {definition}")
+
+    def backfill(self, table: str, key: str, set_sql: str, where_sql: str) -> int:
+        """UPDATE ``table`` in key order, ``batch_size`` rows per committed batch.
+
+        ``where_sql`` selects rows that still need the backfill, which is what
+        makes re-running an interrupted backfill cheap.
+        """
+        self.log(f"  backfill {table}: SET {_first_line(set_sql)} (batches of {self.batch_size})")
+        if self.dry_run:
+            return 0
+        sql = f"""
+        WITH batch AS (
+          SELECT {key} FROM {table}
+          WHERE {key} > %(after)s AND ({where_sql})
+          ORDER BY {key}
+          LIMIT %(batch_size)s
+        )
+        UPDATE {table} t SET {set_sql}
+        FROM batch
+        WHERE t.{key} = batch.{key}
+        RETURNING t.{key};
+        """
+        self.conn.commit()
+        after, total = -1, 0
+        while True:
+            with self.conn.cursor() as cur:
+                cur.execute(sql, {"after": after, "batch_size": self.batch_size})
+                keys = [_first_value(row) for row in cur.fetchall()]
+            self.conn.commit()
+            if not keys:
+                break
+            after = max(keys)
+            total += len(keys)
+            self.log(f"    {total} rows")
+        return total
+
+
+def _first_line(sql: str) -> str:
+    return " ".join(sql.split())[:100]
+
+
+def _first_value(row):
+    return next(iter(row.values())) if isinstance(row, dict) else row[0]
+
+
+def ensure_migrations_table(conn) -> None:
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+              version integer PRIMARY KEY,
+              name text NOT NULL,
+              applied_at timestamptz NOT NULL DEFAULT now()
+            );
+            """
+        )
+    conn.commit()
+
+
+def applied_versions(conn) -> Dict[int, str]:
+    with conn.cursor() as cur:
+        cur.execute("SELECT version, name FROM schema_migrations ORDER BY version;")
+        rows = cur.fetchall()
+    conn.commit()
+    return {(r["version"] if isinstance(r, dict) else r[0]): (r["name"] if isinstance(r, dict) else r[1]) for r in rows}
+
+
+def pending_migrations(conn, target: Optional[int] = None) -> List[Migration]:
+    done = applied_versions(conn)
+    return [m for m in MIGRATIONS if m.version not in done and (target is None or m.version <= target)]
+
+
+def migrate(
+    conn,
+    target: Optional[int] = None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    dry_run: bool = False,
+    log=print,
+) -> List[int]:
+    """Apply pending migrations in version order; returns the versions applied."""
+    ensure_migrations_table(conn)
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_advisory_lock(%s);", (MIGRATION_LOCK_ID,))
+    conn.commit()
+    applied = []
+    try:
+        ctx = MigrationContext(conn, batch_size=batch_size, dry_run=dry_run, log=log)
+        # Re-read under the lock: another machine may have just finished.
+        for m in pending_migrations(conn, target):
+            log(f"{'would apply' if dry_run else 'applying'} {m.version:04d} {m.name}")
+            m.apply(ctx)
+            if not dry_run:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "INSERT INTO schema_migrations (version, name) VALUES (%s, %s) ON CONFLICT DO NOTHING;",
+                        (m.version, m.name),
+                    )
+                conn.commit()
+            applied.append(m.version)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_unlock(%s);", (MIGRATION_LOCK_ID,))
+        conn.commit()
+    return applied
+
+
+# ---------------------------------------------------------------------------
+# Migrations
+# ---------------------------------------------------------------------------
+
+# `season` looks like "Spring 2019"; these expressions pull its parts apart.
+YEAR_SQL = "NULLIF(substring({col} FROM '\\d{{4}}'), '')::smallint"
+SEASON_NAME_SQL = "NULLIF(initcap(substring({col} FROM '^[A-Za-z]+')), '')"
+
+
+@migration(1, "anime_season_derived_columns")
+def _anime_season_derived_columns(ctx: MigrationContext) -> None:
+    year = YEAR_SQL.format(col="t.season")
+    ctx.execute(
+        """
+        ALTER TABLE anime
+          ADD COLUMN IF NOT EXISTS year smallint,
+          ADD COLUMN IF NOT EXISTS decade smallint,
+          ADD COLUMN IF NOT EXISTS season_name text;
+        """
+    )
+    # Keep the columns right for rows written after the backfill.
+    ctx.execute(
+        f"""
+        CREATE OR REPLACE FUNCTION anime_set_season_columns() RETURNS trigger AS $$
+        BEGIN
+          NEW.year := {YEAR_SQL.format(col="NEW.season")};
+          NEW.decade := (NEW.year / 10) * 10;
+          NEW.season_name := {SEASON_NAME_SQL.format(col="NEW.season")};
+          RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+        """
+    )
+    ctx.execute("DROP TRIGGER IF EXISTS anime_season_columns ON anime;")
+    ctx.execute(
+        """
+        CREATE TRIGGER anime_season_columns
+        BEFORE INSERT OR UPDATE OF season ON anime
+        FOR EACH ROW EXECUTE FUNCTION anime_set_season_columns();
+        """
+    )
+    ctx.backfill(
+        "anime",
+        "anime_id",
+        f"year = {year}, decade = ({year} / 10) * 10, season_name = {SEASON_NAME_SQL.format(col='t.season')}",
+        "season IS NOT NULL AND year IS NULL AND season ~ '\\d{4}'",
+    )
+
+
+@migration(2, "anime_season_indexes")
+def _anime_season_indexes(ctx: MigrationContext) -> None:
+    # Partial on score: stats_years_ratings only looks at scored titles.
+    ctx.create_index_concurrently("anime_year_score_idx", "ON anime (year) INCLUDE (score) WHERE score IS NOT NULL;")
+    ctx.create_index_concurrently("anime_decade_idx", "ON anime (decade);")
+    ctx.create_index_concurrently("anime_season_name_year_idx", "ON anime (season_name, year);")
+
+
+# Genres fit in one bigint: bit = genre.bit, assigned densely in genre_id order.
+GENRE_MASK_SQL = """COALESCE((
+  SELECT bit_or(1::bigint << g.bit)
+  FROM anime_genre ag JOIN genre g ON g.genre_id = ag.genre_id
+  WHERE ag.anime_id = {anime_id}
+), 0)"""
+
+
+@migration(3, "anime_genre_mask")
+def _anime_genre_mask(ctx: MigrationContext) -> None:
+    ctx.execute("ALTER TABLE genre ADD COLUMN IF NOT EXISTS bit smallint;")
+    # New genres get the next free bits; existing assignments never move.
+    ctx.execute(
+        """
+        UPDATE genre g SET bit = n.bit
+        FROM (
+          SELECT genre_id,
+                 (SELECT COALESCE(MAX(bit), -1) FROM genre) + row_number() OVER (ORDER BY genre_id) AS bit
+          FROM genre
+          WHERE bit IS NULL
+        ) n
+        WHERE g.genre_id = n.genre_id;
+        """
+    )
+    ctx.execute(
+        f"""
+        DO $$
+        BEGIN
+          IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'genre_bit_range') THEN
+            ALTER TABLE genre ADD CONSTRAINT genre_bit_range CHECK (bit >= 0 AND bit < {MAX_GENRE_BITS});
+          END IF;
+          IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'genre_bit_key') THEN
+            ALTER TABLE genre ADD CONSTRAINT genre_bit_key UNIQUE (bit);
+          END IF;
+        END $$;
+        """
+    )
+    ctx.execute("ALTER TABLE anime ADD COLUMN IF NOT EXISTS genre_mask bigint NOT NULL DEFAULT 0;")
+    ctx.execute(
+        f"""
+        CREATE OR REPLACE FUNCTION anime_refresh_genre_mask(target integer) RETURNS void AS $$
+          UPDATE anime SET genre_mask = {GENRE_MASK_SQL.format(anime_id="target")}
+          WHERE anime_id = target;
+        $$ LANGUAGE sql;
+        """
+    )
+    ctx.execute(
+        """
+        CREATE OR REPLACE FUNCTION anime_genre_mask_trigger() RETURNS trigger AS $$
+        BEGIN
+          IF TG_OP <> 'DELETE' THEN
+            PERFORM anime_refresh_genre_mask(NEW.anime_id);
+          END IF;
+          IF TG_OP <> 'INSERT' THEN
+            PERFORM anime_refresh_genre_mask(OLD.anime_id);
+          END IF;
+          RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """
+    )
+    ctx.execute("DROP TRIGGER IF EXISTS anime_genre_mask ON anime_genre;")
+    ctx.execute(
+        """
+        CREATE TRIGGER anime_genre_mask
+        AFTER INSERT OR UPDATE OR DELETE ON anime_genre
+        FOR EACH ROW EXECUTE FUNCTION anime_genre_mask_trigger();
+        """
+    )
+    ctx.backfill("anime", "anime_id", f"genre_mask = {GENRE_MASK_SQL.format(anime_id='t.anime_id')}", "TRUE")
+
+
+@migration(4, "similar_topk")
+def _similar_topk(ctx: MigrationContext) -> None:
+    # Written by similar_topk.py; done_through is the last anime_id of the last committed chunk.
+    ctx.execute(
+        """
+        CREATE TABLE IF NOT EXISTS similar_topk_run (
+          run_id serial PRIMARY KEY,
+          top_n smallint NOT NULL,
+          done_through integer NOT NULL DEFAULT -1,
+          anime_count integer,
+          started_at timestamptz NOT NULL DEFAULT now(),
+          finished_at timestamptz
+        );
+        """
+    )
+    # Unconstrained numeric keeps the scale route 5's division produces.
+    ctx.execute(
+        """
+        CREATE TABLE IF NOT EXISTS similar_topk (
+          run_id integer NOT NULL REFERENCES similar_topk_run ON DELETE CASCADE,
+          anime_id integer NOT NULL,
+          rank smallint NOT NULL,
+          similar_id integer NOT NULL,
+          similarity numeric NOT NULL,
+          PRIMARY KEY (run_id, anime_id, rank)
+        );
+        """
+    )
+
+
+@migration(5, "job_run")
+def _job_run(ctx: MigrationContext) -> None:
+    # Written by scheduler.py: one row per run of a periodic job, on whichever server led.
+    ctx.execute(
+        """
+        CREATE TABLE IF NOT EXISTS job_run (
+          run_id bigserial PRIMARY KEY,
+          job text NOT NULL,
+          instance text NOT NULL,
+          started_at timestamptz NOT NULL DEFAULT now(),
+          finished_at timestamptz,
+          status text NOT NULL DEFAULT 'running',
+          error text,
+          result jsonb
+        );
+        """
+    )
+    ctx.execute("CREATE INDEX IF NOT EXISTS job_run_job_idx ON job_run (job, run_id DESC);")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--list", action="store_true", help="show applied and pending migrations")
+    parser.add_argument("--dry-run", action="store_true", help="print the steps without running them")
+    parser.add_argument("--target", type=int, help="stop after this version")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    import psycopg2  # pylint: disable=import-outside-toplevel
+    from app import DB_CONFIG  # pylint: disable=import-outside-toplevel
+
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        ensure_migrations_table(conn)
+        if args.list:
+            done = applied_versions(conn)
+            for m in MIGRATIONS:
+                print(f"{m.version:04d} {m.name}: {'applied' if m.version in done else 'pending'}")
+            return 0
+        applied = migrate(conn, target=args.target, batch_size=args.batch_size, dry_run=args.dry_run)
+        if not applied:
+            print("nothing to do")
+        return 0
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,287 @@
+"""Approximate similar-anime search with MinHash signatures and banded LSH.
+
+Route 5 scores every anime against the seed (0.7 x genre Jaccard + 0.3 x
+studio Jaccard), so its cost grows with the catalog. ``MinHashIndex`` puts
+each anime's genre and studio ids into one feature set and hashes that set
+into a MinHash signature of ``bands * rows`` values. Two sets share any one
+signature value with probability equal to their Jaccard similarity. The
+signature is cut into ``bands`` bands of ``rows`` values, and anime that
+agree on a whole band land in the same bucket. A query only re-scores the
+seed's bucket mates, exactly and with the route's Postgres NUMERIC digits.
+
+More bands find more of the true neighbours at the cost of more candidates.
+Measure the trade-off against brute force with
+
+    python minhash.py eval --snapshot catalog.snap --seeds 500 --k 10
+"""
+import argparse
+import json
+import random
+import sys
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from decimal import Decimal
+from functools import lru_cache
+from typing import Any, Callable, Dict, FrozenSet, Iterable, List, Optional, Sequence, Tuple
+
+from catalog import NULL, Catalog
+from derived import DerivedIndex
+from genre_mask import MAX_GENRE_BITS
+from pgnumeric import div, round_half_away
+
+DEFAULT_BANDS = 64
+DEFAULT_ROWS = 4
+GENRE_WEIGHT = Decimal("0.7")
+STUDIO_WEIGHT = Decimal("0.3")
+SIMILARITY_DIGITS = 6  # route 5 sends similarity as a JSON number rounded to this many places
+_PRIME = (1 << 61) - 1  # Mersenne prime for the (a * x + b) mod p hash family
+
+
+def features(genre_mask: int, studios: Iterable[int]) -> FrozenSet[int]:
+    """Genre bits and studio ids as one set of ints (studios shifted past the genre bits)."""
+    genres = [bit for bit in range(MAX_GENRE_BITS) if genre_mask >> bit & 1]
+    return frozenset(genres + [MAX_GENRE_BITS + s for s in studios])
+
+
+def _jaccard(overlap: int, union: int) -> Decimal:
+    # overlap::decimal / union, with the digits Postgres would return
+    return div(Decimal(overlap), Decimal(union)) if union else Decimal(0)
+
+
+@lru_cache(maxsize=65536)
+def _score(genre_overlap: int, genre_union: int, studio_overlap: int, studio_union: int) -> Decimal:
+    # Only a few thousand count combinations occur, so each NUMERIC division runs once.
+    return _jaccard(genre_overlap, genre_union) * GENRE_WEIGHT + _jaccard(studio_overlap, studio_union) * STUDIO_WEIGHT
+
+
+def similarity_number(score: Decimal) -> float:
+    """``score`` as route 5 sends it, like ``ROUND(similarity, 6)::float8`` in Postgres."""
+    return float(round_half_away(score, SIMILARITY_DIGITS))
+
+
+def similarity(mask_a: int, studios_a: FrozenSet[int], mask_b: int, studios_b: FrozenSet[int]) -> Decimal:
+    """Route 5's score: 0.7 x genre Jaccard + 0.3 x studio Jaccard."""
+    return _score(
+        bin(mask_a & mask_b).count("1"),
+        bin(mask_a | mask_b).count("1"),
+        len(studios_a & studios_b),
+        len(studios_a | studios_b),
+    )
+
+
+class MinHasher:
+    """``num_perm`` random hash functions; a set's signature is the minimum of each over its members."""
+
+    def __init__(self, num_perm: int, seed: int = 1):
+        rng = random.Random(seed)
+        self.params = [(rng.randrange(1, _PRIME), rng.randrange(_PRIME)) for _ in range(num_perm)]
+        self._vectors: Dict[int, Tuple[int, ...]] = {}
+
+    def _vector(self, feature: int) -> Tuple[int, ...]:
+        # There are only a few hundred distinct genres and studios, so each
+        # feature is hashed once and signatures are element-wise minimums.
+        vector = self._vectors.get(feature)
+        if vector is None:
+            vector = self._vectors[feature] = tuple((a * feature + b) % _PRIME for a, b in self.params)
+        return vector
+
+    def signature(self, feature_set: Iterable[int]) -> Optional[Tuple[int, ...]]:
+        vectors = [self._vector(f) for f in feature_set]
+        if not vectors:
+            return None
+        return vectors[0] if len(vectors) == 1 else tuple(map(min, *vectors))
+
+
+class MinHashIndex:
+    """LSH buckets over one catalog's genre and studio sets."""
+
+    def __init__(self, catalog: Catalog, bands: int = DEFAULT_BANDS, rows: int = DEFAULT_ROWS, seed: int = 1):
+        self.catalog = catalog
+        self.bands = bands
+        self.rows = rows
+        hasher = MinHasher(bands * rows, seed)
+        self.masks = [0 if m == NULL else m for m in catalog.genre_mask]
+        self.studios = [frozenset(catalog.studios(i)) for i in range(catalog.n)]
+        # Only each band's hash is kept, ``bands`` int64s per anime: a query
+        # needs the bucket keys, never the signature itself. Hashing a band can
+        # collide, which only adds a candidate.
+        self.band_keys = array("q")
+        self.featureless = set()  # no genres and no studios: similar to nothing
+        for row in range(catalog.n):
+            signature = hasher.signature(features(self.masks[row], self.studios[row]))
+            if signature is None:
+                self.featureless.add(row)
+                self.band_keys.extend([0] * bands)
+            else:
+                self.band_keys.extend(hash(signature[band * rows:(band + 1) * rows]) for band in range(bands))
+        # Each band's buckets are runs of equal keys in a sorted array, with the
+        # matching rows alongside; far smaller than a dict of lists.
+        self.sorted_keys: List[array] = []
+        self.sorted_rows: List[array] = []
+        rows_with_features = [row for row in range(catalog.n) if row not in self.featureless]
+        for band in range(bands):
+            keys = self.band_keys[band::bands]
+            order = sorted(rows_with_features, key=keys.__getitem__)
+            self.sorted_keys.append(array("q", (keys[row] for row in order)))
+            self.sorted_rows.append(array("i", order))
+
+    def candidates(self, row: int) -> List[int]:
+        if row in self.featureless:
+            return []
+        found = set()
+        for band, (keys, rows) in enumerate(zip(self.sorted_keys, self.sorted_rows)):
+            key = self.band_keys[row * self.bands + band]
+            found.update(rows[bisect_left(keys, key):bisect_right(keys, key)])
+        found.discard(row)
+        return list(found)
+
+    def _ranked(self, seed: int, rows: Iterable[int], limit: int) -> List[Tuple[Decimal, int]]:
+        catalog, masks, studios = self.catalog, self.masks, self.studios
+        scored = []
+        for row in rows:
+            if not (masks[seed] & masks[row] or studios[seed] & studios[row]):
+                continue
+            scored.append((similarity(masks[seed], studios[seed], masks[row], studios[row]), row))
+        # ORDER BY similarity DESC, score DESC NULLS LAST, members_count DESC NULLS LAST
+        scored.sort(key=lambda item: (
+            -item[0],
+            -catalog.score_cents[item[1]] if catalog.score_cents[item[1]] != NULL else 1,
+            -catalog.members_count[item[1]] if catalog.members_count[item[1]] != NULL else 1,
+            catalog.anime_id[item[1]],
+        ))
+        return scored[:limit]
+
+    def _rows(self, ranked: Sequence[Tuple[Decimal, int]]) -> List[Dict[str, Any]]:
+        return [
+            {**self.catalog.summary(row, "score", "favorites_count", "members_count"), "similarity": score}
+            for score, row in ranked
+        ]
+
+    def similar(self, anime_id: int, limit: int) -> List[Dict[str, Any]]:
+        """Route 5's rows, from the LSH candidates only."""
+        seed = self.catalog.row_of(anime_id)
+        if seed is None:
+            return []
+        return self._rows(self._ranked(seed, self.candidates(seed), limit))
+
+    def exact(self, anime_id: int, limit: int) -> List[Dict[str, Any]]:
+        """Route 5's rows by brute force over the whole catalog."""
+        seed = self.catalog.row_of(anime_id)
+        if seed is None:
+            return []
+        return self._rows(self._ranked(seed, (r for r in range(self.catalog.n) if r != seed), limit))
+
+    def stats(self) -> Dict[str, Any]:
+        largest = 0
+        for keys in self.sorted_keys:
+            run = 0
+            for i, key in enumerate(keys):
+                run = run + 1 if i and keys[i - 1] == key else 1
+                largest = max(largest, run)
+        return {
+            "anime": self.catalog.n,
+            "bands": self.bands,
+            "rows": self.rows,
+            "featureless": len(self.featureless),
+            "largest_bucket": largest,
+        }
+
+
+def recall_at_k(index: MinHashIndex, anime_ids: Iterable[int], k: int) -> Dict[str, Any]:
+    """Share of the exact top ``k`` that approximate search returns, averaged over seeds.
+
+    Ties at the k-th exact score make the exact list ambiguous. An approximate
+    result therefore counts as a hit when its score is at least the k-th one.
+    """
+    recalls, candidates = [], []
+    approx_seconds = exact_seconds = 0.0
+    for anime_id in anime_ids:
+        started = time.perf_counter()
+        approx = index.similar(anime_id, k)
+        approx_seconds += time.perf_counter() - started
+        started = time.perf_counter()
+        exact = index.exact(anime_id, k)
+        exact_seconds += time.perf_counter() - started
+        if not exact:
+            continue
+        cutoff = exact[-1]["similarity"]
+        recalls.append(sum(row["similarity"] >= cutoff for row in approx) / len(exact))
+        candidates.append(len(index.candidates(index.catalog.row_of(anime_id))))
+    seeds = len(recalls)
+    return {
+        "seeds": seeds,
+        "k": k,
+        "bands": index.bands,
+        "rows": index.rows,
+        "recall_at_k": sum(recalls) / seeds if seeds else None,
+        "min_recall": min(recalls, default=None),
+        "avg_candidates": sum(candidates) / seeds if seeds else None,
+        "approx_ms_per_query": 1000 * approx_seconds / max(1, seeds),
+        "exact_ms_per_query": 1000 * exact_seconds / max(1, seeds),
+    }
+
+
+class SimilarIndex(DerivedIndex[MinHashIndex]):
+    """Holds the live ``MinHashIndex`` and rebuilds it from ``loader`` (which returns a Catalog)."""
+
+    name = "minhash"
+
+    def __init__(self, loader: Callable[[], Catalog], bands: int = DEFAULT_BANDS, rows: int = DEFAULT_ROWS):
+        super().__init__(loader)
+        self.bands = bands
+        self.rows = rows
+
+    def _make(self) -> MinHashIndex:
+        return MinHashIndex(self.loader(), self.bands, self.rows)
+
+    def index(self) -> MinHashIndex:
+        return self.get()
+
+    def similar(self, anime_id: int, limit: int) -> List[Dict[str, Any]]:
+        return self.index().similar(anime_id, limit)
+
+    def stats(self) -> Dict[str, Any]:
+        if not self.built:
+            return {"built": False, "bands": self.bands, "rows": self.rows}
+        return super().stats()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Measure MinHash/LSH recall against exact similar-anime search.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    evaluate = sub.add_parser("eval", help="recall@k of approximate search over random seeds")
+    evaluate.add_argument("--snapshot", help="catalog snapshot to use instead of loading from Postgres")
+    evaluate.add_argument("--seeds", type=int, default=200)
+    evaluate.add_argument("--k", type=int, default=10)
+    evaluate.add_argument("--bands", type=int, default=DEFAULT_BANDS)
+    evaluate.add_argument("--rows", type=int, default=DEFAULT_ROWS)
+    evaluate.add_argument("--random-seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if args.snapshot:
+        catalog = Catalog.open(args.snapshot)
+    else:
+        import psycopg2  # pylint: disable=import-outside-toplevel
+        from psycopg2.extras import RealDictCursor  # pylint: disable=import-outside-toplevel
+
+        from app import DB_CONFIG  # pylint: disable=import-outside-toplevel
+
+        conn = psycopg2.connect(cursor_factory=RealDictCursor, **DB_CONFIG)
+        try:
+            with conn.cursor() as cur:
+                catalog = Catalog.from_db(cur)
+        finally:
+            conn.close()
+
+    started = time.perf_counter()
+    index = MinHashIndex(catalog, args.bands, args.rows)
+    build_seconds = time.perf_counter() - started
+    ids = list(catalog.anime_id)
+    seeds = random.Random(args.random_seed).sample(ids, min(args.seeds, len(ids)))
+    print(json.dumps({**recall_at_k(index, seeds, args.k), "build_seconds": build_seconds}, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,255 @@
+"""Postgres NUMERIC arithmetic for the SQLite backend.
+
+The route queries divide, average and round NUMERIC values, and Postgres
+picks the scale of each result by its own rules (``select_div_scale`` and
+friends in ``numeric.c``). To return the same digits from SQLite, those
+queries call the functions registered here. The functions pass values
+between each other as fixed-point text, so no precision is lost to floats.
+"""
+import math
+from decimal import Decimal
+from fractions import Fraction
+from typing import Optional, Union
+
+NBASE_DIGITS = 4  # Postgres stores NUMERIC in base 10000 digits
+MIN_SIG_DIGITS = 16
+MAX_DISPLAY_SCALE = 1000
+
+Value = Union[None, int, float, str, bytes, Decimal]
+
+
+def to_decimal(value: Value, scale: Optional[int] = None) -> Optional[Decimal]:
+    """SQLite value -> Decimal, optionally at the column's declared scale."""
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        value = value.decode()
+    if isinstance(value, float):
+        value = repr(value)
+    d = Decimal(value)
+    return d if scale is None else round_half_away(d, scale)
+
+
+def to_text(value: Optional[Decimal]) -> Optional[str]:
+    return None if value is None else format(value, "f")
+
+
+def dscale(d: Decimal) -> int:
+    return max(0, -d.as_tuple().exponent)
+
+
+def _nbase_digits(d: Decimal):
+    """Weight and base-10000 digits of ``|d|``, as Postgres stores them."""
+    shift = -(-dscale(d) // NBASE_DIGITS)
+    n = int(d.copy_abs().scaleb(shift * NBASE_DIGITS))
+    digits = []
+    while n:
+        n, digit = divmod(n, 10 ** NBASE_DIGITS)
+        digits.append(digit)
+    digits.reverse()
+    return len(digits) - 1 - shift, digits
+
+
+def _weight_and_first_digit(d: Decimal):
+    weight, digits = _nbase_digits(d)
+    return (weight, digits[0]) if digits else (0, 0)
+
+
+def _clamp_scale(scale: int, *scales: int) -> int:
+    return min(max(scale, *scales, 0), MAX_DISPLAY_SCALE)
+
+
+def round_half_away(value: Union[Decimal, Fraction], scale: int) -> Decimal:
+    """Round to ``scale`` decimal places, halves away from zero, like Postgres."""
+    frac = Fraction(value) * 10 ** scale
+    q, r = divmod(abs(frac.numerator), frac.denominator)
+    if 2 * r >= frac.denominator:
+        q += 1
+    return Decimal(-q if frac < 0 else q).scaleb(-scale)
+
+
+def div_scale(a: Decimal, b: Decimal) -> int:
+    """``select_div_scale``: at least 16 significant digits, never fewer decimals than an input."""
+    weight1, first1 = _weight_and_first_digit(a)
+    weight2, first2 = _weight_and_first_digit(b)
+    qweight = weight1 - weight2
+    if first1 <= first2:
+        qweight -= 1
+    return _clamp_scale(MIN_SIG_DIGITS - qweight * NBASE_DIGITS, dscale(a), dscale(b))
+
+
+def div(a: Decimal, b: Decimal) -> Decimal:
+    if b.is_zero():
+        raise ZeroDivisionError("division by zero")
+    return round_half_away(Fraction(a) / Fraction(b), div_scale(a, b))
+
+
+def power_int(base: Decimal, exp: int) -> Decimal:
+    """``power_var_int`` for the small positive exponents the routes use."""
+    if exp < 1:
+        raise ValueError("only positive integer exponents are supported")
+    if base.is_zero():
+        return Decimal(0).scaleb(-_clamp_scale(MIN_SIG_DIGITS, dscale(base)))
+    # Estimate log10(|base| ** exp) from the leading base-10000 digits.
+    weight, digits = _nbase_digits(base)
+    f, p = float(digits[0]), weight * NBASE_DIGITS
+    for i in range(1, len(digits)):
+        if i * NBASE_DIGITS >= 16:
+            break
+        f = f * 10 ** NBASE_DIGITS + digits[i]
+        p -= NBASE_DIGITS
+    estimate = exp * (math.log10(f) + p)
+    scale = _clamp_scale(MIN_SIG_DIGITS - int(estimate), dscale(base))
+    return round_half_away(Fraction(base) ** exp, scale)
+
+
+def sqrt(value: Decimal) -> Decimal:
+    if value < 0:
+        raise ValueError("cannot take square root of a negative number")
+    weight, _ = _weight_and_first_digit(value)
+    sweight = (weight + 1) * NBASE_DIGITS // 2 - 1
+    scale = _clamp_scale(MIN_SIG_DIGITS - sweight, dscale(value))
+    # floor(sqrt) with one guard digit, then round the guard digit away.
+    frac = Fraction(value) * 10 ** (2 * (scale + 1))
+    root = math.isqrt(frac.numerator // frac.denominator)
+    q, guard = divmod(root, 10)
+    return Decimal(q + (guard >= 5)).scaleb(-scale)
+
+
+def _numeric_function(fn):
+    def wrapper(*args):
+        values = [to_decimal(a) for a in args]
+        if any(v is None for v in values):
+            return None
+        return to_text(fn(*values))
+
+    return wrapper
+
+
+def _num(value, scale=None):
+    return to_text(to_decimal(value, None if scale is None else int(scale)))
+
+
+def _num_round(value, scale):
+    d = to_decimal(value)
+    return None if d is None else to_text(round_half_away(d, int(scale)))
+
+
+def _num_power(value, exp):
+    d = to_decimal(value)
+    return None if d is None or exp is None else to_text(power_int(d, int(exp)))
+
+
+class NumericSum:
+    def __init__(self):
+        self.total: Optional[Decimal] = None
+
+    def step(self, value):
+        d = to_decimal(value)
+        if d is not None:
+            self.total = d if self.total is None else self.total + d
+
+    def finalize(self):
+        return to_text(self.total)
+
+
+class NumericAvg(NumericSum):
+    def __init__(self):
+        super().__init__()
+        self.n = 0
+
+    def step(self, value):
+        if value is not None:
+            self.n += 1
+        super().step(value)
+
+    def finalize(self):
+        return None if not self.n else to_text(div(self.total, Decimal(self.n)))
+
+
+class PercentileDisc:
+    """``percentile_disc(fraction) WITHIN GROUP (ORDER BY value)``, written ``percentile_disc(fraction, value)``."""
+
+    def __init__(self):
+        self.fraction = None
+        self.values = []
+
+    def step(self, fraction, value):
+        self.fraction = fraction
+        d = to_decimal(value)
+        if d is not None:
+            self.values.append(d)
+
+    def finalize(self):
+        if not self.values:
+            return None
+        self.values.sort()
+        row = max(1, math.ceil(self.fraction * len(self.values)))
+        return to_text(self.values[row - 1])
+
+
+class Corr:
+    """``corr(y, x)`` with the Youngs-Cramer updates Postgres uses (float8_regr_accum)."""
+
+    def __init__(self):
+        self.n = self.sx = self.sy = self.sxx = self.syy = self.sxy = 0.0
+
+    def step(self, y, x):
+        if x is None or y is None:
+            return
+        x, y = float(x), float(y)
+        old_n = self.n
+        self.n += 1.0
+        self.sx += x
+        self.sy += y
+        if old_n > 0.0:
+            tmp_x = x * self.n - self.sx
+            tmp_y = y * self.n - self.sy
+            scale = 1.0 / (self.n * old_n)
+            self.sxx += tmp_x * tmp_x * scale
+            self.syy += tmp_y * tmp_y * scale
+            self.sxy += tmp_x * tmp_y * scale
+
+    def finalize(self):
+        if self.n < 1.0 or self.sxx == 0.0 or self.syy == 0.0:
+            return None
+        return self.sxy / math.sqrt(self.sxx * self.syy)
+
+
+def width_bucket(operand, low, high, count):
+    """``width_bucket(float8, float8, float8, int)``."""
+    if None in (operand, low, high, count):
+        return None
+    operand, low, high = float(operand), float(low), float(high)
+    if low < high:
+        if operand < low:
+            return 0
+        if operand >= high:
+            return count + 1
+        bucket = int(count * ((operand - low) / (high - low)))
+    else:
+        if operand > low:
+            return 0
+        if operand <= high:
+            return count + 1
+        bucket = int(count * ((low - operand) / (low - high)))
+    return min(bucket, count - 1) + 1
+
+
+def register(conn) -> None:
+    """Register the NUMERIC helpers on a sqlite3 connection."""
+    det = {"deterministic": True}
+    conn.create_function("num", 1, _num, **det)
+    conn.create_function("num", 2, _num, **det)
+    conn.create_function("num_add", 2, _numeric_function(lambda a, b: a + b), **det)
+    conn.create_function("num_sub", 2, _numeric_function(lambda a, b: a - b), **det)
+    conn.create_function("num_mul", 2, _numeric_function(lambda a, b: a * b), **det)
+    conn.create_function("num_div", 2, _numeric_function(div), **det)
+    conn.create_function("num_round", 2, _num_round, **det)
+    conn.create_function("num_power", 2, _num_power, **det)
+    conn.create_function("num_sqrt", 1, _numeric_function(sqrt), **det)
+    conn.create_function("width_bucket", 4, width_bucket, **det)
+    conn.create_aggregate("num_sum", 1, NumericSum)
+    conn.create_aggregate("num_avg", 1, NumericAvg)
+    conn.create_aggregate("percentile_disc", 2, PercentileDisc)
+    conn.create_aggregate("corr", 2, Corr)
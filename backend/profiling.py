@@ -0,0 +1,205 @@
+"""On-demand sampling profiler for a single request.
+
+An admin request with ``X-Profile: 1`` (or ``?profile=1``) runs with a
+profiler. A background thread reads the request thread's Python stack
+(``sys._current_frames``) every ``interval`` seconds until the response is
+done. Each sample is weighted by the time since the previous one, so a
+sample delayed by the GIL still counts for the time it stood for. The C
+code of psycopg2 and sqlite3 has no Python frames, so the backends report
+the route query they are running (``sql``). While a query runs, its samples
+end in a ``SQL <statement>`` frame, and each statement's calls and seconds
+are also timed exactly.
+
+The newest ``keep`` profiles stay in memory. They are served as collapsed
+stacks (``a;b;c <microseconds>`` per line, for ``flamegraph.pl``) or as
+speedscope JSON (https://www.speedscope.app). A request without the flag
+costs each query one context variable lookup, and nothing else.
+"""
+import contextvars
+import itertools
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import nullcontext
+from typing import Any, Dict, List, Optional, Tuple
+
+DEFAULT_SAMPLE_INTERVAL = 0.001
+DEFAULT_PROFILES_KEPT = 20
+MAX_SAMPLES = 100_000  # about 100 s at the default interval
+
+Frame = Tuple[str, str, int]  # function, file, first line
+SQL_FRAME_FILE = "<sql>"
+
+_current: contextvars.ContextVar = contextvars.ContextVar("mal_profile", default=None)
+_NOT_PROFILED = nullcontext()
+
+
+def current() -> Optional["Profile"]:
+    return _current.get()
+
+
+def sql(name: str):
+    """Context manager around one route query; does nothing unless the request is profiled."""
+    profile = _current.get()
+    return _NOT_PROFILED if profile is None else _SQLSpan(profile, name)
+
+
+class _SQLSpan:
+    def __init__(self, profile: "Profile", name: str):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        self.profile.in_sql = self.name
+
+    def __exit__(self, exc_type, exc, tb):
+        self.profile.in_sql = None
+        calls_seconds = self.profile.sql.setdefault(self.name, [0, 0.0])
+        calls_seconds[0] += 1
+        calls_seconds[1] += time.perf_counter() - self.started
+        return False
+
+
+class Profile:
+    """The samples of one request: root-first stacks with weights in microseconds."""
+
+    def __init__(self, profile_id: int, method: str, path: str, thread_id: int, interval: float):
+        self.id = profile_id
+        self.method = method
+        self.path = path
+        self.thread_id = thread_id
+        self.interval = interval
+        self.started_at = time.time()
+        self.seconds: Optional[float] = None
+        self.status: Optional[int] = None
+        self.samples: List[Tuple[Tuple[Frame, ...], int]] = []
+        self.sql: Dict[str, List[Any]] = {}  # statement -> [calls, seconds]
+        self.in_sql: Optional[str] = None
+        self._started = time.perf_counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name=f"profile-{profile_id}", daemon=True)
+
+    def _sample(self) -> None:
+        frames = sys._current_frames  # pylint: disable=protected-access
+        last = self._started
+        while not self._stop.wait(self.interval) and len(self.samples) < MAX_SAMPLES:
+            frame = frames().get(self.thread_id)
+            now = time.perf_counter()
+            weight, last = int((now - last) * 1_000_000), now
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+                frame = frame.f_back
+            stack.reverse()
+            statement = self.in_sql
+            if statement is not None:
+                stack.append((f"SQL {statement}", SQL_FRAME_FILE, 0))
+            if stack and weight:
+                self.samples.append((tuple(stack), weight))
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self, status: Optional[int] = None) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.seconds = time.perf_counter() - self._started
+        self.status = status
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "profile_id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "status": self.status,
+            "started_at": self.started_at,
+            "seconds": None if self.seconds is None else round(self.seconds, 6),
+            "samples": len(self.samples),
+            "sampled_seconds": round(sum(weight for _, weight in self.samples) / 1_000_000, 6),
+            "sql": [
+                {"statement": name, "calls": calls, "seconds": round(seconds, 6)}
+                for name, (calls, seconds) in sorted(self.sql.items(), key=lambda item: -item[1][1])
+            ],
+        }
+
+    def collapsed(self) -> str:
+        """One ``frame;frame;... weight`` line per distinct stack, root first, weights in microseconds."""
+        totals: Dict[str, int] = {}
+        for stack, weight in self.samples:
+            key = ";".join(_label(frame).replace(";", ":") for frame in stack)
+            totals[key] = totals.get(key, 0) + weight
+        return "".join(f"{key} {weight}\n" for key, weight in sorted(totals.items()))
+
+    def speedscope(self) -> Dict[str, Any]:
+        """The samples in order as a speedscope "sampled" profile."""
+        index: Dict[Frame, int] = {}
+        samples = [[index.setdefault(frame, len(index)) for frame in stack] for stack, _ in self.samples]
+        weights = [weight for _, weight in self.samples]
+        name = f"{self.method} {self.path}"
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": name,
+            "exporter": "mal-analytics profiling.py",
+            "activeProfileIndex": 0,
+            "shared": {
+                "frames": [
+                    {"name": function} if path == SQL_FRAME_FILE else {"name": function, "file": path, "line": line}
+                    for function, path, line in index
+                ]
+            },
+            "profiles": [{
+                "type": "sampled",
+                "name": name,
+                "unit": "microseconds",
+                "startValue": 0,
+                "endValue": sum(weights),
+                "samples": samples,
+                "weights": weights,
+            }],
+        }
+
+
+def _label(frame: Frame) -> str:
+    function, path, line = frame
+    return function if path == SQL_FRAME_FILE else f"{function} ({os.path.basename(path)}:{line})"
+
+
+class Profiler:
+    """Starts and keeps per-request profiles; the newest ``keep`` are served by id."""
+
+    def __init__(self, interval: float = DEFAULT_SAMPLE_INTERVAL, keep: int = DEFAULT_PROFILES_KEPT):
+        self.interval = interval
+        self.keep = keep
+        self._profiles: "OrderedDict[int, Profile]" = OrderedDict()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.profiled = 0
+
+    def start(self, method: str, path: str) -> Tuple[Profile, contextvars.Token]:
+        """Profile the calling thread until ``stop``; the profile is current in this context."""
+        profile = Profile(next(self._ids), method, path, threading.get_ident(), self.interval)
+        token = _current.set(profile)
+        profile.start()
+        return profile, token
+
+    def stop(self, profile: Profile, token: contextvars.Token, status: Optional[int] = None) -> None:
+        profile.stop(status)
+        _current.reset(token)
+        with self._lock:
+            self.profiled += 1
+            self._profiles[profile.id] = profile
+            while len(self._profiles) > self.keep:
+                self._profiles.popitem(last=False)
+
+    def get(self, profile_id: int) -> Optional[Profile]:
+        with self._lock:
+            return self._profiles.get(profile_id)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            profiles = [profile.summary() for profile in reversed(self._profiles.values())]
+        return {"interval": self.interval, "keep": self.keep, "profiled": self.profiled, "profiles": profiles}
@@ -0,0 +1,291 @@
+"""Mergeable quantile sketches behind ``/api/stats/distribution``.
+
+A ``QuantileSketch`` counts values in buckets. Merging two sketches adds
+their counts, and removing a value subtracts one. So the sketches follow
+each changed anime instead of being rebuilt. t-digest and KLL cannot
+delete, which is why they are not used here.
+
+- ``score`` is NUMERIC(4,2) and is bucketed by hundredths, i.e. exactly: its
+  quantiles are the ``PERCENTILE_DISC`` values.
+- ``members_count`` and ``favorites_count`` use logarithmic buckets (as in
+  DDSketch). A quantile is within ``relative_accuracy`` of the
+  ``PERCENTILE_DISC`` value, plus 0.5 as it is rounded to an integer, and
+  there are about 800 buckets up to 10M.
+
+``DistributionIndex`` keeps one sketch per metric in each cell of
+(type, source_type, season) and of (genre, type, source_type, season). The
+first cells partition the catalog. In the second, an anime appears once per
+genre. A request merges the cells that pass its filters, grouped by one
+dimension, and the result is cached until the next change. Unfiltered
+groupings skip the merge: each dimension value also has its own sketches.
+"""
+import math
+import threading
+import time
+from decimal import Decimal
+from typing import Any, Callable, Dict, Iterable, List, Mapping, NamedTuple, Optional, Sequence, Tuple
+
+from catalog import NULL, Catalog
+
+DEFAULT_RELATIVE_ACCURACY = 0.01
+DEFAULT_QUANTILES = (0.1, 0.25, 0.5, 0.75, 0.9)
+MAX_CACHED_RESULTS = 256
+
+# metric -> (catalog column, exact buckets?)
+METRICS = {
+    "score": ("score_cents", True),
+    "members": ("members_count", False),
+    "favorites": ("favorites_count", False),
+}
+DIMENSIONS = ("genre", "season", "year", "type", "source_type")
+# ChangeSet columns that move an anime between cells or change its values.
+COLUMNS = ("score", "members_count", "favorites_count", "season", "year", "type", "source_type", "genres",
+           "genre_mask")
+
+
+class QuantileSketch:
+    """Bucket counts of non-negative integers; exact, or within a relative error plus 0.5."""
+
+    __slots__ = ("relative_accuracy", "_log_gamma", "_gamma", "counts", "count")
+
+    def __init__(self, relative_accuracy: float = 0.0):
+        if not 0 <= relative_accuracy < 1:
+            raise ValueError("relative_accuracy must be in [0, 1)")
+        self.relative_accuracy = relative_accuracy
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma) if relative_accuracy else None
+        self.counts: Dict[int, int] = {}
+        self.count = 0
+
+    def _key(self, value: int) -> int:
+        if self._log_gamma is None:
+            return value
+        # Bucket k covers (gamma^(k-1), gamma^k]; -1 holds zero.
+        return -1 if value <= 0 else math.ceil(math.log(value) / self._log_gamma)
+
+    def _value(self, key: int) -> int:
+        if self._log_gamma is None:
+            return key
+        # The point of the bucket with the same relative distance to both ends, rounded: off by up to
+        # relative_accuracy * value + 0.5.
+        return 0 if key < 0 else round(2 * self._gamma ** key / (self._gamma + 1))
+
+    def add(self, value: int, n: int = 1) -> None:
+        """Count ``value`` ``n`` times; a negative ``n`` removes it again."""
+        key = self._key(value)
+        left = self.counts.get(key, 0) + n
+        if left < 0:
+            raise ValueError(f"{value} was removed more often than it was added")
+        if left:
+            self.counts[key] = left
+        else:
+            self.counts.pop(key, None)
+        self.count += n
+
+    def merge(self, other: "QuantileSketch") -> None:
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("cannot merge sketches with different accuracies")
+        counts = self.counts
+        for key, n in other.counts.items():
+            counts[key] = counts.get(key, 0) + n
+        self.count += other.count
+
+    def quantiles(self, qs: Sequence[float]) -> List[Optional[int]]:
+        """``PERCENTILE_DISC(q)`` for each of ``qs``: the first value with ``ceil(q * count)`` values at or below it."""
+        if not self.count:
+            return [None] * len(qs)
+        targets = sorted((max(1, math.ceil(q * self.count)), i) for i, q in enumerate(qs))
+        out: List[Optional[int]] = [None] * len(qs)
+        seen, t = 0, 0
+        for key in sorted(self.counts):
+            seen += self.counts[key]
+            while t < len(targets) and targets[t][0] <= seen:
+                out[targets[t][1]] = self._value(key)
+                t += 1
+            if t == len(targets):
+                break
+        return out
+
+
+class _Record(NamedTuple):
+    """What one anime contributed: its cell, its genres and one value per metric."""
+
+    cell: Tuple[Any, ...]  # (type, source_type, season, year)
+    genre_ids: Tuple[int, ...]
+    values: Tuple[int, ...]  # NULL where the column is NULL
+
+
+def _records(catalog: Catalog, rows: Iterable[int]) -> Dict[int, _Record]:
+    columns = [getattr(catalog, column) for column, _ in METRICS.values()]
+    return {
+        catalog.anime_id[row]: _Record(catalog.labels(row), catalog.genre_ids(row), tuple(c[row] for c in columns))
+        for row in rows
+    }
+
+
+class DistributionIndex:
+    """Per-cell sketches of every metric, kept in step with the catalog that ``loader`` returns."""
+
+    def __init__(self, loader: Callable[[], Catalog], relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY):
+        self.loader = loader
+        self.relative_accuracy = relative_accuracy
+        self._accuracies = [0.0 if exact else relative_accuracy for _, exact in METRICS.values()]
+        # (genre_id or None, type, source_type, season, year) -> one sketch per metric
+        self._cells: Dict[Tuple[Any, ...], List[QuantileSketch]] = {}
+        # (dimension, value) -> one sketch per metric; (None, None) is the whole catalog
+        self._marginals: Dict[Tuple[Any, Any], List[QuantileSketch]] = {}
+        self._records: Dict[int, _Record] = {}
+        self._genre_names: Dict[int, str] = {}
+        self._results: Dict[Tuple[Any, ...], List[Dict[str, Any]]] = {}
+        self._built_at: Optional[float] = None
+        self._synced_at: Optional[float] = None
+        self.updates = 0
+        self._lock = threading.Lock()
+
+    def _apply(self, record: _Record, sign: int) -> None:
+        type_, source_type, season, year = record.cell
+        marginals = [(None, None), ("type", type_), ("source_type", source_type), ("season", season), ("year", year)]
+        marginals.extend(("genre", genre_id) for genre_id in record.genre_ids)
+        cells = [(genre_id, *record.cell) for genre_id in (None, *record.genre_ids)]
+        for table, keys in ((self._cells, cells), (self._marginals, marginals)):
+            for key in keys:
+                sketches = table.get(key)
+                if sketches is None:
+                    sketches = table[key] = [QuantileSketch(accuracy) for accuracy in self._accuracies]
+                for sketch, value in zip(sketches, record.values):
+                    if value != NULL:
+                        sketch.add(value, sign)
+                if sign < 0 and not any(sketch.count for sketch in sketches):
+                    del table[key]
+
+    def sync(self, catalog: Optional[Catalog] = None, anime_ids: Optional[Iterable[int]] = None) -> int:
+        """Bring the sketches in line with ``catalog`` for ``anime_ids`` (None: every anime).
+
+        Only anime whose cell, genres or values changed are moved; the result
+        is how many were. Anime missing from the catalog are removed.
+        """
+        catalog = catalog or self.loader()
+        with self._lock:
+            if anime_ids is None:
+                rows: Iterable[int] = range(catalog.n)
+                ids = set(self._records) | set(catalog.anime_id)
+            else:
+                ids = set(anime_ids)
+                rows = [row for row in map(catalog.row_of, ids) if row is not None]
+            fresh = _records(catalog, rows)
+            changed = 0
+            for anime_id in ids:
+                old, new = self._records.get(anime_id), fresh.get(anime_id)
+                if old == new:
+                    continue
+                changed += 1
+                if old is not None:
+                    self._apply(old, -1)
+                    del self._records[anime_id]
+                if new is not None:
+                    self._apply(new, 1)
+                    self._records[anime_id] = new
+            self._genre_names = {g["genre_id"]: g["name"] for g in catalog.genres}
+            if changed:
+                self._results.clear()
+            if self._built_at is None:
+                self._built_at = time.time()
+            else:
+                self.updates += changed
+            self._synced_at = time.time()
+            return changed
+
+    @property
+    def built(self) -> bool:
+        return self._built_at is not None
+
+    def distribution(
+        self,
+        metric: str,
+        by: Optional[str] = None,
+        filters: Optional[Mapping[str, Any]] = None,
+        qs: Sequence[float] = DEFAULT_QUANTILES,
+    ) -> List[Dict[str, Any]]:
+        """Quantiles of ``metric`` for each value of ``by`` among the anime matching ``filters``.
+
+        ``filters`` may hold ``type``, ``source_type``, ``season``, ``year`` and
+        ``genre_id``; raises ValueError for unknown metrics or dimensions.
+        """
+        if metric not in METRICS:
+            raise ValueError(f"metric must be one of: {', '.join(METRICS)}")
+        if by is not None and by not in DIMENSIONS:
+            raise ValueError(f"by must be one of: {', '.join(DIMENSIONS)}")
+        wanted = {key: value for key, value in (filters or {}).items() if value is not None}
+        unknown = set(wanted) - {"genre_id", "type", "source_type", "season", "year"}
+        if unknown:
+            raise ValueError(f"unknown filters: {', '.join(sorted(unknown))}")
+        if not self.built:
+            self.sync()
+        cache_key = (metric, by, tuple(sorted(wanted.items())), tuple(qs))
+        with self._lock:
+            result = self._results.get(cache_key)
+            if result is None:
+                result = self._merge(metric, by, wanted, qs)
+                if len(self._results) >= MAX_CACHED_RESULTS:
+                    self._results.pop(next(iter(self._results)))
+                self._results[cache_key] = result
+        return result
+
+    def _merge(self, metric: str, by: Optional[str], wanted: Mapping[str, Any], qs: Sequence[float]):
+        index = list(METRICS).index(metric)
+        if not wanted:
+            groups = {value: sketches[index] for (dimension, value), sketches in self._marginals.items()
+                      if dimension == by}
+            return self._shape(metric, by, groups, qs)
+        # Genre grouping or a genre filter reads the per-genre cells, everything else the partition.
+        per_genre = by == "genre" or "genre_id" in wanted
+        positions = {"genre_id": 0, "type": 1, "source_type": 2, "season": 3, "year": 4}
+        group_at = None if by is None else positions["genre_id" if by == "genre" else by]
+        groups: Dict[Any, QuantileSketch] = {}
+        for key, sketches in self._cells.items():
+            if (key[0] is not None) != per_genre:
+                continue
+            if any(key[positions[name]] != value for name, value in wanted.items()):
+                continue
+            group = None if group_at is None else key[group_at]
+            merged = groups.get(group)
+            if merged is None:
+                merged = groups[group] = QuantileSketch(self._accuracies[index])
+            merged.merge(sketches[index])
+        return self._shape(metric, by, groups, qs)
+
+    def _shape(self, metric: str, by: Optional[str], groups: Mapping[Any, QuantileSketch], qs: Sequence[float]):
+        exact_score = metric == "score"
+        result = []
+        for group, sketch in groups.items():
+            if not sketch.count:
+                continue
+            values = sketch.quantiles(qs)
+            item: Dict[str, Any] = (
+                {"genre_id": group, "name": self._genre_names.get(group)} if by == "genre" else {"value": group}
+            )
+            item["count"] = sketch.count
+            item["quantiles"] = {
+                _label(q): (Decimal(v).scaleb(-2) if exact_score and v is not None else v) for q, v in zip(qs, values)
+            }
+            result.append(item)
+        key = "name" if by == "genre" else "value"
+        result.sort(key=lambda item: (-item["count"], item[key] is None, str(item[key] or "")))
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "built": self.built,
+                "built_at": self._built_at,
+                "synced_at": self._synced_at,
+                "anime": len(self._records),
+                "cells": len(self._cells),
+                "updates": self.updates,
+                "cached_results": len(self._results),
+                "relative_accuracy": self.relative_accuracy,
+            }
+
+
+def _label(q: float) -> str:
+    return format(q, "g")
@@ -0,0 +1,289 @@
+"""In-process scheduler for periodic jobs, run by one server at a time.
+
+Every server process runs a ``Scheduler`` with the same jobs, but only the
+leader runs them. The leader is the process whose scheduler connection holds
+the session-level advisory lock ``SCHEDULER_LOCK_ID``. The others try to
+take the lock every ``poll`` seconds. When the leader stops, Postgres ends
+its session and releases the lock, and another server takes over within
+one poll. A server that loses its connection stops leading and cancels the
+queries of its running jobs, since another server may now run them.
+
+Every run is a row of ``job_run`` (migration 5): which server ran it, when,
+and how it ended. A job is due ``interval`` seconds after its last recorded
+start, plus a random delay of up to ``jitter`` seconds, wherever that ran.
+So a new leader does not repeat a job the old one just ran, and does not
+wait a whole interval either. A job runs in its own thread on its own
+connection, and never twice at once. After ``timeout`` seconds the
+scheduler cancels the job's current query. The job fails at that query
+(Python code between queries cannot be interrupted) and the run is
+recorded as ``timeout``.
+
+Jobs are configured as ``name=interval[:jitter[:timeout]],...`` in seconds
+(``MAL_JOBS``). Jitter defaults to a tenth of the interval and the timeout
+to the interval.
+"""
+import json
+import os
+import random
+import socket
+import threading
+import time
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+SCHEDULER_LOCK_ID = 550_2904  # pg_advisory_lock key of the scheduler leader
+DEFAULT_POLL_SECONDS = 30.0
+
+# The newest run of each job, from any server.
+LATEST_RUNS_QUERY = """
+SELECT DISTINCT ON (job)
+  job, run_id, instance, extract(epoch FROM started_at)::float8, extract(epoch FROM finished_at)::float8,
+  status, error
+FROM job_run
+WHERE job = ANY(%s)
+ORDER BY job, run_id DESC;
+"""
+
+
+class JobSpec(NamedTuple):
+    interval: float
+    jitter: float
+    timeout: float
+
+
+def parse_jobs(value: Optional[str]) -> Dict[str, JobSpec]:
+    """Parse ``name=interval[:jitter[:timeout]],...`` (as found in MAL_JOBS)."""
+    jobs: Dict[str, JobSpec] = {}
+    for item in (value or "").split(","):
+        if not item.strip():
+            continue
+        name, _, spec = item.partition("=")
+        parts = spec.strip().split(":")
+        try:
+            interval = float(parts[0])
+            jitter = float(parts[1]) if len(parts) > 1 else interval / 10
+            timeout = float(parts[2]) if len(parts) > 2 else interval
+        except ValueError:
+            raise ValueError(f"job {name.strip()!r} must be interval[:jitter[:timeout]] in seconds") from None
+        if len(parts) > 3 or interval <= 0 or jitter < 0 or timeout <= 0:
+            raise ValueError(f"job {name.strip()!r} must be interval[:jitter[:timeout]] in seconds")
+        jobs[name.strip()] = JobSpec(interval, jitter, timeout)
+    return jobs
+
+
+def default_instance() -> str:
+    """This server's name in ``job_run``: the Fly machine id, else host and pid."""
+    return os.environ.get("FLY_MACHINE_ID") or f"{socket.gethostname()}:{os.getpid()}"
+
+
+class Job:
+    """A named periodic job: ``fn(conn)`` runs in a transaction it may commit, and returns a JSON-able result."""
+
+    def __init__(self, name: str, fn: Callable[[Any], Any], interval: float, jitter: float, timeout: float):
+        self.name = name
+        self.fn = fn
+        self.interval = interval
+        self.jitter = jitter
+        self.timeout = timeout
+        self.last: Optional[Dict[str, Any]] = None  # newest job_run row, from any server
+        self.next_due: Optional[float] = None
+        self._due_after: Any = ()  # run_id next_due was drawn for
+        self.thread: Optional[threading.Thread] = None
+        self.conn = None  # connection of the running run
+        self.timed_out = False
+        self.runs = 0  # runs on this server
+        self.failures = 0
+        self.timeouts = 0
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def schedule(self, rnd: random.Random, now: float) -> None:
+        """Draw ``next_due`` once per newest run: its start plus interval and jitter (or now, if none)."""
+        run_id = None if self.last is None else self.last["run_id"]
+        if run_id == self._due_after:
+            return
+        self._due_after = run_id
+        base = now if self.last is None else self.last["started_at"] + self.interval
+        self.next_due = base + rnd.uniform(0, self.jitter)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "interval": self.interval,
+            "jitter": self.jitter,
+            "timeout": self.timeout,
+            "running": self.running,
+            "next_due": self.next_due,
+            "last": self.last,
+            "runs": self.runs,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+        }
+
+
+class Scheduler:
+    """Runs registered jobs on whichever server holds the leader lock; ``connect`` opens a Postgres connection."""
+
+    def __init__(self, connect: Callable, instance: Optional[str] = None, poll: float = DEFAULT_POLL_SECONDS,
+                 rnd: Optional[random.Random] = None):
+        self.connect = connect
+        self.instance = instance or default_instance()
+        self.poll = poll
+        self.jobs: Dict[str, Job] = {}
+        self.leader_since: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self._conn = None
+        self._random = rnd or random.Random()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def add(self, name: str, fn: Callable[[Any], Any], spec: JobSpec) -> Job:
+        if name in self.jobs:
+            raise ValueError(f"job {name!r} is already registered")
+        job = self.jobs[name] = Job(name, fn, *spec)
+        return job
+
+    @property
+    def leader(self) -> bool:
+        return self.leader_since is not None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def tick(self) -> List[Job]:
+        """One poll: keep or take the leader lock, read the newest runs, and start the due jobs."""
+        try:
+            if self._conn is None:
+                self._conn = self.connect()
+                self._conn.autocommit = True
+            with self._conn.cursor() as cur:
+                if not self.leader:
+                    cur.execute("SELECT pg_try_advisory_lock(%s);", (SCHEDULER_LOCK_ID,))
+                    if cur.fetchone()[0]:
+                        self.leader_since = time.time()
+                        # Runs still open from another server ended with its session.
+                        cur.execute(
+                            """
+                            UPDATE job_run SET finished_at = now(), status = 'abandoned'
+                            WHERE finished_at IS NULL AND instance <> %s;
+                            """,
+                            (self.instance,),
+                        )
+                cur.execute(LATEST_RUNS_QUERY, (sorted(self.jobs),))
+                latest = cur.fetchall()
+        except Exception as exc:  # pylint: disable=broad-except
+            self._step_down(exc)
+            return []
+        for name, run_id, instance, started_at, finished_at, status, error in latest:
+            self.jobs[name].last = {
+                "run_id": run_id, "instance": instance, "started_at": started_at, "finished_at": finished_at,
+                "status": status, "error": error,
+            }
+        if not self.leader:
+            return []
+        now = time.time()
+        started = []
+        for job in self.jobs.values():
+            job.schedule(self._random, now)
+            if not job.running and job.next_due <= now:
+                job.thread = threading.Thread(target=self.run, args=(job,), name=f"job-{job.name}", daemon=True)
+                job.thread.start()
+                started.append(job)
+        return started
+
+    def _step_down(self, exc: Exception) -> None:
+        # Without the session the lock is gone, and another server may start these jobs.
+        self.last_error = f"{type(exc).__name__}: {exc}"
+        print(f"Scheduler error: {self.last_error}")
+        self.leader_since = None
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:  # pylint: disable=broad-except
+                pass
+        for job in self.jobs.values():
+            if job.running and job.conn is not None:
+                job.conn.cancel()
+
+    def run(self, job: Job) -> Dict[str, Any]:
+        """Run ``job`` once on a new connection and record the run in ``job_run``."""
+        conn = self.connect()
+        status, error, result = "ok", None, None
+        job.timed_out = False
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    INSERT INTO job_run (job, instance) VALUES (%s, %s)
+                    RETURNING run_id, extract(epoch FROM started_at)::float8;
+                    """,
+                    (job.name, self.instance),
+                )
+                run_id, started_at = cur.fetchone()
+            conn.commit()
+            job.last = {"run_id": run_id, "instance": self.instance, "started_at": started_at, "finished_at": None,
+                        "status": "running", "error": None}
+            job.conn = conn
+            timer = threading.Timer(job.timeout, self._time_out, (job, conn))
+            timer.daemon = True
+            timer.start()
+            try:
+                result = job.fn(conn)
+                conn.commit()
+            except Exception as exc:  # pylint: disable=broad-except
+                conn.rollback()
+                status = "timeout" if job.timed_out else "error"
+                error = f"{type(exc).__name__}: {str(exc).strip()}"
+            finally:
+                timer.cancel()
+                job.conn = None
+            job.runs += 1
+            if status != "ok":
+                job.failures += 1
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    UPDATE job_run SET finished_at = now(), status = %s, error = %s, result = %s::jsonb
+                    WHERE run_id = %s
+                    RETURNING extract(epoch FROM finished_at)::float8;
+                    """,
+                    (status, error, json.dumps(result, default=str), run_id),
+                )
+                finished_at = cur.fetchone()[0]
+            conn.commit()
+            job.last = {**job.last, "finished_at": finished_at, "status": status, "error": error}
+            return job.last
+        finally:
+            conn.close()
+
+    def _time_out(self, job: Job, conn) -> None:
+        job.timed_out = True
+        job.timeouts += 1
+        conn.cancel()
+
+    def loop(self) -> None:
+        while not self._stop.is_set():
+            self.tick()
+            self._stop.wait(self.poll)
+
+    def start(self) -> threading.Thread:
+        self._thread = threading.Thread(target=self.loop, name="scheduler", daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "instance": self.instance,
+            "running": self.running,
+            "leader": self.leader,
+            "leader_since": self.leader_since,
+            "poll": self.poll,
+            "last_error": self.last_error,
+            "jobs": [job.stats() for job in self.jobs.values()],
+        }
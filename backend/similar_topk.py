@@ -0,0 +1,291 @@
+"""Offline all-pairs top-N for route 5, stored in ``similar_topk``.
+
+Route 5 scores the whole catalog against one seed per request. This job
+scores every seed once and writes each one's ``top_n`` most similar anime
+(same score, same NUMERIC digits, same order), so the route can answer any
+``limit`` up to ``top_n`` with a primary-key range read.
+
+Scoring a seed never looks at all pairs:
+
+* studios are sparse: the seed's studio ids are looked up in an inverted
+  list (studio -> rows), which yields every anime sharing a studio. Those
+  are scored exactly;
+* every other candidate scores ``0.7 * genre Jaccard``, which only depends
+  on its genre mask. Distinct masks (a few thousand) are grouped by that
+  value, best first, and each mask's rows are kept in the route's tie-break
+  order (score, then members). The genre-only part of the answer is read
+  off the front of the groups and stops after ``top_n`` rows.
+
+Seeds are split into chunks and scored on a process pool. Each chunk is
+written and committed with the run's ``done_through`` marker, so an
+interrupted run resumes after the last committed chunk:
+
+    python similar_topk.py                 # new run, or resume the unfinished one
+    python similar_topk.py --top-n 200 --workers 4
+    python similar_topk.py --restart       # drop the unfinished run and start over
+
+A finished run replaces the previous one; the one before that is kept until
+the next run finishes, so servers that still cache its id keep answering.
+"""
+import argparse
+import heapq
+import json
+import multiprocessing
+import os
+import sys
+import time
+from bisect import bisect_right
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+from itertools import chain
+from typing import Any, Callable, Dict, Iterator, List, Mapping, Optional, Sequence, Tuple
+
+from catalog import NULL, Catalog
+from genre_mask import MAX_GENRE_BITS
+from minhash import similarity
+
+SIMILAR_TOPK_LOCK_ID = 550_2903  # pg_advisory_lock key reserved for this job
+DEFAULT_TOP_N = 100
+DEFAULT_CHUNK_SIZE = 500
+MASK_CACHE_SIZE = 4096  # seed masks whose genre groups a worker keeps
+
+# The catalog columns the scorer needs; plain arrays, so they pickle to workers.
+SECTIONS = ("anime_id", "genre_mask", "studio_offsets", "studio_ids", "score_cents", "members_count")
+_NO_STUDIOS: frozenset = frozenset()
+
+
+class TopNScorer:
+    """Route 5's top ``n`` for any seed row of one catalog."""
+
+    def __init__(self, sections: Mapping[str, Sequence[int]]):
+        self.anime_id = sections["anime_id"]
+        self.n = len(self.anime_id)
+        self.masks = [0 if m == NULL else m for m in sections["genre_mask"]]
+        offsets, ids = sections["studio_offsets"], sections["studio_ids"]
+        self.studios = [frozenset(ids[offsets[i]:offsets[i + 1]]) for i in range(self.n)]
+        score, members = sections["score_cents"], sections["members_count"]
+        # ORDER BY score DESC NULLS LAST, members_count DESC NULLS LAST, then anime_id.
+        order = sorted(range(self.n), key=lambda i: (
+            -score[i] if score[i] != NULL else 1,
+            -members[i] if members[i] != NULL else 1,
+            self.anime_id[i],
+        ))
+        self.position = [0] * self.n
+        for position, row in enumerate(order):
+            self.position[row] = position
+        self.by_studio: Dict[int, List[int]] = {}
+        self.by_mask: Dict[int, List[int]] = {}
+        for row in order:
+            for studio in self.studios[row]:
+                self.by_studio.setdefault(studio, []).append(row)
+            if self.masks[row]:
+                self.by_mask.setdefault(self.masks[row], []).append(row)
+        self.mask_bits = {mask: bin(mask).count("1") for mask in self.by_mask}
+        self.by_bit: Dict[int, List[int]] = {}  # genre bit -> masks with that bit
+        for mask in self.by_mask:
+            for bit in range(MAX_GENRE_BITS):
+                if mask >> bit & 1:
+                    self.by_bit.setdefault(bit, []).append(mask)
+        self._groups: Dict[int, List[List[int]]] = {}
+
+    @classmethod
+    def from_catalog(cls, catalog: Catalog) -> "TopNScorer":
+        return cls({name: catalog.sections[name] for name in SECTIONS})
+
+    def _genre_groups(self, seed_mask: int) -> List[List[int]]:
+        """Masks overlapping ``seed_mask``, grouped by genre-only similarity, best first."""
+        groups = self._groups.get(seed_mask)
+        if groups is None:
+            # Overlaps of every mask with the seed in one pass over the seed's genre postings.
+            seed_bits = [bit for bit in range(MAX_GENRE_BITS) if seed_mask >> bit & 1]
+            overlaps = Counter(chain.from_iterable(self.by_bit.get(bit, ()) for bit in seed_bits))
+            by_counts: Dict[Tuple[int, int], List[int]] = {}
+            for mask, overlap in overlaps.items():
+                by_counts.setdefault((overlap, self.mask_bits[mask]), []).append(mask)
+            # The score only depends on the two counts; one representative mask gives it.
+            by_value: Dict[Decimal, List[int]] = {}
+            for masks in by_counts.values():
+                by_value.setdefault(similarity(seed_mask, _NO_STUDIOS, masks[0], _NO_STUDIOS), []).extend(masks)
+            groups = [by_value[value] for value in sorted(by_value, reverse=True)]
+            if len(self._groups) >= MASK_CACHE_SIZE:
+                self._groups.clear()
+            self._groups[seed_mask] = groups
+        return groups
+
+    def top(self, seed: int, n: int) -> List[Tuple[int, Decimal]]:
+        """``(row, similarity)`` of the seed's ``n`` best matches, in route 5's order."""
+        seed_mask, seed_studios = self.masks[seed], self.studios[seed]
+        shared_studio = {row for studio in seed_studios for row in self.by_studio[studio]}
+        shared_studio.discard(seed)
+        genre_only: List[int] = []
+        if seed_mask:
+            for masks in self._genre_groups(seed_mask):
+                lists = [self.by_mask[mask] for mask in masks]
+                rows = lists[0] if len(lists) == 1 else heapq.merge(*lists, key=self.position.__getitem__)
+                for row in rows:
+                    if row != seed and row not in shared_studio:
+                        genre_only.append(row)
+                        if len(genre_only) == n:
+                            break
+                if len(genre_only) == n:
+                    break
+        scored = [
+            (row, similarity(seed_mask, seed_studios, self.masks[row], self.studios[row]))
+            for row in (*shared_studio, *genre_only)
+        ]
+        scored.sort(key=lambda item: (-item[1], self.position[item[0]]))
+        return scored[:n]
+
+
+_worker_scorer: Optional[TopNScorer] = None
+
+
+def _init_worker(sections: Mapping[str, Sequence[int]]) -> None:
+    global _worker_scorer
+    _worker_scorer = TopNScorer(sections)
+
+
+def _score_chunk(bounds: Tuple[int, int, int]) -> List[Tuple[int, List[Tuple[int, Decimal]]]]:
+    start, end, n = bounds
+    scorer = _worker_scorer
+    return [
+        (scorer.anime_id[row], [(scorer.anime_id[r], s) for r, s in scorer.top(row, n)])
+        for row in range(start, end)
+    ]
+
+
+def _imap(fn: Callable, items: Sequence, workers: int, initializer=None, initargs=()) -> Iterator:
+    """Ordered ``map`` over a process pool (or inline for one worker), yielding as results arrive."""
+    if workers <= 1 or len(items) <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        yield from map(fn, items)
+        return
+    # Spawned, not forked, so no lock held by a caller's thread is copied into a
+    # worker. A spawned worker re-imports the caller's main module, which is why
+    # the server runs this job as its own process (see app._refresh_similar_topk).
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=context, initializer=initializer, initargs=initargs
+    ) as pool:
+        yield from pool.map(fn, items)
+
+
+def _row(cur_row, *names):
+    return tuple(cur_row[name] for name in names) if isinstance(cur_row, dict) else tuple(cur_row)
+
+
+def _start_run(conn, top_n: int, restart: bool, log) -> Tuple[int, int]:
+    """``(run_id, done_through)``: the unfinished run to resume, or a new one."""
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT run_id, top_n, done_through FROM similar_topk_run "
+            "WHERE finished_at IS NULL ORDER BY run_id DESC LIMIT 1;"
+        )
+        found = cur.fetchone()
+        if found is not None:
+            run_id, run_top_n, done_through = _row(found, "run_id", "top_n", "done_through")
+            if run_top_n == top_n and not restart:
+                log(f"resuming run {run_id} after anime_id {done_through}")
+                return run_id, done_through
+            log(f"dropping unfinished run {run_id} (top_n {run_top_n})")
+            cur.execute("DELETE FROM similar_topk_run WHERE finished_at IS NULL;")
+        cur.execute("INSERT INTO similar_topk_run (top_n) VALUES (%s) RETURNING run_id;", (top_n,))
+        (run_id,) = _row(cur.fetchone(), "run_id")
+    conn.commit()
+    log(f"started run {run_id} (top_n {top_n})")
+    return run_id, -1
+
+
+def run(conn, top_n: int = DEFAULT_TOP_N, workers: Optional[int] = None, chunk_size: int = DEFAULT_CHUNK_SIZE,
+        restart: bool = False, log=print) -> Dict[str, Any]:
+    """Compute and store the top ``top_n`` of every anime; resumes an unfinished run."""
+    from psycopg2.extras import RealDictCursor, execute_values  # pylint: disable=import-outside-toplevel
+
+    workers = workers or os.cpu_count() or 1
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_advisory_lock(%s);", (SIMILAR_TOPK_LOCK_ID,))
+    conn.commit()
+    try:
+        run_id, done_through = _start_run(conn, top_n, restart, log)
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            catalog = Catalog.from_db(cur)
+        conn.commit()
+        started = time.perf_counter()
+        first = bisect_right(catalog.anime_id, done_through)
+        bounds = [(i, min(i + chunk_size, catalog.n), top_n) for i in range(first, catalog.n, chunk_size)]
+        sections = {name: catalog.sections[name] for name in SECTIONS}
+        seeds = 0
+        for chunk in _imap(_score_chunk, bounds, workers, _init_worker, (sections,)):
+            with conn.cursor() as cur:
+                execute_values(
+                    cur,
+                    "INSERT INTO similar_topk (run_id, anime_id, rank, similar_id, similarity) VALUES %s",
+                    [
+                        (run_id, anime_id, rank, similar_id, score)
+                        for anime_id, neighbours in chunk
+                        for rank, (similar_id, score) in enumerate(neighbours, 1)
+                    ],
+                    page_size=5000,
+                )
+                cur.execute(
+                    "UPDATE similar_topk_run SET done_through = %s WHERE run_id = %s;", (chunk[-1][0], run_id)
+                )
+            conn.commit()
+            seeds += len(chunk)
+            log(f"  {first + seeds} / {catalog.n} anime")
+        with conn.cursor() as cur:
+            cur.execute(
+                "UPDATE similar_topk_run SET finished_at = now(), anime_count = %s WHERE run_id = %s;",
+                (catalog.n, run_id),
+            )
+            # Keep the run this one replaces; drop everything older.
+            cur.execute(
+                """
+                DELETE FROM similar_topk_run
+                WHERE run_id < (
+                  SELECT MAX(run_id) FROM similar_topk_run WHERE finished_at IS NOT NULL AND run_id < %s
+                );
+                """,
+                (run_id,),
+            )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_unlock(%s);", (SIMILAR_TOPK_LOCK_ID,))
+        conn.commit()
+    seconds = time.perf_counter() - started
+    log(f"scored {seeds} anime in {seconds:.1f}s")
+    return {"run_id": run_id, "top_n": top_n, "anime": catalog.n, "scored": seeds, "seconds": round(seconds, 1)}
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Precompute route 5's top-N similar anime for every title.")
+    parser.add_argument("--top-n", type=int, default=DEFAULT_TOP_N, help="neighbours stored per anime")
+    parser.add_argument("--workers", type=int, help="scoring processes (default: one per CPU)")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="seeds per committed chunk")
+    parser.add_argument("--restart", action="store_true", help="drop an unfinished run instead of resuming it")
+    args = parser.parse_args(argv)
+    if args.top_n <= 0 or args.chunk_size <= 0:
+        parser.error("--top-n and --chunk-size must be positive")
+
+    import psycopg2  # pylint: disable=import-outside-toplevel
+
+    from app import DB_CONFIG  # pylint: disable=import-outside-toplevel
+
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        result = run(conn, args.top_n, args.workers, args.chunk_size, args.restart,
+                     log=lambda line: print(line, file=sys.stderr))
+    finally:
+        conn.close()
+    print(json.dumps(result))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,132 @@
+"""Single-flight coalescing of identical concurrent calls.
+
+When several callers ask for the same key at the same time, only the first
+(the leader) runs the work; the others wait for it and share its result or
+its exception. Nothing is cached: once the leader finishes the key is free
+again and the next call runs fresh.
+
+``do`` is for threaded servers. ``do_async`` is for coroutines; it coalesces
+coroutine functions on the running event loop and hands plain functions to
+the loop's executor so they share the in-flight table with threaded callers.
+"""
+import asyncio
+import functools
+import threading
+from typing import Any, Awaitable, Callable, Dict, Hashable, Mapping, Optional, Tuple
+
+
+class CoalesceTimeout(TimeoutError):
+    """Raised to a waiter whose leader did not finish within the timeout."""
+
+
+class _Call:
+    __slots__ = ("done", "result", "error", "waiters")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+        self.waiters = 0
+
+
+def _freeze(value):
+    if isinstance(value, Mapping):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted(_freeze(v) for v in value))
+    return value
+
+
+def coalesce_key(route: str, params: Optional[Mapping[str, Any]] = None) -> Tuple[Hashable, ...]:
+    """Build a hashable key from a route name and its parsed parameters."""
+    return (route, _freeze(params or {}))
+
+
+class SingleFlight:
+    def __init__(self, timeout: Optional[float] = None):
+        self.timeout = timeout
+        self._calls: Dict[Hashable, _Call] = {}
+        self._tasks: Dict[Tuple[int, Hashable], "asyncio.Task"] = {}
+        self._lock = threading.Lock()
+        self.executions = 0
+        self.coalesced = 0
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls) + len(self._tasks)
+
+    def stats(self) -> Dict[str, int]:
+        return {"in_flight": self.in_flight(), "executions": self.executions, "coalesced": self.coalesced}
+
+    def do(self, key: Hashable, fn: Callable[[], Any], timeout: Optional[float] = None) -> Any:
+        """Run ``fn`` unless an identical call is already running; then wait for it."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.executions += 1
+            else:
+                call.waiters += 1
+                self.coalesced += 1
+
+        if leader:
+            try:
+                call.result = fn()
+            except BaseException as exc:  # propagate to every waiter, including us
+                call.error = exc
+            finally:
+                with self._lock:
+                    self._calls.pop(key, None)
+                call.done.set()
+        else:
+            wait = self.timeout if timeout is None else timeout
+            if not call.done.wait(wait):
+                raise CoalesceTimeout(f"timed out after {wait}s waiting for in-flight {key!r}")
+
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    async def do_async(
+        self,
+        key: Hashable,
+        fn: Callable[[], Any],
+        timeout: Optional[float] = None,
+    ) -> Any:
+        """Async counterpart of ``do``.
+
+        ``fn`` may be a coroutine function, which is coalesced per event loop,
+        or a blocking function, which runs through ``do`` in the default
+        executor.
+        """
+        wait = self.timeout if timeout is None else timeout
+        loop = asyncio.get_running_loop()
+
+        if not asyncio.iscoroutinefunction(fn):
+            return await loop.run_in_executor(None, functools.partial(self.do, key, fn, wait))
+
+        task_key = (id(loop), key)
+        with self._lock:
+            task = self._tasks.get(task_key)
+            if task is None:
+                task = loop.create_task(self._lead(task_key, fn))
+                self._tasks[task_key] = task
+                self.executions += 1
+            else:
+                self.coalesced += 1
+
+        try:
+            # shield() so one impatient waiter does not cancel the shared work.
+            return await asyncio.wait_for(asyncio.shield(task), wait)
+        except asyncio.TimeoutError as exc:
+            raise CoalesceTimeout(f"timed out after {wait}s waiting for in-flight {key!r}") from exc
+
+    async def _lead(self, task_key, fn: Callable[[], Awaitable[Any]]) -> Any:
+        try:
+            return await fn()
+        finally:
+            with self._lock:
+                self._tasks.pop(task_key, None)
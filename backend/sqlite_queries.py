@@ -0,0 +1,359 @@
+"""SQLite versions of the route queries, keyed by statement name.
+
+Routes not listed here run their Postgres SQL with only the placeholders
+rewritten (see ``storage.to_named``). The queries here replace what SQLite
+lacks: arrays (``json_each`` instead), GROUPING SETS, ``::`` casts and
+Postgres NUMERIC arithmetic (the ``num_*`` functions from ``pgnumeric``).
+An output column named ``"x [NUMERIC]"`` is returned as a Decimal, like
+psycopg2 returns NUMERIC.
+"""
+from catalog import ANIME_SELECT
+
+# Bit mask and count of the requested genres; an unknown id leaves n short.
+_WANTED_GENRES = """
+wanted AS (
+  SELECT COALESCE(SUM(1 << g.bit), 0) AS mask, COUNT(*) AS n
+  FROM genre g
+  WHERE g.genre_id IN (SELECT value FROM json_each(:genre_ids))
+)"""
+
+_GENRE_FILTER = "(:genre_ids IS NULL OR (w.n = json_array_length(:genre_ids) AND (a.genre_mask & w.mask) = w.mask))"
+
+_RATING_COUNT = """(a.score_1_count + a.score_2_count + a.score_3_count + a.score_4_count +
+     a.score_5_count + a.score_6_count + a.score_7_count + a.score_8_count +
+     a.score_9_count + a.score_10_count)"""
+
+SQLITE_QUERIES = {
+    "search_anime": f"""
+    WITH {_WANTED_GENRES}
+    SELECT {ANIME_SELECT}
+    FROM anime a, wanted w
+    WHERE
+      (:season IS NULL OR a.season = :season) AND
+      (:type IS NULL OR a.type = :type) AND
+      (:source_type IS NULL OR a.source_type = :source_type) AND
+      (:min_score IS NULL OR a.score >= :min_score) AND
+      (:max_score IS NULL OR a.score <= :max_score) AND
+      {_GENRE_FILTER}
+    ORDER BY a.score DESC NULLS LAST, a.members_count DESC NULLS LAST
+    LIMIT :limit;
+    """,
+    # UNION makes every metric NUMERIC in Postgres.
+    "top_lists": """
+    SELECT list, anime_id, title, metric AS "metric [NUMERIC]"
+    FROM (
+      SELECT * FROM (
+        SELECT 'rating' AS list, a.anime_id, a.title, num(a.score, 2) AS metric, a.score AS sort_key
+        FROM anime a
+        WHERE a.score IS NOT NULL
+        ORDER BY a.score DESC
+        LIMIT 10
+      )
+      UNION ALL
+      SELECT * FROM (
+        SELECT 'popularity', a.anime_id, a.title, num(a.members_count), a.members_count
+        FROM anime a
+        ORDER BY a.members_count DESC NULLS LAST
+        LIMIT 10
+      )
+      UNION ALL
+      SELECT * FROM (
+        SELECT 'favorites', a.anime_id, a.title, num(a.favorites_count), a.favorites_count
+        FROM anime a
+        ORDER BY a.favorites_count DESC NULLS LAST
+        LIMIT 10
+      )
+    )
+    ORDER BY list, sort_key DESC NULLS LAST;
+    """,
+    "top_anime": """
+    SELECT a.anime_id, a.title, a.score, a.favorites_count, a.members_count
+    FROM anime a
+    ORDER BY
+      CASE :metric
+        WHEN 'rating' THEN a.score
+        WHEN 'popularity' THEN a.members_count
+        WHEN 'favorites' THEN a.favorites_count
+      END DESC NULLS LAST,
+      a.members_count DESC NULLS LAST
+    LIMIT :limit
+    OFFSET :offset;
+    """,
+    "recommendations_multi": """
+    WITH seeds AS (
+      SELECT s.value AS seed_id, w.value AS weight
+      FROM json_each(:seeds) s
+      JOIN json_each(:weights) w ON w.key = s.key
+    ),
+    pairs AS (
+      SELECT
+        s.seed_id,
+        s.weight,
+        CASE WHEN r.anime_id_a = s.seed_id THEN r.anime_id_b ELSE r.anime_id_a END AS rec_id,
+        MAX(r.num_recommenders) AS votes
+      FROM seeds s
+      JOIN recommendation r ON r.anime_id_a = s.seed_id OR r.anime_id_b = s.seed_id
+      GROUP BY s.seed_id, s.weight, rec_id
+    ),
+    recs AS (
+      SELECT p.rec_id, SUM(p.weight * p.votes) AS votes, COUNT(*) AS seeds
+      FROM pairs p
+      WHERE p.rec_id NOT IN (SELECT seed_id FROM seeds)
+      GROUP BY p.rec_id
+    )
+    SELECT DISTINCT a.anime_id, a.title, a.score, a.num_episodes, recs.votes, recs.seeds
+    FROM recs
+    JOIN anime a ON a.anime_id = recs.rec_id
+    LEFT JOIN anime_genre ag ON ag.anime_id = a.anime_id
+    WHERE (:min_score IS NULL OR a.score >= :min_score)
+      AND (:genre_id IS NULL OR ag.genre_id = :genre_id)
+      AND (:era_start IS NULL OR a.year BETWEEN :era_start AND :era_end)
+    ORDER BY recs.votes DESC, a.score DESC NULLS LAST, a.anime_id
+    LIMIT :limit;
+    """,
+    "similar": """
+    WITH seed_g AS (
+      SELECT genre_id FROM anime_genre WHERE anime_id = :seed_id
+    ),
+    seed_s AS (
+      SELECT studio_id FROM anime_studio WHERE anime_id = :seed_id
+    ),
+    overlap_stats AS (
+      SELECT c.anime_id,
+             COUNT(DISTINCT ag.genre_id) FILTER (WHERE ag.genre_id IN (SELECT genre_id FROM seed_g)) AS g_overlap,
+             COUNT(DISTINCT ast.studio_id) FILTER (WHERE ast.studio_id IN (SELECT studio_id FROM seed_s)) AS s_overlap,
+             COUNT(DISTINCT ag.genre_id) AS g_total_c,
+             (SELECT COUNT(*) FROM seed_g) AS g_total_s,
+             COUNT(DISTINCT ast.studio_id) AS s_total_c,
+             (SELECT COUNT(*) FROM seed_s) AS s_total_s
+      FROM anime c
+      LEFT JOIN anime_genre ag ON ag.anime_id = c.anime_id
+      LEFT JOIN anime_studio ast ON ast.anime_id = c.anime_id
+      WHERE c.anime_id <> :seed_id
+      GROUP BY c.anime_id
+    ),
+    scored AS (
+      SELECT o.anime_id, o.g_overlap, o.s_overlap,
+             num_add(
+               num_mul(CASE WHEN (g_total_c + g_total_s - g_overlap) > 0
+                            THEN num_div(g_overlap, g_total_c + g_total_s - g_overlap) ELSE 0 END, '0.7'),
+               num_mul(CASE WHEN (s_total_c + s_total_s - s_overlap) > 0
+                            THEN num_div(s_overlap, s_total_c + s_total_s - s_overlap) ELSE 0 END, '0.3')
+             ) AS similarity
+      FROM overlap_stats o
+    )
+    SELECT a.anime_id, a.title,
+           a.score, a.favorites_count, a.members_count,
+           CAST(num_round(s.similarity, 6) AS REAL) AS similarity
+    FROM scored s
+    JOIN anime a ON a.anime_id = s.anime_id
+    WHERE s.g_overlap > 0 OR s.s_overlap > 0
+    ORDER BY CAST(s.similarity AS REAL) DESC, a.score DESC NULLS LAST, a.members_count DESC NULLS LAST
+    LIMIT :limit;
+    """,
+    "top_adjusted_score": """
+    WITH hist AS (
+      SELECT
+        a.anime_id,
+        a.title,
+        a.score AS original_score,
+        a.members_count,
+        (a.score_2_count + a.score_3_count + a.score_4_count + a.score_5_count +
+         a.score_6_count + a.score_7_count + a.score_8_count + a.score_9_count +
+         a.score_10_count) AS n_no1,
+        (2 * a.score_2_count + 3 * a.score_3_count + 4 * a.score_4_count +
+         5 * a.score_5_count + 6 * a.score_6_count + 7 * a.score_7_count +
+         8 * a.score_8_count + 9 * a.score_9_count + 10 * a.score_10_count) AS sumx_no1
+      FROM anime a
+    ),
+    scored AS (
+      SELECT
+        anime_id, title, original_score, members_count, n_no1,
+        num_round(num_div(sumx_no1, NULLIF(n_no1, 0)), 2) AS adjusted_score,
+        num_round(num_sub(num_div(sumx_no1, NULLIF(n_no1, 0)), num(original_score, 2)), 2) AS delta_vs_original
+      FROM hist
+      WHERE n_no1 >= 100
+    )
+    SELECT anime_id, title,
+           adjusted_score AS "adjusted_score [NUMERIC]",
+           original_score,
+           delta_vs_original AS "delta_vs_original [NUMERIC]",
+           n_no1 AS remaining_ratings,
+           members_count
+    FROM scored
+    WHERE adjusted_score IS NOT NULL
+    ORDER BY CAST(adjusted_score AS REAL) DESC, remaining_ratings DESC, members_count DESC NULLS LAST
+    LIMIT :limit;
+    """,
+    "stats_years_ratings": f"""
+    WITH with_year AS (
+      SELECT a.year, a.score, {_RATING_COUNT} AS rating_count
+      FROM anime a
+      WHERE a.score IS NOT NULL
+    ),
+    by_year AS (
+      SELECT
+        year,
+        COUNT(*) AS n_titles,
+        SUM(rating_count) AS total_ratings,
+        num_round(num_avg(num(score, 2)), 2) AS avg_score
+      FROM with_year
+      WHERE year IS NOT NULL
+      GROUP BY year
+    ),
+    ranked AS (
+      SELECT
+        year, n_titles, total_ratings, avg_score,
+        DENSE_RANK() OVER (ORDER BY CAST(avg_score AS REAL) DESC NULLS LAST) AS rank_by_avg
+      FROM by_year
+    )
+    SELECT year, n_titles, total_ratings, avg_score AS "avg_score [NUMERIC]", rank_by_avg
+    FROM ranked
+    ORDER BY rank_by_avg, year;
+    """,
+    "stats_episodes_vs_metrics": """
+    WITH base AS (
+      SELECT num_episodes, score, favorites_count, members_count
+      FROM anime
+      WHERE num_episodes IS NOT NULL AND num_episodes > 0
+    ),
+    bins AS (
+      SELECT
+        width_bucket(num_episodes, 1, 100, 10) AS bucket,
+        MIN(num_episodes) AS min_eps,
+        MAX(num_episodes) AS max_eps,
+        COUNT(*) AS n,
+        num_avg(num(score, 2)) AS avg_score,
+        num_avg(favorites_count) AS avg_favorites,
+        num_avg(members_count) AS avg_members
+      FROM base
+      GROUP BY width_bucket(num_episodes, 1, 100, 10)
+    )
+    SELECT b.bucket, b.min_eps, b.max_eps, b.n,
+      b.avg_score AS "avg_score [NUMERIC]",
+      b.avg_favorites AS "avg_favorites [NUMERIC]",
+      b.avg_members AS "avg_members [NUMERIC]",
+      (SELECT corr(CAST(num_episodes AS REAL), CAST(score AS REAL)) FROM base) AS corr_eps_score,
+      (SELECT corr(CAST(num_episodes AS REAL), CAST(favorites_count AS REAL)) FROM base) AS corr_eps_favorites,
+      (SELECT corr(CAST(num_episodes AS REAL), CAST(members_count AS REAL)) FROM base) AS corr_eps_members
+    FROM bins b
+    ORDER BY bucket;
+    """,
+    "ratings_volatile": f"""
+    WITH hist AS (
+      SELECT
+        a.anime_id, a.title,
+        {_RATING_COUNT} AS n,
+        (1 * a.score_1_count + 2 * a.score_2_count + 3 * a.score_3_count + 4 * a.score_4_count +
+         5 * a.score_5_count + 6 * a.score_6_count + 7 * a.score_7_count + 8 * a.score_8_count +
+         9 * a.score_9_count + 10 * a.score_10_count) AS sumx,
+        ( 1 * a.score_1_count + 4 * a.score_2_count + 9 * a.score_3_count + 16 * a.score_4_count +
+           25 * a.score_5_count + 36 * a.score_6_count + 49 * a.score_7_count + 64 * a.score_8_count +
+           81 * a.score_9_count + 100 * a.score_10_count ) AS sumx2
+      FROM anime a
+    ),
+    stats AS (
+      SELECT
+        anime_id,
+        title,
+        n,
+        num_div(sumx, NULLIF(n, 0)) AS mean_score,
+        num_sqrt(num_sub(num_div(sumx2, NULLIF(n, 0)), num_power(num_div(sumx, NULLIF(n, 0)), 2))) AS stddev_score
+      FROM hist
+      WHERE n >= 500
+    )
+    SELECT anime_id, title, n AS rating_count,
+           mean_score AS "mean_score [NUMERIC]", stddev_score AS "stddev_score [NUMERIC]"
+    FROM stats
+    ORDER BY CAST(stddev_score AS REAL) DESC, rating_count DESC
+    LIMIT :limit;
+    """,
+    "stats_sequels_vs_first_season": """
+    WITH RECURSIVE
+    edges AS (
+      SELECT DISTINCT
+             ra.anime_id_a AS earlier_id,
+             ra.anime_id_b AS later_id
+      FROM related_anime ra
+      WHERE ra.relation_type LIKE 'Sequel'
+    ),
+    roots AS (
+      SELECT DISTINCT e.earlier_id AS root_id
+      FROM edges e
+      WHERE NOT EXISTS (SELECT 1 FROM edges x WHERE x.later_id = e.earlier_id)
+    ),
+    chain AS (
+      SELECT r.root_id, r.root_id AS node_id, 0 AS depth
+      FROM roots r
+      UNION ALL
+      SELECT c.root_id, e.later_id, c.depth + 1
+      FROM chain c
+      JOIN edges e ON e.earlier_id = c.node_id
+    ),
+    dedup AS (
+      SELECT root_id, node_id, MIN(depth) AS depth
+      FROM chain
+      WHERE depth > 0
+      GROUP BY root_id, node_id
+    ),
+    pairs AS (
+      SELECT num_sub(num(c.score, 2), num(r.score, 2)) AS diff
+      FROM dedup d
+      JOIN anime r ON r.anime_id = d.root_id
+      JOIN anime c ON c.anime_id = d.node_id
+      WHERE r.score IS NOT NULL AND c.score IS NOT NULL
+    )
+    SELECT
+      COUNT(*) AS comparisons,
+      num_avg(diff) AS "avg_diff [NUMERIC]",
+      percentile_disc(0.5, diff) AS "median_diff [NUMERIC]",
+      num_div(SUM(CAST(diff AS REAL) > 0), COUNT(*)) AS "pct_later_higher [NUMERIC]"
+    FROM pairs;
+    """,
+    # Postgres does this in one GROUPING SETS scan; SQLite gets one scan per facet.
+    "anime_facets": f"""
+    WITH {_WANTED_GENRES},
+    base AS (
+      SELECT
+        a.season, a.type, a.source_type, a.genre_mask,
+        (:season IS NULL OR a.season = :season) AS f_season,
+        (:type IS NULL OR a.type = :type) AS f_type,
+        (:source_type IS NULL OR a.source_type = :source_type) AS f_source_type,
+        ((:min_score IS NULL OR a.score >= :min_score) AND
+         (:max_score IS NULL OR a.score <= :max_score)) AS f_score,
+        {_GENRE_FILTER} AS f_genre
+      FROM anime a, wanted w
+    )
+    SELECT 'season' AS facet, season AS value, NULL AS genre_id,
+           SUM(f_type AND f_source_type AND f_score AND f_genre) AS count
+    FROM base GROUP BY season HAVING count > 0
+    UNION ALL
+    SELECT 'type', type, NULL, SUM(f_season AND f_source_type AND f_score AND f_genre)
+    FROM base GROUP BY type HAVING SUM(f_season AND f_source_type AND f_score AND f_genre) > 0
+    UNION ALL
+    SELECT 'source_type', source_type, NULL, SUM(f_season AND f_type AND f_score AND f_genre)
+    FROM base GROUP BY source_type HAVING SUM(f_season AND f_type AND f_score AND f_genre) > 0
+    UNION ALL
+    SELECT 'total', NULL, NULL, SUM(f_season AND f_type AND f_source_type AND f_score AND f_genre)
+    FROM base
+    UNION ALL
+    SELECT 'genre', g.name, g.genre_id, COUNT(*)
+    FROM base b
+    JOIN genre g ON (b.genre_mask >> g.bit) & 1
+    WHERE b.f_season AND b.f_type AND b.f_source_type AND b.f_score
+    GROUP BY g.genre_id, g.name;
+    """,
+    # Rows the change feed re-reads for the anime an ingest touched.
+    "catalog_anime_by_id": """
+    SELECT a.anime_id, a.title, a.score, a.members_count, a.favorites_count, a.num_episodes,
+           a.year, a.genre_mask, a.type, a.source_type, a.season
+    FROM anime a
+    WHERE a.anime_id IN (SELECT value FROM json_each(:ids))
+    ORDER BY a.anime_id;
+    """,
+    "autocomplete_titles_by_id": """
+    SELECT a.anime_id, a.title, a.score, a.num_episodes, a.members_count
+    FROM anime a
+    WHERE a.title IS NOT NULL AND a.anime_id IN (SELECT value FROM json_each(:ids));
+    """,
+}
@@ -0,0 +1,212 @@
+"""Server-side prepared statements for the fixed route queries.
+
+Every route query is a constant SQL string, so instead of letting Postgres
+parse and plan it on every call we PREPARE it once per pooled connection and
+run it with EXECUTE afterwards. Queries keep their psycopg2 ``%(name)s``
+placeholders; the registry rewrites them to ``$n`` positional parameters.
+"""
+import re
+import threading
+import weakref
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Tuple
+
+import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+
+
+PLAN_CACHE_MODES = ("auto", "force_generic_plan", "force_custom_plan")
+
+# Connection classes that understand PREPARE/EXECUTE. Anything else (test
+# doubles, other drivers) gets the plain query.
+PG_CONNECTION_TYPES: Tuple[type, ...] = (psycopg2.extensions.connection,)
+
+# Errors meaning the server no longer has a usable copy of the statement:
+# the session lost it, or the underlying tables changed shape.
+STALE_STATEMENT_ERRORS: Tuple[type, ...] = (
+    psycopg2.errors.InvalidSqlStatementName,
+    psycopg2.errors.FeatureNotSupported,
+)
+
+_PLACEHOLDER = re.compile(r"%\((\w+)\)s|%%")
+
+# Route names such as "similar" are SQL keywords, so server-side names get a prefix.
+PREPARED_NAME_PREFIX = "mal_"
+
+
+def to_positional(sql: str) -> Tuple[str, List[str]]:
+    """Rewrite ``%(name)s`` placeholders as ``$n``.
+
+    Returns the rewritten SQL and the parameter names in ``$n`` order. A name
+    used several times maps to the same ``$n``.
+    """
+    names: List[str] = []
+
+    def _replace(match):
+        name = match.group(1)
+        if name is None:
+            return "%"
+        if name not in names:
+            names.append(name)
+        return f"${names.index(name) + 1}"
+
+    rewritten = _PLACEHOLDER.sub(_replace, sql).strip().rstrip(";").strip()
+    return rewritten, names
+
+
+def parse_plan_cache_modes(value: Optional[str]) -> Dict[str, str]:
+    """Parse ``name=mode,name=mode`` (as found in MAL_PLAN_CACHE_MODES)."""
+    modes: Dict[str, str] = {}
+    for item in (value or "").split(","):
+        if not item.strip():
+            continue
+        name, _, mode = item.partition("=")
+        name, mode = name.strip(), mode.strip()
+        if mode not in PLAN_CACHE_MODES:
+            raise ValueError(f"plan cache mode for {name!r} must be one of: {', '.join(PLAN_CACHE_MODES)}")
+        modes[name] = mode
+    return modes
+
+
+class Statement:
+    """One named query and the SQL needed to prepare and execute it."""
+
+    def __init__(
+        self,
+        name: str,
+        sql: str,
+        param_types: Optional[Mapping[str, str]] = None,
+        plan_cache_mode: Optional[str] = None,
+    ):
+        if not re.fullmatch(r"[A-Za-z_]\w*", name):
+            raise ValueError(f"invalid statement name: {name!r}")
+        if plan_cache_mode is not None and plan_cache_mode not in PLAN_CACHE_MODES:
+            raise ValueError(f"invalid plan cache mode: {plan_cache_mode!r}")
+
+        self.name = name
+        self.prepared_name = PREPARED_NAME_PREFIX + name
+        self.sql = sql
+        self.plan_cache_mode = plan_cache_mode
+        body, self.param_names = to_positional(sql)
+
+        param_types = param_types or {}
+        missing = [p for p in self.param_names if p not in param_types]
+        if missing:
+            raise ValueError(f"statement {name!r} is missing parameter types for: {', '.join(missing)}")
+
+        types = ", ".join(param_types[p] for p in self.param_names)
+        prepared = self.prepared_name
+        self.prepare_sql = f"PREPARE {prepared} ({types}) AS {body}" if types else f"PREPARE {prepared} AS {body}"
+        placeholders = ", ".join(["%s"] * len(self.param_names))
+        self.execute_sql = f"EXECUTE {prepared} ({placeholders})" if placeholders else f"EXECUTE {prepared}"
+
+    def bind(self, params: Optional[Mapping[str, Any]]) -> List[Any]:
+        params = params or {}
+        return [params[p] for p in self.param_names]
+
+
+class StatementRegistry:
+    """Prepares named statements lazily, once per connection.
+
+    ``invalidate()`` bumps a generation counter; each connection notices on
+    its next use, runs ``DEALLOCATE ALL`` and prepares again. Use it after a
+    schema change (see ``migrations``) so stale plans are never executed.
+    """
+
+    def __init__(
+        self,
+        param_types: Optional[Mapping[str, Mapping[str, str]]] = None,
+        plan_cache_modes: Optional[Mapping[str, str]] = None,
+        enabled: bool = True,
+    ):
+        self.param_types = dict(param_types or {})
+        self.plan_cache_modes = dict(plan_cache_modes or {})
+        self.enabled = enabled
+        self._statements: Dict[str, Statement] = {}
+        self._prepared: "weakref.WeakKeyDictionary[Any, Tuple[int, set]]" = weakref.WeakKeyDictionary()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def statement(self, name: str, sql: str) -> Statement:
+        stmt = self._statements.get(name)
+        if stmt is None or stmt.sql != sql:
+            stmt = Statement(name, sql, self.param_types.get(name), self.plan_cache_modes.get(name))
+            with self._lock:
+                if name in self._statements:
+                    # Same name, new SQL: connections must re-prepare it.
+                    self._generation += 1
+                self._statements[name] = stmt
+        return stmt
+
+    def set_plan_cache_mode(self, name: str, mode: Optional[str]) -> None:
+        if mode is not None and mode not in PLAN_CACHE_MODES:
+            raise ValueError(f"invalid plan cache mode: {mode!r}")
+        with self._lock:
+            if mode is None:
+                self.plan_cache_modes.pop(name, None)
+            else:
+                self.plan_cache_modes[name] = mode
+            if name in self._statements:
+                self._statements[name].plan_cache_mode = mode
+
+    def invalidate(self) -> int:
+        """Forget every prepared statement on every connection."""
+        with self._lock:
+            self._generation += 1
+            return self._generation
+
+    def prepared_on(self, conn) -> Iterable[str]:
+        generation, names = self._prepared.get(conn, (None, set()))
+        return set(names) if generation == self._generation else set()
+
+    def execute(
+        self,
+        cur,
+        name: str,
+        sql: str,
+        params: Optional[Mapping[str, Any]] = None,
+        timeout_ms: Optional[int] = None,
+    ) -> None:
+        """Run ``sql`` under ``name`` on ``cur``, preparing it first if needed.
+
+        ``timeout_ms`` becomes the transaction's ``statement_timeout``.
+        """
+        conn = getattr(cur, "connection", None)
+        if not self.enabled or not isinstance(conn, PG_CONNECTION_TYPES):
+            if timeout_ms and isinstance(conn, PG_CONNECTION_TYPES):
+                cur.execute(f"SET LOCAL statement_timeout = {int(timeout_ms)}")
+            if params is None:
+                cur.execute(sql)
+            else:
+                cur.execute(sql, params)
+            return
+
+        stmt = self.statement(name, sql)
+        try:
+            self._execute_prepared(cur, conn, stmt, params, timeout_ms)
+        except STALE_STATEMENT_ERRORS:
+            # Nothing else has run in this transaction yet, so rolling it back
+            # loses no work. Start over with a clean slate on this connection.
+            conn.rollback()
+            self._prepared.pop(conn, None)
+            self._execute_prepared(cur, conn, stmt, params, timeout_ms)
+
+    def _execute_prepared(self, cur, conn, stmt: Statement, params, timeout_ms: Optional[int] = None) -> None:
+        generation = self._generation
+        seen_generation, names = self._prepared.get(conn, (None, set()))
+        if seen_generation != generation:
+            cur.execute("DEALLOCATE ALL")
+            names = set()
+            self._prepared[conn] = (generation, names)
+        if stmt.name not in names:
+            cur.execute(stmt.prepare_sql)
+            names.add(stmt.name)
+        if stmt.plan_cache_mode:
+            cur.execute(f"SET LOCAL plan_cache_mode = {stmt.plan_cache_mode}")
+        if timeout_ms:
+            cur.execute(f"SET LOCAL statement_timeout = {int(timeout_ms)}")
+        cur.execute(stmt.execute_sql, stmt.bind(params))
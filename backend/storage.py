@@ -0,0 +1,504 @@
+"""Storage backends for the route queries: Postgres or an embedded SQLite file.
+
+Routes call ``BACKEND.fetch(name, query, params)`` with their Postgres SQL.
+``PostgresBackend`` runs it as a prepared statement on a pooled connection.
+``SQLiteBackend`` runs the SQLite version of the same statement
+(``sqlite_queries.py``, or the Postgres text with ``:name`` placeholders when
+the SQL is portable) against a read-only local file, so read traffic can be
+served with no network round trip. Pick the backend with ``MAL_STORAGE``
+(``postgres`` or ``sqlite:///path/to/mal.sqlite3``).
+
+Build the SQLite file from the cleaned CSVs, or copy it from Postgres:
+
+    python storage.py build-sqlite mal.sqlite3 --csv-dir path/to/csvs
+    python storage.py build-sqlite mal.sqlite3 --from-postgres
+"""
+import argparse
+import ast
+import csv
+import datetime
+import json
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+from contextlib import contextmanager
+from decimal import Decimal
+from typing import Any, Callable, Dict, Iterable, List, Mapping, NamedTuple, Optional, Sequence, Tuple
+
+import psycopg2.errors
+import psycopg2.extensions
+
+import deadlines
+import pgnumeric
+import profiling
+from catalog import ANIME_COLUMNS
+from genre_mask import MAX_GENRE_BITS
+from sqlite_queries import SQLITE_QUERIES
+
+ANIME_CSV = "anime cleaned.csv"
+ANIME_ANIME_CSV = "anime_anime cleaned.csv"
+# Optional exports of the database's name tables. The anime dump only names the
+# genres and studios, so without them ids are made up in name order.
+GENRE_CSV = "genre.csv"  # genre_id,name[,bit]
+STUDIO_CSV = "studio.csv"  # studio_id,name
+NULLS = {"", "\\N", "NULL", "nan", "NaT", "<NA>"}
+
+# psycopg2 returns NUMERIC as Decimal. Columns declared NUMERIC_<scale> (and
+# query columns named "x [NUMERIC]") come back from SQLite the same way.
+MAX_NUMERIC_SCALE = 20
+sqlite3.register_converter("NUMERIC", lambda raw: Decimal(raw.decode()))
+for _scale in range(MAX_NUMERIC_SCALE + 1):
+    sqlite3.register_converter(
+        f"NUMERIC_{_scale}", lambda raw, scale=_scale: pgnumeric.to_decimal(raw, scale)
+    )
+sqlite3.register_converter("DATE", lambda raw: datetime.date.fromisoformat(raw.decode()))
+sqlite3.register_converter("TIMESTAMP", lambda raw: datetime.datetime.fromisoformat(raw.decode()))
+sqlite3.register_converter("BOOL", lambda raw: raw not in (b"0", b""))
+sqlite3.register_adapter(Decimal, str)
+
+# Client hang-ups cancel queries on either backend (see deadlines.py).
+WATCHER = deadlines.DisconnectWatcher()
+PROGRESS_STEPS = 10_000  # SQLite VM instructions between deadline checks
+
+_PLACEHOLDER = re.compile(r"%\((\w+)\)s|%%")
+
+
+def to_named(sql: str) -> str:
+    """Rewrite psycopg2 ``%(name)s`` placeholders as SQLite ``:name``."""
+    return _PLACEHOLDER.sub(lambda m: "%" if m.group(1) is None else f":{m.group(1)}", sql)
+
+
+class Columns(NamedTuple):
+    """A result set by column: ``values[i]`` holds every row's value of ``names[i]``."""
+
+    names: List[str]
+    types: List[Tuple[Any, Optional[int], Optional[int]]]  # (Postgres type OID, precision, scale); None on SQLite
+    values: List[Sequence[Any]]
+
+
+def _result(cur, one: bool, columns: bool):
+    if not columns:
+        return cur.fetchone() if one else cur.fetchall()
+    description = cur.description or []
+    rows = cur.fetchall()
+    # One transposition of the row tuples; no per-row dicts are built.
+    values = list(zip(*rows)) if rows else [() for _ in description]
+    types = [(d[1], getattr(d, "precision", None), getattr(d, "scale", None)) for d in description]
+    return Columns([d[0] for d in description], types, values)
+
+
+class PostgresBackend:
+    name = "postgres"
+
+    def __init__(self, connect: Callable, statements):
+        # ``connect`` returns a context manager yielding a pooled connection.
+        self.connect = connect
+        self.statements = statements
+
+    @contextmanager
+    def cursor(self, tuples: bool = False):
+        with self.connect() as conn:
+            # The pool's connections make dict rows; ``tuples`` asks for plain ones.
+            with (conn.cursor(cursor_factory=psycopg2.extensions.cursor) if tuples else conn.cursor()) as cur:
+                yield cur
+
+    def fetch(self, name: str, query: str, params: Optional[Mapping[str, Any]] = None, one: bool = False,
+              columns: bool = False):
+        """Rows as dicts, the first row if ``one``, or a ``Columns`` if ``columns``."""
+        deadline = deadlines.current()
+        if deadline is None:
+            with self.cursor(tuples=columns) as cur:
+                with profiling.sql(name):
+                    self.statements.execute(cur, name, query, params)
+                return _result(cur, one, columns)
+        deadline.check()
+        with self.cursor(tuples=columns) as cur, WATCHER.watch(deadline, lambda: cur.connection.cancel()):
+            try:
+                with profiling.sql(name):
+                    self.statements.execute(cur, name, query, params, timeout_ms=max(1, deadline.remaining_ms()))
+                return _result(cur, one, columns)
+            except psycopg2.errors.QueryCanceled:
+                # statement_timeout and connection.cancel() both end up here.
+                if deadline.disconnected:
+                    raise deadlines.ClientDisconnected(deadline) from None
+                raise deadlines.DeadlineExceeded(deadline.budget_ms) from None
+
+
+def _dict_row(cur, row):
+    return {col[0]: value for col, value in zip(cur.description, row)}
+
+
+class SQLiteBackend:
+    """Read-only SQLite file, one connection per thread."""
+
+    name = "sqlite"
+
+    def __init__(self, path: str, queries: Optional[Mapping[str, str]] = None):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"SQLite database not found: {path}")
+        self.path = os.path.abspath(path)
+        self.queries = dict(SQLITE_QUERIES if queries is None else queries)
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                f"file:{self.path}?mode=ro",
+                uri=True,
+                detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+            )
+            conn.row_factory = _dict_row
+            pgnumeric.register(conn)
+            # SQLite's LOWER folds ASCII only; route 14 matches "élan" against "Élan" as Postgres does.
+            conn.create_function("lower", 1, lambda text: text.lower() if isinstance(text, str) else text,
+                                 deterministic=True)
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def cursor(self, tuples: bool = False):
+        cur = self._connection().cursor()
+        if tuples:
+            cur.row_factory = None
+        try:
+            yield cur
+        finally:
+            cur.close()
+
+    def sql_for(self, name: str, query: str) -> str:
+        return self.queries.get(name) or to_named(query)
+
+    def fetch(self, name: str, query: str, params: Optional[Mapping[str, Any]] = None, one: bool = False,
+              columns: bool = False):
+        # sqlite3 has no array type; list parameters go in as JSON for json_each().
+        bound = {k: json.dumps(v) if isinstance(v, (list, tuple)) else v for k, v in (params or {}).items()}
+        deadline = deadlines.current()
+        if deadline is not None:
+            deadline.check()
+        conn = self._connection()
+        if deadline is not None:
+            # Returning True from the progress handler aborts the query with "interrupted".
+            conn.set_progress_handler(lambda: deadline.disconnected or deadline.expired(), PROGRESS_STEPS)
+        try:
+            with WATCHER.watch(deadline, conn.interrupt), self.cursor(tuples=columns) as cur:
+                with profiling.sql(name):
+                    cur.execute(self.sql_for(name, query), bound)
+                return _result(cur, one, columns)
+        except sqlite3.OperationalError as exc:
+            if deadline is None or "interrupted" not in str(exc):
+                raise
+            if deadline.disconnected:
+                raise deadlines.ClientDisconnected(deadline) from None
+            raise deadlines.DeadlineExceeded(deadline.budget_ms) from None
+        finally:
+            if deadline is not None:
+                conn.set_progress_handler(None, 0)
+
+
+def open_backend(url: str, connect: Callable, statements):
+    """``postgres`` or ``sqlite:///path`` (``sqlite:relative/path`` also works)."""
+    if url in ("", "postgres", "postgresql"):
+        return PostgresBackend(connect, statements)
+    if url.startswith("sqlite:"):
+        path = url[len("sqlite:"):]
+        if path.startswith("//"):
+            path = path[2:]
+        return SQLiteBackend(path)
+    raise ValueError(f"MAL_STORAGE must be 'postgres' or 'sqlite:///path', got {url!r}")
+
+
+# -- building the SQLite file ------------------------------------------------
+
+# table -> (columns, primary key). The anime table's columns come from the source.
+TABLES = {
+    "genre": ([("genre_id", "INTEGER"), ("name", "TEXT"), ("bit", "INTEGER")], ("genre_id",)),
+    "studio": ([("studio_id", "INTEGER"), ("name", "TEXT")], ("studio_id",)),
+    "anime_genre": ([("anime_id", "INTEGER"), ("genre_id", "INTEGER")], ("anime_id", "genre_id")),
+    "anime_studio": ([("anime_id", "INTEGER"), ("studio_id", "INTEGER")], ("anime_id", "studio_id")),
+    "recommendation": (
+        [("anime_id_a", "INTEGER"), ("anime_id_b", "INTEGER"), ("num_recommenders", "INTEGER")],
+        ("anime_id_a", "anime_id_b"),
+    ),
+    "related_anime": (
+        [("anime_id_a", "INTEGER"), ("anime_id_b", "INTEGER"), ("relation_type", "TEXT")],
+        ("anime_id_a", "anime_id_b"),
+    ),
+}
+
+
+def _create_table(conn: sqlite3.Connection, table: str, columns: Sequence[Tuple[str, str]], key: Sequence[str]) -> None:
+    body = ", ".join(f"{name} {sqlite_type}" for name, sqlite_type in columns)
+    conn.execute(f"CREATE TABLE {table} ({body}, PRIMARY KEY ({', '.join(key)}))")
+
+
+# The Postgres indexes (primary keys, migrations 0002/0003) plus the ones the
+# SQLite planner needs for the same lookups.
+INDEXES = [
+    "CREATE INDEX anime_year_score_idx ON anime (year, score) WHERE score IS NOT NULL",
+    "CREATE INDEX anime_decade_idx ON anime (decade)",
+    "CREATE INDEX anime_season_name_year_idx ON anime (season_name, year)",
+    "CREATE INDEX anime_score_idx ON anime (score DESC)",
+    "CREATE INDEX anime_members_idx ON anime (members_count DESC)",
+    "CREATE INDEX anime_favorites_idx ON anime (favorites_count DESC)",
+    "CREATE INDEX anime_season_idx ON anime (season)",
+    "CREATE UNIQUE INDEX genre_bit_key ON genre (bit)",
+    "CREATE INDEX anime_genre_genre_idx ON anime_genre (genre_id)",
+    "CREATE INDEX anime_studio_studio_idx ON anime_studio (studio_id)",
+    "CREATE INDEX recommendation_b_idx ON recommendation (anime_id_b)",
+    "CREATE INDEX related_anime_b_idx ON related_anime (anime_id_b)",
+]
+
+_INT_COLUMN = re.compile(r"^(anime_id|num_episodes|.*_count|.*_rank)$")
+
+
+def _sqlite_type(column: str) -> str:
+    if _INT_COLUMN.match(column):
+        return "INTEGER"
+    if column == "score":
+        return "NUMERIC_2"
+    if column in ("start_date", "end_date"):
+        return "DATE"
+    return "TEXT"
+
+
+def csv_column(name: str) -> str:
+    # The CSVs zero-pad the histogram columns (score_09_count); the tables do not.
+    return re.sub(r"^score_0(\d)_count$", r"score_\1_count", name)
+
+
+def csv_value(value: Optional[str], sqlite_type: str):
+    if value is None or value.strip() in NULLS:
+        return None
+    if sqlite_type == "INTEGER":
+        return int(float(value))
+    if sqlite_type.startswith("NUMERIC"):
+        return Decimal(value)
+    if sqlite_type == "DATE":
+        return value[:10]
+    return value
+
+
+def parse_names(value: Optional[str]) -> List[str]:
+    """Genre/studio lists are stored as "['A', 'B']" or "A, B"."""
+    if value is None or value.strip() in NULLS:
+        return []
+    value = value.strip()
+    items = ast.literal_eval(value) if value.startswith("[") else value.split(",")
+    return [item.strip() for item in items if item and item.strip()]
+
+
+def season_columns(season: Optional[str]) -> Tuple[Optional[int], Optional[int], Optional[str]]:
+    """year, decade and season_name, derived like migration 0001."""
+    if not season:
+        return None, None, None
+    year_match = re.search(r"\d{4}", season)
+    name_match = re.match(r"[A-Za-z]+", season)
+    year = int(year_match.group()) if year_match else None
+    return year, None if year is None else year // 10 * 10, name_match.group().capitalize() if name_match else None
+
+
+def read_name_table(path: str, key: str) -> Dict[str, Dict[str, Optional[int]]]:
+    """name -> {"id", "bit"} from an exported ``genre``/``studio`` table; empty if the file is missing."""
+    if not os.path.exists(path):
+        return {}
+    with open(path, newline="", encoding="utf-8") as f:
+        return {
+            raw["name"]: {"id": int(raw[key]), "bit": csv_value(raw.get("bit"), "INTEGER")}
+            for raw in csv.DictReader(f)
+        }
+
+
+def assign_ids(names: Iterable[str], known: Mapping[str, Dict[str, Optional[int]]]) -> Dict[str, int]:
+    """The exported ids of ``known`` names, then new ids in name order for the rest."""
+    ids = {name: row["id"] for name, row in known.items()}
+    next_id = max(ids.values(), default=0) + 1
+    for name in sorted(set(names) - set(ids)):
+        ids[name], next_id = next_id, next_id + 1
+    return ids
+
+
+def _insert(conn: sqlite3.Connection, table: str, columns: Sequence[str], rows: Iterable[Sequence[Any]]) -> None:
+    placeholders = ", ".join("?" * len(columns))
+    conn.executemany(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})", rows)
+
+
+def load_csvs(conn: sqlite3.Connection, csv_dir: str) -> None:
+    with open(os.path.join(csv_dir, ANIME_CSV), newline="", encoding="utf-8") as f:
+        reader = csv.DictReader(f)
+        header = [h for h in reader.fieldnames or [] if h not in ("genres", "studios")]
+        columns = [(csv_column(h), _sqlite_type(csv_column(h))) for h in header]
+        # Columns of the Anime row that an older dump lacks are NULL, as they would be in Postgres.
+        missing = [name for name in ANIME_COLUMNS if name not in {column for column, _ in columns}]
+        columns += [(name, _sqlite_type(name)) for name in missing]
+        columns += [("year", "INTEGER"), ("decade", "INTEGER"), ("season_name", "TEXT"), ("genre_mask", "INTEGER")]
+        anime, genres_of, studios_of = [], {}, {}
+        for raw in reader:
+            row = [csv_value(raw[h], t) for h, (_, t) in zip(header, columns)]
+            anime_id = row[header.index("anime_id")]
+            genres_of[anime_id] = parse_names(raw.get("genres"))
+            studios_of[anime_id] = parse_names(raw.get("studios"))
+            season = csv_value(raw.get("season"), "TEXT")
+            anime.append(row + [None] * len(missing) + [*season_columns(season), 0])
+
+    # Ids come from the exported tables when present. Bits too; genres without
+    # one get the next free bits in genre_id order, like migration 0003.
+    known_genres = read_name_table(os.path.join(csv_dir, GENRE_CSV), "genre_id")
+    genre_ids = assign_ids((g for names in genres_of.values() for g in names), known_genres)
+    known_studios = read_name_table(os.path.join(csv_dir, STUDIO_CSV), "studio_id")
+    studio_ids = assign_ids((s for names in studios_of.values() for s in names), known_studios)
+    if len(genre_ids) > MAX_GENRE_BITS:
+        raise ValueError(f"{len(genre_ids)} genres do not fit in a {MAX_GENRE_BITS}-bit mask")
+    bits = {name: row["bit"] for name, row in known_genres.items() if row["bit"] is not None}
+    next_bit = max(bits.values(), default=-1) + 1
+    for name in sorted(set(genre_ids) - set(bits), key=genre_ids.get):
+        bits[name], next_bit = next_bit, next_bit + 1
+    for row in anime:
+        row[-1] = sum(1 << bits[g] for g in set(genres_of[row[0]]))
+
+    _create_table(conn, "anime", columns, ("anime_id",))
+    _insert(conn, "anime", [name for name, _ in columns], anime)
+    _insert(conn, "genre", ["genre_id", "name", "bit"], [(i, name, bits[name]) for name, i in genre_ids.items()])
+    _insert(conn, "studio", ["studio_id", "name"], [(i, name) for name, i in studio_ids.items()])
+    _insert(conn, "anime_genre", ["anime_id", "genre_id"],
+            sorted({(a, genre_ids[g]) for a, names in genres_of.items() for g in names}))
+    _insert(conn, "anime_studio", ["anime_id", "studio_id"],
+            sorted({(a, studio_ids[s]) for a, names in studios_of.items() for s in names}))
+
+    known = set(genres_of)
+    recommendations, related = {}, {}
+    with open(os.path.join(csv_dir, ANIME_ANIME_CSV), newline="", encoding="utf-8") as f:
+        for raw in csv.DictReader(f):
+            a, b = csv_value(raw["animeA"], "INTEGER"), csv_value(raw["animeB"], "INTEGER")
+            if a not in known or b not in known:
+                continue
+            if csv_value(raw.get("recommendation"), "INTEGER"):
+                recommendations[(a, b)] = csv_value(raw.get("num_recommenders"), "INTEGER")
+            if csv_value(raw.get("related"), "INTEGER"):
+                related[(a, b)] = csv_value(raw.get("relation_type"), "TEXT")
+    _insert(conn, "recommendation", ["anime_id_a", "anime_id_b", "num_recommenders"],
+            [(a, b, n) for (a, b), n in sorted(recommendations.items())])
+    _insert(conn, "related_anime", ["anime_id_a", "anime_id_b", "relation_type"],
+            [(a, b, t) for (a, b), t in sorted(related.items())])
+
+
+def pg_column_type(data_type: str, scale: Optional[int]) -> str:
+    if data_type in ("smallint", "integer", "bigint"):
+        return "INTEGER"
+    if data_type == "numeric":
+        return "NUMERIC" if scale is None else f"NUMERIC_{min(scale, MAX_NUMERIC_SCALE)}"
+    if data_type in ("real", "double precision"):
+        return "REAL"
+    if data_type == "boolean":
+        return "BOOL"
+    if data_type == "date":
+        return "DATE"
+    if data_type.startswith("timestamp"):
+        return "TIMESTAMP"
+    return "TEXT"  # text, varchar and the enum types
+
+
+def _pg_value(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (list, dict)):
+        return json.dumps(value)
+    return value
+
+
+def load_postgres(conn: sqlite3.Connection, pg_conn, batch_size: int = 5000) -> None:
+    """Copy the tables the routes read, keeping Postgres' ids and column order."""
+    with pg_conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT table_name, column_name, data_type, numeric_scale
+            FROM information_schema.columns
+            WHERE table_schema = 'public' AND table_name = ANY(%s)
+            ORDER BY table_name, ordinal_position;
+            """,
+            (["anime", *TABLES],),
+        )
+        columns: Dict[str, List[Tuple[str, str]]] = {}
+        for table, column, data_type, scale in cur.fetchall():
+            columns.setdefault(table, []).append((column, pg_column_type(data_type, scale)))
+    if "anime" not in columns:
+        raise RuntimeError("Postgres has no anime table")
+
+    _create_table(conn, "anime", columns["anime"], ("anime_id",))
+    for table in ["anime", *TABLES]:
+        if table not in columns:
+            continue
+        names = [name for name, _ in columns[table]]
+        if table != "anime":
+            names = [name for name, _ in TABLES[table][0] if name in names]
+        with pg_conn.cursor(name=f"copy_{table}") as cur:
+            cur.itersize = batch_size
+            cur.execute(f"SELECT {', '.join(names)} FROM {table}")
+            _insert(conn, table, names, ([_pg_value(v) for v in row] for row in cur))
+
+
+def build_sqlite(path: str, load: Callable[[sqlite3.Connection], None]) -> None:
+    """Create the file at a temp path, index it and move it into place."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix=".mal-", suffix=".sqlite3", dir=directory)
+    os.close(fd)
+    try:
+        conn = sqlite3.connect(tmp)
+        try:
+            with conn:
+                for table, (columns, key) in TABLES.items():
+                    _create_table(conn, table, columns, key)
+                load(conn)
+                for ddl in INDEXES:
+                    conn.execute(ddl)
+            conn.execute("ANALYZE")
+            conn.execute("VACUUM")
+        finally:
+            conn.close()
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Build the SQLite database for MAL_STORAGE=sqlite.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build = sub.add_parser("build-sqlite", help="create a SQLite file from the CSVs or from Postgres")
+    build.add_argument("path")
+    source = build.add_mutually_exclusive_group(required=True)
+    source.add_argument(
+        "--csv-dir",
+        help=f"directory holding {ANIME_CSV!r} and {ANIME_ANIME_CSV!r} (and, for Postgres' ids, {GENRE_CSV!r} "
+        f"and {STUDIO_CSV!r})",
+    )
+    source.add_argument("--from-postgres", action="store_true", help="copy the tables from DB_CONFIG")
+    args = parser.parse_args(argv)
+
+    if args.csv_dir:
+        for name in (GENRE_CSV, STUDIO_CSV):
+            if not os.path.exists(os.path.join(args.csv_dir, name)):
+                print(f"no {name} in {args.csv_dir}: its ids are made up and will not match Postgres")
+        build_sqlite(args.path, lambda conn: load_csvs(conn, args.csv_dir))
+    else:
+        import psycopg2  # pylint: disable=import-outside-toplevel
+
+        from app import DB_CONFIG  # pylint: disable=import-outside-toplevel
+
+        pg_conn = psycopg2.connect(**DB_CONFIG)
+        try:
+            build_sqlite(args.path, lambda conn: load_postgres(conn, pg_conn))
+        finally:
+            pg_conn.close()
+    print(f"wrote {args.path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,118 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from admission import AdmissionController, Gate, Limit, Overloaded, parse_limits  # noqa: E402
+
+
+def _hold(gate, started, release):
+    gate.acquire()
+    started.set()
+    release.wait(5)
+    gate.release(0.5)
+
+
+def test_parse_limits():
+    assert parse_limits("similar=4, heavy=2:3:0.5", 2.0) == {
+        "similar": Limit(4, 16, 2.0),
+        "heavy": Limit(2, 3, 0.5),
+    }
+    assert parse_limits(None, 1.0) == {}
+    with pytest.raises(ValueError):
+        parse_limits("similar=four", 1.0)
+    with pytest.raises(ValueError):
+        parse_limits("similar=1:2:3:4", 1.0)
+
+
+def test_gate_sheds_when_queue_is_full():
+    gate = Gate("similar", Limit(1, 0, 1.0))
+    started, release = threading.Event(), threading.Event()
+    holder = threading.Thread(target=_hold, args=(gate, started, release))
+    holder.start()
+    started.wait(5)
+    with pytest.raises(Overloaded) as exc:
+        gate.acquire()
+    assert exc.value.reason == "queue full" and exc.value.retry_after >= 1
+    release.set()
+    holder.join()
+    gate.acquire()  # free again
+    assert gate.stats()["rejected"] == 1 and gate.stats()["admitted"] == 2
+
+
+def test_gate_queues_in_order_and_times_out():
+    gate = Gate("stats", Limit(1, 2, 0.05))
+    started, release = threading.Event(), threading.Event()
+    holder = threading.Thread(target=_hold, args=(gate, started, release))
+    holder.start()
+    started.wait(5)
+    with pytest.raises(Overloaded) as exc:
+        gate.acquire()
+    assert exc.value.reason == "timed out in queue"
+
+    order = []
+
+    def queued(name):
+        gate.acquire(wait=5)
+        order.append(name)
+        gate.release()
+
+    waiters = []
+    for name in ("first", "second"):
+        waiters.append(threading.Thread(target=queued, args=(name,)))
+        waiters[-1].start()
+        while gate.stats()["queued"] < len(waiters):
+            time.sleep(0.001)
+    assert gate.stats()["peak_queued"] == 2
+    release.set()
+    for t in [holder, *waiters]:
+        t.join()
+    assert order == ["first", "second"]
+    assert gate.stats()["timed_out"] == 1 and gate.stats()["active"] == 0
+
+
+def test_shared_gate_spares_the_priority_class():
+    controller = AdmissionController(
+        {"lookup": Limit(4, 0, 0.0), "standard": Limit(4, 0, 0.0)},
+        {"list_genres": "lookup"},
+        shared=Limit(1, 0, 0.0),
+        overrides={"similar": Limit(2, 0, 0.0)},
+    )
+    ticket = controller.admit("similar")
+    with pytest.raises(Overloaded) as exc:
+        controller.admit("search_anime")  # its own gate is free, the shared one is not
+    assert exc.value.gate == "shared"
+    assert controller.gate("search_anime").active == 0  # released again
+    controller.release(controller.admit("list_genres"))
+    controller.release(ticket)
+
+    stats = controller.stats()
+    assert stats["shared"]["admitted"] == 1 and stats["shared"]["rejected"] == 1
+    assert stats["routes"]["similar"]["concurrency"] == 2
+    assert stats["routes"]["list_genres"]["class"] == "lookup"
+    with pytest.raises(ValueError):
+        AdmissionController({"standard": Limit(1, 1, 1)}, {"x": "missing"})
+
+
+def test_priority_gate_caps_the_lookup_routes_together():
+    controller = AdmissionController(
+        {"lookup": Limit(2, 0, 0.0), "standard": Limit(2, 0, 0.0)},
+        {"list_genres": "lookup", "get_anime": "lookup"},
+        shared=Limit(1, 0, 0.0),
+        priority=Limit(2, 0, 0.0),
+    )
+    tickets = [controller.admit("list_genres"), controller.admit("get_anime")]
+    with pytest.raises(Overloaded) as exc:
+        controller.admit("get_anime")  # its own gate has room, the lookups' gate does not
+    assert exc.value.gate == "priority"
+    assert controller.gate("get_anime").active == 1
+    controller.release(controller.admit("search_anime"))  # other classes pass the shared gate
+    for ticket in tickets:
+        controller.release(ticket)
+    stats = controller.stats()
+    assert stats["priority"]["admitted"] == 2 and stats["priority"]["rejected"] == 1
+    assert stats["shared"]["admitted"] == 1
+
@@ -19,6 +19,8 @@ class FakeCursor:
     ):
         self.fetchall_result = fetchall_result or []
         self.fetchone_result = fetchone_result
+        self.description = None
+        self.tuples = False
         self.executed: List[Dict[str, Any]] = []
 
     def __enter__(self):
@@ -29,9 +31,16 @@ class FakeCursor:
 
     def execute(self, query, params=None):
         self.executed.append({"query": query, "params": params})
+        if self.tuples and self.fetchall_result and isinstance(self.fetchall_result[0], dict):
+            # A plain cursor describes the columns of the same rows.
+            names = dict.fromkeys(name for row in self.fetchall_result for name in row)
+            self.description = [(name, None) for name in names]
 
     def fetchall(self):
-        return list(self.fetchall_result)
+        rows = list(self.fetchall_result)
+        if self.tuples and rows and isinstance(rows[0], dict):
+            return [tuple(row.get(col[0]) for col in self.description) for row in rows]
+        return rows
 
     def fetchone(self):
         return self.fetchone_result
@@ -49,7 +58,8 @@ class FakeConn:
     def __exit__(self, exc_type, exc, tb):
         return False
 
-    def cursor(self):
+    def cursor(self, cursor_factory=None):
+        self.cursor_obj.tuples = cursor_factory is not None
         return self.cursor_obj
 
 
@@ -92,6 +102,7 @@ def test_search_anime_runs_query_with_params(client):
     assert params["genre_ids"] == [1, 2]
     assert params["min_score"] == 5.5
     assert params["max_score"] == 9.0
+    assert "a.*" not in cursor.executed[0]["query"] and "a.genre_mask," not in cursor.executed[0]["query"]
 
 
 def test_top_lists_returns_rows(client):
@@ -147,6 +158,31 @@ def test_recommendations_success(client):
     assert resp.get_json()[0]["votes"] == 3
 
 
+def test_graph_recommendations_walk_the_catalog_graph(client, monkeypatch):
+    test_client, cursor = client
+    holder = app.CatalogHolder()
+    holder.swap(app.Catalog.from_rows(
+        [
+            {"anime_id": 1, "title": "Nana"},
+            {"anime_id": 2, "title": "Paradise Kiss", "score": 7.9, "year": 2005},
+            {"anime_id": 3, "title": "Honey and Clover", "score": 8.1, "year": 2005},
+        ],
+        recommendation_rows=[
+            {"anime_id_a": 1, "anime_id_b": 2, "num_recommenders": 4},
+            {"anime_id_a": 3, "anime_id_b": 2, "num_recommenders": 2},
+        ],
+    ))
+    monkeypatch.setattr(app, "CATALOG", holder)
+    monkeypatch.setattr(app, "RECOMMENDATION_GRAPH", app.GraphIndex(lambda: app.CATALOG.current()))
+
+    assert test_client.get("/api/anime/1/recommendations?mode=walk").status_code == 400
+    body = test_client.get("/api/anime/1/recommendations?mode=graph").get_json()
+    assert [(r["anime_id"], r["votes"]) for r in body] == [(2, 4), (3, None)]
+    body = test_client.get("/api/anime/1/recommendations?mode=graph&min_score=8&era=2000").get_json()
+    assert [r["anime_id"] for r in body] == [3] and body[0]["relevance"] > 0
+    assert cursor.executed == []
+
+
 def test_similar_requires_limit(client):
     test_client, _ = client
     resp = test_client.get("/api/anime/1/similar")
@@ -160,6 +196,7 @@ def test_similar_success(client):
     resp = test_client.get("/api/anime/1/similar?limit=1")
     assert resp.status_code == 200
     assert resp.get_json()[0]["similarity"] == 0.8
+    assert "ROUND(s.similarity, 6)::float8 AS similarity" in cursor.executed[-1]["query"]
 
 
 def test_top_adjusted_score_validates_limit(client):
@@ -320,4 +357,549 @@ def test_get_anime_success(client):
     resp = test_client.get("/api/anime/1")
     assert resp.status_code == 200
     assert resp.get_json()["title"] == "Found"
+    # The migrated year, decade and season_name stay out of the Anime row.
+    assert not any("year" in e["query"] or "*" in e["query"] for e in cursor.executed)
+
+
+def test_invalidate_statements_requires_admin(client, monkeypatch):
+    test_client, _ = client
+    monkeypatch.setattr(app, "ADMIN_TOKEN", "secret")
+    resp = test_client.post("/api/admin/statements/invalidate")
+    assert resp.status_code == 403
+
+    before = app.STATEMENTS.generation
+    resp = test_client.post("/api/admin/statements/invalidate", headers={"X-Admin-Token": "secret"})
+    assert resp.status_code == 200
+    assert resp.get_json()["generation"] == before + 1
+
+
+def test_exhausted_pool_waits_then_answers_503(monkeypatch):
+    class FakePool:
+        def getconn(self):
+            conn = FakeConn(FakeCursor(fetchall_result=[{"genre_id": 1, "genre_name": "Action"}]))
+            conn.closed = 0
+            return conn
+
+        def putconn(self, conn, close=False):
+            pass
+
+    monkeypatch.setattr(app, "_get_pool", FakePool)
+    monkeypatch.setattr(app, "_pool_slots", app.threading.BoundedSemaphore(app.POOL_MAX_CONN))
+    monkeypatch.setattr(app, "POOL_WAIT", 0.05)
+    monkeypatch.setattr(app, "INFLIGHT", app.SingleFlight(timeout=1))
+    test_client = app.create_app().test_client()
+
+    held = [app.get_conn() for _ in range(app.POOL_MAX_CONN)]
+    for conn in held:
+        conn.__enter__()
+    resp = test_client.get("/api/genres")
+    assert resp.status_code == 503 and resp.headers["Retry-After"] == "1"
+
+    held.pop().__exit__(None, None, None)
+    assert test_client.get("/api/genres").get_json() == [{"genre_id": 1, "genre_name": "Action"}]
+    for conn in held:
+        conn.__exit__(None, None, None)
+
+
+def test_coalesce_timeout_returns_504(client, monkeypatch):
+    test_client, _ = client
+
+    class TimedOut:
+        def do(self, key, fn, timeout=None):
+            raise app.CoalesceTimeout("slow leader")
+
+    monkeypatch.setattr(app, "INFLIGHT", TimedOut())
+    resp = test_client.get("/api/anime/top-lists")
+    assert resp.status_code == 504
+
+
+def test_autocomplete_uses_trie(client, monkeypatch):
+    test_client, cursor = client
+    index = app.AutocompleteIndex(lambda: [
+        {"anime_id": 1, "title": "Naruto", "score": 8.0, "num_episodes": 220, "members_count": 10},
+        {"anime_id": 2, "title": "Nana", "score": 8.5, "num_episodes": 47, "members_count": 5},
+    ])
+    monkeypatch.setattr(app, "AUTOCOMPLETE", index)
+
+    resp = test_client.get("/api/anime/autocomplete?q=na&limit=1")
+    assert resp.status_code == 200
+    assert [row["anime_id"] for row in resp.get_json()] == [1]
+    assert test_client.get("/api/anime/autocomplete?q=").get_json() == []
+    assert cursor.executed == []
+
+
+def test_autocomplete_stats_requires_admin(client, monkeypatch):
+    test_client, _ = client
+    monkeypatch.setattr(app, "ADMIN_TOKEN", "secret")
+    monkeypatch.setattr(app, "AUTOCOMPLETE", app.AutocompleteIndex(lambda: []))
+    assert test_client.get("/api/admin/autocomplete").status_code == 403
+
+    resp = test_client.post("/api/admin/autocomplete/rebuild", headers={"X-Admin-Token": "secret"})
+    assert resp.status_code == 200
+    assert resp.get_json()["titles"] == 0
+
+
+FACET_ROWS = [
+    {"facet": "total", "value": None, "genre_id": None, "count": 7},
+    {"facet": "type", "value": "Movie", "genre_id": None, "count": 2},
+    {"facet": "type", "value": "TV", "genre_id": None, "count": 5},
+    {"facet": "season", "value": "Spring 2019", "genre_id": None, "count": 3},
+    {"facet": "genre", "value": "Action", "genre_id": 1, "count": 4},
+]
+
+
+def test_facets_shapes_counts(client):
+    test_client, cursor = client
+    cursor.fetchall_result = FACET_ROWS
+    resp = test_client.get("/api/anime/facets?type=TV&genre_ids=2,1")
+    body = resp.get_json()
+    assert resp.status_code == 200
+    assert body["total"] == 7
+    assert body["type"] == [{"value": "TV", "count": 5}, {"value": "Movie", "count": 2}]
+    assert body["genre"] == [{"genre_id": 1, "name": "Action", "count": 4}]
+    assert body["source_type"] == []
+    params = cursor.executed[0]["params"]
+    assert params["type"] == "TV"
+    assert params["genre_ids"] == [1, 2]
+    assert "limit" not in params
+    assert "Cache-Control" not in resp.headers
+
+
+def test_facets_validates_genre_ids(client):
+    test_client, _ = client
+    resp = test_client.get("/api/anime/facets?genre_ids=abc")
+    assert resp.status_code == 400
+
+
+def test_unfiltered_facets_are_cached(client, monkeypatch):
+    test_client, cursor = client
+    monkeypatch.setattr(app, "FACETS_CACHE", app.TTLCache(ttl=60, max_entries=1))
+    cursor.fetchall_result = FACET_ROWS
+    first = test_client.get("/api/anime/facets")
+    second = test_client.get("/api/anime/facets")
+    assert first.get_json() == second.get_json()
+    assert len(cursor.executed) == 1
+    assert "max-age" in second.headers["Cache-Control"]
+
+
+def test_catalog_serves_top_routes_without_the_database(client, monkeypatch):
+    test_client, cursor = client
+    holder = app.CatalogHolder()
+    holder.swap(app.Catalog.from_rows(
+        [
+            {"anime_id": 1, "title": "Nana", "score": 8.5, "members_count": 5, "favorites_count": 2},
+            {"anime_id": 2, "title": "Naruto", "score": 8.0, "members_count": 10, "favorites_count": 1},
+        ],
+        [{"genre_id": 1, "name": "Drama", "bit": 0}],
+    ))
+    monkeypatch.setattr(app, "CATALOG", holder)
+
+    resp = test_client.get("/api/anime/top?metric=popularity&limit=1")
+    assert resp.get_json() == [
+        {"anime_id": 2, "title": "Naruto", "score": "8.00", "favorites_count": 1, "members_count": 10}
+    ]
+    lists = test_client.get("/api/anime/top-lists").get_json()
+    assert [row["list"] for row in lists] == ["favorites"] * 2 + ["popularity"] * 2 + ["rating"] * 2
+    assert test_client.get("/api/genres").get_json() == [{"genre_id": 1, "name": "Drama"}]
+    assert cursor.executed == []
+
+
+def test_published_changes_patch_only_affected_entries(client, monkeypatch):
+    test_client, cursor = client
+    monkeypatch.setattr(app, "ADMIN_TOKEN", "secret")
+    rows = [
+        {"anime_id": 1, "title": "Nana", "score": 8.5, "members_count": 5, "favorites_count": 2},
+        {"anime_id": 2, "title": "Naruto", "score": 8.0, "members_count": 10, "favorites_count": 1},
+    ]
+    holder = app.CatalogHolder()
+    holder.swap(app.Catalog.from_rows(rows))
+    monkeypatch.setattr(app, "CATALOG", holder)
+    monkeypatch.setattr(app, "AUTOCOMPLETE", app.AutocompleteIndex(app.load_autocomplete_rows))
+    monkeypatch.setattr(app, "FACETS_CACHE", app.TTLCache(ttl=60, max_entries=1))
+    app.FACETS_CACHE.set("unfiltered", {"total": 2})
+    assert [r["anime_id"] for r in app.AUTOCOMPLETE.lookup("na")] == [2, 1]
+    headers = {"X-Admin-Token": "secret"}
+
+    assert test_client.post("/api/admin/changes", json={"anime_ids": [1]}).status_code == 403
+    resp = test_client.post("/api/admin/changes", json={"anime_ids": ["1"]}, headers=headers)
+    assert resp.status_code == 400
+
+    cursor.fetchall_result = [{**rows[0], "members_count": 50}]
+    resp = test_client.post("/api/admin/changes", json={"anime_ids": [1], "columns": ["members_count"]},
+                            headers=headers)
+    assert resp.status_code == 200 and resp.get_json()["anime_ids"] == 1
+    assert cursor.executed[-1]["params"] == {"ids": [1]}
+    assert holder.current().meta.get("patched_at")
+    assert test_client.get("/api/anime/top?metric=popularity&limit=1").get_json()[0]["anime_id"] == 1
+    assert [r["anime_id"] for r in app.AUTOCOMPLETE.lookup("na")] == [1, 2]
+    assert app.FACETS_CACHE.get("unfiltered") == {"total": 2}  # members_count is not a facet
+
+    cursor.fetchall_result = [{**rows[1], "score": 9.0}]
+    test_client.post("/api/admin/changes", json={"anime_ids": [2], "columns": ["score"]}, headers=headers)
+    assert app.FACETS_CACHE.get("unfiltered") is None
+
+
+def test_admission_limits_leave_the_reserved_connections_free():
+    admitted = app.ADMISSION.priority.limit.concurrency + app.ADMISSION.shared.limit.concurrency
+    assert admitted + app.RESERVED_CONNECTIONS <= app.POOL_MAX_CONN
+    assert app.ADMISSION.classes["lookup"].concurrency <= app.ADMISSION.priority.limit.concurrency
+
+
+def test_overloaded_route_returns_503_while_lookups_still_run(client, monkeypatch):
+    test_client, cursor = client
+    controller = app.AdmissionController(
+        {"lookup": app.Limit(4, 4, 0.0), "standard": app.Limit(4, 4, 0.0), "heavy": app.Limit(0, 0, 0.0)},
+        app.ROUTE_CLASSES,
+        shared=app.Limit(0, 0, 0.0),
+    )
+    monkeypatch.setattr(app, "ADMISSION", controller)
+    monkeypatch.setattr(app, "ADMIN_TOKEN", "secret")
+
+    resp = test_client.get("/api/anime/1/similar?limit=3")
+    assert resp.status_code == 503
+    assert resp.headers["Retry-After"] == "1"
+    assert test_client.get("/api/anime?limit=3").status_code == 503  # no shared slot left
+    cursor.fetchall_result = [{"genre_id": 1, "name": "Drama"}]
+    assert test_client.get("/api/genres").status_code == 200
 
+    stats = test_client.get("/api/admin/admission", headers={"X-Admin-Token": "secret"}).get_json()
+    assert stats["routes"]["similar"]["rejected"] == 1
+    assert stats["routes"]["list_genres"]["admitted"] == 1 and stats["routes"]["list_genres"]["active"] == 0
+
+
+def test_deadline_headers_and_504_when_the_query_is_cancelled(client, monkeypatch):
+    test_client, cursor = client
+    cursor.fetchall_result = [{"genre_id": 1, "name": "Drama"}]
+
+    resp = test_client.get("/api/genres")
+    assert resp.status_code == 200
+    assert resp.headers["X-Deadline-Ms"] == str(app.DEADLINE_CLASSES_MS["lookup"])
+    assert 0 <= int(resp.headers["X-Deadline-Remaining-Ms"]) <= app.DEADLINE_CLASSES_MS["lookup"]
+    monkeypatch.setattr(app, "DEADLINE_OVERRIDES_MS", {"lookup": 0})
+    assert "X-Deadline-Ms" not in test_client.get("/api/genres").headers
+
+    def cancelled(query, params=None):
+        raise app.psycopg2.errors.QueryCanceled("canceling statement due to statement timeout")
+
+    monkeypatch.setattr(cursor, "execute", cancelled)
+    monkeypatch.setattr(app, "DEADLINE_OVERRIDES_MS", {"list_genres": 250})
+    resp = test_client.get("/api/genres")
+    assert resp.status_code == 504
+    assert resp.get_json() == {"error": "query exceeded its deadline", "deadline_ms": 250}
+    assert resp.headers["X-Deadline-Ms"] == "250"
+
+
+def test_similar_approx_mode_uses_the_minhash_index(client, monkeypatch):
+    test_client, cursor = client
+    holder = app.CatalogHolder()
+    holder.swap(app.Catalog.from_rows(
+        [
+            {"anime_id": 1, "title": "Nana", "score": 8.5, "members_count": 5, "favorites_count": 2, "genre_mask": 3},
+            {"anime_id": 2, "title": "Naruto", "score": 8.0, "members_count": 10, "favorites_count": 1,
+             "genre_mask": 1},
+        ],
+    ))
+    monkeypatch.setattr(app, "CATALOG", holder)
+    monkeypatch.setattr(app, "SIMILAR_INDEX", app.SimilarIndex(lambda: app.CATALOG.current(), bands=8, rows=2))
+
+    resp = test_client.get("/api/anime/1/similar?limit=5&mode=approx")
+    assert resp.status_code == 200
+    assert resp.get_json() == [{
+        "anime_id": 2, "title": "Naruto", "score": "8.00", "favorites_count": 1, "members_count": 10,
+        "similarity": 0.35,
+    }]
+    assert test_client.get("/api/anime/1/similar?limit=5&mode=fuzzy").status_code == 400
+    assert cursor.executed == []
+
+
+def test_distribution_route_answers_from_sketches_and_follows_changes(client, monkeypatch):
+    test_client, cursor = client
+    rows = [
+        {"anime_id": 1, "title": "Nana", "score": 8.5, "members_count": 5, "genre_mask": 1, "type": "TV"},
+        {"anime_id": 2, "title": "Naruto", "score": 8.0, "members_count": 10, "genre_mask": 3, "type": "TV"},
+        {"anime_id": 3, "title": "Akira", "score": 7.0, "members_count": None, "genre_mask": 2, "type": "Movie"},
+    ]
+    holder = app.CatalogHolder()
+    holder.swap(app.Catalog.from_rows(
+        rows, [{"genre_id": 1, "name": "Drama", "bit": 0}, {"genre_id": 2, "name": "Action", "bit": 1}],
+    ))
+    monkeypatch.setattr(app, "CATALOG", holder)
+    monkeypatch.setattr(app, "DISTRIBUTIONS", app.DistributionIndex(lambda: app.CATALOG.current()))
+
+    for query in ("metric=rating", "metric=score&by=studio", "metric=score&q=2", "metric=score&year=x"):
+        assert test_client.get(f"/api/stats/distribution?{query}").status_code == 400
+    resp = test_client.get("/api/stats/distribution?metric=score&by=genre&q=0.5,1")
+    assert resp.get_json() == [
+        {"genre_id": 2, "name": "Action", "count": 2, "quantiles": {"0.5": "7.00", "1": "8.00"}},
+        {"genre_id": 1, "name": "Drama", "count": 2, "quantiles": {"0.5": "8.00", "1": "8.50"}},
+    ]
+    resp = test_client.get("/api/stats/distribution?metric=members&by=type&genre_id=2&q=0.5")
+    assert resp.get_json() == [{"value": "TV", "count": 1, "quantiles": {"0.5": 10}}]
+
+    cursor.fetchall_result = [{**rows[2], "score": 9.0}]
+    app.CHANGES.publish(app.ChangeSet.of([3], ["score"]))
+    resp = test_client.get("/api/stats/distribution?metric=score&by=type&q=0.5")
+    assert resp.get_json()[1] == {"value": "Movie", "count": 1, "quantiles": {"0.5": "9.00"}}
+    assert app.DISTRIBUTIONS.stats()["updates"] == 1
+
+
+def test_cube_route_rolls_up_the_catalog(client, monkeypatch):
+    test_client, cursor = client
+    monkeypatch.setattr(app, "ADMIN_TOKEN", "secret")
+    holder = app.CatalogHolder()
+    holder.swap(app.Catalog.from_rows(
+        [
+            {"anime_id": 1, "title": "Nana", "score": 8.5, "members_count": 5, "genre_mask": 1, "type": "TV"},
+            {"anime_id": 2, "title": "Naruto", "score": 8.0, "members_count": 10, "genre_mask": 3, "type": "TV"},
+        ],
+        [{"genre_id": 1, "name": "Drama", "bit": 0}, {"genre_id": 2, "name": "Action", "bit": 1}],
+    ))
+    monkeypatch.setattr(app, "CATALOG", holder)
+    monkeypatch.setattr(app, "CUBE", app.CubeIndex(lambda: app.CATALOG.current()))
+
+    for query in ("by=studio", "measures=rating", "year=x", "by=type,type"):
+        assert test_client.get(f"/api/stats/cube?{query}").status_code == 400
+    resp = test_client.get("/api/stats/cube?by=genre,type&measures=score&type=TV")
+    assert resp.get_json() == [
+        {"genre_id": 2, "genre": "Action", "type": "TV", "count": 1,
+         "score": {"count": 1, "sum": "8.00", "avg": 8.0, "stddev": None, "min": "8.00", "max": "8.00"}},
+        {"genre_id": 1, "genre": "Drama", "type": "TV", "count": 2,
+         "score": {"count": 2, "sum": "16.50", "avg": 8.25, "stddev": 0.3536, "min": "8.00", "max": "8.50"}},
+    ]
+    members = test_client.get("/api/stats/cube?measures=members").get_json()
+    assert members == [{"count": 2, "members": {"count": 2, "sum": 15, "avg": 7.5, "stddev": 3.5355, "min": 5,
+                                                 "max": 10}}]
+    assert test_client.get("/api/admin/cube").status_code == 403
+    stats = test_client.get("/api/admin/cube", headers={"X-Admin-Token": "secret"}).get_json()
+    assert stats["built"] and stats["anime"] == 2
+    assert cursor.executed == []
+
+
+def test_format_arrow_without_pyarrow_returns_406(client, monkeypatch):
+    test_client, _ = client
+    assert test_client.get("/api/stats/years/ratings?format=csv").status_code == 400
+    monkeypatch.setattr(app.arrow_ipc, "pa", None)
+    resp = test_client.get("/api/stats/years/ratings?format=arrow")
+    assert resp.status_code == 406 and "pyarrow" in resp.get_json()["error"]
+
+
+def test_format_arrow_returns_an_ipc_stream_built_from_columns(client):
+    pa = pytest.importorskip("pyarrow")
+    test_client, cursor = client
+    cursor.description = [("year", 21), ("n_titles", 20)]
+    cursor.fetchall_result = [(2001, 12), (2002, 9)]
+    resp = test_client.get("/api/stats/years/ratings?format=arrow")
+    assert resp.mimetype == "application/vnd.apache.arrow.stream"
+    table = pa.ipc.open_stream(resp.get_data()).read_all()
+    assert table.to_pydict() == {"year": [2001, 2002], "n_titles": [12, 9]}
+    assert str(table.schema.field("year").type) == "int16"
+
+
+def test_large_json_is_compressed_when_the_client_accepts_it(client, monkeypatch):
+    import gzip
+    import json
+
+    test_client, cursor = client
+    monkeypatch.setattr(app, "COMPRESSION", app.Compressor(min_size=512, encodings=("gzip",)))
+    cursor.fetchall_result = [{"anime_id": i, "title": "Demo"} for i in range(100)]
+
+    resp = test_client.get("/api/anime?limit=100", headers={"Accept-Encoding": "gzip"})
+    assert resp.headers["Content-Encoding"] == "gzip" and resp.headers["Vary"] == "Accept-Encoding"
+    assert json.loads(gzip.decompress(resp.get_data())) == cursor.fetchall_result
+
+    assert "Content-Encoding" not in test_client.get("/api/anime?limit=100").headers
+    cursor.fetchall_result = cursor.fetchall_result[:2]  # under min_size
+    assert "Content-Encoding" not in test_client.get("/api/anime?limit=2", headers={"Accept-Encoding": "gzip"}).headers
+
+
+def test_similar_reads_the_precomputed_top_n_when_limit_fits(client, monkeypatch):
+    test_client, cursor = client
+    monkeypatch.setattr(app, "SIMILAR_TOPK_CACHE", app.TTLCache(ttl=60, max_entries=1))
+    monkeypatch.setattr(app, "_similar_topk_stale_through", 0)
+    cursor.fetchone_result = {"run_id": 3, "top_n": 50}
+    cursor.fetchall_result = [{"anime_id": 2, "similarity": 0.8}]
+
+    assert test_client.get("/api/anime/1/similar?limit=50").get_json()[0]["anime_id"] == 2
+    assert "FROM similar_topk t" in cursor.executed[-1]["query"]
+    assert "ROUND(t.similarity, 6)::float8 AS similarity" in cursor.executed[-1]["query"]
+    assert cursor.executed[-1]["params"] == {"run_id": 3, "seed_id": 1, "limit": 50}
+
+    # More than the run holds: scored live.
+    test_client.get("/api/anime/1/similar?limit=51")
+    assert "overlap_stats" in cursor.executed[-1]["query"]
+    assert "ROUND(s.similarity, 6)::float8 AS similarity" in cursor.executed[-1]["query"]
+
+    # A genre change makes every run so far stale.
+    cursor.fetchone_result = {"run_id": 3}
+    app.CHANGES.publish(app.ChangeSet.of([7], ["genres"]))
+    cursor.fetchone_result = {"run_id": 3, "top_n": 50}
+    test_client.get("/api/anime/1/similar?limit=5")
+    assert "overlap_stats" in cursor.executed[-1]["query"]
+
+
+def test_similar_text_serves_neighbours_from_the_synopsis_index(client, monkeypatch):
+    test_client, cursor = client
+    monkeypatch.setattr(app, "_text_index", None)
+    monkeypatch.setattr(app, "_text_index_error", None)
+    monkeypatch.setattr(app, "TEXT_INDEX_PATH", None)
+    assert test_client.get("/api/anime/1/similar-text?limit=2").status_code == 503
+
+    index = app.TextIndex.build([
+        {"anime_id": 1, "synopsis": "Bounty hunters drift through space."},
+        {"anime_id": 2, "synopsis": "Space bounty hunters again."},
+        {"anime_id": 3, "synopsis": "A girl moves to Tokyo."},
+        {"anime_id": 4, "synopsis": "Tokyo band dreams."},
+    ], workers=1, top_k=1)
+    monkeypatch.setattr(app, "_text_index", index)
+    cursor.fetchall_result = [
+        {"anime_id": 2, "title": "Bebop 2", "score": 8.1, "favorites_count": 3, "members_count": 40, "year": 2001}
+    ]
+
+    resp = test_client.get("/api/anime/1/similar-text?limit=1")
+    assert resp.status_code == 200
+    body = resp.get_json()
+    assert [row["anime_id"] for row in body] == [2] and 0 < body[0]["similarity"] <= 1
+    assert "year" not in body[0]
+    assert cursor.executed[-1]["params"] == {"ids": [2]}
+    assert test_client.get("/api/anime/1/similar-text?limit=2&mode=precomputed").status_code == 400
+    assert test_client.get("/api/anime/1/similar-text?limit=2&mode=query").status_code == 200
+    assert test_client.get("/api/anime/1/similar-text?limit=2&mode=nearest").status_code == 400
+
+
+def test_franchise_routes_read_the_catalog(client, monkeypatch):
+    test_client, cursor = client
+    monkeypatch.setattr(app, "ADMIN_TOKEN", "secret")
+    holder = app.CatalogHolder()
+    holder.swap(app.Catalog.from_rows(
+        [
+            {"anime_id": 1, "title": "Nana", "score": 8.5, "members_count": 5},
+            {"anime_id": 2, "title": "Nana 2", "score": 7.5, "members_count": 3},
+            {"anime_id": 3, "title": "Naruto", "score": 8.0, "members_count": 10},
+        ],
+        related_rows=[{"anime_id_a": 2, "anime_id_b": 1}],
+    ))
+    monkeypatch.setattr(app, "CATALOG", holder)
+    monkeypatch.setattr(app, "FRANCHISES", app.FranchiseIndex(lambda: app.CATALOG.current()))
+
+    body = test_client.get("/api/franchises/2").get_json()
+    assert body["franchise_id"] == 1 and body["size"] == 2 and body["avg_score"] == 8.0
+    assert [a["anime_id"] for a in body["anime"]] == [1, 2]
+    assert test_client.get("/api/franchises/404").status_code == 404
+    for query in ("metric=rating", "limit=0", "offset=-1", "min_size=x"):
+        assert test_client.get(f"/api/franchises/top?{query}").status_code == 400
+    top = test_client.get("/api/franchises/top?metric=members").get_json()
+    assert [(f["franchise_id"], f["total_members"]) for f in top] == [(3, 10), (1, 8)]
+    assert [f["franchise_id"] for f in test_client.get("/api/franchises/top?min_size=2").get_json()] == [1]
+    assert test_client.get("/api/admin/franchises").status_code == 403
+    stats = test_client.get("/api/admin/franchises", headers={"X-Admin-Token": "secret"}).get_json()
+    assert stats["built"] and stats["franchises"] == 2
+    assert cursor.executed == []
+
+
+def test_multi_seed_recommendations_validate_seeds(client):
+    test_client, cursor = client
+    for query in ("", "seeds=1,x", "seeds=1,1", "seeds=1,2&weights=3", "seeds=1,2&weights=1,0", "seeds=1&mode=walk",
+                  "seeds=" + ",".join(map(str, range(app.MAX_RECOMMENDATION_SEEDS + 1)))):
+        assert test_client.get(f"/api/anime/recommendations?{query}").status_code == 400
+    cursor.fetchall_result = [{"anime_id": 3, "votes": 7, "seeds": 2}]
+    resp = test_client.get("/api/anime/recommendations?seeds=1,2&weights=2,1&limit=5&era=2000")
+    assert resp.get_json()[0]["votes"] == 7
+    params = cursor.executed[0]["params"]
+    assert params["seeds"] == [1, 2] and params["weights"] == [2, 1]
+    assert params["limit"] == 5 and params["era_end"] == 2009 and params["genre_id"] is None
+
+
+def test_multi_seed_recommendations_merge_votes_in_the_catalog(client, monkeypatch):
+    test_client, cursor = client
+    holder = app.CatalogHolder()
+    holder.swap(app.Catalog.from_rows(
+        [
+            {"anime_id": 1, "title": "Nana"},
+            {"anime_id": 2, "title": "Paradise Kiss"},
+            {"anime_id": 3, "title": "Honey and Clover", "score": 8.1},
+            {"anime_id": 4, "title": "Beck", "score": 8.3},
+        ],
+        recommendation_rows=[
+            {"anime_id_a": 1, "anime_id_b": 2, "num_recommenders": 9},
+            {"anime_id_a": 1, "anime_id_b": 3, "num_recommenders": 4},
+            {"anime_id_a": 2, "anime_id_b": 3, "num_recommenders": 1},
+            {"anime_id_a": 2, "anime_id_b": 4, "num_recommenders": 5},
+        ],
+    ))
+    monkeypatch.setattr(app, "CATALOG", holder)
+    monkeypatch.setattr(app, "RECOMMENDATION_GRAPH", app.GraphIndex(lambda: app.CATALOG.current()))
+
+    body = test_client.get("/api/anime/recommendations?seeds=1,2").get_json()
+    assert [(r["anime_id"], r["votes"], r["seeds"]) for r in body] == [(4, 5, 1), (3, 5, 2)]
+    body = test_client.get("/api/anime/recommendations?seeds=1,2&weights=1,3").get_json()
+    assert [(r["anime_id"], r["votes"]) for r in body] == [(4, 15), (3, 7)]
+    body = test_client.get("/api/anime/recommendations?seeds=1,2&mode=graph&min_score=8.2").get_json()
+    assert [(r["anime_id"], r["votes"]) for r in body] == [(4, 5)] and body[0]["relevance"] > 0
+    assert cursor.executed == []
+
+
+def test_admin_requests_can_be_profiled(client, monkeypatch):
+    test_client, cursor = client
+    monkeypatch.setattr(app, "ADMIN_TOKEN", "secret")
+    monkeypatch.setattr(app, "PROFILER", app.Profiler(keep=3))
+    assert "X-Profile-Id" not in test_client.get("/api/genres", headers={"X-Profile": "1"}).headers
+
+    cursor.fetchall_result = [{"genre_id": 1, "genre_name": "Action"}]
+    resp = test_client.get("/api/genres?profile=1", headers={"X-Admin-Token": "secret"})
+    profile_id = resp.headers["X-Profile-Id"]
+    listing = test_client.get("/api/admin/profiles", headers={"X-Admin-Token": "secret"}).get_json()
+    assert listing["profiled"] == 1 and listing["profiles"][0]["status"] == 200
+    assert listing["profiles"][0]["sql"][0]["calls"] == 1
+
+    url = f"/api/admin/profiles/{profile_id}"
+    assert test_client.get(url).status_code == 403
+    resp = test_client.get(url, headers={"X-Admin-Token": "secret"})
+    assert resp.get_json()["profiles"][0]["type"] == "sampled"
+    assert resp.headers["Content-Disposition"].endswith('.speedscope.json"')
+    resp = test_client.get(url + "?format=collapsed", headers={"X-Admin-Token": "secret"})
+    assert resp.mimetype == "text/plain"
+    assert test_client.get(url + "?format=pprof", headers={"X-Admin-Token": "secret"}).status_code == 400
+    assert test_client.get("/api/admin/profiles/99", headers={"X-Admin-Token": "secret"}).status_code == 404
+
+
+def test_similar_topk_job_runs_the_script_in_its_own_process(monkeypatch):
+    class FakeProcess:
+        started: List[List[str]] = []
+
+        def __init__(self, argv, stdout=None, stderr=None):
+            self.started.append(argv)
+            self.polls, self.returncode, self.killed = 0, None, False
+
+        def poll(self):
+            self.polls += 1
+            if self.polls > 2:
+                self.returncode = 0
+            return self.returncode
+
+        def communicate(self):
+            return b'{"run_id": 4, "scored": 10}\n', b""
+
+        def kill(self):
+            self.killed = True
+
+        def wait(self):
+            return self.returncode
+
+    monkeypatch.setattr(app.subprocess, "Popen", FakeProcess)
+    cursor = FakeCursor()
+    assert app._refresh_similar_topk(FakeConn(cursor)) == {"run_id": 4, "scored": 10}
+    # Spawned workers re-import the child's main module, similar_topk.py, never the server's.
+    assert FakeProcess.started[0][1] == app.SIMILAR_TOPK_SCRIPT and app.SIMILAR_TOPK_SCRIPT.endswith("similar_topk.py")
+    assert [e["query"] for e in cursor.executed] == ["SELECT pg_sleep(1);"] * 2
+
+    # The scheduler cancels the wait on a timeout: the process is killed.
+    class CancelledCursor(FakeCursor):
+        def execute(self, query, params=None):
+            raise app.psycopg2.errors.QueryCanceled("canceling statement due to user request")
+
+    processes = []
+    monkeypatch.setattr(app.subprocess, "Popen", lambda *a, **kw: processes.append(FakeProcess(*a, **kw))
+                        or processes[-1])
+    with pytest.raises(app.psycopg2.errors.QueryCanceled):
+        app._refresh_similar_topk(FakeConn(CancelledCursor()))
+    assert processes[0].killed
@@ -0,0 +1,50 @@
+import os
+import sys
+from collections import namedtuple
+from decimal import Decimal
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import storage  # noqa: E402
+
+pa = pytest.importorskip("pyarrow")
+import arrow_ipc  # noqa: E402  pylint: disable=wrong-import-position
+
+# What psycopg2's cursor.description holds per column.
+Column = namedtuple("Column", "name type_code display_size internal_size precision scale null_ok")
+
+
+def _read(data: bytes):
+    return pa.ipc.open_stream(data).read_all()
+
+
+def test_ipc_stream_uses_postgres_types_and_declared_numeric_scale():
+    cur = type("Cursor", (), {})()
+    cur.description = [
+        Column("anime_id", 23, None, 4, None, None, None),
+        Column("title", 25, None, -1, None, None, None),
+        Column("score", 1700, None, -1, 4, 2, None),
+        Column("avg_score", 1700, None, -1, None, None, None),  # computed: inferred
+        Column("corr", 701, None, 8, None, None, None),
+    ]
+    cur.fetchall = lambda: [
+        (1, "Bebop", Decimal("8.75"), Decimal("7.1234567890123456"), 0.5),
+        (2, "Nana", None, Decimal("6.5"), None),
+    ]
+    columns = storage._result(cur, one=False, columns=True)  # pylint: disable=protected-access
+    assert columns.names == ["anime_id", "title", "score", "avg_score", "corr"]
+    table = _read(arrow_ipc.to_ipc(columns))
+    assert [str(f.type) for f in table.schema] == ["int32", "string", "decimal128(4, 2)", "decimal128(17, 16)", "double"]
+    assert table.column("score").to_pylist() == [Decimal("8.75"), None]
+    assert table.column("avg_score").to_pylist()[0] == Decimal("7.1234567890123456")
+
+
+def test_dict_rows_and_empty_results_convert():
+    table = _read(arrow_ipc.to_ipc(arrow_ipc.columns_from_rows([
+        {"list": "rating", "anime_id": 1, "metric": Decimal("9.10")},
+        {"list": "rating", "anime_id": 2, "metric": None},
+    ])))
+    assert table.num_rows == 2 and table.column("metric").type == pa.decimal128(3, 2)
+    empty = storage.Columns(["anime_id"], [(23, None, None)], [()])
+    assert _read(arrow_ipc.to_ipc(empty)).schema.field("anime_id").type == pa.int32()
@@ -0,0 +1,92 @@
+import os
+import sys
+import threading
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from autocomplete import AutocompleteIndex, Trie, normalize  # noqa: E402
+
+ROWS = [
+    {"anime_id": 1, "title": "Naruto", "members_count": 2000},
+    {"anime_id": 2, "title": "Naruto: Shippuuden", "members_count": 1500},
+    {"anime_id": 3, "title": "Nana", "members_count": 300},
+    {"anime_id": 4, "title": "Shingeki no Kyojin", "members_count": 3000},
+    {"anime_id": 5, "title": "Pokémon", "members_count": 800},
+    {"anime_id": 6, "title": "Boruto: Naruto Next Generations", "members_count": None},
+]
+
+
+def _ids(rows):
+    return [row["anime_id"] for row in rows]
+
+
+def test_normalize():
+    assert normalize("  Pokémon: The Movie!! ") == "pokemon the movie"
+    assert normalize("") == ""
+
+
+def test_lookup_ranks_by_members():
+    trie = Trie.build(ROWS)
+    assert _ids(trie.lookup("na")) == [1, 2, 3, 6]
+    assert _ids(trie.lookup("NARUTO")) == [1, 2, 6]
+    assert _ids(trie.lookup("naruto s")) == [2]
+    assert _ids(trie.lookup("nax")) == []
+    assert _ids(trie.lookup("")) == []
+
+
+def test_lookup_matches_later_words_and_accents():
+    trie = Trie.build(ROWS)
+    assert _ids(trie.lookup("kyo")) == [4]
+    assert _ids(trie.lookup("pokemon")) == [5]
+
+
+def test_top_k_and_limit():
+    trie = Trie.build(ROWS, top_k=2)
+    assert _ids(trie.lookup("n")) == [4, 1]
+    assert _ids(trie.lookup("n", limit=1)) == [4]
+
+
+def test_memory_reported():
+    assert Trie.build(ROWS).memory_bytes() > Trie.build(ROWS[:1]).memory_bytes() > 0
+
+
+def test_index_builds_once_and_swaps_on_rebuild():
+    loads = []
+    data = {"rows": ROWS[:1]}
+
+    def loader():
+        loads.append(1)
+        return data["rows"]
+
+    index = AutocompleteIndex(loader)
+    assert index.stats() == {"built": False}
+
+    threads = [threading.Thread(target=index.lookup, args=("na",)) for _ in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(loads) == 1
+
+    old = index.trie()
+    data["rows"] = ROWS
+    index.rebuild()
+    assert index.trie() is not old
+    assert _ids(old.lookup("na")) == [1]
+    assert _ids(index.lookup("na")) == [1, 2, 3, 6]
+    assert index.stats()["titles"] == len(ROWS)
+
+
+def test_patched_reranks_only_changed_titles_and_leaves_the_old_trie_alone():
+    trie = Trie.build(ROWS)
+    before = {prefix: _ids(trie.lookup(prefix)) for prefix in ("na", "nana", "n", "naruto")}
+    patched = trie.patched([{"anime_id": 3, "title": "Nana", "members_count": 5000}])
+    assert _ids(patched.lookup("na")) == [3, 1, 2, 6]
+    assert patched.lookup("nana")[0]["members_count"] == 5000
+    assert _ids(patched.lookup("n")) == [3, 4, 1, 2, 6]
+    assert {prefix: _ids(trie.lookup(prefix)) for prefix in before} == before  # readers of the old trie
+    assert patched.root.children["b"] is trie.root.children["b"]  # off the changed paths: shared
+    # New titles and renames change the trie's shape: nothing is applied.
+    assert patched.patched([{"anime_id": 1, "title": "Naruto", "members_count": 1},
+                            {"anime_id": 99, "title": "X"}]) is None
+    assert patched.patched([{"anime_id": 1, "title": "Boruto", "members_count": 1}]) is None
+    assert _ids(patched.lookup("naruto")) == [1, 2, 6]
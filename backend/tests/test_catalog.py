@@ -0,0 +1,152 @@
+import os
+import sys
+from decimal import Decimal
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from catalog import Catalog, CatalogHolder, SnapshotError  # noqa: E402
+
+ANIME = [
+    {"anime_id": 3, "title": "Cowboy Bebop", "score": Decimal("8.75"), "members_count": 900, "favorites_count": 50,
+     "num_episodes": 26, "year": 1998, "genre_mask": 0b11, "type": "TV", "source_type": "Original",
+     "season": "Spring 1998"},
+    {"anime_id": 1, "title": "Nana", "score": Decimal("8.50"), "members_count": 500, "favorites_count": 70,
+     "num_episodes": 47, "year": 2006, "genre_mask": 0b100, "type": "TV", "source_type": "Manga",
+     "season": "Spring 2006"},
+    {"anime_id": 7, "title": "Ōkami", "score": None, "members_count": None, "favorites_count": 1,
+     "num_episodes": None, "year": None, "genre_mask": 0, "type": None, "source_type": None, "season": None},
+]
+GENRES = [{"genre_id": 10, "name": "Drama", "bit": 2}, {"genre_id": 11, "name": "Action", "bit": 0}]
+STUDIOS = [{"anime_id": 3, "studio_id": 5}, {"anime_id": 1, "studio_id": 6}, {"anime_id": 3, "studio_id": 4}]
+RECS = [
+    {"anime_id_a": 1, "anime_id_b": 3, "num_recommenders": 4},
+    {"anime_id_a": 3, "anime_id_b": 1, "num_recommenders": 9},
+    {"anime_id_a": 3, "anime_id_b": 7, "num_recommenders": 2},
+    {"anime_id_a": 3, "anime_id_b": 404, "num_recommenders": 1},
+]
+
+
+@pytest.fixture
+def catalog():
+    return Catalog.from_rows(ANIME, GENRES, STUDIOS, RECS)
+
+
+def _check(cat):
+    assert list(cat.anime_id) == [1, 3, 7]
+    row = cat.row_of(3)
+    assert cat.title(row) == "Cowboy Bebop"
+    assert cat.score(row) == Decimal("8.75")
+    assert cat.value("year", row) == 1998
+    assert cat.genre_mask[row] == 0b11
+    assert list(cat.studios(row)) == [4, 5]
+    assert cat.types[cat.type_code[row]] == "TV"
+    neighbours, votes = cat.recommendations(row)
+    # Undirected, weighted by the larger direction, most votes first; unknown ids dropped.
+    assert [cat.anime_id[i] for i in neighbours] == [1, 7]
+    assert list(votes) == [9, 2]
+    nameless = cat.row_of(7)
+    assert cat.title(nameless) == "Ōkami"
+    assert cat.score(nameless) is None and cat.value("members_count", nameless) is None
+
+
+def test_from_rows(catalog):
+    _check(catalog)
+
+
+def test_snapshot_round_trip(catalog, tmp_path):
+    path = str(tmp_path / "catalog.snap")
+    catalog.write(path)
+    mapped = Catalog.open(path)
+    assert mapped.source == "snapshot"
+    assert isinstance(mapped.anime_id, memoryview)
+    _check(mapped)
+    assert mapped.stats()["checksum"] == mapped.meta["checksum"]
+    assert mapped.top_lists() == catalog.top_lists()
+
+
+def test_corrupt_snapshot_is_rejected(catalog, tmp_path):
+    path = tmp_path / "catalog.snap"
+    catalog.write(str(path))
+    data = bytearray(path.read_bytes())
+    data[-1] ^= 0xFF
+    path.write_bytes(bytes(data))
+    with pytest.raises(SnapshotError, match="checksum"):
+        Catalog.open(str(path))
+
+    path.write_bytes(b"not a snapshot at all, just some bytes here" * 2)
+    with pytest.raises(SnapshotError, match="not a catalog snapshot"):
+        Catalog.open(str(path))
+
+
+def test_top_and_top_lists(catalog):
+    assert [r["anime_id"] for r in catalog.top("rating", limit=5)] == [3, 1, 7]
+    assert [r["anime_id"] for r in catalog.top("favorites", limit=1, offset=1)] == [3]
+    assert catalog.top("popularity", limit=1)[0] == {
+        "anime_id": 3, "title": "Cowboy Bebop", "score": Decimal("8.75"), "favorites_count": 50, "members_count": 900,
+    }
+
+    lists = catalog.top_lists()
+    assert [r["list"] for r in lists] == ["favorites"] * 3 + ["popularity"] * 3 + ["rating"] * 2
+    assert lists[3]["metric"] == Decimal(900)
+    assert lists[5]["metric"] is None
+    assert catalog.genre_list() == [{"genre_id": 11, "name": "Action"}, {"genre_id": 10, "name": "Drama"}]
+
+
+def test_holder_keeps_old_catalog_when_refresh_fails(catalog):
+    holder = CatalogHolder()
+    swapped = []
+    holder.subscribe(swapped.append)
+    assert holder.refresh(lambda: catalog) is catalog
+    assert holder.current() is catalog and swapped == [catalog]
+
+    def _broken():
+        raise RuntimeError("database is down")
+
+    assert holder.refresh(_broken) is None
+    assert holder.current() is catalog
+    assert "database is down" in holder.last_error
+
+
+def test_patched_copies_fixed_width_columns(catalog, tmp_path):
+    path = str(tmp_path / "catalog.snap")
+    catalog.write(path)
+    mapped = Catalog.open(path)
+    patched = mapped.patched([{**ANIME[1], "members_count": 5000, "score": Decimal("9.10"), "type": "Movie"}])
+    row = patched.row_of(1)
+    assert patched.value("members_count", row) == 5000 and patched.score(row) == Decimal("9.10")
+    assert patched.types[patched.type_code[row]] == "Movie"
+    assert patched.top("popularity", 1)[0]["anime_id"] == 1
+    assert mapped.value("members_count", row) == 500  # the mapped catalog is untouched
+    assert patched.title(row) == "Nana" and list(patched.studios(patched.row_of(3))) == [4, 5]
+    assert patched.stats()["checksum"] is None and patched.stats()["patched_at"]
+
+    assert catalog.patched([{**ANIME[1], "title": "NANA"}]) is None
+    assert catalog.patched([{**ANIME[1], "anime_id": 99}]) is None
+    assert catalog.patched([{**ANIME[1], "genre_mask": 0b1000}]) is None  # bit without a known genre
+
+
+def test_holder_reloads_when_asked_during_a_refresh(catalog):
+    holder = CatalogHolder()
+    calls = []
+
+    def loader():
+        calls.append(1)
+        if len(calls) == 1:
+            assert holder.refresh(loader) is None  # arrives while the first load runs
+        return catalog
+
+    assert holder.refresh(loader) is catalog
+    assert len(calls) == 2 and not holder.refreshing
+
+
+def test_recommendation_filter_compares_min_score_in_decimal(catalog):
+    def kept(*args):
+        keep = catalog.recommendation_filter(*args)
+        return [catalog.anime_id[row] for row in range(len(catalog.anime_id)) if keep(row)]
+
+    assert kept(None, None, None) == [1, 3, 7]
+    assert kept(8.5, None, None) == [1, 3]  # 8.50 >= 8.5; NULL scores drop out
+    assert kept(8.501, None, None) == [3]
+    assert kept(None, 11, (1990, 2000)) == [3]
+    assert catalog.recommendation_filter(None, 404, None) is None
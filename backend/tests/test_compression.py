@@ -0,0 +1,68 @@
+import gzip
+import json
+import os
+import sys
+
+import pytest
+from flask import Response
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from compression import Compressor, negotiate  # noqa: E402
+
+
+def test_negotiate_follows_q_values_then_server_preference():
+    assert negotiate("gzip, deflate, br", ("br", "gzip")) == "br"
+    assert negotiate("gzip;q=1.0, br;q=0.5", ("br", "gzip")) == "gzip"
+    assert negotiate("br", ("gzip",)) is None
+    assert negotiate("*", ("br", "gzip")) == "br"
+    assert negotiate("*;q=0.5, gzip;q=0", ("gzip",)) is None
+    assert negotiate("GZIP;q=bogus, identity", ("gzip",)) is None
+    assert negotiate("", ("gzip",)) is None and negotiate(None, ("gzip",)) is None
+
+
+def _json_response(body):
+    return Response(json.dumps(body), mimetype="application/json")
+
+
+def test_apply_compresses_large_json_once_per_distinct_body():
+    compressor = Compressor(min_size=100, encodings=("gzip",))
+    body = [{"anime_id": i, "title": "Cowboy Bebop"} for i in range(50)]
+
+    first = compressor.apply(_json_response(body), "gzip, br")
+    assert first.headers["Content-Encoding"] == "gzip" and "Accept-Encoding" in first.vary
+    assert json.loads(gzip.decompress(first.get_data())) == body
+    assert int(first.headers["Content-Length"]) == len(first.get_data())
+
+    second = compressor.apply(_json_response(body), "gzip")
+    assert second.get_data() == first.get_data()
+    stats = compressor.stats()
+    assert stats["compressed"] == 1 and stats["cache_hits"] == 1 and stats["bytes_out"] < stats["bytes_in"]
+
+
+def test_apply_leaves_small_unaccepted_and_binary_bodies_alone():
+    compressor = Compressor(min_size=100, encodings=("gzip",))
+    small = compressor.apply(_json_response({"a": 1}), "gzip")
+    assert "Content-Encoding" not in small.headers and "Accept-Encoding" in small.vary
+    plain = compressor.apply(_json_response(list(range(100))), "identity")
+    assert "Content-Encoding" not in plain.headers
+    binary = compressor.apply(Response(b"\0" * 500, mimetype="application/octet-stream"), "gzip")
+    assert "Content-Encoding" not in binary.headers and "Accept-Encoding" not in binary.vary
+    assert compressor.stats()["compressed"] == 0
+
+
+def test_cache_is_bounded_by_bytes():
+    compressor = Compressor(min_size=0, cache_bytes=200, encodings=("gzip",))
+    for i in range(20):
+        compressor.compress(os.urandom(64) + bytes([i]), "gzip")
+    stats = compressor.stats()
+    assert 0 < stats["cache_bytes"] <= 200 and stats["cache_entries"] < 20
+
+
+def test_brotli_is_preferred_when_installed():
+    brotli = pytest.importorskip("brotli")
+    compressor = Compressor(min_size=100)
+    assert compressor.encodings == ("br", "gzip")
+    body = [{"anime_id": i, "title": "Cowboy Bebop"} for i in range(50)]
+    resp = compressor.apply(_json_response(body), "gzip, deflate, br")
+    assert resp.headers["Content-Encoding"] == "br"
+    assert json.loads(brotli.decompress(resp.get_data())) == body
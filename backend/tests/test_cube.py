@@ -0,0 +1,116 @@
+import itertools
+import math
+import os
+import random
+import sys
+from decimal import Decimal
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from catalog import Catalog  # noqa: E402
+from cube import DIMENSIONS, Cube, CubeIndex, parse_query  # noqa: E402
+
+GENRES = [{"genre_id": 10 + bit, "name": f"genre {bit}", "bit": bit} for bit in range(4)]
+COLUMNS = {"score": "score", "members": "members_count", "favorites": "favorites_count"}
+
+
+def _anime(rnd, anime_id):
+    season = rnd.choice([None, "Spring 2019", "Fall 2019", "Spring 2020"])
+    return {
+        "anime_id": anime_id,
+        "title": f"t{anime_id}",
+        "score": rnd.choice([None, round(rnd.uniform(3, 9.5), 2)]),
+        "members_count": rnd.choice([None, rnd.randint(0, 10**6)]),
+        "favorites_count": rnd.randint(0, 500),
+        "genre_mask": rnd.randint(0, 15),
+        "type": rnd.choice([None, "TV", "Movie"]),
+        "source_type": rnd.choice(["Manga", "Original"]),
+        "season": season,
+        "year": int(season[-4:]) if season else None,
+    }
+
+
+def _brute(rows, by, filters):
+    groups = {}
+    for row in rows:
+        genres = [g["genre_id"] for g in GENRES if row["genre_mask"] >> g["bit"] & 1]
+        if "genre" in by or "genre_id" in filters:
+            expanded = [{**row, "genre": genre_id, "genre_id": genre_id} for genre_id in genres]
+        else:
+            expanded = [row]
+        for item in expanded:
+            if all(item[name] == value for name, value in filters.items()):
+                groups.setdefault(tuple(item[name] for name in by), []).append(item)
+    out = {}
+    for key, items in groups.items():
+        measures = {}
+        for measure, column in COLUMNS.items():
+            values = [Decimal(str(i[column])) if measure == "score" else i[column] for i in items
+                      if i[column] is not None]
+            mean = sum(values) / len(values) if values else None
+            measures[measure] = (
+                len(values),
+                sum(values) if values else None,
+                min(values, default=None),
+                max(values, default=None),
+                None if mean is None else round(float(mean), 4),
+                round(math.sqrt(sum((float(v) - float(mean)) ** 2 for v in values) / (len(values) - 1)), 4)
+                if len(values) > 1 else None,
+            )
+        out[key] = (len(items), measures)
+    return out
+
+
+def test_every_roll_up_and_slice_matches_a_group_by():
+    rnd = random.Random(5)
+    rows = [_anime(rnd, anime_id) for anime_id in range(1, 301)]
+    cube = Cube.build(Catalog.from_rows(rows, GENRES))
+    for size in range(3):
+        for by in itertools.combinations(DIMENSIONS, size):
+            for filters in ({}, {"type": "TV"}, {"genre_id": 11}, {"year": 2019, "source_type": "Manga"}):
+                got = {}
+                for item in cube.query(*parse_query(",".join(by), filters, None)):
+                    key = tuple(item["genre_id"] if name == "genre" else item[name] for name in by)
+                    got[key] = (item["count"], {
+                        measure: tuple(item[measure][f] for f in ("count", "sum", "min", "max", "avg", "stddev"))
+                        for measure in COLUMNS
+                    })
+                expected = _brute(rows, by, filters)
+                assert got.keys() == expected.keys(), (by, filters)
+                for key, (count, measures) in expected.items():
+                    assert got[key][0] == count
+                    for measure, (n, total, low, high, avg, stddev) in measures.items():
+                        g = got[key][1][measure]
+                        assert g[:4] == (n, total, low, high), (by, filters, key, measure)
+                        assert g[4] == pytest.approx(avg, abs=1e-4) if avg is not None else g[4] is None
+                        assert g[5] == pytest.approx(stddev, abs=1e-4) if stddev is not None else g[5] is None
+
+
+def test_results_are_ordered_by_the_grouping_and_cached():
+    rnd = random.Random(6)
+    cube = Cube.build(Catalog.from_rows([_anime(rnd, anime_id) for anime_id in range(1, 101)], GENRES))
+    args = parse_query("genre,year", {}, "score")
+    first = cube.query(*args)
+    assert [(r["genre"], r["year"] is None) for r in first] == sorted((r["genre"], r["year"] is None) for r in first)
+    assert set(first[0]) == {"genre_id", "genre", "year", "count", "score"}
+    assert cube.query(*args) is first and cube.stats()["cuboids"] == 32
+
+
+def test_parse_query_rejects_unknown_names():
+    for by, filters, measures in (("studio", {}, None), ("type,type", {}, None), ("", {}, "rating"),
+                                  ("", {"min_score": 5}, None)):
+        with pytest.raises(ValueError):
+            parse_query(by, filters, measures)
+    assert parse_query(None, {"type": None}, None) == ([], {}, ["score", "members", "favorites"])
+
+
+def test_index_builds_on_first_query_and_swaps_on_rebuild():
+    rnd = random.Random(7)
+    catalogs = [Catalog.from_rows([_anime(rnd, 1)], GENRES), Catalog.from_rows([], GENRES)]
+    index = CubeIndex(lambda: catalogs[0])
+    assert not index.built
+    assert index.query(None, {}, "favorites")[0]["count"] == 1
+    catalogs.pop(0)
+    index.rebuild()
+    assert index.query(None, {}, "favorites") == [] and index.stats()["anime"] == 0
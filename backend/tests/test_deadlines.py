@@ -0,0 +1,84 @@
+import os
+import socket
+import sys
+import threading
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import deadlines  # noqa: E402
+from deadlines import ClientDisconnected, Deadline, DeadlineExceeded, DisconnectWatcher, parse_deadlines  # noqa: E402
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_parse_deadlines():
+    assert parse_deadlines("similar=20000, heavy=0") == {"similar": 20000, "heavy": 0}
+    assert parse_deadlines("") == {}
+    with pytest.raises(ValueError):
+        parse_deadlines("heavy=soon")
+
+
+def test_deadline_counts_down_and_checks():
+    clock = Clock()
+    deadline = Deadline(500, clock=clock)
+    deadline.check()
+    clock.now += 0.2
+    assert deadline.remaining_ms() == 300
+    assert deadline.remaining_seconds() == pytest.approx(0.3)
+    clock.now += 0.4
+    assert deadline.remaining_ms() == 0 and deadline.expired()
+    with pytest.raises(DeadlineExceeded) as excinfo:
+        deadline.check()
+    assert excinfo.value.budget_ms == 500
+
+    deadline.disconnected = True
+    with pytest.raises(ClientDisconnected):
+        deadline.check()
+
+
+def test_current_deadline_is_scoped_to_the_context():
+    assert deadlines.current() is None
+    deadline = Deadline(100)
+    token = deadlines.activate(deadline)
+    assert deadlines.current() is deadline
+    deadlines.deactivate(token)
+    assert deadlines.current() is None
+
+
+def test_watcher_cancels_when_the_client_hangs_up():
+    server, client = socket.socketpair()
+    watcher = DisconnectWatcher(interval=0.01)
+    deadline = Deadline(5000, client_socket=server)
+    cancelled = threading.Event()
+    try:
+        with watcher.watch(deadline, cancelled.set):
+            client.close()
+            assert cancelled.wait(2)
+        assert deadline.disconnected and watcher.cancelled == 1
+    finally:
+        server.close()
+
+
+def test_watcher_leaves_live_clients_alone():
+    server, client = socket.socketpair()
+    watcher = DisconnectWatcher(interval=0.01)
+    deadline = Deadline(5000, client_socket=server)
+    cancelled = threading.Event()
+    try:
+        with watcher.watch(deadline, cancelled.set):
+            client.sendall(b"GET / HTTP/1.1\r\n")  # a pipelined request is not a hang-up
+            assert not cancelled.wait(0.1)
+        with watcher.watch(Deadline(5000), cancelled.set):  # no socket: nothing to watch
+            pass
+        assert not deadline.disconnected and watcher.cancelled == 0
+        assert server.recv(3) == b"GET"  # the peek left the data in place
+    finally:
+        server.close()
+        client.close()
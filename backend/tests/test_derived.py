@@ -0,0 +1,55 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from derived import DerivedIndex  # noqa: E402
+
+
+class Counted:
+    def __init__(self, version):
+        self.version = version
+
+    def stats(self):
+        return {"version": self.version}
+
+
+class CountedIndex(DerivedIndex[Counted]):
+    name = "counted"
+
+    def _make(self) -> Counted:
+        return Counted(self.loader())
+
+
+def test_builds_once_on_first_use_and_reports_the_value_stats():
+    versions = iter(range(1, 10))
+    index = CountedIndex(lambda: next(versions))
+    assert not index.built and index.stats() == {"built": False}
+    assert index.get().version == 1 and index.get().version == 1
+    assert index.rebuild().version == 2
+    stats = index.stats()
+    assert stats["built"] and stats["version"] == 2 and stats["build_seconds"] >= 0
+
+
+def test_requests_during_a_background_rebuild_run_exactly_one_more():
+    started, release = threading.Event(), threading.Event()
+    loads = []
+
+    def loader():
+        loads.append(1)
+        if len(loads) == 1:
+            started.set()
+            release.wait(5)
+        return len(loads)
+
+    index = CountedIndex(loader)
+    index.rebuild_in_background()
+    assert started.wait(5) and index.rebuilding
+    for _ in range(3):  # three change sets while the first rebuild reads the catalog
+        index.rebuild_in_background()
+    release.set()
+    deadline = time.time() + 5
+    while (index.rebuilding or index.get().version < 2) and time.time() < deadline:
+        time.sleep(0.01)
+    assert index.get().version == 2 and len(loads) == 2
@@ -0,0 +1,76 @@
+import os
+import random
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from catalog import Catalog, _components  # noqa: E402
+from franchises import COLUMNS, FranchiseIndex, Franchises  # noqa: E402
+
+
+def _catalog(related, **anime):
+    ids = sorted({x for a, b in related for x in (a, b)} | {int(k[1:]) for k in anime})
+    rows = [{"anime_id": i, "title": f"t{i}", **anime.get(f"a{i}", {})} for i in ids]
+    return Catalog.from_rows(rows, related_rows=[{"anime_id_a": a, "anime_id_b": b} for a, b in related])
+
+
+def test_components_match_a_breadth_first_search():
+    rnd = random.Random(7)
+    n = 300
+    pairs = [(rnd.randrange(n), rnd.randrange(n)) for _ in range(200)]
+    roots = _components(n, pairs)
+    adjacent = {i: set() for i in range(n)}
+    for a, b in pairs:
+        adjacent[a].add(b)
+        adjacent[b].add(a)
+    for start in range(n):
+        seen, frontier = {start}, [start]
+        while frontier:
+            frontier = [b for a in frontier for b in adjacent[a] if b not in seen]
+            seen.update(frontier)
+        assert {row for row in range(n) if roots[row] == roots[start]} == seen
+
+
+def test_franchise_ids_are_the_smallest_member():
+    # A chain listed out of order, a pair related in both directions, and a loner.
+    catalog = _catalog([(30, 20), (20, 10), (40, 50), (50, 40), (20, 30)], a60={})
+    assert list(catalog.franchise_id) == [10, 10, 10, 40, 40, 60]
+    assert catalog.franchise_of(30) == 10 and catalog.franchise_of(60) == 60 and catalog.franchise_of(7) is None
+    assert catalog.stats()["franchises"] == 3
+
+
+def test_aggregates_and_top_lists():
+    catalog = _catalog(
+        [(1, 2), (2, 3), (4, 5)],
+        a1={"score": 8.0, "members_count": 100, "year": 2006},
+        a2={"score": 7.5, "members_count": 300, "year": 2004},
+        a3={"score": None, "members_count": None, "year": None},
+        a4={"score": 9.0, "members_count": 50, "year": 2010},
+        a5={"score": 8.5, "members_count": 60, "year": 2011},
+        a6={"score": None, "members_count": 1000},
+    )
+    franchises = Franchises(catalog)
+    found = franchises.franchise(3)
+    assert {k: v for k, v in found.items() if k != "anime"} == {
+        "franchise_id": 1, "title": "t2", "size": 3, "avg_score": 7.75, "total_members": 400,
+    }
+    assert [a["anime_id"] for a in found["anime"]] == [2, 1, 3]
+    # Every column a member row shows is one whose change rebuilds the franchises.
+    assert set(found["anime"][0]) - {"anime_id"} <= set(COLUMNS)
+    assert franchises.franchise(6)["avg_score"] is None and franchises.franchise(99) is None
+
+    def ids(metric, **kwargs):
+        return [f["franchise_id"] for f in franchises.top(metric, 10, **kwargs)]
+
+    assert ids("size") == [1, 4, 6]
+    assert ids("score") == [4, 1, 6]
+    assert ids("members") == [6, 1, 4]
+    assert ids("members", min_size=2) == [1, 4] and franchises.top("members", 1, offset=1)[0]["franchise_id"] == 1
+    assert franchises.stats() == {"anime": 6, "franchises": 3, "singletons": 1, "largest": 3}
+
+
+def test_index_builds_on_first_use():
+    catalog = _catalog([(1, 2)])
+    index = FranchiseIndex(lambda: catalog)
+    assert index.stats() == {"built": False}
+    assert index.franchises().franchise(2)["size"] == 2
+    assert index.built and index.stats()["franchises"] == 1
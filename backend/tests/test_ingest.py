@@ -0,0 +1,80 @@
+import csv
+import datetime
+import os
+import sys
+from decimal import Decimal
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from changes import ChangeFeed, ChangeSet  # noqa: E402
+import franchises  # noqa: E402
+from ingest import changed_columns, read_dump, row_hash, with_derived  # noqa: E402
+
+COLUMN_TYPES = {
+    "anime_id": "INTEGER",
+    "title": "TEXT",
+    "score": "NUMERIC_2",
+    "members_count": "INTEGER",
+    "start_date": "DATE",
+    "year": "INTEGER",
+    "genre_mask": "INTEGER",
+}
+
+
+def _write_dump(path, rows):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["anime_id", "title", "score", "members_count", "start_date", "genres", "extra"])
+        writer.writerows(rows)
+
+
+def test_read_dump_and_hash_match_postgres_values(tmp_path):
+    path = tmp_path / "anime cleaned.csv"
+    _write_dump(path, [
+        [1, "Naruto", "7.9", "5000.0", "2002-10-03", "['Comedy', 'Action']", "x"],
+        [2, "Nana", "", "", "", "", "y"],
+    ])
+    columns, rows = read_dump(str(path), COLUMN_TYPES)
+    # Derived columns and columns the table lacks are not compared.
+    assert columns == ["anime_id", "title", "score", "members_count", "start_date", "genres"]
+    assert rows[1]["genres"] == ["Action", "Comedy"] and rows[2]["score"] is None
+
+    # What psycopg2 returns for the same row.
+    pg_row = [1, "Naruto", Decimal("7.90"), 5000, datetime.date(2002, 10, 3), ["Comedy", "Action"]]
+    assert row_hash([rows[1][c] for c in columns]) == row_hash(pg_row)
+    assert row_hash([rows[1][c] for c in columns]) != row_hash([*pg_row[:3], 5001, *pg_row[4:]])
+
+    old = dict(zip(columns, pg_row), members_count=4000, genres=["Action"])
+    assert changed_columns(old, rows[1], columns) == ["members_count", "genres"]
+    assert changed_columns(None, rows[2], columns) == columns
+
+
+def test_changes_report_the_columns_the_triggers_derive():
+    assert with_derived(["season"]) == {"season", "year", "decade", "season_name"}
+    assert with_derived(["genres", "score"]) == {"genres", "genre_mask", "score"}
+    assert with_derived(["members_count"]) == {"members_count"}
+    # The franchise aggregates read year, not season.
+    assert ChangeSet.of([1], with_derived(["season"])).touches(franchises.COLUMNS)
+
+
+def test_change_set_payload_round_trip():
+    changes = ChangeSet.of(range(1, 1201), ["members_count"])
+    parts = changes.split()
+    assert [len(p.anime_ids) for p in parts] == [500, 500, 200]
+    assert all(len(p.to_payload()) < 8000 for p in parts)
+    assert ChangeSet.from_payload(parts[0].to_payload()) == parts[0]
+    assert ChangeSet.from_payload(ChangeSet.everything().to_payload()) == ChangeSet.everything()
+    assert changes.touches(["score", "members_count"]) and not changes.touches(["title"])
+    assert ChangeSet.everything().touches(["title"])
+
+
+def test_feed_keeps_publishing_past_a_failing_subscriber():
+    feed, seen = ChangeFeed(), []
+
+    def broken(_changes):
+        raise RuntimeError("boom")
+
+    feed.subscribe(broken)
+    feed.subscribe(seen.append)
+    feed.publish(ChangeSet.of([1]))
+    assert seen == [ChangeSet.of([1])]
+    assert "boom" in feed.stats()["last_error"]
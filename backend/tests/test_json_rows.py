@@ -0,0 +1,59 @@
+import datetime
+import os
+import sys
+from decimal import Decimal
+
+import pytest
+from flask import Flask, jsonify
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import json_rows  # noqa: E402
+from storage import Columns  # noqa: E402
+
+ROWS = [
+    (1, "Cowboy Bebop", Decimal("8.75"), 1.5, True, datetime.date(1998, 4, 3), None, [1, 2]),
+    (2, "Shōjo \"K\"\n", None, float("nan"), False, None, "Spring", None),
+    (3, None, Decimal("1E+1"), float("-inf"), None, datetime.datetime(2001, 2, 3, 4, 5, 6), 7, []),
+]
+NAMES = ["anime_id", "title", "score", "ratio", "airing", "aired", "mixed", "genres"]
+# What psycopg2 reports: int4, text, numeric, float8, bool, date, then no OID for the last two.
+PG_TYPES = [(23, None, None), (25, None, None), (1700, 4, 2), (701, None, None), (16, None, None),
+            (1082, None, None), (None, None, None), (None, None, None)]
+
+
+@pytest.fixture()
+def flask_app():
+    app = Flask(__name__)
+    with app.app_context():
+        yield app
+
+
+def _columns(names, types, rows):
+    return Columns(list(names), list(types), list(zip(*rows)) if rows else [() for _ in names])
+
+
+def _jsonify(value):
+    return jsonify(value).get_data()
+
+
+@pytest.mark.parametrize("types", [PG_TYPES, [(None, None, None)] * len(NAMES)], ids=["postgres", "inferred"])
+def test_encode_matches_jsonify_of_dict_rows(flask_app, types):
+    columns = _columns(NAMES, types, ROWS)
+    assert json_rows.encode(columns) == _jsonify([dict(zip(NAMES, row)) for row in ROWS])
+    assert json_rows.rows(columns) == [dict(zip(NAMES, row)) for row in ROWS]
+    assert json_rows.encode(_columns(NAMES, types, [])) == _jsonify([]) == b"[]\n"
+
+
+def test_repeated_and_odd_column_names(flask_app):
+    names = ["b", "a%s", "b", "é"]
+    rows = [(1, 2, 3, 4), (5, 6, 7, 8)]
+    columns = _columns(names, [(23, None, None)] * 4, rows)
+    assert json_rows.encode(columns) == _jsonify([dict(zip(names, row)) for row in rows])
+
+
+def test_objects_embed_columns(flask_app):
+    columns = _columns(NAMES, PG_TYPES, ROWS)
+    bins = json_rows.select(columns, ["score", "anime_id"])
+    assert bins.values[0] is columns.values[2]
+    expected = {"bins": [{"anime_id": row[0], "score": row[2]} for row in ROWS], "corr": 0.25, "none": None}
+    assert json_rows.encode({"corr": 0.25, "bins": bins, "none": None}) == _jsonify(expected)
@@ -0,0 +1,123 @@
+import json
+import os
+import random
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import loadgen  # noqa: E402
+from loadgen import ROUTES, Client, Profile, Recorder, parse_mix, percentile, summarize  # noqa: E402
+
+POPULAR = [{"anime_id": 100 + i, "title": title} for i, title in enumerate(["Cowboy Bebop", "Naruto", "K", ""])]
+FACETS = {
+    "total": 4,
+    "genre": [{"genre_id": 1, "name": "Action", "count": 3}, {"genre_id": 2, "name": "Drama", "count": 1}],
+    "season": [{"value": "Spring 1998", "count": 2}, {"value": None, "count": 2}],
+    "type": [{"value": "TV", "count": 4}],
+}
+
+
+def test_parse_mix_overrides_the_defaults():
+    mix = parse_mix("similar=20,facets=0,list_genres")
+    assert mix["similar"] == 20 and mix["list_genres"] == 1 and "anime_facets" not in mix
+    assert "similar_text" not in parse_mix(None)
+    for bad in ("nope=1", "search=1", "similar=x", "similar=-1"):
+        with pytest.raises(ValueError):
+            parse_mix(bad)
+    with pytest.raises(ValueError):
+        parse_mix(",".join(f"{name}=0" for name in ROUTES))
+
+
+def test_percentile_is_nearest_rank():
+    values = list(range(1, 101))
+    assert percentile(values, 0.5) == 50 and percentile(values, 0.99) == 99 and percentile(values, 1.0) == 100
+    assert percentile([7], 0.99) == 7 and percentile([], 0.5) is None
+
+
+def test_summarize_reports_throughput_latency_and_errors_per_route():
+    recorder = Recorder()
+    for ms in range(1, 101):
+        recorder.add("get_anime", ms / 1000, 200)
+    recorder.add("similar", 0.5, 503)
+    recorder.add("similar", 0.1, 0)
+    report = summarize(recorder, 2.0)
+    assert report["total"]["requests"] == 102 and report["total"]["errors"] == 2
+    get_anime = report["routes"]["get_anime"]
+    assert get_anime["throughput"] == 50.0 and get_anime["p50_ms"] == 50.0 and get_anime["p99_ms"] == 99.0
+    assert report["routes"]["similar"]["statuses"] == {"0": 1, "503": 1}
+    assert report["routes"]["similar"]["error_rate"] == 1.0
+
+
+def test_profile_draws_follow_the_data():
+    profile = Profile.build(POPULAR, FACETS)
+    rng = random.Random(1)
+    seeds = [profile.anime_ids[profile.anime(rng)] for _ in range(2000)]
+    # Zipf by rank: the most popular title gets the most traffic.
+    assert seeds.count(100) > seeds.count(101) > seeds.count(103) > 0
+    assert profile.seasons == ["Spring 1998"]
+    assert all(set(profile.genre_combo(rng)) <= {1, 2} for _ in range(50))
+    prefixes = {profile.prefix(rng, min_len=2) for _ in range(200)}
+    assert {"co", "na", "k", ""} <= prefixes and all(any(p in t.lower() for t in profile.titles) for p in prefixes)
+    for build in ROUTES.values():
+        assert build(profile, rng).startswith("/api/")
+    with pytest.raises(ValueError):
+        Profile.build([], FACETS)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):  # noqa: N802
+        if self.path.startswith("/api/anime/top?"):
+            body = json.dumps(POPULAR).encode()
+        elif self.path == "/api/anime/facets":
+            body = json.dumps(FACETS).encode()
+        else:
+            body = b"[]"
+        status = 503 if "/similar" in self.path else 200
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture()
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_closed_and_open_loops_record_every_request(server):
+    profile = Profile.fetch(Client(server))
+    assert profile.anime_ids[0] == 100 and profile.genre_ids == [1, 2]
+    mix = parse_mix("similar=10")
+
+    recorder, elapsed = loadgen.run_closed(lambda: Client(server), profile, mix, 2, 0.3, seed=1)
+    report = summarize(recorder, elapsed)
+    assert report["total"]["requests"] > 10
+    assert report["routes"]["similar"]["statuses"] == {"503": report["routes"]["similar"]["requests"]}
+
+    recorder, elapsed = loadgen.run_open(lambda: Client(server), profile, mix, 200, 0.3, max_inflight=4, seed=1)
+    report = summarize(recorder, elapsed)
+    # About rate * duration arrivals, every one answered.
+    assert 20 < report["total"]["requests"] < 120 and "0" not in report["total"]["statuses"]
+
+
+def test_unreachable_server_counts_as_errors():
+    profile = Profile.build(POPULAR, FACETS)
+    recorder, elapsed = loadgen.run_closed(
+        lambda: Client(f"http://127.0.0.1:{loadgen._free_port()}", timeout=1),
+        profile, {"list_genres": 1}, 1, 0.1,
+    )
+    assert summarize(recorder, elapsed)["total"]["statuses"].keys() == {"0"}
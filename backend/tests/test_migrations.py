@@ -0,0 +1,116 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import migrations  # noqa: E402  pylint: disable=wrong-import-position
+
+
+class FakeMigrationConn:
+    """Records SQL and plays back canned results for the runner's bookkeeping queries."""
+
+    def __init__(self, applied=None, backfill_batches=None, invalid_indexes=()):
+        self.applied = dict(applied or {})
+        self.invalid_indexes = set(invalid_indexes)
+        self.backfill_batches = list(backfill_batches or [])
+        self.executed = []
+        self.commits = 0
+        self.autocommit = False
+        self.autocommit_statements = []
+
+    def cursor(self):
+        return FakeMigrationCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+
+class FakeMigrationCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.result = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def execute(self, sql, params=None):
+        self.conn.executed.append((sql, params))
+        if self.conn.autocommit:
+            self.conn.autocommit_statements.append(sql)
+        if sql.startswith("SELECT version, name FROM schema_migrations"):
+            self.result = sorted(self.conn.applied.items())
+        elif sql.startswith("INSERT INTO schema_migrations"):
+            self.conn.applied[params[0]] = params[1]
+        elif sql.startswith("SELECT indisvalid FROM pg_index"):
+            self.result = [(False,)] if params[0] in self.conn.invalid_indexes else []
+        elif "UPDATE anime t SET year" in sql:
+            self.result = [(k,) for k in self.conn.backfill_batches.pop(0)] if self.conn.backfill_batches else []
+
+    def fetchall(self):
+        return self.result
+
+    def fetchone(self):
+        return self.result[0] if self.result else None
+
+
+def _sql(conn):
+    return [" ".join(sql.split()) for sql, _ in conn.executed]
+
+
+def test_migrations_are_ordered_and_unique():
+    versions = [m.version for m in migrations.MIGRATIONS]
+    assert versions == sorted(set(versions))
+
+
+def test_migrate_applies_pending_in_order_and_records_them():
+    conn = FakeMigrationConn(backfill_batches=[[1, 2], [3]])
+    applied = migrations.migrate(conn, batch_size=2, log=lambda _msg: None)
+
+    assert applied == [m.version for m in migrations.MIGRATIONS]
+    assert set(conn.applied) == set(applied)
+    sql = _sql(conn)
+    assert sql[0].startswith("CREATE TABLE IF NOT EXISTS schema_migrations")
+    assert any(s.startswith("ALTER TABLE anime ADD COLUMN IF NOT EXISTS year") for s in sql)
+    assert sql[-1].startswith("SELECT pg_advisory_unlock")
+    # Backfill keeps going until a batch comes back empty, resuming after the last key.
+    updates = [params for s, params in conn.executed if "UPDATE anime t SET year" in s]
+    assert [p["after"] for p in updates] == [-1, 2, 3]
+    assert all(p["batch_size"] == 2 for p in updates)
+    # Concurrent index builds cannot run inside a transaction.
+    assert conn.autocommit_statements
+    assert all("CONCURRENTLY" in s for s in conn.autocommit_statements)
+
+
+def test_an_invalid_index_left_by_a_failed_build_is_dropped_and_rebuilt():
+    conn = FakeMigrationConn(applied={1: "anime_season_columns"}, invalid_indexes={"anime_decade_idx"})
+    migrations.migrate(conn, target=2, log=lambda _msg: None)
+    statements = [" ".join(s.split()) for s in conn.autocommit_statements]
+    assert statements.index("DROP INDEX CONCURRENTLY IF EXISTS anime_decade_idx;") == statements.index(
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS anime_decade_idx ON anime (decade);") - 1
+    assert sum(s.startswith("DROP INDEX") for s in statements) == 1
+
+
+def test_migrate_is_idempotent():
+    conn = FakeMigrationConn(applied={m.version: m.name for m in migrations.MIGRATIONS})
+    assert migrations.migrate(conn, log=lambda _msg: None) == []
+    assert not any("ALTER TABLE" in s for s in _sql(conn))
+
+
+def test_dry_run_executes_nothing():
+    conn = FakeMigrationConn()
+    messages = []
+    applied = migrations.migrate(conn, dry_run=True, log=messages.append)
+    assert applied == [m.version for m in migrations.MIGRATIONS]
+    assert conn.applied == {}
+    assert not any("ALTER TABLE" in s or "UPDATE" in s for s in _sql(conn))
+    assert any("would apply 0001" in m for m in messages)
+
+
+def test_target_stops_early():
+    conn = FakeMigrationConn()
+    assert migrations.migrate(conn, target=1, log=lambda _msg: None) == [1]
@@ -0,0 +1,105 @@
+import os
+import sys
+import threading
+import time
+from decimal import Decimal
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from catalog import Catalog  # noqa: E402
+from genre_mask import MAX_GENRE_BITS  # noqa: E402
+from minhash import (  # noqa: E402
+    MinHasher, MinHashIndex, SimilarIndex, features, recall_at_k, similarity, similarity_number,
+)
+
+ANIME = [
+    {"anime_id": 1, "title": "Bebop", "score": 8.75, "members_count": 900, "favorites_count": 5, "genre_mask": 0b0111},
+    {"anime_id": 2, "title": "Bebop Movie", "score": 8.4, "members_count": 300, "favorites_count": 1,
+     "genre_mask": 0b0111},
+    {"anime_id": 3, "title": "Trigun", "score": 8.2, "members_count": 600, "favorites_count": 2, "genre_mask": 0b0011},
+    {"anime_id": 4, "title": "Nana", "score": None, "members_count": 500, "favorites_count": 3, "genre_mask": 0b1000},
+    {"anime_id": 5, "title": "Unknown", "score": None, "members_count": None, "favorites_count": None,
+     "genre_mask": 0},
+]
+STUDIOS = [
+    {"anime_id": 1, "studio_id": 14},
+    {"anime_id": 2, "studio_id": 14},
+    {"anime_id": 2, "studio_id": 20},
+    {"anime_id": 3, "studio_id": 7},
+]
+
+
+def _catalog():
+    return Catalog.from_rows(ANIME, studio_rows=STUDIOS)
+
+
+def test_similarity_has_postgres_numeric_digits():
+    # Trigun vs Bebop: 2 of 3 genres, no shared studio.
+    assert str(similarity(0b0011, frozenset({7}), 0b0111, frozenset({14}))) == "0.466666666666666666669"
+    assert similarity(0b1, frozenset(), 0b1, frozenset()) == Decimal("0.7")
+    assert features(0b101, [3]) == frozenset({0, 2, MAX_GENRE_BITS + 3})
+
+
+def test_similarity_number_rounds_halves_away_like_postgres():
+    assert similarity_number(Decimal("0.466666666666666666669")) == 0.466667
+    assert similarity_number(Decimal("0.0000125")) == 0.000013  # Decimal round() gives 0.000012
+    assert isinstance(similarity_number(Decimal("0.7")), float)
+
+
+def test_signatures_agree_as_often_as_the_sets_overlap():
+    hasher = MinHasher(512)
+    a, b = hasher.signature(range(0, 8)), hasher.signature(range(4, 12))  # Jaccard 4/12
+    assert abs(sum(x == y for x, y in zip(a, b)) / 512 - 1 / 3) < 0.08
+    assert hasher.signature([]) is None
+    assert hasher.signature([5]) == hasher.signature({5})
+
+
+def test_exact_matches_the_route_ordering():
+    index = MinHashIndex(_catalog(), bands=16, rows=2)
+    rows = index.exact(1, 10)
+    assert [r["anime_id"] for r in rows] == [2, 3]
+    assert rows[0]["similarity"] == Decimal("0.7") + Decimal("0.3") * Decimal("0.50000000000000000000")
+    assert rows[0]["score"] == Decimal("8.40") and rows[0]["members_count"] == 300
+    assert index.exact(5, 10) == [] and index.exact(404, 10) == []
+
+
+def test_approximate_search_finds_near_duplicates_and_rescores_exactly():
+    index = MinHashIndex(_catalog(), bands=16, rows=2)
+    assert index.similar(1, 1) == index.exact(1, 1)
+    assert index.candidates(index.catalog.row_of(5)) == []
+    assert index.similar(4, 5) == []  # its only genre is its own
+    stats = recall_at_k(index, [1, 2, 3, 4, 5], 2)
+    assert stats["seeds"] == 3 and stats["recall_at_k"] == 1.0
+
+
+def test_similar_index_builds_lazily_from_the_loader():
+    calls = []
+    holder = SimilarIndex(lambda: calls.append(1) or _catalog(), bands=8, rows=2)
+    assert not holder.built and holder.stats() == {"built": False, "bands": 8, "rows": 2}
+    assert [r["anime_id"] for r in holder.similar(3, 5)][:1] == [1]
+    holder.similar(3, 5)
+    assert calls == [1]
+    holder.rebuild()
+    assert calls == [1, 1] and holder.stats()["anime"] == 5
+
+
+def test_a_change_during_a_background_rebuild_asks_for_one_more():
+    started, release = threading.Event(), threading.Event()
+    catalogs = [_catalog(), Catalog.from_rows(ANIME[:3], studio_rows=STUDIOS)]
+    calls = []
+
+    def loader():
+        calls.append(1)
+        if len(calls) == 1:
+            started.set()
+            release.wait(5)
+        return catalogs[len(calls) - 1]
+
+    holder = SimilarIndex(loader, bands=8, rows=2)
+    holder.rebuild_in_background()
+    assert started.wait(5)
+    holder.rebuild_in_background()  # the next ingest batch, while the first rebuild reads the catalog
+    release.set()
+    deadline = time.time() + 5
+    while not (holder.built and holder.index().catalog is catalogs[1]) and time.time() < deadline:
+        time.sleep(0.01)
+    assert holder.index().catalog is catalogs[1] and len(calls) == 2
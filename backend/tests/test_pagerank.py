@@ -0,0 +1,132 @@
+import os
+import random
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from catalog import Catalog  # noqa: E402
+from pagerank import GraphIndex, RecommendationGraph  # noqa: E402
+
+GENRES = [{"genre_id": 10, "name": "Drama", "bit": 0}, {"genre_id": 11, "name": "Action", "bit": 1}]
+
+
+def _catalog(edges, n=None, **anime):
+    ids = sorted({x for a, b, _ in edges for x in (a, b)} | set(range(1, (n or 0) + 1)))
+    rows = [{"anime_id": i, "title": f"t{i}", **anime.get(f"a{i}", {})} for i in ids]
+    recs = [{"anime_id_a": a, "anime_id_b": b, "num_recommenders": v} for a, b, v in edges]
+    return Catalog.from_rows(rows, GENRES, [], recs)
+
+
+def _reference(graph, start, restart, iterations=300):
+    # Plain dense power iteration, dangling anime jumping back to the start.
+    n = len(graph.anime_id)
+    x = [start.get(i, 0.0) for i in range(n)]
+    for _ in range(iterations):
+        nxt = [restart * start.get(i, 0.0) for i in range(n)]
+        for u in range(n):
+            neighbours, probabilities = graph.outgoing[u]
+            if not neighbours:
+                for row, weight in start.items():
+                    nxt[row] += (1 - restart) * x[u] * weight
+            for v, p in zip(neighbours, probabilities):
+                nxt[v] += (1 - restart) * x[u] * p
+        x = nxt
+    return x
+
+
+def test_two_anime_have_the_closed_form_relevance():
+    graph = RecommendationGraph(_catalog([(1, 2, 5)]))
+    walk = graph.walk({0: 1.0}, restart=0.15, tolerance=1e-12, max_iterations=1000)
+    assert walk.scores[0] == pytest.approx(1 / 1.85) and walk.scores[1] == pytest.approx(0.85 / 1.85)
+    assert walk.residual < 1e-12 and walk.iterations < 1000
+    capped = graph.walk({0: 1.0}, restart=0.15, tolerance=1e-12, max_iterations=3)
+    assert capped.iterations == 3 and capped.residual > 1e-12
+    with pytest.raises(ValueError):
+        graph.walk({0: 0.0})
+
+
+def test_sparse_and_dense_iterations_match_the_reference():
+    rnd = random.Random(4)
+    # A connected cluster big enough for the dense phase, a small separate one, and isolated anime.
+    edges = [(rnd.randint(1, 60), rnd.randint(1, 60), rnd.randint(0, 40)) for _ in range(240)]
+    edges += [(70, 71, 3), (71, 72, 1), (72, 73, 0)]
+    graph = RecommendationGraph(_catalog([e for e in edges if e[0] != e[1]], n=80))
+    for start in ({graph.row_of(1): 1.0}, {graph.row_of(70): 1.0}, {graph.row_of(1): 2.0, graph.row_of(72): 1.0},
+                  {graph.row_of(80): 1.0}):
+        walk = graph.walk(start, restart=0.2, tolerance=1e-13, max_iterations=500)
+        total = sum(start.values())
+        expected = _reference(graph, {row: w / total for row, w in start.items()}, 0.2)
+        assert walk.scores == pytest.approx(expected, abs=1e-10)
+        assert sum(walk.scores) == pytest.approx(1.0)
+
+
+def test_recommend_ranks_multi_hop_titles_and_applies_the_filters():
+    catalog = _catalog(
+        [(1, 2, 10), (2, 3, 10), (3, 4, 10), (1, 5, 1)],
+        a2={"score": 8.57, "year": 2005, "genre_mask": 1},
+        a3={"score": 7.0, "year": 2012, "genre_mask": 3},
+        a4={"score": 9.0, "year": 2001, "genre_mask": 2},
+        a5={"score": None, "year": None},
+    )
+    index = GraphIndex(lambda: catalog, tolerance=1e-9, cache_size=1)
+    ranked = index.recommend({1: 1}, 10)
+    # Three hops along strong edges beat one weak direct recommendation.
+    assert [r["anime_id"] for r in ranked] == [2, 3, 4, 5]
+    assert [r["votes"] for r in ranked] == [10, None, None, 1] and ranked[0]["relevance"] > ranked[1]["relevance"]
+    assert [r["anime_id"] for r in index.recommend({1: 1}, 10, min_score=8.57)] == [2, 4]
+    assert [r["anime_id"] for r in index.recommend({1: 1}, 10, genre_id=11)] == [3, 4]
+    assert [r["anime_id"] for r in index.recommend({1: 1}, 10, era=(2000, 2009))] == [2, 4]
+    assert index.recommend({1: 1}, 1) == ranked[:1]
+    assert index.recommend({1: 1}, 10, genre_id=99) == [] and index.recommend({404: 1}, 10) == []
+
+    stats = index.stats()
+    assert stats["misses"] == 1 and stats["hits"] == 5 and stats["edges"] == 4
+    index.recommend({2: 1}, 10)
+    assert index.stats()["cached_seeds"] == 1
+    index.rebuild()
+    assert index.stats()["cached_seeds"] == 0
+
+
+def test_recommend_loads_the_catalog_once_per_build():
+    catalog = _catalog([(1, 2, 10), (2, 3, 10)], a2={"score": 8.0}, a3={"score": 7.0})
+    loads = []
+    index = GraphIndex(lambda: loads.append(1) or catalog)
+    for _ in range(5):
+        assert [r["anime_id"] for r in index.recommend({1: 1}, 10)] == [2, 3]
+    assert len(loads) == 1
+    index.rebuild()
+    index.recommend({1: 1}, 10)
+    assert len(loads) == 2
+
+    # A live catalog, when there is one, supplies the patched filter columns.
+    patched = _catalog([(1, 2, 10), (2, 3, 10)], a2={"score": 6.0}, a3={"score": 7.0})
+    index.current = lambda: patched
+    assert [r["anime_id"] for r in index.recommend({1: 1}, 10, min_score=6.5)] == [3]
+    assert len(loads) == 2
+
+
+def test_a_reload_during_a_background_rebuild_asks_for_one_more():
+    started, release = threading.Event(), threading.Event()
+    catalogs = [_catalog([(1, 2, 5)]), _catalog([(1, 2, 5), (2, 3, 4)])]
+    loads = []
+
+    def loader():
+        loads.append(1)
+        if len(loads) == 1:
+            started.set()
+            release.wait(5)
+        return catalogs[len(loads) - 1]
+
+    index = GraphIndex(loader)
+    index.rebuild_in_background()
+    assert started.wait(5)
+    index.rebuild_in_background()  # a catalog reload while the first rebuild reads the old one
+    release.set()
+    deadline = time.time() + 5
+    while not (index.built and len(index.graph().anime_id) == 3) and time.time() < deadline:
+        time.sleep(0.01)
+    assert len(index.graph().anime_id) == 3 and len(loads) == 2
+    assert [r["anime_id"] for r in index.recommend({1: 1.0}, 5)] == [2, 3]
@@ -0,0 +1,51 @@
+import os
+import sqlite3
+import sys
+from decimal import Decimal
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import pgnumeric  # noqa: E402  pylint: disable=wrong-import-position
+from pgnumeric import div, power_int, round_half_away, sqrt  # noqa: E402
+
+D = Decimal
+
+# Expected values are what Postgres 16 returns for the same expressions.
+
+
+def test_division_scale_matches_postgres():
+    assert str(div(D(1), D(3))) == "0.33333333333333333333"
+    assert str(div(D(10), D(4))) == "2.5000000000000000"
+    assert str(div(D("12345.67"), D("0.5"))) == "24691.340000000000"
+    assert str(div(D(2), D(3)) * D("0.7")) == "0.466666666666666666669"
+
+
+def test_power_sqrt_and_rounding_match_postgres():
+    assert str(power_int(D("7.25"), 2)) == "52.562500000000000"
+    assert power_int(D("0.0001"), 2) == D("1.0000000000000000E-8")
+    assert str(sqrt(D(2))) == "1.414213562373095"
+    assert str(sqrt(D("6.25"))) == "2.500000000000000"
+    assert str(round_half_away(D("7.125"), 2)) == "7.13"
+    assert str(round_half_away(D("-7.125"), 2)) == "-7.13"
+
+
+def test_registered_functions_and_aggregates():
+    conn = sqlite3.connect(":memory:")
+    pgnumeric.register(conn)
+    conn.execute("CREATE TABLE t (x, score)")
+    conn.executemany("INSERT INTO t VALUES (?, ?)", [(1, 8.5), (2, 7.25), (3, 9.0), (4, None)])
+    row = conn.execute(
+        "SELECT num_avg(num(score, 2)), num_avg(x), percentile_disc(0.5, x), num_div(NULL, 2), "
+        "width_bucket(100, 1, 100, 10), width_bucket(99, 1, 100, 10), width_bucket(0, 1, 100, 10) FROM t"
+    ).fetchone()
+    assert row == ("8.2500000000000000", "2.5000000000000000", "2", None, 11, 10, 0)
+
+
+def test_corr_matches_definition():
+    agg = pgnumeric.Corr()
+    for x, y in [(1, 2), (2, 4), (3, 6.5), (None, 1)]:
+        agg.step(y, x)
+    assert 0.99 < agg.finalize() <= 1.0
+    flat = pgnumeric.Corr()
+    flat.step(1, 1)
+    flat.step(1, 2)
+    assert flat.finalize() is None
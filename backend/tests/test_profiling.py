@@ -0,0 +1,55 @@
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import profiling  # noqa: E402
+from profiling import Profiler  # noqa: E402
+
+
+def _handler():
+    time.sleep(0.02)
+    with profiling.sql("top_anime"):
+        time.sleep(0.03)
+
+
+def test_profile_samples_python_frames_and_sql():
+    profiler = Profiler(interval=0.001, keep=5)
+    assert profiling.current() is None
+    profile, token = profiler.start("GET", "/api/anime/top?limit=5")
+    assert profiling.current() is profile
+    _handler()
+    profiler.stop(profile, token, 200)
+    assert profiling.current() is None
+
+    summary = profile.summary()
+    assert summary["status"] == 200 and summary["samples"] > 0
+    assert summary["sql"][0]["statement"] == "top_anime" and summary["sql"][0]["calls"] == 1
+    assert summary["sql"][0]["seconds"] >= 0.03
+    assert abs(summary["sampled_seconds"] - summary["seconds"]) < 0.02
+
+    lines = profile.collapsed().splitlines()
+    assert any("_handler (test_profiling.py:" in line for line in lines)
+    sql_time = sum(int(line.rsplit(" ", 1)[1]) for line in lines if ";SQL top_anime " in line)
+    assert sql_time >= 15_000
+
+    doc = profile.speedscope()
+    frames, (sampled,) = doc["shared"]["frames"], doc["profiles"]
+    assert {"name": "SQL top_anime"} in frames
+    assert len(sampled["samples"]) == len(sampled["weights"]) == summary["samples"]
+    assert all(0 <= i < len(frames) for stack in sampled["samples"] for i in stack)
+    assert sampled["endValue"] == sum(sampled["weights"])
+
+
+def test_queries_outside_a_profile_are_not_recorded():
+    with profiling.sql("top_anime"):
+        pass
+    profiler = Profiler(keep=2)
+    ids = []
+    for _ in range(3):
+        profile, token = profiler.start("GET", "/api/genres")
+        profiler.stop(profile, token, 200)
+        ids.append(profile.id)
+    assert profiler.get(ids[0]) is None and profiler.get(ids[2]) is not None
+    stats = profiler.stats()
+    assert stats["profiled"] == 3 and [p["profile_id"] for p in stats["profiles"]] == ids[:0:-1]
@@ -0,0 +1,115 @@
+import math
+import os
+import random
+import sys
+from decimal import Decimal
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from catalog import Catalog  # noqa: E402
+from quantiles import DistributionIndex, QuantileSketch  # noqa: E402
+
+QS = (0, 0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99, 1)
+GENRES = [{"genre_id": 10 + bit, "name": f"genre {bit}", "bit": bit} for bit in range(4)]
+
+
+def percentile_disc(values, q):
+    ordered = sorted(values)
+    return ordered[max(1, math.ceil(q * len(ordered))) - 1]
+
+
+def test_exact_sketch_matches_percentile_disc_and_forgets_removed_values():
+    rnd = random.Random(1)
+    values = [rnd.randint(100, 1000) for _ in range(500)]
+    sketch = QuantileSketch()
+    for value in values + [5, 5, 9999]:
+        sketch.add(value)
+    sketch.add(5, -2)
+    sketch.add(9999, -1)
+    assert sketch.count == len(values)
+    assert sketch.quantiles(QS) == [percentile_disc(values, q) for q in QS]
+    with pytest.raises(ValueError):
+        sketch.add(5, -1)
+    assert QuantileSketch().quantiles([0.5]) == [None]
+
+
+def test_log_sketch_stays_within_its_relative_accuracy():
+    rnd = random.Random(2)
+    values = [int(rnd.paretovariate(0.7) * 50) for _ in range(3000)] + [0] * 40
+    halves = QuantileSketch(0.01), QuantileSketch(0.01)
+    for i, value in enumerate(values):
+        halves[i % 2].add(value)
+    halves[0].merge(halves[1])
+    for q, got in zip(QS, halves[0].quantiles(QS)):
+        expected = percentile_disc(values, q)
+        assert abs(got - expected) <= 0.01 * expected + 0.5
+    with pytest.raises(ValueError):
+        QuantileSketch(0.01).merge(QuantileSketch(0.02))
+
+
+def _anime(rnd, anime_id):
+    season = rnd.choice([None, "Spring 2019", "Fall 2019", "Spring 2020"])
+    return {
+        "anime_id": anime_id,
+        "title": f"t{anime_id}",
+        "score": rnd.choice([None, round(rnd.uniform(3, 9.5), 2)]),
+        "members_count": rnd.choice([None, rnd.randint(0, 10**6)]),
+        "favorites_count": rnd.randint(0, 500),
+        "genre_mask": rnd.randint(0, 15),
+        "type": rnd.choice([None, "TV", "Movie"]),
+        "source_type": rnd.choice(["Manga", "Original"]),
+        "season": season,
+        "year": int(season[-4:]) if season else None,
+    }
+
+
+def _brute(rows, metric, by, filters):
+    column = {"score": "score", "members": "members_count", "favorites": "favorites_count"}[metric]
+    groups = {}
+    for row in rows:
+        genres = [g["genre_id"] for g in GENRES if row["genre_mask"] >> g["bit"] & 1]
+        if row[column] is None or any(
+            (value not in genres) if name == "genre_id" else row[name] != value for name, value in filters.items()
+        ):
+            continue
+        if by == "genre" and "genre_id" in filters:
+            genres = [filters["genre_id"]]  # like a join on anime_genre filtered to that genre
+        for group in (genres if by == "genre" else [None if by is None else row[by]]):
+            groups.setdefault(group, []).append(Decimal(str(row[column])) if metric == "score" else row[column])
+    return {group: (len(values), percentile_disc(values, 0.5)) for group, values in groups.items()}
+
+
+def test_distribution_merges_cells_like_a_group_by_and_follows_changes():
+    rnd = random.Random(3)
+    rows = [_anime(rnd, anime_id) for anime_id in range(1, 301)]
+    catalog = Catalog.from_rows(rows, GENRES)
+    index = DistributionIndex(lambda: catalog, relative_accuracy=0)
+
+    def check(rows):
+        for metric in ("score", "members"):
+            for by in (None, "genre", "type", "season", "year"):
+                for filters in ({}, {"type": "TV"}, {"genre_id": 11}, {"year": 2019, "source_type": "Manga"}):
+                    got = {
+                        item["genre_id"] if by == "genre" else item["value"]: (item["count"], item["quantiles"]["0.5"])
+                        for item in index.distribution(metric, by, filters)
+                    }
+                    assert got == _brute(rows, metric, by, filters), (metric, by, filters)
+
+    check(rows)
+    assert index.distribution("score", "genre")[0]["name"].startswith("genre ")
+
+    # Change some anime, drop one and add one; syncing just those ids moves only them.
+    changed = {row["anime_id"]: _anime(rnd, row["anime_id"]) for row in rnd.sample(rows, 40)}
+    rows = [changed.get(row["anime_id"], row) for row in rows if row["anime_id"] != 7] + [_anime(rnd, 999)]
+    catalog = Catalog.from_rows(rows, GENRES)
+    assert index.sync(catalog, [*changed, 7, 999]) >= 2
+    check(rows)
+    assert index.sync(catalog) == 0 and index.stats()["anime"] == 300
+
+
+def test_distribution_rejects_unknown_arguments():
+    index = DistributionIndex(lambda: Catalog.from_rows([], GENRES))
+    for args in (("rating", None, {}), ("score", "studio", {}), ("score", None, {"min_score": 5})):
+        with pytest.raises(ValueError):
+            index.distribution(*args)
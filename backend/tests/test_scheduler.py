@@ -0,0 +1,165 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from scheduler import JobSpec, Scheduler, parse_jobs  # noqa: E402
+
+
+class FakeDatabase:
+    """The advisory lock and ``job_run`` table shared by every connection of the fake servers."""
+
+    def __init__(self):
+        self.lock_owner = None
+        self.runs = []
+
+    def connect(self):
+        return FakeSchedulerConn(self)
+
+
+class FakeSchedulerConn:
+    def __init__(self, db):
+        self.db = db
+        self.closed = False
+        self.autocommit = False
+        self.cancelled = threading.Event()
+        self.rollbacks = 0
+
+    def cursor(self):
+        if self.closed:
+            raise RuntimeError("connection already closed")
+        return FakeSchedulerCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def close(self):
+        self.closed = True
+        if self.db.lock_owner is self:
+            self.db.lock_owner = None
+
+
+class FakeSchedulerCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.result = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def execute(self, sql, params=None):
+        db, sql = self.conn.db, " ".join(sql.split())
+        if sql.startswith("SELECT pg_try_advisory_lock"):
+            if db.lock_owner is None:
+                db.lock_owner = self.conn
+            self.result = [(db.lock_owner is self.conn,)]
+        elif sql.startswith("UPDATE job_run SET finished_at = now(), status = 'abandoned'"):
+            for run in db.runs:
+                if run["finished_at"] is None and run["instance"] != params[0]:
+                    run.update(finished_at=time.time(), status="abandoned")
+        elif sql.startswith("SELECT DISTINCT ON (job)"):
+            latest = {}
+            for run in db.runs:
+                if run["job"] in params[0]:
+                    latest[run["job"]] = run
+            self.result = [
+                (r["job"], r["run_id"], r["instance"], r["started_at"], r["finished_at"], r["status"], r["error"])
+                for r in latest.values()
+            ]
+        elif sql.startswith("INSERT INTO job_run"):
+            run = {"run_id": len(db.runs) + 1, "job": params[0], "instance": params[1], "started_at": time.time(),
+                   "finished_at": None, "status": "running", "error": None, "result": None}
+            db.runs.append(run)
+            self.result = [(run["run_id"], run["started_at"])]
+        elif sql.startswith("UPDATE job_run SET finished_at = now(), status = %s"):
+            run = db.runs[params[3] - 1]
+            run.update(finished_at=time.time(), status=params[0], error=params[1], result=params[2])
+            self.result = [(run["finished_at"],)]
+        elif sql.startswith("SELECT pg_sleep"):
+            if self.conn.cancelled.wait(5):
+                raise RuntimeError("canceling statement due to user request")
+
+    def fetchone(self):
+        return self.result[0]
+
+    def fetchall(self):
+        return self.result
+
+
+def _wait(scheduler):
+    for job in scheduler.jobs.values():
+        if job.thread is not None:
+            job.thread.join(5)
+
+
+def test_parse_jobs():
+    assert parse_jobs("similar_topk=3600, refresh=60:5:30") == {
+        "similar_topk": JobSpec(3600, 360, 3600), "refresh": JobSpec(60, 5, 30),
+    }
+    assert parse_jobs(None) == {}
+    for bad in ("x=", "x=0", "x=10:-1", "x=10:1:0", "x=1:2:3:4", "x=soon"):
+        with pytest.raises(ValueError):
+            parse_jobs(bad)
+
+
+def test_one_leader_runs_each_job_and_another_takes_over():
+    db = FakeDatabase()
+    calls = []
+    a, b = Scheduler(db.connect, "a"), Scheduler(db.connect, "b")
+    for scheduler in (a, b):
+        job = lambda conn, name=scheduler.instance: calls.append(name) or {"n": 1}  # noqa: E731
+        scheduler.add("count", job, JobSpec(100, 0, 10))
+
+    assert [job.name for job in a.tick()] == ["count"] and b.tick() == []
+    _wait(a)
+    assert a.leader and not b.leader and calls == ["a"]
+    assert a.tick() == [] and b.tick() == []
+    assert b.jobs["count"].last["instance"] == "a" and b.jobs["count"].last["status"] == "ok"
+    assert db.runs[0]["result"] == '{"n": 1}'
+
+    # The leader's session ends with a run it started long ago still open.
+    db.runs.append({"run_id": 2, "job": "count", "instance": "a", "started_at": time.time() - 200,
+                    "finished_at": None, "status": "running", "error": None, "result": None})
+    a._conn.close()
+    assert a.tick() == [] and not a.leader and a.last_error
+    # b takes the lock, closes the open run, and the job is due after its start.
+    assert [job.name for job in b.tick()] == ["count"]
+    _wait(b)
+    assert b.leader and db.runs[1]["status"] == "abandoned" and calls == ["a", "b"]
+    assert a.tick() == [] and b.tick() == [] and a.jobs["count"].last["instance"] == "b"
+    assert b.stats()["jobs"][0]["runs"] == 1
+
+
+def test_timeouts_cancel_the_query_and_failures_are_recorded():
+    db = FakeDatabase()
+    scheduler = Scheduler(db.connect, "a")
+
+    def slow(conn):
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_sleep(60);")
+
+    def broken(conn):
+        raise ValueError("no such table")
+
+    slow_job = scheduler.add("slow", slow, JobSpec(100, 0, 0.05))
+    broken_job = scheduler.add("broken", broken, JobSpec(100, 0, 10))
+    scheduler.tick()
+    _wait(scheduler)
+    assert slow_job.last["status"] == "timeout" and slow_job.timeouts == 1 and slow_job.failures == 1
+    assert broken_job.last["status"] == "error" and broken_job.last["error"] == "ValueError: no such table"
+    assert [run["status"] for run in db.runs] in (["timeout", "error"], ["error", "timeout"])
+    assert scheduler.tick() == []
+    with pytest.raises(ValueError):
+        scheduler.add("slow", slow, JobSpec(1, 0, 1))
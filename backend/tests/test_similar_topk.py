@@ -0,0 +1,134 @@
+import os
+import random
+import subprocess
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import similar_topk  # noqa: E402
+from catalog import Catalog  # noqa: E402
+from minhash import MinHashIndex  # noqa: E402
+from similar_topk import TopNScorer  # noqa: E402
+
+
+def _random_catalog(n=300, seed=7):
+    rnd = random.Random(seed)
+    anime, studios = [], []
+    for anime_id in range(1, n + 1):
+        anime.append({
+            "anime_id": anime_id,
+            "title": f"t{anime_id}",
+            # Coarse scores and members make plenty of ties to break.
+            "score": rnd.choice([None, 7.5, 8.0, 8.5]),
+            "members_count": rnd.choice([None, 100, 200]),
+            "genre_mask": sum(1 << g for g in rnd.sample(range(8), rnd.choice([0, 1, 2, 2, 3]))),
+        })
+        for studio_id in rnd.sample(range(12), rnd.choice([0, 1, 1, 2])):
+            studios.append({"anime_id": anime_id, "studio_id": studio_id})
+    return Catalog.from_rows(anime, studio_rows=studios)
+
+
+def test_top_n_matches_brute_force_for_every_seed():
+    catalog = _random_catalog()
+    scorer, index = TopNScorer.from_catalog(catalog), MinHashIndex(catalog, bands=4, rows=2)
+    for n in (5, 40):
+        for row, anime_id in enumerate(catalog.anime_id):
+            expected = [(r["anime_id"], r["similarity"]) for r in index.exact(anime_id, n)]
+            got = [(catalog.anime_id[r], score) for r, score in scorer.top(row, n)]
+            # Same anime, same order and the same NUMERIC digits.
+            assert [(a, str(s)) for a, s in got] == [(a, str(s)) for a, s in expected]
+
+
+class FakeJobCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def execute(self, sql, params=None):
+        self.conn.executed.append((" ".join(sql.split()), params))
+        if sql.startswith("SELECT run_id, top_n, done_through"):
+            self._one = self.conn.unfinished
+        elif sql.startswith("INSERT INTO similar_topk_run"):
+            self._one = (9,)
+
+    def fetchone(self):
+        return self._one
+
+
+class FakeJobConn:
+    def __init__(self, unfinished=None):
+        self.unfinished = unfinished
+        self.executed = []
+        self.commits = 0
+
+    def cursor(self, cursor_factory=None):
+        return FakeJobCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+
+def _run(monkeypatch, conn, **kwargs):
+    catalog = _random_catalog(n=50)
+    monkeypatch.setattr(similar_topk.Catalog, "from_db", classmethod(lambda cls, cur: catalog))
+    written = []
+    import psycopg2.extras  # pylint: disable=import-outside-toplevel
+
+    monkeypatch.setattr(psycopg2.extras, "execute_values", lambda cur, sql, rows, page_size: written.extend(rows))
+    result = similar_topk.run(conn, top_n=3, workers=1, chunk_size=20, log=lambda line: None, **kwargs)
+    return result, written
+
+
+def test_run_writes_ranked_rows_chunk_by_chunk(monkeypatch):
+    conn = FakeJobConn()
+    result, written = _run(monkeypatch, conn)
+    assert result["run_id"] == 9 and result["scored"] == 50
+    assert {run_id for run_id, *_ in written} == {9}
+    assert all(1 <= rank <= 3 for _, _, rank, _, _ in written)
+    markers = [params[0] for sql, params in conn.executed if sql.startswith("UPDATE similar_topk_run SET done_through")]
+    assert markers == [20, 40, 50]
+    sqls = [sql for sql, _ in conn.executed]
+    assert sqls[0].startswith("SELECT pg_advisory_lock") and sqls[-1].startswith("SELECT pg_advisory_unlock")
+    assert any(sql.startswith("DELETE FROM similar_topk_run WHERE run_id <") for sql in sqls)
+
+
+def test_run_resumes_after_the_last_committed_chunk(monkeypatch):
+    conn = FakeJobConn(unfinished=(4, 3, 40))
+    result, written = _run(monkeypatch, conn)
+    assert result["run_id"] == 4 and result["scored"] == 10
+    assert {anime_id for _, anime_id, *_ in written} <= set(range(41, 51))
+
+    # A different top_n (or --restart) starts over.
+    conn = FakeJobConn(unfinished=(4, 10, 40))
+    result, _ = _run(monkeypatch, conn)
+    assert result["run_id"] == 9 and result["scored"] == 50
+    assert any(sql == "DELETE FROM similar_topk_run WHERE finished_at IS NULL;" for sql, _ in conn.executed)
+
+
+def test_workers_are_spawned_not_forked(monkeypatch):
+    # The server runs the job from a scheduler thread; forking would copy other threads' held locks.
+    methods = []
+    get_context = similar_topk.multiprocessing.get_context
+    monkeypatch.setattr(similar_topk.multiprocessing, "get_context", lambda method: methods.append(method)
+                        or get_context(method))
+    assert list(similar_topk._imap(abs, [-3, -1, -2], 2)) == [3, 1, 2]  # pylint: disable=protected-access
+    assert methods == ["spawn"]
+
+
+def test_spawned_workers_reimport_only_the_job_module():
+    # A spawned worker runs its parent's main module as __mp_main__; the server's job starts similar_topk.py.
+    code = (
+        "import runpy, sys; runpy.run_path(sys.argv[1], run_name='__mp_main__'); "
+        "print(sorted({'app', 'flask'} & set(sys.modules)))"
+    )
+    script = os.path.abspath(similar_topk.__file__)
+    done = subprocess.run([sys.executable, "-c", code, script], cwd=os.path.dirname(script),
+                          capture_output=True, text=True, check=True)
+    assert done.stdout.strip() == "[]"
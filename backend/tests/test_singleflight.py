@@ -0,0 +1,136 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from singleflight import CoalesceTimeout, SingleFlight, coalesce_key  # noqa: E402
+
+
+def _run_concurrently(n, target):
+    results = [None] * n
+    errors = [None] * n
+
+    def worker(i):
+        try:
+            results[i] = target()
+        except Exception as exc:  # pylint: disable=broad-except
+            errors[i] = exc
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results, errors
+
+
+def test_coalesce_key_normalizes_params():
+    assert coalesce_key("similar", {"seed_id": 1, "limit": 5}) == coalesce_key("similar", {"limit": 5, "seed_id": 1})
+    assert coalesce_key("search", {"genre_ids": [1, 2]}) != coalesce_key("other", {"genre_ids": [1, 2]})
+    hash(coalesce_key("search", {"genre_ids": [1, 2], "season": None}))
+
+
+def test_concurrent_calls_share_one_execution():
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        release.wait(2)
+        return ["row"]
+
+    threading.Timer(0.2, release.set).start()
+    results, errors = _run_concurrently(8, lambda: flight.do("key", slow))
+
+    assert calls == [1]
+    assert errors == [None] * 8
+    assert all(r == ["row"] for r in results)
+    assert flight.stats() == {"in_flight": 0, "executions": 1, "coalesced": 7}
+
+
+def test_errors_propagate_to_waiters():
+    flight = SingleFlight()
+
+    def boom():
+        time.sleep(0.1)
+        raise RuntimeError("db down")
+
+    _, errors = _run_concurrently(4, lambda: flight.do("key", boom))
+    assert all(isinstance(e, RuntimeError) for e in errors)
+
+
+def test_waiter_times_out():
+    flight = SingleFlight(timeout=0.05)
+    started = threading.Event()
+
+    def slow():
+        started.set()
+        time.sleep(0.3)
+        return 1
+
+    leader = threading.Thread(target=flight.do, args=("key", slow))
+    leader.start()
+    started.wait(1)
+    with pytest.raises(CoalesceTimeout):
+        flight.do("key", slow)
+    leader.join()
+
+
+def test_sequential_calls_run_again():
+    flight = SingleFlight()
+    assert flight.do("key", lambda: 1) == 1
+    assert flight.do("key", lambda: 2) == 2
+
+
+def test_async_coroutines_share_one_execution():
+    flight = SingleFlight()
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "rows"
+
+    async def main():
+        return await asyncio.gather(*(flight.do_async("key", fetch) for _ in range(5)))
+
+    assert asyncio.run(main()) == ["rows"] * 5
+    assert calls == [1]
+
+
+def test_async_timeout_does_not_cancel_leader():
+    flight = SingleFlight()
+
+    async def fetch():
+        await asyncio.sleep(0.1)
+        return "rows"
+
+    async def main():
+        leader = asyncio.ensure_future(flight.do_async("key", fetch))
+        await asyncio.sleep(0)
+        with pytest.raises(CoalesceTimeout):
+            await flight.do_async("key", fetch, timeout=0.01)
+        return await leader
+
+    assert asyncio.run(main()) == "rows"
+
+
+def test_async_blocking_function_uses_thread_table():
+    flight = SingleFlight()
+    calls = []
+
+    def blocking():
+        calls.append(1)
+        time.sleep(0.05)
+        return 42
+
+    async def main():
+        return await asyncio.gather(*(flight.do_async("key", blocking) for _ in range(4)))
+
+    assert asyncio.run(main()) == [42] * 4
+    assert len(calls) < 4
@@ -0,0 +1,140 @@
+import os
+import sys
+
+import psycopg2.errors
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import statements  # noqa: E402  pylint: disable=wrong-import-position
+from statements import Statement, StatementRegistry, parse_plan_cache_modes, to_positional  # noqa: E402
+
+
+class FakePgConn:
+    """Stands in for a psycopg2 connection so the registry takes the PREPARE path."""
+
+    def __init__(self):
+        self.rollbacks = 0
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+class RecordingCursor:
+    def __init__(self, conn, fail_on=None):
+        self.connection = conn
+        self.executed = []
+        self.fail_on = list(fail_on or [])
+
+    def execute(self, query, params=None):
+        self.executed.append((query, params))
+        if self.fail_on and query.startswith(self.fail_on[0][0]):
+            _, exc = self.fail_on.pop(0)
+            raise exc
+
+
+@pytest.fixture
+def pg(monkeypatch):
+    monkeypatch.setattr(statements, "PG_CONNECTION_TYPES", (FakePgConn,))
+    return FakePgConn()
+
+
+QUERY = "SELECT * FROM anime WHERE (%(season)s IS NULL OR season = %(season)s) AND title LIKE '%%x' LIMIT %(limit)s;"
+TYPES = {"q": {"season": "text", "limit": "int"}}
+
+
+def test_to_positional_reuses_numbers_for_repeated_names():
+    sql, names = to_positional(QUERY)
+    assert names == ["season", "limit"]
+    assert sql == "SELECT * FROM anime WHERE ($1 IS NULL OR season = $1) AND title LIKE '%x' LIMIT $2"
+
+
+def test_statement_requires_types_for_every_parameter():
+    with pytest.raises(ValueError):
+        Statement("q", QUERY, {"season": "text"})
+
+
+def test_statement_sql():
+    stmt = Statement("q", QUERY, TYPES["q"])
+    assert stmt.prepare_sql.startswith("PREPARE mal_q (text, int) AS SELECT")
+    assert stmt.execute_sql == "EXECUTE mal_q (%s, %s)"
+    assert stmt.bind({"limit": 5, "season": None}) == [None, 5]
+    assert Statement("genres", "SELECT 1;").execute_sql == "EXECUTE mal_genres"
+    # Keywords are fine as route names.
+    assert Statement("similar", "SELECT 1;").prepare_sql == "PREPARE mal_similar AS SELECT 1"
+
+
+def test_non_postgres_cursor_runs_plain_query():
+    registry = StatementRegistry(TYPES)
+    cur = RecordingCursor(conn=object())
+    registry.execute(cur, "q", QUERY, {"season": None, "limit": 1})
+    registry.execute(cur, "genres", "SELECT 1;")
+    assert cur.executed == [(QUERY, {"season": None, "limit": 1}), ("SELECT 1;", None)]
+
+
+def test_prepares_once_per_connection(pg):
+    registry = StatementRegistry(TYPES)
+    cur = RecordingCursor(pg)
+    registry.execute(cur, "q", QUERY, {"season": "Spring 2020", "limit": 3})
+    registry.execute(cur, "q", QUERY, {"season": None, "limit": 4})
+
+    queries = [q for q, _ in cur.executed]
+    assert sum(q.startswith("PREPARE mal_q") for q in queries) == 1
+    assert cur.executed[-1] == ("EXECUTE mal_q (%s, %s)", [None, 4])
+    assert registry.prepared_on(pg) == {"q"}
+
+    other = RecordingCursor(FakePgConn())
+    registry.execute(other, "q", QUERY, {"season": None, "limit": 1})
+    assert any(q.startswith("PREPARE mal_q") for q, _ in other.executed)
+
+
+def test_plan_cache_mode_is_set_per_execution(pg):
+    registry = StatementRegistry(TYPES, plan_cache_modes={"q": "force_custom_plan"})
+    cur = RecordingCursor(pg)
+    registry.execute(cur, "q", QUERY, {"season": None, "limit": 1})
+    assert ("SET LOCAL plan_cache_mode = force_custom_plan", None) in cur.executed
+
+    registry.set_plan_cache_mode("q", None)
+    cur.executed.clear()
+    registry.execute(cur, "q", QUERY, {"season": None, "limit": 1})
+    assert not any("plan_cache_mode" in q for q, _ in cur.executed)
+
+
+def test_timeout_sets_statement_timeout_before_execute(pg):
+    registry = StatementRegistry(TYPES)
+    cur = RecordingCursor(pg)
+    registry.execute(cur, "q", QUERY, {"season": None, "limit": 1}, timeout_ms=1500)
+    assert cur.executed[-2:] == [("SET LOCAL statement_timeout = 1500", None), ("EXECUTE mal_q (%s, %s)", [None, 1])]
+
+
+def test_invalidate_deallocates_and_reprepares(pg):
+    registry = StatementRegistry(TYPES)
+    cur = RecordingCursor(pg)
+    registry.execute(cur, "q", QUERY, {"season": None, "limit": 1})
+    registry.invalidate()
+    assert registry.prepared_on(pg) == set()
+
+    cur.executed.clear()
+    registry.execute(cur, "q", QUERY, {"season": None, "limit": 1})
+    queries = [q for q, _ in cur.executed]
+    assert queries[0] == "DEALLOCATE ALL"
+    assert queries[1].startswith("PREPARE mal_q")
+
+
+def test_stale_statement_is_reprepared_after_rollback(pg):
+    registry = StatementRegistry(TYPES)
+    cur = RecordingCursor(pg)
+    registry.execute(cur, "q", QUERY, {"season": None, "limit": 1})
+
+    cur.fail_on = [("EXECUTE mal_q", psycopg2.errors.FeatureNotSupported())]
+    cur.executed.clear()
+    registry.execute(cur, "q", QUERY, {"season": None, "limit": 1})
+    assert pg.rollbacks == 1
+    assert any(q.startswith("PREPARE mal_q") for q, _ in cur.executed)
+    assert cur.executed[-1][0] == "EXECUTE mal_q (%s, %s)"
+
+
+def test_parse_plan_cache_modes():
+    assert parse_plan_cache_modes("a=auto, b=force_generic_plan") == {"a": "auto", "b": "force_generic_plan"}
+    assert parse_plan_cache_modes(None) == {}
+    with pytest.raises(ValueError):
+        parse_plan_cache_modes("a=sometimes")
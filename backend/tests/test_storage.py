@@ -0,0 +1,228 @@
+import csv
+import os
+import sys
+from decimal import Decimal
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import app  # noqa: E402  pylint: disable=wrong-import-position
+import storage  # noqa: E402  pylint: disable=wrong-import-position
+
+HISTOGRAM = [f"score_{n:02d}_count" for n in range(10, 0, -1)]
+ANIME_HEADER = ["anime_id", "title", "type", "source_type", "num_episodes", "start_date", "season", "studios",
+                "genres", "score", "members_count", "favorites_count", *HISTOGRAM]
+ANIME_ROWS = [
+    [1, "Naruto", "TV", "Manga", 220, "2002-10-03", "Fall 2002", "Pierrot", "['Action', 'Adventure']", "7.99",
+     5000, 40, *[100] * 10],
+    [2, "Nana", "TV", "Manga", 47, "2006-04-05", "Spring 2006", "Madhouse", "['Drama', 'Romance']", "8.50",
+     3000, 70, *[10] * 10],
+    [3, "Bleach", "TV", "Manga", 366, "", "Fall 2004", "Pierrot", "['Action']", "", 4000, 20, *[0] * 10],
+]
+ANIME_ANIME = [
+    {"animeA": 1, "animeB": 3, "recommendation": 1, "related": 0, "num_recommenders": 12, "relation_type": ""},
+    {"animeA": 3, "animeB": 1, "recommendation": 1, "related": 0, "num_recommenders": 30, "relation_type": ""},
+    {"animeA": 1, "animeB": 2, "recommendation": 0, "related": 1, "num_recommenders": "", "relation_type": "Sequel"},
+    {"animeA": 1, "animeB": 404, "recommendation": 1, "related": 0, "num_recommenders": 1, "relation_type": ""},
+]
+
+
+@pytest.fixture(scope="module")
+def sqlite_path(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("csv")
+    with open(directory / storage.ANIME_CSV, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(ANIME_HEADER)
+        writer.writerows(ANIME_ROWS)
+    with open(directory / storage.ANIME_ANIME_CSV, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=[*ANIME_ANIME[0], "recommendation_url"])
+        writer.writeheader()
+        writer.writerows(ANIME_ANIME)
+    path = str(directory / "mal.sqlite3")
+    storage.build_sqlite(path, lambda conn: storage.load_csvs(conn, str(directory)))
+    return path
+
+
+@pytest.fixture
+def sqlite_client(sqlite_path, monkeypatch):
+    monkeypatch.setattr(app, "BACKEND", storage.SQLiteBackend(sqlite_path))
+    monkeypatch.setattr(app, "COALESCE_ENABLED", False)
+    monkeypatch.setattr(app, "get_conn", lambda: pytest.fail("Postgres used"))
+    flask_app = app.create_app()
+    flask_app.testing = True
+    return flask_app.test_client()
+
+
+def test_to_named():
+    assert storage.to_named("a = %(x)s AND b LIKE '%%y' OR c = %(x)s") == "a = :x AND b LIKE '%y' OR c = :x"
+
+
+def test_open_backend():
+    assert storage.open_backend("postgres", None, None).name == "postgres"
+    with pytest.raises(FileNotFoundError):
+        storage.open_backend("sqlite:///nowhere/mal.sqlite3", None, None)
+    with pytest.raises(ValueError):
+        storage.open_backend("mysql://x", None, None)
+
+
+def test_sqlite_lower_folds_non_ascii_like_postgres(sqlite_path):
+    backend = storage.SQLiteBackend(sqlite_path)
+    sql = ("SELECT LOWER('ÉLAN Ōkami') AS folded, LOWER(NULL) AS missing, "
+           "LOWER('Élan vital') LIKE LOWER(%(pattern)s) AS found;")
+    row = backend.fetch("lower", sql, {"pattern": "%élan%"}, one=True)
+    assert row == {"folded": "élan ōkami", "missing": None, "found": 1}
+
+
+def test_catalog_loaded_through_sqlite_reports_its_source(sqlite_path, monkeypatch):
+    monkeypatch.setattr(app, "BACKEND", storage.SQLiteBackend(sqlite_path))
+    assert app.load_catalog().source == "sqlite"
+
+
+def test_csv_load_derives_columns(sqlite_path):
+    row = storage.SQLiteBackend(sqlite_path).fetch("get_anime", "SELECT * FROM anime WHERE anime_id = %(id)s;",
+                                                   {"id": 1}, one=True)
+    assert row["score"] == Decimal("7.99") and str(row["score"]) == "7.99"
+    assert row["score_9_count"] == 100 and "score_09_count" not in row
+    assert (row["year"], row["decade"], row["season_name"]) == (2002, 2000, "Fall")
+    assert row["start_date"].isoformat() == "2002-10-03"
+    assert row["genre_mask"] == 0b11  # Action, Adventure: bits 0 and 1 in name order
+    assert "genres" not in row
+
+
+def test_routes_run_on_sqlite(sqlite_client):
+    by_genre = sqlite_client.get("/api/anime?limit=5&genre_ids=1").get_json()
+    assert [r["anime_id"] for r in by_genre] == [1, 3]
+    assert set(by_genre[0]) == set(storage.ANIME_COLUMNS)  # no genre_mask
+    assert sqlite_client.get("/api/anime?limit=5&genre_ids=1,99").get_json() == []
+
+    recs = sqlite_client.get("/api/anime/1/recommendations?limit=5").get_json()
+    assert recs == [{"anime_id": 3, "title": "Bleach", "score": None, "num_episodes": 366, "votes": 30}]
+
+    similar = sqlite_client.get("/api/anime/3/similar?limit=5").get_json()
+    assert similar[0]["anime_id"] == 1
+    assert similar[0]["similarity"] == 0.65 and isinstance(similar[0]["similarity"], float)
+
+    lists = sqlite_client.get("/api/anime/top-lists").get_json()
+    assert {"list": "popularity", "anime_id": 1, "title": "Naruto", "metric": "5000"} in lists
+
+    years = sqlite_client.get("/api/stats/years/ratings").get_json()
+    assert years[0] == {"year": 2006, "n_titles": 1, "total_ratings": 100, "avg_score": "8.50", "rank_by_avg": 1}
+
+    sequels = sqlite_client.get("/api/stats/sequels-vs-first-season").get_json()
+    assert sequels == {"comparisons": 1, "avg_diff": "0.51000000000000000000", "median_diff": "0.51",
+                       "pct_later_higher": "1.00000000000000000000"}
+
+    facets = sqlite_client.get("/api/anime/facets?genre_ids=1").get_json()
+    assert facets["total"] == 2
+    assert {"genre_id": 3, "name": "Drama", "count": 1} in facets["genre"]
+
+    adjusted = sqlite_client.get("/api/anime/top/adjusted-score?limit=5").get_json()
+    assert adjusted[0]["adjusted_score"] == "6.00" and adjusted[0]["delta_vs_original"] == "-1.99"
+    assert sqlite_client.get("/api/anime/404").status_code == 404
+    assert set(sqlite_client.get("/api/anime/1").get_json()) == set(storage.ANIME_COLUMNS)
+
+
+# The same three anime as they sit in Postgres, whose ids are not in name order.
+PG_GENRES = [(3, "Action", 0), (6, "Adventure", 1), (9, "Drama", 2), (12, "Romance", 3), (15, "Horror", 4)]
+PG_STUDIOS = [(7, "Pierrot"), (2, "Madhouse")]
+PG_ANIME_GENRES = [(1, 3), (1, 6), (2, 9), (2, 12), (3, 3)]
+PG_ANIME_STUDIOS = [(1, 7), (2, 2), (3, 7)]
+
+
+class FakePostgres:
+    """Just enough of a psycopg2 connection for ``storage.load_postgres``."""
+
+    def __init__(self, tables):
+        self.tables = tables  # table -> ([(column, data_type, scale)], rows)
+
+    def cursor(self, name=None):
+        return FakePostgresCursor(self.tables)
+
+
+class FakePostgresCursor:
+    def __init__(self, tables):
+        self.tables = tables
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def execute(self, sql, params=None):
+        if "information_schema.columns" in sql:
+            self.rows = [(table, *column) for table in params[0] if table in self.tables
+                         for column in self.tables[table][0]]
+            return
+        names, table = sql[len("SELECT "):].split(" FROM ")
+        columns = [column for column, _, _ in self.tables[table][0]]
+        positions = [columns.index(name) for name in names.split(", ")]
+        self.rows = [tuple(row[i] for i in positions) for row in self.tables[table][1]]
+
+    def fetchall(self):
+        return self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+def _postgres_tables():
+    header = [storage.csv_column(h) for h in ANIME_HEADER]
+    types = {"score": ("numeric", 2), "title": ("text", None), "type": ("USER-DEFINED", None),
+             "source_type": ("USER-DEFINED", None), "synopsis": ("text", None), "main_pic": ("text", None),
+             "status": ("USER-DEFINED", None), "season": ("text", None), "season_name": ("text", None)}
+    columns = [(name, *types.get(name, ("integer", None)))
+               for name in [*storage.ANIME_COLUMNS, "year", "decade", "season_name", "genre_mask"]]
+    bits = {genre_id: bit for genre_id, _, bit in PG_GENRES}
+    anime = []
+    for values in ANIME_ROWS:
+        raw = dict(zip(header, values))
+        row = {name: raw.get(name) for name, _, _ in columns}
+        row["score"] = Decimal(raw["score"]) if raw["score"] else None
+        row["year"], row["decade"], row["season_name"] = storage.season_columns(raw["season"])
+        row["genre_mask"] = sum(1 << bits[g] for a, g in PG_ANIME_GENRES if a == raw["anime_id"])
+        anime.append(tuple(row[name] for name, _, _ in columns))
+    return {
+        "anime": (columns, anime),
+        "genre": ([("genre_id", "integer", None), ("name", "text", None), ("bit", "smallint", None)], PG_GENRES),
+        "studio": ([("studio_id", "integer", None), ("name", "text", None)], PG_STUDIOS),
+        "anime_genre": ([("anime_id", "integer", None), ("genre_id", "integer", None)], PG_ANIME_GENRES),
+        "anime_studio": ([("anime_id", "integer", None), ("studio_id", "integer", None)], PG_ANIME_STUDIOS),
+        "recommendation": ([("anime_id_a", "integer", None), ("anime_id_b", "integer", None),
+                            ("num_recommenders", "integer", None)], [(1, 3, 12), (3, 1, 30)]),
+        "related_anime": ([("anime_id_a", "integer", None), ("anime_id_b", "integer", None),
+                           ("relation_type", "text", None)], [(1, 2, "Sequel")]),
+    }
+
+
+def test_csv_build_with_exported_ids_matches_postgres(tmp_path, monkeypatch):
+    directory = tmp_path / "csv"
+    directory.mkdir()
+    with open(directory / storage.ANIME_CSV, "w", newline="", encoding="utf-8") as f:
+        csv.writer(f).writerows([ANIME_HEADER, *ANIME_ROWS])
+    with open(directory / storage.ANIME_ANIME_CSV, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=list(ANIME_ANIME[0]))
+        writer.writeheader()
+        writer.writerows(ANIME_ANIME)
+    with open(directory / storage.GENRE_CSV, "w", newline="", encoding="utf-8") as f:
+        csv.writer(f).writerows([("genre_id", "name", "bit"), *PG_GENRES])
+    with open(directory / storage.STUDIO_CSV, "w", newline="", encoding="utf-8") as f:
+        csv.writer(f).writerows([("studio_id", "name"), *PG_STUDIOS])
+    from_csv, from_postgres = str(tmp_path / "csv.sqlite3"), str(tmp_path / "pg.sqlite3")
+    storage.build_sqlite(from_csv, lambda conn: storage.load_csvs(conn, str(directory)))
+    storage.build_sqlite(from_postgres, lambda conn: storage.load_postgres(conn, FakePostgres(_postgres_tables())))
+
+    monkeypatch.setattr(app, "COALESCE_ENABLED", False)
+    test_client = app.create_app().test_client()
+    urls = ["/api/genres", "/api/anime?limit=5&genre_ids=6", "/api/anime?limit=5&genre_ids=3,9",
+            "/api/anime?limit=5&genre_ids=3", "/api/anime/facets?genre_ids=3",
+            "/api/anime/1/recommendations?limit=5&genre_ids=3", "/api/anime/3/similar?limit=5"]
+    bodies = {}
+    for path in (from_csv, from_postgres):
+        monkeypatch.setattr(app, "BACKEND", storage.SQLiteBackend(path))
+        app.SIMILAR_TOPK_CACHE.clear()
+        bodies[path] = [test_client.get(url).get_json() for url in urls]
+    assert bodies[from_csv] == bodies[from_postgres]
+    genres, with_adventure = bodies[from_csv][:2]
+    assert genres[0] == {"genre_id": 3, "name": "Action"} and [r["anime_id"] for r in with_adventure] == [1]
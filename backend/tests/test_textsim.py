@@ -0,0 +1,73 @@
+import math
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from catalog import SnapshotError  # noqa: E402
+from textsim import TextIndex, tokenize  # noqa: E402
+
+ROWS = [
+    {"anime_id": 3, "synopsis": "Space bounty hunters chase criminals across the solar system."},
+    {"anime_id": 1, "synopsis": "Bounty hunters in space. [Written by MAL Rewrite]"},
+    {"anime_id": 7, "synopsis": "Two girls named Nana share an apartment in Tokyo."},
+    {"anime_id": 9, "synopsis": "A girl moves to Tokyo to chase her band dreams."},
+    {"anime_id": 4, "synopsis": None},
+]
+
+
+def test_tokenize_drops_stop_words_credits_and_accents():
+    assert tokenize("The Café in Tokyo, 1998! (Source: ANN)") == ["cafe", "tokyo"]
+    assert tokenize(None) == []
+
+
+def test_rows_are_unit_vectors_and_cosine_is_their_dot_product():
+    index = TextIndex.build(ROWS, workers=1, top_k=3)
+    assert list(index.anime_id) == [1, 3, 4, 7, 9]
+    for row in range(index.n):
+        start, end = index.doc_offsets[row], index.doc_offsets[row + 1]
+        norm = math.sqrt(sum(w * w for w in index.doc_weights[start:end]))
+        assert norm == pytest.approx(1.0 if end > start else 0.0, abs=1e-6)
+
+    (nearest, score), = index.similar(1, 1, precomputed=False)
+    assert nearest == 3
+    vectors = []
+    for anime_id in (1, 3):
+        row = index.row_of(anime_id)
+        start, end = index.doc_offsets[row], index.doc_offsets[row + 1]
+        vectors.append(dict(zip(index.doc_terms[start:end], index.doc_weights[start:end])))
+    assert score == pytest.approx(sum(w * vectors[1].get(t, 0.0) for t, w in vectors[0].items()))
+    assert index.similar(4, 5) == [] and index.similar(404, 5) == []
+
+
+def test_precomputed_neighbours_match_the_query(tmp_path):
+    index = TextIndex.build(ROWS, workers=1, top_k=2)
+    for anime_id in (1, 3, 7, 9):
+        exact = index.similar(anime_id, 2, precomputed=False)
+        table = index.similar(anime_id, 2, precomputed=True)
+        assert [a for a, _ in table] == [a for a, _ in exact]
+        assert [s for _, s in table] == pytest.approx([s for _, s in exact], abs=1e-6)
+    # Beyond the table the query runs instead.
+    assert len(index.similar(7, 3)) == len(index.similar(7, 3, precomputed=False))
+
+    path = tmp_path / "synopsis.idx"
+    index.write(str(path))
+    mapped = TextIndex.open(str(path))
+    assert mapped.similar(7, 2) == index.similar(7, 2)
+    assert mapped.stats()["top_k"] == 2 and mapped.stats()["terms"] == index.stats()["terms"]
+
+
+def test_parallel_build_matches_inline_build():
+    rows = [{"anime_id": i, "synopsis": f"hero {i % 7} village {i % 5} dragon {i % 3}"} for i in range(40)]
+    inline = TextIndex.build(rows, workers=1, chunk_size=8, min_df=1, max_df=1.0)
+    pooled = TextIndex.build(rows, workers=2, chunk_size=8, min_df=1, max_df=1.0)
+    assert list(pooled.doc_terms) == list(inline.doc_terms)
+    assert list(pooled.nbr_rows) == list(inline.nbr_rows)
+
+
+def test_open_rejects_other_files(tmp_path):
+    path = tmp_path / "not-an-index"
+    path.write_bytes(b"x" * 128)
+    with pytest.raises(SnapshotError, match="not a synopsis index"):
+        TextIndex.open(str(path))
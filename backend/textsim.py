@@ -0,0 +1,309 @@
+"""Synopsis similarity with TF-IDF vectors and sparse cosine top-k.
+
+Each synopsis becomes a sparse vector: sublinear term frequency
+(1 + log tf) times smoothed IDF, L2-normalized, so the cosine of two anime
+is the dot product of their rows. The vectors are stored twice, once by
+anime (CSR: the terms of each row) and once by term (postings: the rows
+containing each term). A query walks the seed's terms and adds
+``w_seed * w_row`` along each posting list. Only rows that share a term
+are ever touched.
+
+Building runs offline in chunks on a process pool: tokenizing first, then
+optionally the top ``top_k`` neighbours of every anime. The result is written
+in the catalog's snapshot layout (see ``catalog.write_sections``) and mapped
+at startup, so the neighbour table and the on-demand query share one file::
+
+    python textsim.py build synopsis.idx --workers 4 --top-k 50
+    python textsim.py info synopsis.idx
+    python textsim.py query synopsis.idx 1 --limit 10
+"""
+import argparse
+import heapq
+import json
+import math
+import os
+import re
+import sys
+import time
+import unicodedata
+from array import array
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple
+
+from catalog import map_sections, write_sections
+
+TEXT_MAGIC = b"MALTXT\r\n"
+DEFAULT_TOP_K = 50
+DEFAULT_CHUNK_SIZE = 1000
+MIN_DF = 2  # a term in one synopsis only says nothing about similarity
+MAX_DF = 0.5  # nor does one in most of them; dropping these also keeps posting lists short
+
+SECTIONS = {
+    "anime_id": "i",
+    "doc_offsets": "i",  # n + 1 offsets into doc_terms / doc_weights
+    "doc_terms": "i",
+    "doc_weights": "f",
+    "post_offsets": "i",  # vocabulary + 1 offsets into post_rows / post_weights
+    "post_rows": "i",
+    "post_weights": "f",
+    "nbr_offsets": "i",  # n + 1 offsets into nbr_rows / nbr_scores; all zero when not precomputed
+    "nbr_rows": "i",
+    "nbr_scores": "f",
+}
+
+_WORD = re.compile(r"[a-z0-9]+")
+# MAL synopses end with a credit line that every row shares.
+_CREDITS = re.compile(r"\[written by [^\]]*\]|\(source:[^)]*\)", re.IGNORECASE)
+STOP_WORDS = frozenset("""
+a about after again against all also an and any are as at be because been before being between both but by
+can could did do does doing down during each even ever few for from further had has have having he her here
+hers herself him himself his how however i if in into is it its itself just like made make many may me more
+most much must my myself new no nor not now of off on once one only or other our ours out over own same she
+should since so some still such than that the their theirs them themselves then there these they this those
+through to too two under until up upon very was we were what when where whether which while who whom whose
+why will with within without would yet you your yours
+""".split())
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    text = unicodedata.normalize("NFKD", _CREDITS.sub(" ", text or ""))
+    text = "".join(c for c in text if not unicodedata.combining(c)).casefold()
+    return [w for w in _WORD.findall(text) if len(w) > 1 and w not in STOP_WORDS and not w.isdigit()]
+
+
+def _term_counts(texts: Sequence[Optional[str]]) -> List[Dict[str, int]]:
+    return [Counter(tokenize(text)) for text in texts]
+
+
+_worker_index: Optional["TextIndex"] = None
+
+
+def _init_worker(sections: Mapping[str, array]) -> None:
+    global _worker_index
+    _worker_index = TextIndex(sections, {})
+
+
+def _neighbor_chunk(bounds: Tuple[int, int, int]) -> List[List[Tuple[int, float]]]:
+    start, end, k = bounds
+    return [_worker_index.query(row, k) for row in range(start, end)]
+
+
+def _map(fn: Callable, items: Sequence, workers: int, initializer=None, initargs=()) -> List:
+    """``map`` over a process pool, or inline for one worker."""
+    if workers <= 1 or len(items) <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        return [fn(item) for item in items]
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as pool:
+        return list(pool.map(fn, items))
+
+
+class TextIndex:
+    def __init__(self, sections: Mapping[str, Sequence], meta: Mapping[str, Any], mapped=None):
+        self.sections = dict(sections)
+        self.meta = dict(meta)
+        self._mapped = mapped  # keeps the mmap alive while views point into it
+        for name, values in self.sections.items():
+            setattr(self, name, values)
+        self.n = len(self.anime_id)
+        self._row_of = {anime_id: row for row, anime_id in enumerate(self.anime_id)}
+
+    # -- building -----------------------------------------------------------
+
+    @classmethod
+    def build(
+        cls,
+        rows: Iterable[Mapping[str, Any]],
+        top_k: int = DEFAULT_TOP_K,
+        neighbors: bool = True,
+        min_df: int = MIN_DF,
+        max_df: float = MAX_DF,
+        workers: Optional[int] = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        log: Callable[[str], None] = lambda line: None,
+    ) -> "TextIndex":
+        """Vectorize ``{anime_id, synopsis}`` rows and, if ``neighbors``, precompute each row's top ``top_k``."""
+        workers = workers or os.cpu_count() or 1
+        docs = sorted((row["anime_id"], row.get("synopsis")) for row in rows)
+        texts = [text for _, text in docs]
+        chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+        counts = [c for chunk in _map(_term_counts, chunks, workers) for c in chunk]
+        n = len(counts)
+
+        df: Counter = Counter()
+        for c in counts:
+            df.update(c.keys())
+        vocabulary = sorted(t for t, d in df.items() if min_df <= d <= max_df * n)
+        term_id = {t: i for i, t in enumerate(vocabulary)}
+        # Smoothed IDF, as if one extra document contained every term.
+        idf = [math.log((1 + n) / (1 + df[t])) + 1 for t in vocabulary]
+        log(f"tokenized {n} synopses: {len(df)} terms, {len(vocabulary)} kept")
+
+        sections = {name: array(code) for name, code in SECTIONS.items()}
+        sections["anime_id"].extend(anime_id for anime_id, _ in docs)
+        sections["doc_offsets"].append(0)
+        for c in counts:
+            vector = sorted((term_id[t], (1 + math.log(tf)) * idf[term_id[t]]) for t, tf in c.items() if t in term_id)
+            norm = math.sqrt(sum(w * w for _, w in vector)) or 1.0
+            sections["doc_terms"].extend(t for t, _ in vector)
+            sections["doc_weights"].extend(w / norm for _, w in vector)
+            sections["doc_offsets"].append(len(sections["doc_terms"]))
+
+        # Transpose into posting lists (a counting sort by term).
+        post_counts = [0] * (len(vocabulary) + 1)
+        for t in sections["doc_terms"]:
+            post_counts[t + 1] += 1
+        for t in range(len(vocabulary)):
+            post_counts[t + 1] += post_counts[t]
+        sections["post_offsets"] = array("i", post_counts)
+        fill = list(post_counts[:-1])
+        nnz = len(sections["doc_terms"])
+        sections["post_rows"] = array("i", bytes(4 * nnz))
+        sections["post_weights"] = array("f", bytes(4 * nnz))
+        doc_offsets = sections["doc_offsets"]
+        for row in range(n):
+            for i in range(doc_offsets[row], doc_offsets[row + 1]):
+                t = sections["doc_terms"][i]
+                sections["post_rows"][fill[t]] = row
+                sections["post_weights"][fill[t]] = sections["doc_weights"][i]
+                fill[t] += 1
+
+        sections["nbr_offsets"].extend([0] * (n + 1))
+        meta = {"built_at": time.time(), "terms": vocabulary, "min_df": min_df, "max_df": max_df, "top_k": 0}
+        index = cls(sections, meta)
+        if neighbors:
+            index.precompute(top_k, workers, chunk_size, log)
+        return index
+
+    def precompute(self, top_k: int = DEFAULT_TOP_K, workers: Optional[int] = None,
+                   chunk_size: int = DEFAULT_CHUNK_SIZE, log: Callable[[str], None] = lambda line: None) -> None:
+        """Fill the neighbour table with every row's ``top_k`` most similar rows."""
+        workers = workers or os.cpu_count() or 1
+        started = time.perf_counter()
+        bounds = [(i, min(i + chunk_size, self.n), top_k) for i in range(0, self.n, chunk_size)]
+        shared = {name: self.sections[name] for name in ("doc_offsets", "doc_terms", "doc_weights",
+                                                         "post_offsets", "post_rows", "post_weights")}
+        shared = {name: array(SECTIONS[name], values) for name, values in shared.items()}
+        shared["anime_id"] = array("i", self.anime_id)
+        offsets, rows, scores = array("i", [0]), array("i"), array("f")
+        for chunk in _map(_neighbor_chunk, bounds, workers, _init_worker, (shared,)):
+            for neighbours in chunk:
+                rows.extend(r for r, _ in neighbours)
+                scores.extend(s for _, s in neighbours)
+                offsets.append(len(rows))
+        self.sections.update(nbr_offsets=offsets, nbr_rows=rows, nbr_scores=scores)
+        self.nbr_offsets, self.nbr_rows, self.nbr_scores = offsets, rows, scores
+        self.meta["top_k"] = top_k
+        log(f"precomputed top {top_k} for {self.n} anime in {time.perf_counter() - started:.1f}s")
+
+    def write(self, path: str) -> None:
+        write_sections(path, TEXT_MAGIC, {name: (code, self.sections[name]) for name, code in SECTIONS.items()},
+                       self.meta, kind="synopsis-index")
+
+    @classmethod
+    def open(cls, path: str, verify: bool = True) -> "TextIndex":
+        sections, meta, mapped = map_sections(path, TEXT_MAGIC, verify, kind="synopsis index")
+        return cls(sections, meta, mapped=mapped)
+
+    # -- lookups ------------------------------------------------------------
+
+    def row_of(self, anime_id: int) -> Optional[int]:
+        return self._row_of.get(anime_id)
+
+    @property
+    def top_k(self) -> int:
+        return self.meta.get("top_k", 0)
+
+    def query(self, row: int, k: int) -> List[Tuple[int, float]]:
+        """Top ``k`` (row, cosine) by sparse dot products over the posting lists; ties by row."""
+        scores: Dict[int, float] = {}
+        post_offsets, post_rows, post_weights = self.post_offsets, self.post_rows, self.post_weights
+        for i in range(self.doc_offsets[row], self.doc_offsets[row + 1]):
+            t, w = self.doc_terms[i], self.doc_weights[i]
+            start, end = post_offsets[t], post_offsets[t + 1]
+            for other, w_other in zip(post_rows[start:end], post_weights[start:end]):
+                scores[other] = scores.get(other, 0.0) + w * w_other
+        scores.pop(row, None)
+        return heapq.nlargest(k, scores.items(), key=lambda item: (item[1], -item[0]))
+
+    def precomputed(self, row: int, k: int) -> List[Tuple[int, float]]:
+        start = self.nbr_offsets[row]
+        end = min(self.nbr_offsets[row + 1], start + k)
+        return list(zip(self.nbr_rows[start:end], self.nbr_scores[start:end]))
+
+    def similar(self, anime_id: int, limit: int, precomputed: Optional[bool] = None) -> List[Tuple[int, float]]:
+        """(anime_id, cosine) of the nearest synopses.
+
+        ``precomputed=None`` uses the neighbour table when it covers ``limit``
+        and runs the query otherwise.
+        """
+        row = self.row_of(anime_id)
+        if row is None:
+            return []
+        if precomputed is None:
+            precomputed = limit <= self.top_k
+        found = self.precomputed(row, limit) if precomputed else self.query(row, limit)
+        return [(self.anime_id[r], score) for r, score in found]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "anime": self.n,
+            "terms": len(self.meta.get("terms", ())),
+            "nonzeros": len(self.doc_terms),
+            "top_k": self.top_k,
+            "built_at": self.meta.get("built_at"),
+            "checksum": self.meta.get("checksum"),
+            "path": self.meta.get("path"),
+        }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Build or inspect the synopsis TF-IDF index.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build = sub.add_parser("build", help="vectorize every synopsis in Postgres and write the index")
+    build.add_argument("path")
+    build.add_argument("--workers", type=int, default=None, help="processes (default: one per CPU)")
+    build.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    build.add_argument("--top-k", type=int, default=DEFAULT_TOP_K, help="neighbours to precompute per anime")
+    build.add_argument("--no-neighbors", action="store_true", help="skip the neighbour table; queries run on demand")
+    info = sub.add_parser("info", help="verify an index and print its size")
+    info.add_argument("path")
+    query = sub.add_parser("query", help="print the nearest synopses of one anime")
+    query.add_argument("path")
+    query.add_argument("anime_id", type=int)
+    query.add_argument("--limit", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    if args.command == "info":
+        index = TextIndex.open(args.path)
+        print(json.dumps({**index.stats(), "size_bytes": os.path.getsize(args.path)}, indent=2))
+        return 0
+    if args.command == "query":
+        index = TextIndex.open(args.path)
+        for anime_id, score in index.similar(args.anime_id, args.limit):
+            print(f"{anime_id}\t{score:.4f}")
+        return 0
+
+    import psycopg2  # pylint: disable=import-outside-toplevel
+    from psycopg2.extras import RealDictCursor  # pylint: disable=import-outside-toplevel
+
+    from app import DB_CONFIG  # pylint: disable=import-outside-toplevel
+
+    started = time.perf_counter()
+    conn = psycopg2.connect(cursor_factory=RealDictCursor, **DB_CONFIG)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT anime_id, synopsis FROM anime ORDER BY anime_id;")
+            rows = cur.fetchall()
+    finally:
+        conn.close()
+    index = TextIndex.build(rows, top_k=args.top_k, neighbors=not args.no_neighbors, workers=args.workers,
+                            chunk_size=args.chunk_size, log=lambda line: print(line, file=sys.stderr))
+    index.write(args.path)
+    print(f"wrote {index.n} anime to {args.path} in {time.perf_counter() - started:.1f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
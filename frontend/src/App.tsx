@@ -937,24 +937,40 @@ function RecommendPage() {
       return;
     }
 
+    let cancelled = false;
+    const q = encodeURIComponent(searchQuery);
+    const limit = 10;
+
+    // The dropdown comes from the autocomplete trie. Only when it has fewer
+    // than `limit` word-prefix matches does the substring search fill in
+    // mid-word matches.
     const timeoutId = setTimeout(() => {
       setSearching(true);
-      fetch(`/api/anime/search?q=${encodeURIComponent(searchQuery)}&limit=10`)
+      fetch(`/api/anime/autocomplete?q=${q}&limit=${limit}`)
         .then((res) => res.json())
         .then((data) => {
-          if (Array.isArray(data)) {
+          if (cancelled || (Array.isArray(data) && data.length >= limit)) {
+            return data;
+          }
+          return fetch(`/api/anime/search?q=${q}&limit=${limit}`).then((res) => res.json());
+        })
+        .then((data) => {
+          if (!cancelled && Array.isArray(data)) {
             setSearchResults(data);
             setShowDropdown(data.length > 0);
           }
         })
         .catch((err) => {
           console.error("Search error:", err);
-          setSearchResults([]);
+          if (!cancelled) setSearchResults([]);
         })
         .finally(() => setSearching(false));
     }, 300);
 
-    return () => clearTimeout(timeoutId);
+    return () => {
+      cancelled = true;
+      clearTimeout(timeoutId);
+    };
   }, [searchQuery, selectedAnime]);
 
   const handleSelectAnime = (anime: SearchAnime) => {
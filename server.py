@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 """Production server that serves both Flask API and React frontend static files."""
 import os
+import sys
 from flask import Flask, send_from_directory
+
+# backend modules import each other as top-level modules (as in backend/tests).
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
 from backend.app import create_app
 
 app = create_app()